@@ -10,7 +10,7 @@ from Experiment import Experiment               # Main experiment class
 from pUtil import tolog                         # Logging method that sends text to the pilot log
 from pUtil import readpar                       # Used to read values from the schedconfig DB (queuedata)
 from pUtil import isAnalysisJob                 # Is the current job a user analysis job or a production job?
-from pUtil import grep                          # Grep function - reimplement using cli command
+from LogScanner import scanPayloadStdout        # Single pass scan of the payload stdout
 from pUtil import getCmtconfig                  # Get the cmtconfig from the job def or queuedata
 from pUtil import getCmtconfigAlternatives      # Get a list of locally available cmtconfigs
 from pUtil import verifyReleaseString           # To verify the release string (move to Experiment later)
@@ -705,14 +705,14 @@ class AMSTaiwanExperiment(Experiment):
             N = 0
             if os.path.exists(filename):
                 tolog("Processing stdout file: %s" % (filename))
-                matched_lines = grep(["events processed so far"], filename)
-                if len(matched_lines) > 0:
-                    if "events read and" in matched_lines[-1]:
+                last_line = scanPayloadStdout(filename, final=True).getLastLine('eventsprocessed')
+                if last_line:
+                    if "events read and" in last_line:
                         # event #415044, run #142189 2 events read and 0 events processed so far
-                        N = int(re.match('.* run #\d+ \d+ events read and (\d+) events processed so far.*', matched_lines[-1]).group(1))
+                        N = int(re.match('.* run #\d+ \d+ events read and (\d+) events processed so far.*', last_line).group(1))
                     else:
                         # event #4, run #0 3 events processed so far
-                        N = int(re.match('.* run #\d+ (\d+) events processed so far.*', matched_lines[-1]).group(1))
+                        N = int(re.match('.* run #\d+ (\d+) events processed so far.*', last_line).group(1))
 
             if len(nEvents_str) == 0:
                 nEvents_str = str(N)
@@ -884,9 +884,10 @@ class AMSTaiwanExperiment(Experiment):
             filename = os.path.join(job.workdir, _stdout)
             if os.path.exists(filename):
                 tolog("Processing stdout file: %s" % (filename))
-                matched_lines = grep(["St9bad_alloc", "std::bad_alloc"], filename)
+                scanner = scanPayloadStdout(filename, final=True)
+                matched_lines = scanner.getLines('badalloc')
                 if len(matched_lines) > 0:
-                    tolog("Identified an out of memory error in %s stdout:" % (job.payload))
+                    tolog("Identified an out of memory error in %s stdout (%d line(s)):" % (job.payload, scanner.getCount('badalloc')))
                     for line in matched_lines:
                         tolog(line)
                     out_of_memory = True
@@ -2340,8 +2341,8 @@ class AMSTaiwanExperiment(Experiment):
         out_of_memory = self.isOutOfMemory(job=job, number_of_jobs=number_of_jobs)
         failed = out_of_memory # failed boolean used below
 
-        # Always look for the max and average VmPeak?
-        if not self.__analysisJob:
+        # Always look for the max and average VmPeak? (unless the values are known from the memory sampler)
+        if not self.__analysisJob and not job.vmPeakMax:
             setup = getSourceSetup(runCommandList[0])
             job.vmPeakMax, job.vmPeakMean, job.RSSMean = findVmPeaks(setup)
 
@@ -10,7 +10,7 @@ from Experiment import Experiment               # Main experiment class
 from pUtil import tolog                         # Logging method that sends text to the pilot log
 from pUtil import readpar                       # Used to read values from the schedconfig DB (queuedata)
 from pUtil import isAnalysisJob                 # Is the current job a user analysis job or a production job?
-from pUtil import grep                          # Grep function - reimplement using cli command
+from LogScanner import scanPayloadStdout        # Single pass scan of the payload stdout
 from pUtil import getCmtconfig                  # Get the cmtconfig from the job def or queuedata
 from pUtil import verifyReleaseString           # To verify the release string (move to Experiment later)
 from pUtil import timedCommand                  # Protect cmd with timed_command
@@ -806,14 +806,14 @@ class ATLASExperiment(Experiment):
             N = 0
             if os.path.exists(filename):
                 tolog("Processing stdout file: %s" % (filename))
-                matched_lines = grep(["events processed so far"], filename)
-                if len(matched_lines) > 0:
-                    if "events read and" in matched_lines[-1]:
+                last_line = scanPayloadStdout(filename, final=True).getLastLine('eventsprocessed')
+                if last_line:
+                    if "events read and" in last_line:
                         # event #415044, run #142189 2 events read and 0 events processed so far
-                        N = int(re.match('.* run #\d+ \d+ events read and (\d+) events processed so far.*', matched_lines[-1]).group(1))
+                        N = int(re.match('.* run #\d+ \d+ events read and (\d+) events processed so far.*', last_line).group(1))
                     else:
                         # event #4, run #0 3 events processed so far
-                        N = int(re.match('.* run #\d+ (\d+) events processed so far.*', matched_lines[-1]).group(1))
+                        N = int(re.match('.* run #\d+ (\d+) events processed so far.*', last_line).group(1))
 
             if len(nEvents_str) == 0:
                 nEvents_str = str(N)
@@ -985,9 +985,10 @@ class ATLASExperiment(Experiment):
             filename = os.path.join(job.workdir, _stdout)
             if os.path.exists(filename):
                 tolog("Processing stdout file: %s" % (filename))
-                matched_lines = grep(["St9bad_alloc", "std::bad_alloc"], filename)
+                scanner = scanPayloadStdout(filename, final=True)
+                matched_lines = scanner.getLines('badalloc')
                 if len(matched_lines) > 0:
-                    tolog("Identified an out of memory error in %s stdout:" % (job.payload))
+                    tolog("Identified an out of memory error in %s stdout (%d line(s)):" % (job.payload, scanner.getCount('badalloc')))
                     for line in matched_lines:
                         tolog(line)
                     out_of_memory = True
@@ -1368,8 +1369,8 @@ class ATLASExperiment(Experiment):
         out_of_memory = self.isOutOfMemory(job=job, number_of_jobs=number_of_jobs)
         failed = out_of_memory # failed boolean used below
 
-        # Always look for the max and average VmPeak?
-        if not self.__analysisJob and not self.shouldExecuteUtility():
+        # Always look for the max and average VmPeak? (unless the values are known from the memory sampler)
+        if not self.__analysisJob and not self.shouldExecuteUtility() and not job.vmPeakMax:
             setup = getSourceSetup(runCommandList[0])
             job.vmPeakMax, job.vmPeakMean, job.RSSMean = findVmPeaks(setup)
 
@@ -1471,9 +1472,8 @@ class ATLASExperiment(Experiment):
         failed = False
         error = PilotErrors()
 
-        e1 = "prepare 5 database is locked"
-        e2 = "Error SQLiteStatement"
-        _out = commands.getoutput('grep "%s" %s | grep "%s"' % (e1, filename, e2))
+        # lines with "prepare 5 database is locked" and "Error SQLiteStatement"
+        _out = "\n".join(scanPayloadStdout(filename, final=True).getLines('sqlitelocking'))
         if 'sqlite' in _out and job:
             job.pilotErrorDiag = "NFS/SQLite locking problems: %s" % _out
             job.result[2] = error.ERR_NFSSQLITE
@@ -1496,10 +1496,8 @@ class ATLASExperiment(Experiment):
 
         if transExitCode == 221:
             tolog("Exit code 221 detected, will scan payload stdout for GLIBC errors")
-            e1 = "cling::DynamicLibraryManager::loadLibrary():"
-            e2 = "GLIBC"
-            e3 = "not found"
-            _out = commands.getoutput('grep "%s" %s | grep "%s" | grep "%s"' % (e1, filename, e2, e3))
+            # lines with "cling::DynamicLibraryManager::loadLibrary():" followed by "GLIBC" and "not found"
+            _out = "\n".join(scanPayloadStdout(filename, final=True).getLines('wrongarchitecture'))
             if _out and job:
                 job.pilotErrorDiag = "Architecture problem detected: %s" % _out
                 job.result[2] = error.ERR_WRONGARCHITECTURE
@@ -0,0 +1,140 @@
+# This module contains the checksum calculation used for local files (stage-in/out verification, output file info,
+# metadata). adler32 and md5 are computed together in a single pass over the file and the results are cached, so that
+# the same (multi-GB) file is never read twice as long as it has not been modified.
+
+import io
+import os
+import zlib
+import hashlib
+import threading
+
+from pUtil import tolog
+
+CHECKSUM_TYPES = ['adler32', 'md5']
+BLOCKSIZE = 16 * 1024 * 1024 # read buffer, 16 MB (a multiple of any file system block size)
+
+# FORMAT: { (st_dev, st_ino, st_size, st_mtime): { checksum_type: value, .. } }
+__cache = {}
+__cache_lock = threading.Lock()
+
+def getFileKey(filename):
+    """ Return the cache key for a file (raises OSError if the file cannot be stat'ed) """
+
+    st = os.stat(filename)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+def getCachedChecksum(filename, checksum_type="adler32"):
+    """ Return the cached checksum of the given type for a file, or None if it has not been calculated yet """
+
+    try:
+        key = getFileKey(filename)
+    except OSError:
+        return None
+
+    with __cache_lock:
+        return __cache.get(key, {}).get(checksum_type, None)
+
+def setCachedChecksums(filename, checksums):
+    """ Cache checksums { checksum_type: value, .. } that were calculated while the file was written """
+
+    try:
+        key = getFileKey(filename)
+    except OSError:
+        return
+
+    with __cache_lock:
+        __cache.setdefault(key, {}).update(checksums)
+
+def calculateChecksums(filename, checksum_types=None):
+    """
+    Return a dictionary with the checksums of a file for the given checksum types (default: adler32 and md5).
+    All checksums are calculated in a single pass over the file, the values are cached using
+    (device, inode, size, modification time) as key.
+    Raises an exception if the file does not exist or cannot be read.
+    """
+
+    if not checksum_types:
+        checksum_types = CHECKSUM_TYPES
+    for checksum_type in checksum_types:
+        if checksum_type not in CHECKSUM_TYPES:
+            raise ValueError("Unsupported checksum type: %s" % (checksum_type))
+
+    key = getFileKey(filename)
+    with __cache_lock:
+        cached = __cache.get(key, {})
+        if all([cached.has_key(checksum_type) for checksum_type in checksum_types]):
+            return dict([(checksum_type, cached[checksum_type]) for checksum_type in checksum_types])
+
+    # calculate all supported checksums at once, the file is read anyway
+    asum = 1 # default adler32 starting value
+    md5 = hashlib.md5()
+    buf = bytearray(BLOCKSIZE)
+
+    f = io.open(filename, 'rb', buffering=0)
+    try:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            data = buffer(buf, 0, n) # no copy of the read buffer
+            asum = zlib.adler32(data, asum)
+            md5.update(data)
+    finally:
+        f.close()
+
+    # correct for bug 32 bit zlib
+    if asum < 0:
+        asum += 2**32
+
+    checksums = {'adler32': "%08x" % asum, 'md5': md5.hexdigest()}
+
+    # only cache the values if the file was not modified while it was being read
+    if getFileKey(filename) == key:
+        with __cache_lock:
+            __cache[key] = checksums
+
+    return dict([(checksum_type, checksums[checksum_type]) for checksum_type in checksum_types])
+
+def calculateChecksum(filename, checksum_type="adler32"):
+    """ Return the checksum of the given type (adler32 or md5) for a file """
+
+    return calculateChecksums(filename, [checksum_type])[checksum_type]
+
+def calculateChecksumsInParallel(filenames, checksum_types=None, threads=4):
+    """
+    Calculate the checksums for several files using a thread pool.
+    Return a dictionary { filename: { checksum_type: value, .. }, .. }; files that could not be read are
+    reported in the log and left out of the dictionary.
+    """
+
+    from ThreadPool import ThreadPool
+
+    results = {}
+    lock = threading.Lock()
+
+    def _calculate(filename):
+        try:
+            checksums = calculateChecksums(filename, checksum_types)
+        except Exception, e:
+            tolog("!!WARNING!!2999!! Failed to calculate checksums for file %s: %s" % (filename, e))
+        else:
+            with lock:
+                results[filename] = checksums
+
+    threads = max(1, min(threads, len(filenames)))
+    if threads == 1:
+        for filename in filenames:
+            _calculate(filename)
+    else:
+        threadpool = ThreadPool(threads)
+        for filename in filenames:
+            threadpool.add_task(_calculate, filename)
+        threadpool.wait_completion()
+
+    return results
+
+def clearChecksumCache():
+    """ Remove all cached checksums """
+
+    with __cache_lock:
+        __cache.clear()
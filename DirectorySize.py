@@ -0,0 +1,434 @@
+import os
+import stat
+import errno
+import atexit
+import select
+import struct
+import threading
+from time import time
+
+from pUtil import tolog
+
+# inotify constants (from sys/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+IN_FILE_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE
+IN_DIR_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+IN_WATCH_MASK = IN_FILE_EVENTS | IN_DIR_EVENTS | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+EVENT_HEADER = "iIII"
+EVENT_HEADER_SIZE = struct.calcsize(EVENT_HEADER)
+
+class Inotify:
+    """ Minimal ctypes wrapper around the Linux inotify API """
+
+    def __init__(self):
+        """ Default initialization (raises OSError if inotify is not available) """
+
+        import ctypes
+        import ctypes.util
+
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self.__libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.__libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not supported by %s" % (libc_name))
+
+        self.__get_errno = ctypes.get_errno
+        # the descriptor is not inherited by the payload
+        self.fd = self.__libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = self.__get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def addWatch(self, path, mask):
+        """ Add a watch for path and return the watch descriptor (raises OSError on failure) """
+
+        wd = self.__libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            e = self.__get_errno()
+            raise OSError(e, "%s: %s" % (os.strerror(e), path))
+        return wd
+
+    def waitEvents(self, timeout):
+        """ Wait at most timeout seconds for events, return True if events are pending """
+
+        try:
+            return bool(select.select([self.fd], [], [], timeout)[0])
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                return False
+            raise
+
+    def readEvents(self):
+        """ Return all pending events as a list of (wd, mask, name) tuples """
+
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not buf:
+                break
+
+            pos = 0
+            while pos + EVENT_HEADER_SIZE <= len(buf):
+                wd, mask, cookie, length = struct.unpack_from(EVENT_HEADER, buf, pos)
+                pos += EVENT_HEADER_SIZE
+                name = buf[pos:pos + length].rstrip('\0')
+                pos += length
+                events.append((wd, mask, name))
+
+        return events
+
+    def close(self):
+        """ Close the inotify file descriptor """
+
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+class DirectorySize:
+    """
+    In-process size accountant for a directory tree (e.g. the job work directory).
+
+    The first call to update() walks the whole tree and caches the size of every file and directory. Later calls only
+    look at what has changed since the previous call:
+      - with inotify (Linux), the changed files and directories are known from the kernel events, which are read by a
+        reader thread as they arrive (so that the kernel event queue does not overflow between two updates)
+      - otherwise the tree is walked again, but the listing of a directory is only re-read if its mtime has changed,
+        and only files that were modified recently (less than settle_time seconds ago) are stat'ed again.
+        A full rescan is done every full_scan_interval updates to pick up late changes to settled files.
+    Sizes are counted in allocated blocks, i.e. the same way as du does.
+    """
+
+    def __init__(self, path, use_inotify=True, settle_time=3600, full_scan_interval=6):
+        """ Default initialization """
+
+        self.__path = os.path.abspath(path)
+        self.__settle_time = settle_time
+        self.__full_scan_interval = full_scan_interval
+        self.__dirs = {}     # FORMAT: { dir_path: [mtime, size, [file names], [subdir names]] }
+        self.__files = {}    # FORMAT: { file_path: [size, mtime] }
+        self.__size = 0
+        self.__peak = 0
+        self.__updates = 0
+        self.__inotify = None
+        self.__wds = {}      # FORMAT: { watch descriptor: dir_path }
+        self.__use_inotify = use_inotify
+
+        # changes collected by the inotify reader thread since the last update
+        self.__lock = threading.RLock()
+        self.__reader = None
+        self.__stop = threading.Event()
+        self.__dirty_dirs = set()
+        self.__dirty_files = set()
+        self.__overflow = False
+        self.__read_error = None
+
+    def getPath(self):
+        """ Return the path of the tracked directory """
+
+        return self.__path
+
+    def getSize(self):
+        """ Return the size (B) measured at the last update """
+
+        return self.__size
+
+    def getPeakSize(self):
+        """ Return the maximum size (B) measured so far """
+
+        return self.__peak
+
+    def isIncremental(self):
+        """ Return True if inotify is used for tracking changes """
+
+        return self.__inotify is not None
+
+    def update(self):
+        """ Update and return the size (B) of the directory tree """
+
+        full = self.__updates == 0 or (self.__full_scan_interval and self.__updates % self.__full_scan_interval == 0)
+
+        if not os.path.isdir(self.__path):
+            self.__reset()
+        elif self.__updates == 0:
+            if self.__use_inotify:
+                try:
+                    self.__inotify = Inotify()
+                except Exception, e:
+                    tolog("inotify not available (will use cached directory walk): %s" % (e))
+                    self.__inotify = None
+            with self.__lock:
+                self.__scanDir(self.__path, True, True)
+            self.__startReader()
+        elif self.__inotify:
+            self.__processEvents()
+        else:
+            self.__scanDir(self.__path, True, full)
+
+        self.__updates += 1
+        self.__size = sum([f[0] for f in self.__files.itervalues()]) + sum([d[1] for d in self.__dirs.itervalues()])
+        if self.__size > self.__peak:
+            self.__peak = self.__size
+
+        return self.__size
+
+    def close(self):
+        """ Stop tracking the directory """
+
+        # the reader thread stops at its next wakeup (it is not joined, close() can be called with the lock held)
+        self.__stop.set()
+        self.__reader = None
+        with self.__lock:
+            if self.__inotify:
+                self.__inotify.close()
+                self.__inotify = None
+            self.__wds = {}
+            self.__dirty_dirs = set()
+            self.__dirty_files = set()
+            self.__overflow = False
+            self.__read_error = None
+
+    def __startReader(self):
+        """ Start the thread reading the inotify events """
+
+        if self.__inotify and not self.__reader:
+            self.__stop = threading.Event()
+            self.__reader = threading.Thread(target=self.__readEvents, args=(self.__inotify, self.__stop), name="DirectorySize")
+            self.__reader.setDaemon(True)
+            self.__reader.start()
+
+    def __readEvents(self, inotify, stop):
+        """ Collect the inotify events as they arrive (reader thread) """
+
+        while not stop.isSet():
+            try:
+                if not inotify.waitEvents(0.5):
+                    continue
+                with self.__lock:
+                    if stop.isSet():
+                        break
+                    self.__collectEvents(inotify.readEvents())
+            except Exception, e:
+                with self.__lock:
+                    if not stop.isSet():
+                        self.__read_error = e
+                break
+
+    def __reset(self):
+        """ Forget the cached tree """
+
+        self.close()
+        self.__dirs = {}
+        self.__files = {}
+        self.__updates = -1
+
+    def __watch(self, path):
+        """ Add an inotify watch for path, fall back to directory walks if the watch cannot be added """
+
+        if not self.__inotify:
+            return
+        try:
+            wd = self.__inotify.addWatch(path, IN_WATCH_MASK)
+        except OSError, e:
+            # e.g. fs.inotify.max_user_watches reached
+            tolog("!!WARNING!!4350!! Failed to add inotify watch, will use cached directory walk: %s" % (e))
+            self.close()
+        else:
+            self.__wds[wd] = path
+
+    def __statFile(self, path):
+        """ Update the cached size of a file """
+
+        try:
+            st = os.lstat(path)
+        except OSError:
+            if self.__files.has_key(path):
+                del self.__files[path]
+        else:
+            self.__files[path] = [st.st_blocks * 512, st.st_mtime]
+
+    def __forgetDir(self, path):
+        """ Remove a directory and everything below it from the cache """
+
+        entry = self.__dirs.pop(path, None)
+        if entry:
+            for name in entry[2]:
+                self.__files.pop(os.path.join(path, name), None)
+            for name in entry[3]:
+                self.__forgetDir(os.path.join(path, name))
+
+    def __scanDir(self, path, recursive, full):
+        """ Update the cached sizes of directory path (and its subdirectories if recursive) """
+
+        try:
+            st = os.lstat(path)
+        except OSError:
+            self.__forgetDir(path)
+            return
+
+        entry = self.__dirs.get(path, None)
+        if entry and not full and entry[0] == st.st_mtime:
+            # the listing has not changed, only re-stat the files that may still be written
+            entry[1] = st.st_blocks * 512
+            now = time()
+            for name in entry[2]:
+                filename = os.path.join(path, name)
+                f = self.__files.get(filename, None)
+                if not f or now - f[1] < self.__settle_time:
+                    self.__statFile(filename)
+            subdirs = entry[3]
+        else:
+            if not entry:
+                self.__watch(path)
+            try:
+                names = os.listdir(path)
+            except OSError:
+                self.__forgetDir(path)
+                return
+
+            files = []
+            subdirs = []
+            for name in names:
+                filename = os.path.join(path, name)
+                try:
+                    _st = os.lstat(filename)
+                except OSError:
+                    # removed after the listing
+                    continue
+                if stat.S_ISDIR(_st.st_mode):
+                    subdirs.append(name)
+                else:
+                    files.append(name)
+                    self.__files[filename] = [_st.st_blocks * 512, _st.st_mtime]
+
+            if entry:
+                # forget entries that have disappeared
+                for name in set(entry[2]) - set(files):
+                    self.__files.pop(os.path.join(path, name), None)
+                for name in set(entry[3]) - set(subdirs):
+                    self.__forgetDir(os.path.join(path, name))
+
+            new_subdirs = [name for name in subdirs if not self.__dirs.has_key(os.path.join(path, name))]
+            self.__dirs[path] = [st.st_mtime, st.st_blocks * 512, files, subdirs]
+
+            if not recursive:
+                # new subdirectories have not been seen before and must always be scanned
+                for name in new_subdirs:
+                    self.__scanDir(os.path.join(path, name), True, True)
+
+        if recursive:
+            for name in subdirs:
+                self.__scanDir(os.path.join(path, name), True, full)
+
+    def __collectEvents(self, events):
+        """ Add the changed directories and files of the events to the pending changes (the lock is held) """
+
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.__overflow = True
+                continue
+            if self.__overflow:
+                # the whole tree is rescanned anyway
+                continue
+
+            path = self.__wds.get(wd, None)
+            if mask & IN_IGNORED:
+                self.__wds.pop(wd, None)
+                continue
+            if path is None:
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.__dirty_dirs.add(os.path.dirname(path))
+            elif mask & IN_DIR_EVENTS or (mask & IN_ISDIR):
+                self.__dirty_dirs.add(path)
+            elif name:
+                self.__dirty_files.add(os.path.join(path, name))
+            else:
+                self.__dirty_dirs.add(path)
+
+        if self.__overflow:
+            self.__dirty_dirs = set()
+            self.__dirty_files = set()
+
+    def __processEvents(self):
+        """ Apply the pending inotify events to the cache """
+
+        with self.__lock:
+            try:
+                if self.__read_error:
+                    raise self.__read_error
+                # also the events that have not been picked up by the reader thread yet
+                self.__collectEvents(self.__inotify.readEvents())
+            except Exception, e:
+                tolog("!!WARNING!!4351!! Failed to read inotify events, will use cached directory walk: %s" % (e))
+                self.close()
+                self.__scanDir(self.__path, True, True)
+                return
+
+            dirty_dirs, dirty_files, overflow = self.__dirty_dirs, self.__dirty_files, self.__overflow
+            self.__dirty_dirs = set()
+            self.__dirty_files = set()
+            self.__overflow = False
+
+            if overflow:
+                tolog("inotify event queue overflow, rescanning %s" % (self.__path))
+                self.__scanDir(self.__path, True, True)
+                return
+
+            for path in dirty_dirs:
+                if path.startswith(self.__path):
+                    self.__scanDir(path, False, True)
+            for path in dirty_files:
+                if os.path.dirname(path) not in dirty_dirs:
+                    self.__statFile(path)
+
+            if not self.__inotify:
+                # a watch could not be added while processing the events
+                self.__scanDir(self.__path, True, True)
+
+# Trackers are kept for the lifetime of the pilot process, keyed by the absolute directory path
+__trackers = {}
+
+def getDirectorySize(path):
+    """ Return the DirectorySize tracker for path (created on first use) """
+
+    path = os.path.abspath(path)
+    if not __trackers.has_key(path):
+        __trackers[path] = DirectorySize(path)
+    return __trackers[path]
+
+def releaseDirectorySize(path):
+    """ Stop tracking path (e.g. before the work directory is renamed or removed) """
+
+    tracker = __trackers.pop(os.path.abspath(path), None)
+    if tracker:
+        tracker.close()
+
+def releaseAllDirectorySizes():
+    """ Stop tracking all directories (closes the inotify descriptors, called at exit) """
+
+    for path in __trackers.keys():
+        releaseDirectorySize(path)
+
+atexit.register(releaseAllDirectorySizes)
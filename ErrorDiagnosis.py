@@ -7,6 +7,7 @@ import re
 from Diagnosis import Diagnosis
 from PilotErrors import PilotErrors
 from pUtil import tolog, getExperiment
+from JobReport import getReport
 
 class ErrorDiagnosis(Diagnosis):
 
@@ -83,59 +84,9 @@ class ErrorDiagnosis(Diagnosis):
 
     ### WARNING: EXPERIMENT SPECIFIC, MOVE LATER
     def getJobReport(self, workDir):
-        """ Get the jobReport.json dictionary """
-
-        fileName = os.path.join(workDir, "jobReport.json")
-        if os.path.exists(fileName):
-            # the jobReport file exists, read it back                                                                                                                                                                                                          
-            try:
-                f = open(fileName, "r")
-            except Exception, e:
-                tolog("!!WARNING!!1001!! Could not open file: %s, %s" % (fileName, e))
-                jobReport_dictionary = {}
-            else:
-                from json import load
-                try:
-                    # load the dictionary
-                    jobReport_dictionary = load(f)
-                except Exception, e:
-                    tolog("!!WARNING!!1001!! Could not read back jobReport dictionary: %s" % (e))
-                    jobReport_dictionary = {}
-
-                # done with the file
-                f.close()
-        else:
-            tolog("WARNING: File %s does not exist" % (fileName))
-            jobReport_dictionary = {}
-
-        return jobReport_dictionary
-
-    ### WARNING: EXPERIMENT SPECIFIC, MOVE LATER
-    def getJobReportErrors(self, jobReport_dictionary):
-        """ Extract the error list from the jobReport.json dictionary """
-        # WARNING: Currently compatible with version <= 0.9.4
-
-        jobReportErrors = []
-        if jobReport_dictionary.has_key('reportVersion'):
-            tolog("Scanning jobReport (v %s) for error info" % jobReport_dictionary['reportVersion'])
-        else:
-            tolog("WARNING: jobReport does not have the reportVersion key")
-
-        if jobReport_dictionary.has_key('executor'):
-            try:
-                error_details = jobReport_dictionary['executor'][0]['logfileReport']['details']['ERROR']
-            except Exception, e:
-                tolog("WARNING: Aborting jobReport scan: %s"% (e))
-            else:
-                try:
-                    for m in error_details:
-                        jobReportErrors.append(m['message'])
-                except Exception, e:
-                    tolog("!!WARNING!!1113!! Did not get a list object: %s" % (e))
-        else:
-            tolog("WARNING: jobReport does not have the executor key (aborting)")
+        """ Get the jobReport.json dictionary (cached, do not modify) """
 
-        return jobReportErrors
+        return getReport(workDir).getDictionary()
 
     ### WARNING: EXPERIMENT SPECIFIC, MOVE LATER
     def isBadAlloc(self, jobReportErrors):
@@ -161,9 +112,9 @@ class ErrorDiagnosis(Diagnosis):
         pilotErrorDiag = ""
         bad_alloc = False
 
-        jobReport_dictionary = self.getJobReport(workDir)
-        if jobReport_dictionary != {}:
-            jobReportErrors = self.getJobReportErrors(jobReport_dictionary)
+        jobReport = getReport(workDir)
+        if jobReport.getDictionary() != {}:
+            jobReportErrors = jobReport.getErrors()
 
             # Check for specific errors
             if jobReportErrors != []:
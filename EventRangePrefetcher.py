@@ -0,0 +1,337 @@
+# Class definition:
+#   EventRangePrefetcher
+#   Background download of event ranges for RunJobEvent, used instead of downloading a batch of event ranges from the
+#   server when AthenaMP reports "Ready for events" (the worker is idle for a full server round-trip in that case).
+#   The thread keeps a buffer of downloaded event ranges between a low and a high watermark: when the buffer falls to
+#   the low watermark, a new batch is downloaded. The batch size grows with the observed event range processing rate so
+#   that the buffer covers the download time. The buffer is not refilled after "No more events" from the server, or
+#   after the thread was stopped (soft/hard kill); event ranges left in the buffer are not processed by this job, they
+#   are taken with drain() and reported as failed (recoverable) so that the server hands them out again.
+#   Watermarks are set with catchall es_prefetch_low=<n> and es_prefetch_high=<n> (default: job.coreCount and twice
+#   that, es_prefetch_high=0 switches the prefetcher off).
+
+import json
+import math
+import time
+import threading
+from collections import deque
+
+from pUtil import tolog
+from StoppableThread import StoppableThread
+from EventRanges import downloadEventRanges
+
+class EventRangePrefetcher(StoppableThread):
+
+    # default settings
+    MAXFAILURES = 3                        # max number of consecutive download failures before giving up
+    RATEWINDOW = 300                       # time window for the processing rate [s]
+
+    def __init__(self, job, url, lowWatermark, highWatermark, maxRanges=None, event_ranges=None):
+        """
+        job: the job (jobId, jobsetID, taskID and pandaProxySecretKey are used for the downloads), url: PanDA server url,
+        lowWatermark/highWatermark: buffer size limits, maxRanges: max number of event ranges per download
+        (default: 10 x highWatermark), event_ranges: already downloaded event ranges
+        """
+
+        StoppableThread.__init__(self, name='EventRangePrefetcher')
+        self.setDaemon(True)
+
+        self.job = job
+        self.url = url
+        self.lowWatermark = max(0, lowWatermark)
+        self.highWatermark = max(self.lowWatermark + 1, highWatermark)
+        self.maxRanges = maxRanges or 10 * self.highWatermark
+
+        self.__buffer = deque(event_ranges or [])
+        self.__condition = threading.Condition()
+        self.__exhausted = False           # the server has no more event ranges (or the downloads keep failing)
+        self.__failures = 0                # number of consecutive download failures
+        self.__latency = None              # download time, moving average [s]
+        self.__consumed = deque()          # FORMAT: [(time, number of event ranges handed out), ..]
+        self.__counts = {'downloads': 0, 'ranges': len(self.__buffer), 'waits': 0, 'waitTime': 0.0, 'savedTime': 0.0,
+                         'returned': 0}
+
+    def stop(self):
+        """ Stop the downloads (also used for soft/hard kill, get() will not return more event ranges) """
+
+        StoppableThread.stop(self)
+        with self.__condition:
+            self.__condition.notifyAll()
+
+    def download(self, numRanges):
+        """ Download event ranges from the server. Return a list of event ranges, [] if there are no more, None on failure """
+
+        message = downloadEventRanges(self.job.jobId, self.job.jobsetID, self.job.taskID, self.job.pandaProxySecretKey, numRanges=numRanges, url=self.url)
+        if message == "No more events":
+            return []
+        if isinstance(message, list):
+            return message
+        try:
+            event_ranges = json.loads(message)
+        except Exception, e:
+            tolog("!!WARNING!!2999!! Could not extract any event ranges from server message: %s (%s)" % (message, e))
+            return None
+        if not isinstance(event_ranges, list):
+            tolog("!!WARNING!!2999!! Unexpected server message: %s" % (message))
+            return None
+
+        return event_ranges
+
+    def getRate(self):
+        """ Return the number of event ranges handed out per second (averaged over the rate time window) """
+
+        now = time.time()
+        with self.__condition:
+            while self.__consumed and now - self.__consumed[0][0] > self.RATEWINDOW:
+                self.__consumed.popleft()
+            if len(self.__consumed) < 2:
+                return 0.0
+            return sum([n for t, n in self.__consumed]) / max(now - self.__consumed[0][0], 1.0)
+
+    def getBatchSize(self, buffered):
+        """ Return the number of event ranges to download when buffered event ranges are left """
+
+        # the buffer should last longer than the next download (twice the download time at the current rate)
+        target = self.highWatermark
+        if self.__latency:
+            target = max(target, int(math.ceil(self.getRate() * self.__latency * 2)))
+
+        return max(1, min(self.maxRanges, target - buffered))
+
+    def run(self):
+        """ Refill the buffer whenever it has fallen to the low watermark """
+
+        while not self.stopped():
+            with self.__condition:
+                while not self.stopped() and len(self.__buffer) > self.lowWatermark:
+                    self.__condition.wait(1)
+                if self.stopped():
+                    break
+                numRanges = self.getBatchSize(len(self.__buffer))
+
+            t0 = time.time()
+            event_ranges = self.download(numRanges)
+            t = time.time() - t0
+            self.__latency = t if self.__latency is None else 0.7 * self.__latency + 0.3 * t
+
+            with self.__condition:
+                self.__counts['downloads'] += 1
+                if event_ranges is None:
+                    self.__failures += 1
+                    if self.__failures >= self.MAXFAILURES:
+                        tolog("!!WARNING!!2999!! Event range download failed %d times in a row - no more event ranges will be downloaded" % (self.__failures))
+                        self.__exhausted = True
+                elif event_ranges == []:
+                    tolog("No more events on the server")
+                    self.__exhausted = True
+                else:
+                    tolog("Prefetched %d event range(s) in %.1f s (requested %d, buffer: %d)" % (len(event_ranges), t, numRanges, len(self.__buffer) + len(event_ranges)))
+                    self.__failures = 0
+                    self.__buffer.extend(event_ranges)
+                    self.__counts['ranges'] += len(event_ranges)
+                self.__condition.notifyAll()
+
+            if self.__exhausted:
+                break
+            if event_ranges is None:
+                # back off before the next attempt
+                self._stop.wait(10 * self.__failures)
+
+    def get(self, numRanges):
+        """
+        Return up to numRanges event ranges from the buffer, wait for the next download if the buffer is empty.
+        Return [] if there are no more event ranges or when the prefetcher has been stopped
+        """
+
+        t0 = time.time()
+        with self.__condition:
+            while not self.__buffer and not self.__exhausted and not self.stopped():
+                self.__condition.wait(1)
+            if self.stopped():
+                return []
+            event_ranges = [self.__buffer.popleft() for i in range(min(max(1, numRanges), len(self.__buffer)))]
+            self.__condition.notifyAll()
+
+            # a synchronous download would have kept the requesting worker idle during the download time
+            waited = time.time() - t0
+            if waited > 0.1:
+                self.__counts['waits'] += 1
+            self.__counts['waitTime'] += waited
+            if event_ranges and self.__latency:
+                self.__counts['savedTime'] += max(0.0, self.__latency - waited)
+            if event_ranges:
+                self.__consumed.append((time.time(), len(event_ranges)))
+
+        return event_ranges
+
+    def drain(self):
+        """ Remove and return the event ranges left in the buffer (after stop(), get() does not return them) """
+
+        with self.__condition:
+            event_ranges = list(self.__buffer)
+            self.__buffer.clear()
+            self.__counts['returned'] += len(event_ranges)
+
+        return event_ranges
+
+    def getCounts(self):
+        """ Return a dictionary with the number of downloads, downloaded event ranges, event ranges left in the buffer,
+        number of waits for a download, total wait time, saved idle worker time [s] and drained event ranges """
+
+        with self.__condition:
+            counts = dict(self.__counts)
+            counts['buffered'] = len(self.__buffer)
+
+        return counts
+
+def benchmark(eventRangesFile=None, nWorkers=8, processingTime=0.2, latency=0.3):
+    """
+    Run the prefetcher against a local fake dispatcher (getEventRanges, updateEventRanges) serving the event ranges of
+    a JSON file (list of event ranges as sent by the server, 100 event ranges are generated if no file is given) with
+    a download time of latency seconds. nWorkers AthenaMP workers ask for one event range at a time and report it as
+    finished with EventRangeUpdater. The idle worker time is compared with a synchronous download per request, then a
+    soft kill after half of the event ranges checks that the prefetched but unprocessed event ranges are returned.
+    usage: python EventRangePrefetcher.py [event ranges JSON file ('' for generated)] [workers] [processing time] [download time]
+    """
+
+    import os
+    import cgi
+    import shutil
+    import urllib
+    import tempfile
+    import BaseHTTPServer
+    import SocketServer
+    from PilotErrors import PilotErrors
+    from EventRangeUpdater import EventRangeUpdater
+
+    if eventRangesFile:
+        f = open(eventRangesFile)
+        try:
+            allRanges = json.load(f)
+        finally:
+            f.close()
+    else:
+        allRanges = [{'eventRangeID': '1234-5678-9012-%d-1' % (i), 'LFN': 'EVNT.01234567._000001.pool.root.1',
+                      'GUID': '74DFB3ED-DAA7-E011-8954-001E4F3D9CB1', 'startEvent': i, 'lastEvent': i, 'scope': 'mc16_13TeV'}
+                     for i in range(1, 101)]
+
+    class Dispatcher(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            form = dict(cgi.parse_qsl(self.rfile.read(int(self.headers.getheader('content-length', 0)))))
+            if self.path.endswith('/getEventRanges'):
+                time.sleep(latency)
+                with server.lock:
+                    n = int(form.get('nRanges', 1))
+                    event_ranges, server.ranges[:n] = server.ranges[:n], []
+                    server.downloads += 1
+                body = urllib.urlencode({'StatusCode': 0, 'eventRanges': json.dumps(event_ranges)})
+            else:
+                event_ranges = json.loads(form['eventRanges'])
+                with server.lock:
+                    for event_range in event_ranges:
+                        server.updates[event_range['eventRangeID']] = (event_range['eventStatus'], event_range.get('errorCode'))
+                body = json.dumps({'StatusCode': 0, 'Returns': [True] * len(event_ranges)})
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    class Job(object):
+        jobId = '1234'
+        jobsetID = '5678'
+        taskID = '9012'
+        pandaProxySecretKey = None
+
+    server = Server(('localhost', 0), Dispatcher)
+    server.lock = threading.Lock()
+    serverthread = threading.Thread(target=server.serve_forever)
+    serverthread.setDaemon(True)
+    serverthread.start()
+    url = 'http://localhost:%d/server/panda' % (server.server_address[1])
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+
+    def _run(mode, softKill=False):
+        server.ranges = list(allRanges)
+        server.updates = {}
+        server.downloads = 0
+        job = Job()
+        updater = EventRangeUpdater(job.jobId, url, maxRanges=50, maxDelay=1)
+        updater.start()
+        prefetcher = None
+        if mode == 'prefetch':
+            prefetcher = EventRangePrefetcher(job, url, nWorkers, 2 * nWorkers)
+            prefetcher.start()
+        idle = []
+        processed = []
+        lock = threading.Lock()
+
+        def _worker():
+            while True:
+                t0 = time.time()
+                if prefetcher:
+                    event_ranges = prefetcher.get(1)
+                else:
+                    message = downloadEventRanges(job.jobId, job.jobsetID, job.taskID, numRanges=1, url=url)
+                    event_ranges = [] if message == "No more events" else json.loads(message)
+                with lock:
+                    idle.append(time.time() - t0)
+                    if event_ranges and softKill and len(processed) >= len(allRanges) / 2 and not prefetcher.stopped():
+                        prefetcher.stop()  # as RunJobEvent.checkSoftMessage()
+                if not event_ranges:
+                    return
+                time.sleep(processingTime)
+                for event_range in event_ranges:
+                    updater.add(event_range['eventRangeID'], 'finished')
+                with lock:
+                    processed.extend(event_ranges)
+
+        workers = [threading.Thread(target=_worker) for i in range(nWorkers)]
+        t0 = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        walltime = time.time() - t0
+
+        returned = []
+        if prefetcher:
+            # as RunJobEvent.stopEventRangePrefetcher()
+            prefetcher.stop()
+            prefetcher.join(5)
+            returned = prefetcher.drain()
+            for event_range in returned:
+                updater.add(event_range['eventRangeID'], 'failed', errorCode=PilotErrors.ERR_ESRECOVERABLE)
+        updater.stop()
+
+        # every event range is processed, returned (as failed) or still on the server, and the server knows about it
+        assert len(processed) + len(returned) + len(server.ranges) == len(allRanges), "event ranges lost"
+        for event_range in processed:
+            assert server.updates.get(event_range['eventRangeID']) == ('finished', None), "%s not reported" % (event_range)
+        for event_range in returned:
+            assert server.updates.get(event_range['eventRangeID']) == ('failed', PilotErrors.ERR_ESRECOVERABLE), "%s not returned" % (event_range)
+
+        print "%-20s: %6.2f s, %3d processed, %3d returned, %3d left on the server, %3d downloads, idle worker time %6.2f s" % \
+            (mode + (" (soft kill)" if softKill else ""), walltime, len(processed), len(returned), len(server.ranges), server.downloads, sum(idle))
+
+    try:
+        _run('synchronous')
+        _run('prefetch')
+        _run('prefetch', softKill=True)
+    finally:
+        server.shutdown()
+        os.chdir('/')
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+
+    import sys
+    benchmark(*(sys.argv[1:2] + [int(arg) for arg in sys.argv[2:3]] + [float(arg) for arg in sys.argv[3:5]]))
@@ -0,0 +1,215 @@
+# Class definition:
+#   EventRangeRegistry
+#   Event range bookkeeping for RunJobEvent: the downloaded event ranges, the output files that AthenaMP reported for them,
+#   the stage-out queue and the final status of each event range, with the event counters that are derived from them.
+#   Event ranges can be looked up by event range id and by output file paths (reverse index) in constant time, the
+#   stage-out queue is a FIFO queue. The registry is shared by the payload listener, the output stager and the main loop,
+#   all methods are thread-safe.
+#   Counters: nEvents (output messages from AthenaMP), nEventsW (staged-out event ranges), nEventsFailed (failed event
+#   ranges) and nEventsFailedStagedOut (event ranges that failed in the stage-out). An event range has one final status,
+#   a later status of the same event range replaces the earlier one in the counters.
+
+import time
+import threading
+from collections import deque
+
+class EventRangeRegistry(object):
+
+    def __init__(self):
+        """ Create an empty registry """
+
+        self.__lock = threading.Lock()
+        self.__done = {}                   # FORMAT: { event_range_id: True if the event range has a final status }
+        self.__outputs = {}                # FORMAT: { event_range_id: [paths, cpu, wall] }
+        self.__paths = {}                  # FORMAT: { tuple(paths): event_range_id }
+        self.__status = {}                 # FORMAT: { event_range_id: (status, stagedOut) }
+        self.__queue = deque()             # output paths waiting for the stage-out, oldest first
+        self.__queued = set()              # tuple(paths) in the queue
+        self.__nStaging = 0                # outputs taken from the queue whose stage-out has not finished
+        self.__npending = 0                # number of event ranges without final status
+        self.__counts = {'nEvents': 0, 'nEventsW': 0, 'nEventsFailed': 0, 'nEventsFailedStagedOut': 0}
+
+    def addEventRangeIDs(self, event_range_ids):
+        """ Add downloaded event ranges (event ranges that are already known are ignored) """
+
+        with self.__lock:
+            for event_range_id in event_range_ids:
+                if not self.__done.has_key(event_range_id):
+                    self.__done[event_range_id] = False
+                    self.__npending += 1
+
+    def hasEventRanges(self):
+        """ Have any event ranges been added? """
+
+        return len(self.__done) > 0
+
+    def getEventRangeIDs(self):
+        """ Return a dictionary { event_range_id: True if the event range has a final status } """
+
+        with self.__lock:
+            return dict(self.__done)
+
+    def allDone(self):
+        """ Do all event ranges have a final status? """
+
+        return self.__npending == 0
+
+    def addOutput(self, event_range_id, paths, cpu=None, wall=None):
+        """
+        Add the output of an event range reported by AthenaMP and queue it for the stage-out.
+        Return False if the output is empty or already known
+        """
+
+        with self.__lock:
+            self.__counts['nEvents'] += 1
+            if not paths:
+                return False
+            key = tuple(paths)
+            if key in self.__queued:
+                return False
+
+            self.__outputs[event_range_id] = [paths, cpu, wall]
+            self.__paths[key] = event_range_id
+            self.__queue.append(paths)
+            self.__queued.add(key)
+
+            return True
+
+    def getEventRangeID(self, paths):
+        """ Return the event range id for the output paths ("" if unknown) """
+
+        return self.__paths.get(tuple(paths), "")
+
+    def getOutput(self, event_range_id):
+        """ Return [paths, cpu, wall] of an event range (None if unknown) """
+
+        return self.__outputs.get(event_range_id)
+
+    def getOutputs(self):
+        """ Return a dictionary { event_range_id: [paths, cpu, wall] } """
+
+        with self.__lock:
+            return dict(self.__outputs)
+
+    def popStageOut(self):
+        """ Return the oldest output paths from the stage-out queue (None if the queue is empty) """
+
+        with self.__lock:
+            if not self.__queue:
+                return None
+            paths = self.__queue.popleft()
+            self.__queued.discard(tuple(paths))
+            self.__nStaging += 1
+
+            return paths
+
+    def stageOutFinished(self):
+        """ The stage-out of all outputs taken from the queue has finished (successfully or not) """
+
+        with self.__lock:
+            self.__nStaging = 0
+
+    def isStageOutIdle(self):
+        """ Is the stage-out queue empty with no stage-out in progress? """
+
+        with self.__lock:
+            return not self.__queue and self.__nStaging == 0
+
+    def getStageOutQueue(self):
+        """ Return a list of the output paths in the stage-out queue """
+
+        with self.__lock:
+            return list(self.__queue)
+
+    def getStageOutQueueLength(self):
+        """ Return the number of outputs in the stage-out queue """
+
+        return len(self.__queue)
+
+    def setStatus(self, event_range_id, status, stagedOut=True):
+        """
+        Set the final status of an event range: 'finished' (staged out) or a failure status ('failed', 'fatal', ..).
+        stagedOut: the failure happened in the stage-out
+        """
+
+        with self.__lock:
+            previous = self.__status.get(event_range_id)
+            if previous:
+                self.__count(previous, -1)
+            self.__status[event_range_id] = (status, stagedOut)
+            self.__count(self.__status[event_range_id], 1)
+
+            if not self.__done.get(event_range_id, False):
+                if self.__done.has_key(event_range_id):
+                    self.__npending -= 1
+                self.__done[event_range_id] = True
+
+    def __count(self, status, n):
+        """ Update the counters for an event range status (status, stagedOut) (lock must be held) """
+
+        status, stagedOut = status
+        if status == 'finished':
+            self.__counts['nEventsW'] += n
+        else:
+            self.__counts['nEventsFailed'] += n
+            if stagedOut:
+                self.__counts['nEventsFailedStagedOut'] += n
+
+    def getCounts(self):
+        """ Return nEvents, nEventsW, nEventsFailed, nEventsFailedStagedOut """
+
+        with self.__lock:
+            return self.__counts['nEvents'], self.__counts['nEventsW'], self.__counts['nEventsFailed'], self.__counts['nEventsFailedStagedOut']
+
+def benchmark(n=100000):
+    """
+    Compare the registry with the former list/dictionary bookkeeping for n event ranges (one output file each):
+    add the output of every event range, then stage out the queue and look up the event range ids.
+    usage: python EventRangeRegistry.py [number of event ranges]
+    """
+
+    ids = ["12345-67890-111-%d-1" % i for i in range(n)]
+    outputs = [["/tmp/athenaMP-workers/worker_%d/HITS.pool.root_%d" % (i % 64, i)] for i in range(n)]
+
+    # former bookkeeping: list queue, linear look-up of the event range id
+    def _former(n):
+        eventRange_dictionary = {}
+        stageout_queue = []
+        for i in range(n):
+            if outputs[i] not in stageout_queue:
+                eventRange_dictionary[ids[i]] = [outputs[i], 0, 0]
+                stageout_queue.append(outputs[i])
+        while stageout_queue:
+            paths = stageout_queue.pop(0)
+            for event_range in eventRange_dictionary.keys():
+                if eventRange_dictionary[event_range][0] == paths:
+                    break
+
+    def _registry(n):
+        registry = EventRangeRegistry()
+        registry.addEventRangeIDs(ids[:n])
+        for i in range(n):
+            registry.addOutput(ids[i], outputs[i], 0, 0)
+        while True:
+            paths = registry.popStageOut()
+            if paths is None:
+                break
+            registry.setStatus(registry.getEventRangeID(paths), 'finished')
+        registry.stageOutFinished()
+        assert registry.isStageOutIdle() and registry.allDone() and registry.getCounts()[1] == n
+
+    # the former bookkeeping is quadratic, it is timed for a subset and extrapolated
+    m = min(n, 5000)
+    t0 = time.time()
+    _former(m)
+    t1 = time.time()
+    _registry(n)
+    t2 = time.time()
+
+    print "former bookkeeping:  %8.2f s for %d event ranges (%.0f s extrapolated to %d)" % (t1 - t0, m, (t1 - t0) * (float(n) / m)**2, n)
+    print "EventRangeRegistry:  %8.2f s for %d event ranges" % (t2 - t1, n)
+
+if __name__ == "__main__":
+
+    import sys
+    benchmark(*[int(arg) for arg in sys.argv[1:2]])
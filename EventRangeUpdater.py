@@ -0,0 +1,255 @@
+# Class definition:
+#   EventRangeUpdater
+#   Bulk event range status updates for RunJobEvent, used instead of one updateEventRange() server request per finished
+#   event range. The statuses are collected and sent with updateEventRanges() when maxRanges updates are pending or when
+#   the oldest pending update is maxDelay seconds old, so that server instructions in the replies (tobekilled, softkill)
+#   still arrive within maxDelay seconds. The replies are passed to a callback (RunJobEvent.checkSoftMessage()).
+#   Pending updates are written to a journal file as they are added and the journal is rewritten after each update
+#   of the server, so the pending updates survive the pilot process; they are sent again by the next EventRangeUpdater
+#   that uses the same journal, by the job recovery of a later pilot (replayJournals()) for a pilot that was killed,
+#   and flushed from the signal handler of RunJobEvent. Failed updates stay pending and are sent again later.
+#   The journal starts with a header line holding the pandaProxySecretKey of the job, needed to replay the updates.
+#   Settings are read from the catchall field of queuedata: es_update_delay=<s> and es_update_ranges=<n>.
+
+import os
+import json
+import time
+import threading
+from glob import glob
+
+from pUtil import tolog, chunks
+from StoppableThread import StoppableThread
+from EventRanges import updateEventRanges
+
+class EventRangeUpdater(StoppableThread):
+
+    # default settings
+    MAXRANGES = 100                        # max number of event ranges per server update
+    MAXDELAY = 60                          # max time an update is kept pending [s]
+    RETRYDELAY = 300                       # time before a failed update is sent again [s]
+
+    def __init__(self, jobId, url, pandaProxySecretKey=None, journal=None, maxRanges=MAXRANGES, maxDelay=MAXDELAY, callback=None):
+        """
+        jobId, url, pandaProxySecretKey: as for updateEventRanges(), journal: file for the pending updates,
+        callback: function called with the server reply of each update
+        """
+
+        StoppableThread.__init__(self, name='EventRangeUpdater')
+        self.setDaemon(True)
+
+        self.jobId = jobId
+        self.url = url
+        self.pandaProxySecretKey = pandaProxySecretKey
+        self.journal = journal
+        self.maxRanges = max(1, maxRanges)
+        self.maxDelay = maxDelay
+        self.callback = callback
+
+        self.__pending = []                # FORMAT: [{'eventRangeID': .., 'eventStatus': .., ..}, ..]
+        self.__since = None                # time of the oldest pending update
+        self.__retryTime = 0               # time of the next attempt after a failed update
+        self.__lock = threading.RLock()    # protects the pending updates and the journal (also taken in signal handlers)
+        self.__sendLock = threading.Lock() # one server update at a time
+        self.__wakeup = threading.Event()
+        self.__counts = {'ranges': 0, 'requests': 0, 'failures': 0}
+
+        self.__loadJournal()
+
+    def __loadJournal(self):
+        """ Add the pending updates left in the journal by a previous process """
+
+        if not self.journal or not os.path.exists(self.journal):
+            return
+
+        try:
+            f = open(self.journal)
+            try:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    record = json.loads(line)
+                    if 'eventRangeID' in record:
+                        self.__pending.append(record)
+                    elif self.pandaProxySecretKey is None: # header
+                        self.pandaProxySecretKey = record.get('pandaProxySecretKey')
+            finally:
+                f.close()
+        except Exception, e:
+            tolog("!!WARNING!!2999!! Failed to read event range update journal %s: %s" % (self.journal, e))
+        if self.__pending:
+            tolog("Found %d pending event range update(s) in %s" % (len(self.__pending), self.journal))
+            self.__since = time.time() - self.maxDelay
+
+    def __getJournalHeader(self):
+        """ Return the header line of the journal """
+
+        return json.dumps({'jobId': self.jobId, 'pandaProxySecretKey': self.pandaProxySecretKey}) + '\n'
+
+    def __writeJournal(self):
+        """ Replace the journal with the current pending updates (lock must be held) """
+
+        if not self.journal:
+            return
+
+        tmpname = "%s.tmp" % (self.journal)
+        try:
+            f = open(tmpname, 'w')
+            try:
+                if self.__pending:
+                    f.write(self.__getJournalHeader())
+                for event_range in self.__pending:
+                    f.write(json.dumps(event_range) + '\n')
+            finally:
+                f.close()
+            os.rename(tmpname, self.journal)
+        except Exception, e:
+            tolog("!!WARNING!!2999!! Failed to write event range update journal %s: %s" % (self.journal, e))
+
+    def add(self, event_range_id, status, os_bucket_id=-1, errorCode=None):
+        """ Add an event range status (arguments as for updateEventRange()) """
+
+        eventrange = {'eventRangeID': event_range_id, 'eventStatus': status}
+        if os_bucket_id != -1:
+            eventrange['objstoreID'] = os_bucket_id
+        if errorCode:
+            eventrange['errorCode'] = errorCode
+
+        with self.__lock:
+            self.__pending.append(eventrange)
+            if self.__since is None:
+                self.__since = time.time()
+            if self.journal:
+                try:
+                    f = open(self.journal, 'a')
+                    try:
+                        if os.fstat(f.fileno()).st_size == 0:
+                            f.write(self.__getJournalHeader())
+                        f.write(json.dumps(eventrange) + '\n')
+                    finally:
+                        f.close()
+                except IOError, e:
+                    tolog("!!WARNING!!2999!! Failed to write event range update journal %s: %s" % (self.journal, e))
+            full = len(self.__pending) >= self.maxRanges
+
+        if full:
+            self.__wakeup.set()
+
+    def getPendingCount(self):
+        """ Return the number of pending updates """
+
+        with self.__lock:
+            return len(self.__pending)
+
+    def flush(self, blocking=True):
+        """ Send all pending updates to the server. Return True if all updates were accepted
+        (blocking=False: return False if another update is being sent, e.g. from a signal handler) """
+
+        if not self.__sendLock.acquire(blocking):
+            return False
+        try:
+            return self.__flush()
+        finally:
+            self.__sendLock.release()
+
+    def __flush(self):
+        """ Send all pending updates (the send lock is held) """
+
+        with self.__lock:
+            event_ranges = list(self.__pending)
+        if not event_ranges:
+            return True
+
+        sent = 0
+        for chunk in chunks(event_ranges, self.maxRanges):
+            status, output = updateEventRanges(chunk, pandaProxySecretKey=self.pandaProxySecretKey, jobId=self.jobId, url=self.url, version=1)
+            tolog("Update of %d event range(s): status: %s, output: %s" % (len(chunk), status, output))
+            self.__counts['requests'] += 1
+
+            # did the reply contain an instruction (tobekilled, softkill)?
+            if self.callback and output:
+                try:
+                    self.callback(output)
+                except Exception, e:
+                    tolog("!!WARNING!!2999!! Failed to process event range update reply: %s" % (e))
+
+            if str(status) != '0':
+                tolog("Failed to update event ranges, %d update(s) will be sent again later" % (len(event_ranges) - sent))
+                self.__counts['failures'] += 1
+                break
+            sent += len(chunk)
+
+        with self.__lock:
+            # updates added meanwhile were appended after the sent ones
+            self.__pending = self.__pending[sent:]
+            self.__since = time.time() if self.__pending else None
+            self.__writeJournal()
+        self.__counts['ranges'] += sent
+
+        if sent < len(event_ranges):
+            self.__retryTime = time.time() + self.RETRYDELAY
+            return False
+        self.__retryTime = 0
+        return True
+
+    def run(self):
+        """ Send the pending updates when enough are collected or the oldest one is maxDelay seconds old """
+
+        while not self.stopped():
+            self.__wakeup.wait(1)
+            self.__wakeup.clear()
+
+            with self.__lock:
+                npending = len(self.__pending)
+                since = self.__since
+            if not npending or time.time() < self.__retryTime:
+                continue
+            if npending >= self.maxRanges or time.time() - since >= self.maxDelay:
+                try:
+                    self.flush()
+                except Exception, e:
+                    tolog("!!WARNING!!2999!! Failed to update event ranges: %s" % (e))
+
+    def stop(self):
+        """ Stop the thread and send the pending updates """
+
+        StoppableThread.stop(self)
+        self.__wakeup.set()
+        self.flush()
+        tolog("Event range updater: %d event range(s) sent in %d request(s), %d failed request(s), %d update(s) pending" %\
+              (self.__counts['ranges'], self.__counts['requests'], self.__counts['failures'], self.getPendingCount()))
+
+def replayJournals(dir_path, url, minAge):
+    """
+    Send the pending updates left in the journals of killed pilots (<dir_path>/Panda_Pilot_*/*/eventRangeUpdates-<jobId>.json,
+    not modified for minAge seconds), with the pandaProxySecretKey of the journal header. A journal is removed once all
+    its updates were accepted, otherwise it is left for the next pilot. Return the number of sent updates
+    """
+
+    nsent = 0
+    for journal in glob(os.path.join(dir_path, "Panda_Pilot_*", "*", "eventRangeUpdates-*.json")):
+        try:
+            if time.time() - os.path.getmtime(journal) < minAge or os.path.getsize(journal) == 0:
+                continue
+            # claim the journal (another pilot can scan the same directory)
+            claimed = "%s.replay-%d" % (journal, os.getpid())
+            os.rename(journal, claimed)
+        except OSError:
+            continue
+
+        jobId = os.path.basename(journal)[len("eventRangeUpdates-"):-len(".json")]
+        updater = EventRangeUpdater(jobId, url, journal=claimed)
+        npending = updater.getPendingCount()
+        tolog("Replaying %d event range update(s) of job %s from %s" % (npending, jobId, journal))
+        try:
+            if updater.flush():
+                os.remove(claimed)
+            else:
+                os.rename(claimed, journal)
+            nsent += npending - updater.getPendingCount()
+        except Exception, e:
+            tolog("!!WARNING!!2999!! Failed to replay event range updates from %s: %s" % (journal, e))
+            if os.path.exists(claimed):
+                os.rename(claimed, journal)
+
+    return nsent
@@ -3,32 +3,33 @@
 #   This class is used to generate EventService class objects corresponding to a given "experiment"
 #   Based the on Factory Design Pattern
 #   Note: not compatible with Singleton Design Pattern due to the subclassing
+#   The event service modules are only imported when the experiment is requested (see PluginRegistry)
 
-from types import TypeType
-from EventService import EventService
-from ATLASEventService import ATLASEventService
+from PluginRegistry import PluginRegistry
+
+# experiment name (as returned by getEventService()) and module of all event service classes
+eventServices = PluginRegistry("EventServiceFactory", [
+    ("generic", "EventService"),
+    ("ATLAS", "ATLASEventService"),
+    ])
 
 class EventServiceFactory(object):
 
     def newEventService(self, experiment):
-        """ Generate a new site information object """
-
-        # get all classes
-        eventServiceClasses = [j for (i,j) in globals().iteritems() if isinstance(j, TypeType) and issubclass(j, EventService)]
-        print eventServiceClasses
-        # loop over all subclasses
+        """ Return the event service class for the given experiment """
 
         if experiment == "Nordugrid-ATLAS":
             experiment = "ATLAS"
-        for eventServiceClass in eventServiceClasses:
-            si = eventServiceClass()
 
-            # return the matching eventService class
-            if si.getEventService() == experiment:
-                return eventServiceClass
+        return eventServices.getClass(experiment)
+
+    def getEventService(self, experiment):
+        """ Return the event service object for the given experiment (one per process) """
+
+        if experiment == "Nordugrid-ATLAS":
+            experiment = "ATLAS"
 
-        # if no class was found, raise an error
-        raise ValueError('EventServiceFactory: No such class: "%s"' % (eventServiceClass))
+        return eventServices.getInstance(experiment)
 
 if __name__ == "__main__":
 
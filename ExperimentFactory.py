@@ -3,33 +3,31 @@
 #   This class is used to generate Experiment class objects corresponding to a given "experiment"
 #   Based the on Factory Design Pattern
 #   Note: not compatible with Singleton Design Pattern due to the subclassing
+#   The experiment modules are only imported when the experiment is requested (see PluginRegistry)
 
-from types import TypeType
-from Experiment import Experiment
-from ATLASExperiment import ATLASExperiment
-from CMSExperiment import CMSExperiment
-from OtherExperiment import OtherExperiment
-from AMSTaiwanExperiment import AMSTaiwanExperiment
-from NordugridATLASExperiment import NordugridATLASExperiment
+from PluginRegistry import PluginRegistry
+
+# experiment name (as returned by getExperiment()) and module of all experiment classes
+experiments = PluginRegistry("ExperimentFactory", [
+    ("generic", "Experiment"),
+    ("ATLAS", "ATLASExperiment"),
+    ("CMS", "CMSExperiment"),
+    ("Other", "OtherExperiment"),
+    ("AMSTaiwan", "AMSTaiwanExperiment"),
+    ("Nordugrid-ATLAS", "NordugridATLASExperiment"),
+    ])
 
 class ExperimentFactory(object):
 
     def newExperiment(self, experiment):
-        """ Generate a new site information object """
-
-        # get all classes
-        experimentClasses = [j for (i,j) in globals().iteritems() if isinstance(j, TypeType) and issubclass(j, Experiment)]
+        """ Return the experiment class for the given experiment """
 
-        # loop over all subclasses
-        for experimentClass in experimentClasses:
-            si = experimentClass()
+        return experiments.getClass(experiment)
 
-            # return the matching experiment class
-            if si.getExperiment() == experiment:
-                return experimentClass
+    def getExperiment(self, experiment):
+        """ Return the experiment object for the given experiment (one per process) """
 
-        # if no class was found, raise an error
-        raise ValueError('ExperimentFactory: No such class: "%s"' % (experiment))
+        return experiments.getInstance(experiment)
 
 if __name__ == "__main__":
 
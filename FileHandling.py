@@ -5,6 +5,7 @@ from time import time
 from commands import getoutput
 
 from pUtil import tolog, convert, readpar
+from JobReport import getReport
 
 def openFile(filename, mode):
     """ Open and return a file pointer for the given mode """
@@ -432,22 +433,12 @@ def getJobReportFileName(workDir):
 
     return os.path.join(workDir, "jobReport.json")
 
-# WARNING: EXPERIMENT SPECIFIC AND ALSO DEFINED IN ERRORDIAGNOSIS
+# WARNING: EXPERIMENT SPECIFIC
 def getJobReport(workDir):
     """ Get the jobReport.json dictionary """
-    # Note: always return at least an empty dictionary
+    # Note: always return at least an empty dictionary. The dictionary is cached (see JobReport), do not modify it
 
-    dictionary = {}
-    filename = getJobReportFileName(workDir)
-    if os.path.exists(filename):
-        # the jobReport file exists, read it back (with unicode to utf-8 conversion)
-        dictionary = getJSONDictionary(filename)
-        if not dictionary: # getJSONDictionary() can return None
-            dictionary = {}
-    else:
-        tolog("!!WARNING!!1111!! File %s does not exist" % (filename))
-
-    return dictionary
+    return getReport(workDir).getDictionary()
 
 def removeNoOutputFiles(workdir, outFiles, allowNoOutput, outFilesGuids):
     """ Remove files from output file list if they are listed in allowNoOutput and do not exist """
@@ -499,32 +490,10 @@ def addToJobReport(workDir, key, value, section=None, subsection=None):
     """ Add the key with value to the jobReport """
     # Add the key and value to the corresponding section in set
 
-    # Note: the function reads the jobReport, adds the new key (or overwrites it) then saves the updated jobReport again (overwrite)
+    # Note: the key is added to the cached jobReport (see JobReport), which is then written once (overwrite)
 
     try:
-        jobReport_dictionary = getJobReport(workDir)
-        if jobReport_dictionary != {}:
-            # Add the new key and value
-            if section:
-                if jobReport_dictionary.has_key(section):
-                    if subsection:
-                        if jobReport_dictionary[section].has_key(subsection):
-                            jobReport_dictionary[section][subsection][key] = value
-                        else:
-                            tolog("!!WARNING!!2325!! jobReport does not have subsection=%s in the expected location; will not add key=%s" % (subsection, key))
-                    else:
-                        jobReport_dictionary[section][key] = value
-                else:
-                    tolog("!!WARNING!!2324!! jobReport does not have section=%s in the expected location; will not add key=%s" % (section, key))
-            else:
-                jobReport_dictionary[key] = value
-
-            # Overwrite the jobReport with the updated dictionary
-            filename = getJobReportFileName(workDir)
-            if not writeJSON(filename, jobReport_dictionary):
-                tolog("!!WARNING!!2323!! Failed to write updated jobReport")
-        else:
-            tolog("jobReport not available, will not add new key: %s" % (key))
+        getReport(workDir).add(key, value, section=section, subsection=subsection)
     except Exception, e:
         tolog("!!WARNING!!2321!! Exception caught: %s" % (e))
 
@@ -536,61 +505,48 @@ def extractOutputFilesFromJSON(workDir, allowNoOutput):
     guids = []
     tolog("Extracting output files from jobReport")
 
-    jobReport_dictionary = getJobReport(workDir)
-    if jobReport_dictionary != {}:
-
-        if jobReport_dictionary.has_key('files'):
-            file_dictionary = jobReport_dictionary['files']
-            if file_dictionary.has_key('output'):
-                output_file_list = file_dictionary['output']
-                for f_dictionary in output_file_list:
-                    if f_dictionary.has_key('subFiles'):
-                        subFiles_list = f_dictionary['subFiles']
-                        for f_names_dictionary in subFiles_list:
-                            if f_names_dictionary.has_key('name'):# and f_names_dictionary.has_key('nentries'):
-                                # Only add the file is nentries > 0
-                                nentries = f_names_dictionary.get("nentries", "UNDEFINED")
-                                if type(nentries) == int and nentries > 0:
-                                    output_files.append(f_names_dictionary['name'])
-
-                                    # Also get the file guid
-                                    if f_names_dictionary.has_key('file_guid'):
-                                        guids.append(f_names_dictionary['file_guid'])
-                                    else:
-                                        tolog("!!WARNING!!1212!! Did not find any guid for this file: %s (will be generated)" % (f_names_dictionary['name']))
-                                        guids.append(None)
-                                else:
-                                    # Only ignore the file if it is allowed to be ignored
-                                    if not type(nentries) == int:
-                                        tolog("!!WARNING!!4542!! nentries is not a number: %s" % str(nentries))
-
-                                    # Special handling for origName._NNN
-                                    # origName._NNN are unmerged files dynamically produced by AthenaMP. Job definition doesn't
-                                    # explicitly specify those names but only the base names, thus allowNoOutput contains only base names
-                                    # in this case. We want to ignore origName._NNN when allowNoOutput=['origName']
-                                    from re import compile
-                                    allowNoOutputEx = [compile(s+'\.?_\d+$') for s in allowNoOutput]
-                                    if f_names_dictionary['name'] in allowNoOutput or any(patt.match(f_names_dictionary['name']) for patt in allowNoOutputEx):
-                                        tolog("Ignoring file %s since nentries=%s" % (f_names_dictionary['name'], str(nentries)))
-                                    else:
-                                        tolog("Will not ignore empty file %s since file is not in allowNoOutput list" % (f_names_dictionary['name']))
-                                        output_files.append(f_names_dictionary['name'])
-
-                                        # Also get the file guid
-                                        if f_names_dictionary.has_key('file_guid'):
-                                            guids.append(f_names_dictionary['file_guid'])
-                                        else:
-                                            tolog("!!WARNING!!1212!! Did not find any guid for this file: %s (will be generated)" % (f_names_dictionary['name']))
-                                            guids.append(None)
-
-                            else:
-                                tolog("No such key: name/nentries")
+    jobReport = getReport(workDir)
+    if jobReport.getDictionary() != {}:
+
+        for f_names_dictionary in jobReport.getOutputFiles():
+            if f_names_dictionary.has_key('name'):# and f_names_dictionary.has_key('nentries'):
+                # Only add the file is nentries > 0
+                nentries = f_names_dictionary.get("nentries", "UNDEFINED")
+                if type(nentries) == int and nentries > 0:
+                    output_files.append(f_names_dictionary['name'])
+
+                    # Also get the file guid
+                    if f_names_dictionary.has_key('file_guid'):
+                        guids.append(f_names_dictionary['file_guid'])
+                    else:
+                        tolog("!!WARNING!!1212!! Did not find any guid for this file: %s (will be generated)" % (f_names_dictionary['name']))
+                        guids.append(None)
+                else:
+                    # Only ignore the file if it is allowed to be ignored
+                    if not type(nentries) == int:
+                        tolog("!!WARNING!!4542!! nentries is not a number: %s" % str(nentries))
+
+                    # Special handling for origName._NNN
+                    # origName._NNN are unmerged files dynamically produced by AthenaMP. Job definition doesn't
+                    # explicitly specify those names but only the base names, thus allowNoOutput contains only base names
+                    # in this case. We want to ignore origName._NNN when allowNoOutput=['origName']
+                    from re import compile
+                    allowNoOutputEx = [compile(s+'\.?_\d+$') for s in allowNoOutput]
+                    if f_names_dictionary['name'] in allowNoOutput or any(patt.match(f_names_dictionary['name']) for patt in allowNoOutputEx):
+                        tolog("Ignoring file %s since nentries=%s" % (f_names_dictionary['name'], str(nentries)))
                     else:
-                        tolog("No such key: subFiles")
+                        tolog("Will not ignore empty file %s since file is not in allowNoOutput list" % (f_names_dictionary['name']))
+                        output_files.append(f_names_dictionary['name'])
+
+                        # Also get the file guid
+                        if f_names_dictionary.has_key('file_guid'):
+                            guids.append(f_names_dictionary['file_guid'])
+                        else:
+                            tolog("!!WARNING!!1212!! Did not find any guid for this file: %s (will be generated)" % (f_names_dictionary['name']))
+                            guids.append(None)
+
             else:
-                tolog("No such key: output")
-        else:
-            tolog("No such key: files")
+                tolog("No such key: name/nentries")
 
         if len(output_files) == 0:
             tolog("No output files found in jobReport")
@@ -652,21 +608,21 @@ def filterSpilloverFilename(filename):
     return filename
 
 def getDirSize(d):
-    """ Return the size of directory d using du -sk """
+    """ Return the size of directory d """
+    # The size is measured incrementally by a DirectorySize tracker that is kept for the lifetime of the pilot
+    # process, i.e. the directory tree is only walked in full the first time (unlike du -sk)
 
     tolog("Checking size of work dir: %s" % (d))
-    from commands import getoutput
-    size_str = getoutput("du -sk %s" % (d))
+    from DirectorySize import getDirectorySize
     size = 0
 
-    # E.g., size_str = "900\t/scratch-local/nilsson/pilot3z"
     try:
-        # Remove tab and path, and convert to int (and B)
-        size = int(size_str.split("\t")[0])*1024
+        tracker = getDirectorySize(d)
+        size = tracker.update()
     except Exception, e:
-        tolog("!!WARNING!!4343!! Failed to convert to int: %s" % (e))
+        tolog("!!WARNING!!4343!! Failed to measure directory size: %s" % (e))
     else:
-        tolog("Size of directory %s: %d B" % (d, size))
+        tolog("Size of directory %s: %d B (peak: %d B)" % (d, size, tracker.getPeakSize()))
 
     return size
 
@@ -775,28 +731,7 @@ def getMaxWorkDirSize(path, jobId):
 def getNumberOfEvents(workDir):
     """ Extract the number of events from the job report """
 
-    Nevents = {} # FORMAT: { format : total_events, .. }
-
-    jobReport_dictionary = getJobReport(workDir)
-    if jobReport_dictionary != {}:
-
-        if jobReport_dictionary.has_key('resource'):
-            resource_dictionary = jobReport_dictionary['resource']
-            if resource_dictionary.has_key('executor'):
-                executor_dictionary = resource_dictionary['executor']
-                for format in executor_dictionary.keys(): # "RAWtoESD", ..
-                    if executor_dictionary[format].has_key('nevents'):
-                        if Nevents.has_key(format):
-                            print executor_dictionary[format]['nevents']
-                            Nevents[format] += executor_dictionary[format]['nevents']
-                        else:
-                            Nevents[format] = executor_dictionary[format]['nevents']
-                    else:
-                        tolog("Format %s has no such key: nevents" % (format))
-            else:
-                tolog("No such key: executor")
-        else:
-            tolog("No such key: resource")
+    Nevents = getReport(workDir).getNumberOfEvents() # FORMAT: { format : total_events, .. }
 
     # Now find the largest number of events among the different formats
     if Nevents != {}:
@@ -818,35 +753,7 @@ def getDBInfo(workDir):
     # Input:  workDir (location of jobReport.json
     # Output: dbTime, dbData [converted strings, e.g. "dbData=105077960 dbTime=251.42"]
 
-    dbTime = 0
-    dbData = 0L
-
-    jobReport_dictionary = getJobReport(workDir)
-    if jobReport_dictionary != {}:
-
-        if jobReport_dictionary.has_key('resource'):
-            resource_dictionary = jobReport_dictionary['resource']
-            if resource_dictionary.has_key('executor'):
-                executor_dictionary = resource_dictionary['executor']
-                for format in executor_dictionary.keys(): # "RAWtoESD", ..
-                    if executor_dictionary[format].has_key('dbData'):
-                        try:
-                            dbData += executor_dictionary[format]['dbData']
-                        except:
-                            pass
-                    else:
-                        tolog("Format %s has no such key: dbData" % (format))
-                    if executor_dictionary[format].has_key('dbTime'):
-                        try:
-                            dbTime += executor_dictionary[format]['dbTime']
-                        except:
-                            pass
-                    else:
-                        tolog("Format %s has no such key: dbTime" % (format))
-            else:
-                tolog("No such key: executor")
-        else:
-            tolog("No such key: resource")
+    dbTime, dbData = getReport(workDir).getDBInfo()
 
     if dbData != 0L:
         dbDataS = "%s" % (dbData)
@@ -866,26 +773,7 @@ def getCPUTimes(workDir):
     # Input:  workDir (location of jobReport.json)
     # Output: cpuCU (unit), totalCPUTime, conversionFactor
 
-    totalCPUTime = 0L
-
-    jobReport_dictionary = getJobReport(workDir)
-    if jobReport_dictionary != {}:
-        if jobReport_dictionary.has_key('resource'):
-            resource_dictionary = jobReport_dictionary['resource']
-            if resource_dictionary.has_key('executor'):
-                executor_dictionary = resource_dictionary['executor']
-                for format in executor_dictionary.keys(): # "RAWtoESD", ..
-                    if executor_dictionary[format].has_key('cpuTime'):
-                        try:
-                            totalCPUTime += executor_dictionary[format]['cpuTime']
-                        except:
-                            pass
-                    else:
-                        tolog("Format %s has no such key: cpuTime" % (format))
-            else:
-                tolog("No such key: executor")
-        else:
-            tolog("No such key: resource")
+    totalCPUTime = getReport(workDir).getCPUTime()
 
     conversionFactor = 1.0
     cpuCU = "s"
@@ -1,6 +1,7 @@
 import os
 import commands
 from pUtil import tolog
+from StateJournal import StateJournal
 
 class FileState:
     """
@@ -45,6 +46,9 @@ class FileState:
     the state will be changed to "remote_io" / "file_stager". Brokerage can also decide that remote IO is to be used. In that case,
     "remote_io" will be set for the relevant input files (e.g. DBRelease and lib files are excluded, i.e. they will have "copy_to_scratch"
     transfer mode).
+
+    The file is a StateJournal: a snapshot of the dictionary followed by deltas { file_name: state_list } (one per
+    state update), so that a state update does not rewrite the whole dictionary.
     """
 
     def __init__(self, workDir, jobId="0", mode="", ftype="output", fileName=""):
@@ -62,6 +66,7 @@ class FileState:
         # add mode variable if needed (e.g. mode="test")
         if self.mode != "":
             self.filename = self.filename.replace(".pickle", "-%s.pickle" % (self.mode))
+        self.journal = StateJournal(self.filename)
 
         # load the dictionary from file if it exists
         if os.path.exists(self.filename):
@@ -75,23 +80,15 @@ class FileState:
 
         status = False
 
-        # De-serialize the file state file
-        try:
-            fp = open(self.filename, "r")
-        except:
-            tolog("FILESTATE FAILURE: get function could not open file: %s" % self.filename)
-            pass
+        # De-serialize the file state file (snapshot and the state updates)
+        snapshot, deltas = self.journal.read()
+        if snapshot is None:
+            tolog("FILESTATE FAILURE: could not deserialize file: %s" % self.filename)
         else:
-            from pickle import load
-            try:
-                # load the dictionary from file
-                self.fileStateDictionary = load(fp)
-            except:
-                tolog("FILESTATE FAILURE: could not deserialize file: %s" % self.filename)
-                pass
-            else:
-                status = True
-            fp.close()
+            self.fileStateDictionary = snapshot
+            for delta in deltas:
+                self.fileStateDictionary.update(delta)
+            status = True
 
         return status
     
@@ -102,26 +99,35 @@ class FileState:
 
         status = False
 
-        # write pickle file
-        from pickle import dump
+        # write the dictionary to a temporary file which replaces the file state file
         try:
-            fp = open(self.filename, "w")
+            self.journal.writeSnapshot(self.fileStateDictionary)
         except Exception, e:
-            tolog("FILESTATE FAILURE: Could not open file state file: %s, %s" % (self.filename, str(e)))
+            tolog("FILESTATE FAILURE: Could not write file state file: %s, %s" % (self.filename, str(e)))
             _cmd = "whoami; ls -lF %s" % (self.filename)
             tolog("Executing command: %s" % (_cmd))
             ec, rs = commands.getstatusoutput(_cmd)
             tolog("%d, %s" % (ec, rs))
         else:
+            status = True
+
+        return status
+
+    def putState(self, filename, state_list):
+        """
+        Update the state list for a file and append it to the file state file
+        (the whole dictionary is written when the journal needs a new snapshot)
+        """
+
+        status = self.updateStateList(filename, state_list)
+        if status:
             try:
-                # write the dictionary to file
-                dump(self.fileStateDictionary, fp)
+                if not self.journal.append({filename: state_list}):
+                    status = self.put()
             except Exception, e:
-                tolog("FILESTATE FAILURE: Could not pickle data to file state file: %s, %s" % (self.filename, str(e)))
-            else:
-                status = True
-            fp.close()
-                                                                                                        
+                tolog("FILESTATE FAILURE: Could not update file state file: %s, %s" % (self.filename, str(e)))
+                status = False
+
         return status
 
     def getNumberOfFiles(self):
@@ -180,12 +186,8 @@ class FileState:
         except Exception, e:
             tolog("FILESTATE FAILURE: %s" % str(e))
         else:
-            # update state list
-            status = self.updateStateList(filename, state_list)
-
-        # update the file state file for every update (necessary since a failed put operation can abort everything)
-        if status:
-            status = self.put()
+            # update the state list and the file state file for every update (necessary since a failed put operation can abort everything)
+            status = self.putState(filename, state_list)
 
         return status
 
@@ -1,59 +1,68 @@
+import threading
+
 from FileState import FileState
 from pUtil import tolog
 
+# the file state files are read, updated and written back by each call, serialize the calls of concurrent transfers
+__lock = threading.RLock()
+
 def createFileStates(workDir, jobId, outFiles=None, inFiles=None, logFile=None, ftype="output"):
     """ Create the initial file state dictionary """
 
-    # file list
-    if ftype == "output":
-        files = outFiles
-        files.append(logFile)
-    else:
-        files = inFiles
+    with __lock:
+        # file list
+        if ftype == "output":
+            files = outFiles
+            files.append(logFile)
+        else:
+            files = inFiles
 
-    # create temporary file state object
-    FS = FileState(workDir=workDir, jobId=jobId, ftype=ftype)
-    FS.resetStates(files, ftype=ftype)
+        # create temporary file state object
+        FS = FileState(workDir=workDir, jobId=jobId, ftype=ftype)
+        FS.resetStates(files, ftype=ftype)
 
-    # cleanup
-    del FS
+        # cleanup
+        del FS
 
 def updateFileStates(files, workDir, jobId, mode="file_state", state="not_created", ftype="output"):
     """ Update the current file states (for all files) """
 
-    # create a temporary file state object
-    FS = FileState(workDir=workDir, jobId=jobId, ftype=ftype)
+    with __lock:
+        # create a temporary file state object
+        FS = FileState(workDir=workDir, jobId=jobId, ftype=ftype)
 
-    # update all files
-    for fileName in files:
-        FS.updateState(fileName, mode=mode, state=state)
+        # update all files
+        for fileName in files:
+            FS.updateState(fileName, mode=mode, state=state)
 
-    # cleanup
-    del FS
+        # cleanup
+        del FS
 
 def updateFileState(fileName, workDir, jobId, mode="file_state", state="not_created", ftype="output"):
     """ Update the current file states (for all files) """
 
-    # create a temporary file state object
-    FS = FileState(workDir=workDir, jobId=jobId, ftype=ftype)
+    with __lock:
+        # create a temporary file state object
+        FS = FileState(workDir=workDir, jobId=jobId, ftype=ftype)
 
-    # update this file
-    FS.updateState(fileName, mode=mode, state=state)
+        # update this file
+        FS.updateState(fileName, mode=mode, state=state)
 
-    # cleanup
-    del FS
+        # cleanup
+        del FS
 
 def dumpFileStates(workDir, jobId, ftype="output"):
     """ Update the current file states (for all files) """
 
-    # create a temporary file state object
-    FS = FileState(workDir=workDir, jobId=jobId, ftype=ftype)
+    with __lock:
+        # create a temporary file state object
+        FS = FileState(workDir=workDir, jobId=jobId, ftype=ftype)
 
-    # dump file states for all files
-    FS.dumpFileStates(ftype=ftype)
+        # dump file states for all files
+        FS.dumpFileStates(ftype=ftype)
 
-    # cleanup
-    del FS
+        # cleanup
+        del FS
 
 def getFilesOfState(workDir, jobId, ftype="output", state="transferred"):
     """ Return a comma-separated list of files in a given state"""
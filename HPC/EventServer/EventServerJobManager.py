@@ -21,6 +21,8 @@ except:
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 from pandayoda.yodacore import Logger
 from FileHandling import getCPUTimes
+from ProcessTable import ProcessTable
+from pUtil import flushLog
 
 from signal_block.signal_block import block_sig, unblock_sig
 
@@ -182,35 +184,18 @@ class EventServerJobManager():
             ret = time.time() - self.__startTime
         return ret
 
-    def getCPUConsumptionTimeFromProcPid(self, pid):
-        try:
-            if not os.path.exists(os.path.join('/proc/', str(pid), 'stat')):
-                return 0
-            with open(os.path.join('/proc/', str(pid), 'stat'), 'r') as pidfile:
-                proctimes = pidfile.readline()
-                # get utime from /proc/<pid>/stat, 14 item
-                utime = proctimes.split(' ')[13]
-                # get stime from proc/<pid>/stat, 15 item
-                stime = proctimes.split(' ')[14]
-                # count total process used time
-                proctotal = int(utime) + int(stime)
-            return(float(proctotal))
-        except:
-            # self.__log.debug("Rank %s: Failed to get cpu consumption time for pid %s: %s" % (self.__rank, pid, traceback.format_exc()))
-            return 0
-
     def getCPUConsumptionTimeFromProc(self):
         cpuConsumptionTime = 0L
         try:
-            CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
             if self.__child_pid:
+                table = ProcessTable()
                 self.__childProcs = []
-                self.getChildren(self.__child_pid)
+                self.getChildren(self.__child_pid, table=table)
                 for process in self.__childProcs:
                     if process not in self.__child_cpuTime.keys():
                         self.__child_cpuTime[process] = 0
                 for process in self.__child_cpuTime.keys():
-                    cpuTime = self.getCPUConsumptionTimeFromProcPid(process) / CLOCK_TICKS
+                    cpuTime = table.getCPUTime(process, children=False, reaped=False)
                     if cpuTime > self.__child_cpuTime[process]:
                         self.__child_cpuTime[process] = cpuTime
                     cpuConsumptionTime += self.__child_cpuTime[process]
@@ -358,6 +343,7 @@ class EventServerJobManager():
             self.terminateChild()
             self.__log.debug("Rank %s: Child terminated" % (self.__rank))
             # sys.exit(0)
+            flushLog()
             os._exit(0)
         else:
             self.__child_pid = child_pid
@@ -640,38 +626,21 @@ class EventServerJobManager():
             unblock_sig(signal.SIGTERM)
             return True
 
-    def findChildProcesses(self,pid):
-        command = "/bin/ps -e --no-headers -o pid -o ppid -o fname"
-        status,output = commands.getstatusoutput(command)
-        #print "ps output: %s" % output
+    def findChildProcesses(self, pid, table=None):
+        """ Return the pids of the direct children of pid """
 
-        pieces = []
-        result = []
-        for line in output.split("\n"):
-            pieces= line.split()
-            try:
-                value=int(pieces[1])
-            except Exception,e:
-                #print "trouble interpreting ps output %s: \n %s" % (e,pieces)
-                continue
-            if value==pid:
-                try:
-                    job=int(pieces[0])
-                except ValueError,e:
-                    #print "trouble interpreting ps output %s: \n %s" % (e,pieces[0])
-                    continue
-                result.append(job)
-        return result
-
-    def getChildren(self, pid):
-        #self.__childProcs = []
-        if pid not in self.__childProcs:
-            self.__childProcs.append(pid)
-        childProcs = self.findChildProcesses(pid)
-        for child in childProcs:
-            #print "Child Process found: %s" % child
-            #self.__childProcs.append(child)
-            self.getChildren(child)
+        if not table:
+            table = ProcessTable()
+        return table.getChildren(pid)
+
+    def getChildren(self, pid, table=None):
+        """ Add pid and all its descendants to the child process list, using a single process table snapshot """
+
+        if not table:
+            table = ProcessTable()
+        for process in table.getSubtree(pid):
+            if process not in self.__childProcs:
+                self.__childProcs.append(process)
 
     def killProcess(self, pid):
         self.__isKilled = True
@@ -2,362 +2,266 @@ import os
 import json
 import sqlite3
 import datetime
+import threading
+
+
+# sql to make event table
+sqlM  = "CREATE TABLE JEDI_Events("
+sqlM += "eventRangeID text,"
+sqlM += "startEvent integer,"
+sqlM += "lastEvent integer,"
+sqlM += "LFN text,"
+sqlM += "GUID text,"
+sqlM += "scope text,"
+sqlM += "status text,"
+sqlM += "todump integer,"
+sqlM += "output text,"
+sqlM  = sqlM[:-1]
+sqlM += ")"
+
+# sql to make indexes (updates are done by eventRangeID, dumps look for todump)
+sqlX = ["CREATE INDEX JEDI_Events_eventRangeID_idx ON JEDI_Events (eventRangeID)",
+        "CREATE INDEX JEDI_Events_todump_status_idx ON JEDI_Events (todump,status)"]
+
+# sql to insert event ranges
+sqlI  = "INSERT INTO JEDI_Events ("
+sqlI += "eventRangeID,"
+sqlI += "startEvent,"
+sqlI += "lastEvent,"
+sqlI += "LFN,"
+sqlI += "GUID,"
+sqlI += "scope,"
+sqlI += "status,"
+sqlI += "todump,"
+sqlI  = sqlI[:-1]
+sqlI += ") "
+sqlI += "VALUES("
+sqlI += ":eventRangeID,"
+sqlI += ":startEvent,"
+sqlI += ":lastEvent,"
+sqlI += ":LFN,"
+sqlI += ":GUID,"
+sqlI += ":scope,"
+sqlI += ":status,"
+sqlI += ":todump,"
+sqlI  = sqlI[:-1]
+sqlI += ")"
 
 
 # database class
 class Backend:
-  
+
     # constructor
-    def __init__(self, workingDir):
+    def __init__(self, workingDir, journalMode='WAL'):
         self.workingDir = workingDir
         # database file name
         self.dsFileName = os.path.join(self.workingDir, './events_sqlite.db')
         self.dsFileName_backup = os.path.join(self.workingDir, './events_sqlite_backup.db')
-        # timestamp when dumping updates 
+        # journal mode of the databases (WAL lets readers work while ranges are updated)
+        self.journalMode = journalMode
+        # timestamp when dumping updates
         self.dumpedTime = None
         self.conn = None
         self.conn_backup = None
         self.cur = None
         self.cur_backup = None
-
-    def createEventTable(self):
-        # delete file just in case
+        # the connections are shared by the Yoda main loop and its helper thread
+        self.lock = threading.RLock()
+
+
+    # make connections (they are kept open and reused)
+    def connect(self, journalMode=None):
+        if journalMode == None:
+            journalMode = self.journalMode
+        if self.conn == None:
+            self.conn = sqlite3.connect(self.dsFileName, check_same_thread=False)
+            self.cur = self.conn.cursor()
+            self.setJournalMode(self.cur, journalMode)
+        if self.conn_backup == None:
+            self.conn_backup = sqlite3.connect(self.dsFileName_backup, check_same_thread=False)
+            self.cur_backup = self.conn_backup.cursor()
+            self.setJournalMode(self.cur_backup, journalMode)
+
+
+    # set journal mode
+    def setJournalMode(self, cur, journalMode):
+        if not journalMode:
+            return
         try:
-            os.remove(self.dsFileName)
-            os.remove(self.dsFileName_backup)
-        except:
+            # sqlite keeps the old mode if the new one is not supported (e.g. WAL on some shared file systems)
+            cur.execute('PRAGMA journal_mode = %s' % journalMode)
+            if journalMode.upper() == 'WAL':
+                cur.execute('PRAGMA synchronous = NORMAL')
+        except sqlite3.Error:
             pass
-        # make connection
-        self.conn = sqlite3.connect(self.dsFileName)
-        self.conn_backup = sqlite3.connect(self.dsFileName_backup)
-        # make cursor
-        self.cur = self.conn.cursor()
-        self.cur_backup = self.conn_backup.cursor()
-        #self.cur.execute('''PRAGMA journal_mode = OFF''')
-        #self.cur_backup.execute('''PRAGMA journal_mode = OFF''')
 
-        # make event table
-        sqlM  = "CREATE TABLE JEDI_Events("
-        sqlM += "eventRangeID text,"
-        sqlM += "startEvent integer,"
-        sqlM += "lastEvent integer,"
-        sqlM += "LFN text,"
-        sqlM += "GUID text,"
-        sqlM += "scope text,"
-        sqlM += "status text,"
-        sqlM += "todump integer,"
-        sqlM += "output text,"
-        sqlM  = sqlM[:-1]
-        sqlM += ")"
-        self.cur.execute(sqlM)
-        self.conn.commit()
-        self.cur_backup.execute(sqlM)
-        self.conn_backup.commit()
 
-    # setup table
-    def setupEventTable(self,job,eventRangeList):
+    # close connections
+    def close(self):
+        with self.lock:
+            for conn in [self.conn, self.conn_backup]:
+                if conn != None:
+                    try:
+                        conn.close()
+                    except sqlite3.Error:
+                        pass
+            self.conn = None
+            self.conn_backup = None
+            self.cur = None
+            self.cur_backup = None
+
+
+    # delete old database files and make new event tables
+    def makeTables(self, journalMode=None):
+        self.close()
         # delete file just in case
-        try:
-            os.remove(self.dsFileName)
-            os.remove(self.dsFileName_backup)
-        except:
-            pass
+        for fileName in [self.dsFileName, self.dsFileName_backup]:
+            for suffix in ['', '-wal', '-shm', '-journal']:
+                try:
+                    os.remove(fileName + suffix)
+                except:
+                    pass
         # make connection
-        self.conn = sqlite3.connect(self.dsFileName)
-        # make cursor
-        self.cur = self.conn.cursor()
-        self.cur.execute('''PRAGMA journal_mode = OFF''')
+        self.connect(journalMode)
+        # make event table
+        for cur in [self.cur, self.cur_backup]:
+            cur.execute(sqlM)
+            for sql in sqlX:
+                cur.execute(sql)
 
-        self.conn_backup = sqlite3.connect(self.dsFileName_backup)
-        self.cur_backup = self.conn_backup.cursor()
-        self.cur_backup.execute('''PRAGMA journal_mode = OFF''')
 
-        # make event table
-        sqlM  = "CREATE TABLE JEDI_Events("
-        sqlM += "eventRangeID text,"
-        sqlM += "startEvent integer,"
-        sqlM += "lastEvent integer,"
-        sqlM += "LFN text,"
-        sqlM += "GUID text,"
-        sqlM += "scope text,"
-        sqlM += "status text,"
-        sqlM += "todump integer,"
-        sqlM += "output text,"
-        sqlM  = sqlM[:-1]
-        sqlM += ")"
-        self.cur.execute(sqlM)
-        self.cur_backup.execute(sqlM)
-
-        # insert event ranges
-        sqlI  = "INSERT INTO JEDI_Events ("
-        sqlI += "eventRangeID,"
-        sqlI += "startEvent,"
-        sqlI += "lastEvent,"
-        sqlI += "LFN,"
-        sqlI += "GUID,"
-        sqlI += "scope,"
-        sqlI += "status,"
-        sqlI += "todump,"
-        sqlI  = sqlI[:-1]
-        sqlI += ") "
-        sqlI += "VALUES("
-        sqlI += ":eventRangeID,"
-        sqlI += ":startEvent,"
-        sqlI += ":lastEvent,"
-        sqlI += ":LFN,"
-        sqlI += ":GUID,"
-        sqlI += ":scope,"
-        sqlI += ":status,"
-        sqlI += ":todump,"
-        sqlI  = sqlI[:-1]
-        sqlI += ")"
+    # insert event ranges into both databases in one transaction
+    def insertRows(self, eventRangeList):
+        rows = []
         for tmpDict in eventRangeList:
             tmpDict['status'] = 'ready'
             tmpDict['todump'] = 0
-            self.cur.execute(sqlI,tmpDict)
-            self.cur_backup.execute(sqlI,tmpDict)
+            rows.append(tmpDict)
+        if rows:
+            self.cur.executemany(sqlI, rows)
+            self.cur_backup.executemany(sqlI, rows)
         self.conn.commit()
         self.conn_backup.commit()
+
+
+    def createEventTable(self):
+        with self.lock:
+            self.makeTables()
+            self.conn.commit()
+            self.conn_backup.commit()
+
+    # setup table
+    def setupEventTable(self,job,eventRangeList):
+        with self.lock:
+            self.makeTables()
+            # insert event ranges
+            self.insertRows(eventRangeList)
         # return
         return
 
 
     # setup table
     def setupJobsEventTable(self,jobs, eventRangeList):
-        # delete file just in case
-        try:
-            os.remove(self.dsFileName)
-            os.remove(self.dsFileName_backup)
-        except:
-            pass
-        # make connection
-        self.conn = sqlite3.connect(self.dsFileName)
-        # make cursor
-        self.cur = self.conn.cursor()
-        self.cur.execute('''PRAGMA journal_mode = OFF''')
-
-        self.conn_backup = sqlite3.connect(self.dsFileName_backup)
-        self.cur_backup = self.conn_backup.cursor()
-        self.cur_backup.execute('''PRAGMA journal_mode = OFF''')
-
-        # make event table
-        sqlM  = "CREATE TABLE JEDI_Events("
-        sqlM += "eventRangeID text,"
-        sqlM += "startEvent integer,"
-        sqlM += "lastEvent integer,"
-        sqlM += "LFN text,"
-        sqlM += "GUID text,"
-        sqlM += "scope text,"
-        sqlM += "status text,"
-        sqlM += "todump integer,"
-        sqlM += "output text,"
-        sqlM  = sqlM[:-1]
-        sqlM += ")"
-        self.cur.execute(sqlM)
-        self.cur_backup.execute(sqlM)
-
-        # insert event ranges
-        sqlI  = "INSERT INTO JEDI_Events ("
-        sqlI += "eventRangeID,"
-        sqlI += "startEvent,"
-        sqlI += "lastEvent,"
-        sqlI += "LFN,"
-        sqlI += "GUID,"
-        sqlI += "scope,"
-        sqlI += "status,"
-        sqlI += "todump,"
-        sqlI  = sqlI[:-1]
-        sqlI += ") "
-        sqlI += "VALUES("
-        sqlI += ":eventRangeID,"
-        sqlI += ":startEvent,"
-        sqlI += ":lastEvent,"
-        sqlI += ":LFN,"
-        sqlI += ":GUID,"
-        sqlI += ":scope,"
-        sqlI += ":status,"
-        sqlI += ":todump,"
-        sqlI  = sqlI[:-1]
-        sqlI += ")"
-        for jobid in eventRangeList:
-            for tmpDict in eventRangeList[jobid]:
-                tmpDict['status'] = 'ready'
-                tmpDict['todump'] = 0
-                self.cur.execute(sqlI,tmpDict)
-                self.cur_backup.execute(sqlI,tmpDict)
-        self.conn.commit()
-        self.conn_backup.commit()
+        with self.lock:
+            self.makeTables()
+            # insert event ranges
+            rows = []
+            for jobid in eventRangeList:
+                rows.extend(eventRangeList[jobid])
+            self.insertRows(rows)
         # return
         return
 
 
     def insertEventRanges(self, eventRanges):
-        # make connection
-        self.conn = sqlite3.connect(self.dsFileName)
-        # make cursor
-        self.cur = self.conn.cursor()
-
-        self.conn_backup = sqlite3.connect(self.dsFileName_backup)
-        self.cur_backup = self.conn_backup.cursor()
-
-        # insert event ranges
-        sqlI  = "INSERT INTO JEDI_Events ("
-        sqlI += "eventRangeID,"
-        sqlI += "startEvent,"
-        sqlI += "lastEvent,"
-        sqlI += "LFN,"
-        sqlI += "GUID,"
-        sqlI += "scope,"
-        sqlI += "status,"
-        sqlI += "todump,"
-        sqlI  = sqlI[:-1]
-        sqlI += ") "
-        sqlI += "VALUES("
-        sqlI += ":eventRangeID,"
-        sqlI += ":startEvent,"
-        sqlI += ":lastEvent,"
-        sqlI += ":LFN,"
-        sqlI += ":GUID,"
-        sqlI += ":scope,"
-        sqlI += ":status,"
-        sqlI += ":todump,"
-        sqlI  = sqlI[:-1]
-        sqlI += ")"
-        for tmpDict in eventRanges:
-            tmpDict['status'] = 'ready'
-            tmpDict['todump'] = 0
-            self.cur.execute(sqlI,tmpDict)
-            self.cur_backup.execute(sqlI,tmpDict)
-        self.conn.commit()
-        self.conn_backup.commit()
+        with self.lock:
+            # make connection
+            self.connect()
+            # insert event ranges
+            self.insertRows(eventRanges)
 
 
     def insertJobsEventRanges(self, eventRanges):
-        # make connection
-        self.conn = sqlite3.connect(self.dsFileName)
-        # make cursor
-        self.cur = self.conn.cursor()
-
-        self.conn_backup = sqlite3.connect(self.dsFileName_backup)
-        self.cur_backup = self.conn_backup.cursor()
-
-        # insert event ranges
-        sqlI  = "INSERT INTO JEDI_Events ("
-        sqlI += "eventRangeID,"
-        sqlI += "startEvent,"
-        sqlI += "lastEvent,"
-        sqlI += "LFN,"
-        sqlI += "GUID,"
-        sqlI += "scope,"
-        sqlI += "status,"
-        sqlI += "todump,"
-        sqlI  = sqlI[:-1]
-        sqlI += ") "
-        sqlI += "VALUES("
-        sqlI += ":eventRangeID,"
-        sqlI += ":startEvent,"
-        sqlI += ":lastEvent,"
-        sqlI += ":LFN,"
-        sqlI += ":GUID,"
-        sqlI += ":scope,"
-        sqlI += ":status,"
-        sqlI += ":todump,"
-        sqlI  = sqlI[:-1]
-        sqlI += ")"
-        for jobId in eventRanges:
-            for tmpDict in eventRanges[jobId]:
-                tmpDict['status'] = 'ready'
-                tmpDict['todump'] = 0
-                self.cur.execute(sqlI,tmpDict)
-                self.cur_backup.execute(sqlI,tmpDict)
-        self.conn.commit()
-        self.conn_backup.commit()
+        with self.lock:
+            # make connection
+            self.connect()
+            # insert event ranges
+            rows = []
+            for jobId in eventRanges:
+                rows.extend(eventRanges[jobId])
+            self.insertRows(rows)
 
 
     # get event ranges
     def getEventRanges(self,nRanges):
-        # make connection
-        self.conn = sqlite3.connect(self.dsFileName)
-        # make cursor
-        self.cur = self.conn.cursor()
-
         # sql to get event range
-        sqlI  = "SELECT "
-        sqlI += "eventRangeID,"
-        sqlI += "startEvent,"
-        sqlI += "lastEvent,"
-        sqlI += "LFN,"
-        sqlI += "GUID,"
-        sqlI += "scope,"
-        sqlI  = sqlI[:-1]
-        sqlI += " FROM JEDI_Events WHERE status=:status ORDER BY rowid "
-        # sql to update event range
-        sqlU  = "UPDATE JEDI_Events SET status=:status WHERE eventRangeID=:eventRangeID "
-        # get event ranges
-        varMap = {}
-        varMap['status'] = 'ready'
-        self.cur.execute(sqlI,varMap)
-        retRanges = []
-        for i in range(nRanges):
-            # get one row
-            tmpRet = self.cur.fetchone()
-            if tmpRet == None:
-                break
-            eventRangeID,startEvent,lastEvent,LFN,GUID,scope = tmpRet
-            tmpDict = {}
-            tmpDict['eventRangeID'] = eventRangeID
-            tmpDict['startEvent']   = startEvent
-            tmpDict['lastEvent']    = lastEvent
-            tmpDict['LFN']          = LFN
-            tmpDict['GUID']         = GUID
-            tmpDict['scope']        = scope
-            ## update status
-            #varMap = {}
-            #varMap['eventRangeID'] = eventRangeID
-            #varMap['status'] = 'running'
-            #self.cur.execute(sqlU,varMap)
-            #should not update cursor here. otherwise next fetchone will return None
-            # append
-            retRanges.append(tmpDict)
-        for retRange in retRanges:
+        sqlS  = "SELECT "
+        sqlS += "eventRangeID,"
+        sqlS += "startEvent,"
+        sqlS += "lastEvent,"
+        sqlS += "LFN,"
+        sqlS += "GUID,"
+        sqlS += "scope,"
+        sqlS  = sqlS[:-1]
+        sqlS += " FROM JEDI_Events WHERE status=:status ORDER BY rowid LIMIT :nRanges "
+        with self.lock:
+            # make connection
+            self.connect()
+            # get event ranges
             varMap = {}
-            varMap['eventRangeID'] = retRange['eventRangeID']
-            varMap['status'] = 'running'
-            self.cur.execute(sqlU,varMap)
-        self.conn.commit()
+            varMap['status'] = 'ready'
+            varMap['nRanges'] = nRanges
+            self.cur.execute(sqlS,varMap)
+            retRanges = []
+            for eventRangeID,startEvent,lastEvent,LFN,GUID,scope in self.cur.fetchall():
+                tmpDict = {}
+                tmpDict['eventRangeID'] = eventRangeID
+                tmpDict['startEvent']   = startEvent
+                tmpDict['lastEvent']    = lastEvent
+                tmpDict['LFN']          = LFN
+                tmpDict['GUID']         = GUID
+                tmpDict['scope']        = scope
+                # append
+                retRanges.append(tmpDict)
+            # update status
+            self.setEventRangesStatus([retRange['eventRangeID'] for retRange in retRanges], 'running')
         # return list
         #return json.dumps(retRanges)
         return retRanges
 
 
+    # set the status of several event ranges in one transaction
+    def setEventRangesStatus(self, eventRangeIDs, eventStatus):
+        sqlU = "UPDATE JEDI_Events SET status=? WHERE eventRangeID=? "
+        with self.lock:
+            # make connection
+            self.connect()
+            self.cur.executemany(sqlU, [(eventStatus, eventRangeID) for eventRangeID in eventRangeIDs])
+            self.conn.commit()
+        return
+
 
     # update event range
     def updateEventRange(self,eventRangeID,eventStatus, output):
-        # make connection
-        self.conn = sqlite3.connect(self.dsFileName)
-        # make cursor
-        self.cur = self.conn.cursor()
-
         sql = "UPDATE JEDI_Events SET status=:status,todump=:todump, output=:output WHERE eventRangeID=:eventRangeID "
         varMap = {}
         varMap['eventRangeID'] = eventRangeID
         varMap['status']       = eventStatus
         varMap['todump']       = 1
         varMap['output']       = output
-        self.cur.execute(sql,varMap)
-        self.conn.commit()
+        with self.lock:
+            # make connection
+            self.connect()
+            self.cur.execute(sql,varMap)
+            self.conn.commit()
         return
 
 
 
-    # update event range
+    # update event ranges, a list of (eventRangeID, eventStatus, output), in one transaction
     def updateEventRanges(self, eventRanges):
-        # make connection
-        self.conn = sqlite3.connect(self.dsFileName)
-        # make cursor
-        self.cur = self.conn.cursor()
-
         sql = "UPDATE JEDI_Events SET status=:status,todump=:todump, output=:output WHERE eventRangeID=:eventRangeID "
+        varMaps = []
         for eventRangeID,eventStatus,output in eventRanges:
             varMap = {}
             varMap['eventRangeID'] = eventRangeID
@@ -368,19 +272,18 @@ class Backend:
             else:
                 varMap['todump']       = 0
                 varMap['output']       = ''
-            self.cur.execute(sql,varMap)
-        self.conn.commit()
+            varMaps.append(varMap)
+        with self.lock:
+            # make connection
+            self.connect()
+            self.cur.executemany(sql,varMaps)
+            self.conn.commit()
         return
 
 
 
     # dump updated records
     def dumpUpdates(self,forceDump=False):
-        # make connection
-        self.conn = sqlite3.connect(self.dsFileName)
-        # make cursor
-        self.cur = self.conn.cursor()
-
         timeNow = datetime.datetime.utcnow()
         # forced or first dump or enough interval
         if forceDump or self.dumpedTime == None or \
@@ -389,28 +292,32 @@ class Backend:
             sqlG = "SELECT eventRangeID,status,output FROM JEDI_Events WHERE todump=:todump "
             # sql to reset flag
             sqlR = "UPDATE JEDI_Events SET todump=:todump WHERE eventRangeID=:eventRangeID AND status=:status"
-            # get event ranges to be dumped
-            varMap = {}
-            varMap['todump'] = 1
-            self.cur.execute(sqlG,varMap)
-            # dump
-            res = self.cur.fetchall()
-            if len(res) > 0:
-                outFileName = timeNow.strftime("%Y-%m-%d-%H-%M-%S") + '.dump'
-                outFileName = os.path.join(self.workingDir, outFileName)
-                outFile = open(outFileName,'w')
-                for eventRangeID,status,output in res:
-                    outFile.write('{0} {1} {2}\n'.format(eventRangeID,status,output))
-                    # reset flag
-                    varMap = {}
-                    varMap['todump'] = 0
-                    varMap['status'] = status
-                    varMap['eventRangeID'] = eventRangeID
-                    self.cur.execute(sqlR,varMap)
-                outFile.close()
-            self.conn.commit()
+            with self.lock:
+                # make connection
+                self.connect()
+                # get event ranges to be dumped
+                varMap = {}
+                varMap['todump'] = 1
+                self.cur.execute(sqlG,varMap)
+                # dump
+                res = self.cur.fetchall()
+                if len(res) > 0:
+                    outFileName = timeNow.strftime("%Y-%m-%d-%H-%M-%S") + '.dump'
+                    outFileName = os.path.join(self.workingDir, outFileName)
+                    outFile = open(outFileName,'w')
+                    varMaps = []
+                    for eventRangeID,status,output in res:
+                        outFile.write('{0} {1} {2}\n'.format(eventRangeID,status,output))
+                        # reset flag
+                        varMap = {}
+                        varMap['todump'] = 0
+                        varMap['status'] = status
+                        varMap['eventRangeID'] = eventRangeID
+                        varMaps.append(varMap)
+                    outFile.close()
+                    self.cur.executemany(sqlR,varMaps)
+                self.conn.commit()
             # update timestamp
             self.dumpedTime = timeNow
         # return
         return
- 
@@ -0,0 +1,134 @@
+import ast
+import os
+import time
+
+# Append-only event status log of a Yoda job (<jobId>_event_status.dump[.type]) with the matching POOL-style metadata
+# XML. Each record is one line "<jobId> <eventRangeID> <status> <output>", the same line format as the former full
+# dump, so the log can be read by the former readers as well. New records are appended to the log and inserted
+# before the closing tag of the metadata XML; at checkpoints the log is synced and the metadata XML is rewritten from
+# the log into a temporary file, which is renamed atomically (repairing a torn XML append after a crash).
+# A torn record at the end of the log (Yoda killed during the write) is ignored by readEventStatusLog().
+
+XMLHEADER = '<?xml version="1.0" encoding="UTF-8" standalone="no" ?>\n' \
+            '<!-- Edited By POOL -->\n' \
+            '<!DOCTYPE POOLFILECATALOG SYSTEM "InMemory">\n' \
+            '<POOLFILECATALOG>\n'
+XMLTRAILER = '</POOLFILECATALOG>\n'
+
+
+class EventStatusLog(object):
+    # default settings
+    CHECKPOINTINTERVAL = 3600              # seconds between two checkpoints
+
+    def __init__(self, jobId, fileName, metadataFileName=None, checkpointInterval=CHECKPOINTINTERVAL):
+        self.jobId = str(jobId)
+        self.fileName = fileName
+        self.metadataFileName = metadataFileName
+        self.checkpointInterval = checkpointInterval
+        self.count = 0                     # number of records written by this object
+        self.lastCheckpoint = None
+        self.xmlOffset = None              # offset of the closing tag in the metadata XML
+
+        # a new log is started for every Yoda run (as the former full dump did)
+        self.logFile = open(fileName, 'w')
+
+    # append records (eventRangeID, status, output) to the log and the metadata XML
+    def append(self, outputs):
+        if not outputs:
+            return
+        lines = []
+        entries = []
+        for eventRangeID, status, output in outputs:
+            lines.append('{0} {1} {2} {3}\n'.format(self.jobId, str(eventRangeID), str(status), str(output)))
+            entries.append(formatMetadataEntry(eventRangeID, status, output))
+        self.logFile.write(''.join(lines))
+        self.logFile.flush()
+        self.count += len(outputs)
+
+        if self.metadataFileName:
+            if self.xmlOffset is None or self.lastCheckpoint is None or \
+               time.time() - self.lastCheckpoint > self.checkpointInterval:
+                self.checkpoint()
+            else:
+                # overwrite the closing tag
+                data = ''.join(entries)
+                metafd = open(self.metadataFileName, 'r+')
+                try:
+                    metafd.seek(self.xmlOffset)
+                    metafd.write(data + XMLTRAILER)
+                    metafd.truncate()
+                finally:
+                    metafd.close()
+                self.xmlOffset += len(data)
+
+    # sync the log and rewrite the metadata XML from the log (atomic rename)
+    def checkpoint(self):
+        self.logFile.flush()
+        os.fsync(self.logFile.fileno())
+        self.lastCheckpoint = time.time()
+        if not self.metadataFileName:
+            return
+
+        tmpName = self.metadataFileName + '.new'
+        metafd = open(tmpName, 'w')
+        try:
+            metafd.write(XMLHEADER)
+            for jobId, eventRangeID, status, output in readEventStatusLog(self.fileName):
+                metafd.write(formatMetadataEntry(eventRangeID, status, output))
+            self.xmlOffset = metafd.tell()
+            metafd.write(XMLTRAILER)
+        finally:
+            metafd.close()
+        os.rename(tmpName, self.metadataFileName)
+
+    def close(self):
+        self.checkpoint()
+        self.logFile.close()
+
+
+# the metadata XML entry of an event range
+def formatMetadataEntry(eventRangeID, status, output):
+    status = str(status)
+    if status.startswith("ERR"):
+        status = 'failed'
+    # outputs that were lists are written as their string representation to the log
+    if isinstance(output, basestring) and output[:1] in ('[', '('):
+        try:
+            output = ast.literal_eval(output)
+        except (ValueError, SyntaxError):
+            pass
+    entry = '  <File EventRangeID="%s" Status="%s">\n' % (eventRangeID, status)
+    entry += "    <physical>\n"
+    if isinstance(output, (list, tuple)):
+        pfns = output
+    else:
+        pfns = output.split(",")[:-3]
+    for output1 in pfns:
+        entry += '      <pfn filetype="ROOT_All" name="%s"/>\n' % (str(output1))
+    entry += "    </physical>\n"
+    entry += "  </File>\n"
+    return entry
+
+
+# stream the records (jobId, eventRangeID, status, output) of an event status log
+def readEventStatusLog(fileName):
+    for offset, record in readEventStatusLogFrom(fileName):
+        yield record
+
+
+# stream the records of an event status log from the given offset (the start of a record) as (end offset, record)
+def readEventStatusLogFrom(fileName, offset=0):
+    logFile = open(fileName)
+    try:
+        logFile.seek(offset)
+        for line in logFile:
+            if not line.endswith('\n'):
+                # torn record at the end of the log (or a record being appended)
+                break
+            offset += len(line)
+            items = line[:-1].split(" ", 3)
+            if len(items) < 4:
+                continue
+            yield offset, tuple(items)
+    finally:
+        logFile.close()
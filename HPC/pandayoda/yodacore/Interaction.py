@@ -5,23 +5,35 @@ import json
 import time
 import urllib
 import Queue
+import threading
 import traceback
+from collections import deque
 
 recvQueue = Queue.Queue()
 sendQueue = Queue.Queue()
 
+# response queues of simulated ranks in non-MPI mode
+localRecvQueues = {}
+
+# tag of the message which stops the MPI receiver thread
+STOP_TAG = 32767
+
+# give up if no request is received for this time
+MAX_IDLE_TIME = 40 * 60
+
 
 # class to receive requests
 class Receiver:
 
     # constructor
-    def __init__(self, rank=None, nonMPIMode=False, logger=None):
+    def __init__(self, rank=None, nonMPIMode=False, logger=None, maxCoalesce=1000):
         if nonMPIMode:
             self.comm = None
             self.stat = None
             self.nRank = 0
             self.totalRanks = 1
             self.selectSource = None
+            self.threadMode = False
         else:
             from mpi4py import MPI
             self.comm = MPI.COMM_WORLD
@@ -29,6 +41,9 @@ class Receiver:
             self.nRank = self.comm.Get_rank()
             self.totalRanks = self.comm.Get_size()
             self.selectSource = MPI.ANY_SOURCE
+            # a receiver thread can only do blocking receives while the main thread sends the responses
+            # if MPI is initialized with full thread support, otherwise Iprobe is polled with a backoff
+            self.threadMode = MPI.Query_thread() == MPI.THREAD_MULTIPLE
 
         self.logger = logger
 
@@ -37,88 +52,158 @@ class Receiver:
         self.recvQueue = recvQueue
         self.sendQueue = sendQueue
 
+        # requests which have been received but not yet served, FORMAT: deque([(source rank or None for rank 0, request), ..])
+        self.pendingRequests = deque()
+        # max number of requests taken in one wake-up
+        self.maxCoalesce = maxCoalesce
+        # source rank of the request being served (None for a request from rank 0 itself)
+        self.source = None
+
+        # statistics: number of wake-ups and of requests served
+        self.numWakeups = 0
+        self.numRequests = 0
+
+        self.stopEvent = threading.Event()
+        self.receiverThread = None
+        self.tickThread = threading.Thread(target=self.tick, name="ReceiverTick")
+        self.tickThread.setDaemon(True)
+        self.tickThread.start()
+        if self.threadMode:
+            self.receiverThread = threading.Thread(target=self.receiveMPIRequests, name="ReceiverMPI")
+            self.receiverThread.setDaemon(True)
+            self.receiverThread.start()
+
 
     # get rank of itself
     def getRank(self):
         return self.comm.Get_rank() if self.comm else self.nRank
 
 
-    # receive request
-    def receiveRequest(self):
-        # wait for a request from any ranks
-        t1 = time.time()
-        self.hasMessage = False
-        if self.comm:
-            while not self.comm.Iprobe(source=self.selectSource,
-                                       status=self.stat):
-                if not self.recvQueue.empty():
-                    self.hasMessage = True
-                    break
-                time.sleep(0.0001)
-                if (time.time() - t1) > 40 * 60:
-                    # waiting too log, should quit.
-                    errMsg = 'No messages received for 40 minutes. quit'
-                    return False,errMsg,None
-        else:
-            while self.recvQueue.empty():
-                time.sleep(0.0001)
-                if (time.time() - t1) > 40 * 60:
-                    # waiting too log, should quit.
-                    errMsg = 'No messages received for 40 minutes. quit'
-                    return False,errMsg,None
-            self.hasMessage = True
-
-        if self.hasMessage:
+    # receiver thread: blocking receives from all ranks, the requests are put in the request queue
+    def receiveMPIRequests(self):
+        from mpi4py import MPI
+        status = MPI.Status()
+        while True:
             try:
-                reqData = self.recvQueue.get()
-                # self.stat.Set_source(0)
-                data = json.loads(reqData)
-                return True,data['method'],data['params']
+                reqData = self.comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
             except:
-                errtype,errvalue = sys.exc_info()[:2]
-                errMsg = 'failed to got proper request with: %s' % traceback.format_exc()
-                return False,errMsg,None
+                if self.logger:
+                    self.logger.error('failed to receive request: %s' % traceback.format_exc())
+                self.recvQueue.put(None)
+                break
+            if status.Get_tag() == STOP_TAG and status.Get_source() == self.nRank:
+                break
+            self.recvQueue.put((status.Get_source(), reqData))
+
+
+    # wake up the receiver every minute to check for the idle time, without a timeout on the blocking wait
+    def tick(self):
+        while not self.stopEvent.isSet():
+            time.sleep(60)
+            self.recvQueue.put(None)
+
+
+    # add a request from the request queue to the pending requests
+    def addRequest(self, item):
+        if item == None:
+            # tick
+            return False
+        if isinstance(item, tuple):
+            self.pendingRequests.append(item)
         else:
-            try:
-                # get the request
-                # reqData = self.comm.recv(source=self.selectSource, status=self.stat)
-                reqData = self.comm.recv(source=self.stat.Get_source())
-                # decode
-                data = json.loads(reqData)
-                return True,data['method'],data['params']
-            except:
-                errtype,errvalue = sys.exc_info()[:2]
-                errMsg = 'failed to got proper request with: %s' % traceback.format_exc()
+            self.pendingRequests.append((None, item))
+        return True
+
+
+    # wait until at least one request is available, then take all available requests (up to maxCoalesce)
+    def waitRequests(self):
+        t1 = time.time()
+        if self.comm and not self.threadMode:
+            sleepTime = 0.0001
+            while True:
+                while len(self.pendingRequests) < self.maxCoalesce:
+                    try:
+                        self.addRequest(self.recvQueue.get_nowait())
+                    except Queue.Empty:
+                        break
+                while len(self.pendingRequests) < self.maxCoalesce and \
+                        self.comm.Iprobe(source=self.selectSource, status=self.stat):
+                    source = self.stat.Get_source()
+                    self.pendingRequests.append((source, self.comm.recv(source=source)))
+                if self.pendingRequests:
+                    break
+                if (time.time() - t1) > MAX_IDLE_TIME:
+                    return False
+                # back off while idle, up to 10 ms
+                time.sleep(sleepTime)
+                sleepTime = min(sleepTime * 2, 0.01)
+        else:
+            while True:
+                # blocking wait on the queue condition, no polling
+                if self.addRequest(self.recvQueue.get()):
+                    break
+                if (time.time() - t1) > MAX_IDLE_TIME:
+                    return False
+            while len(self.pendingRequests) < self.maxCoalesce:
+                try:
+                    self.addRequest(self.recvQueue.get_nowait())
+                except Queue.Empty:
+                    break
+        self.numWakeups += 1
+        return True
+
+
+    # receive request
+    def receiveRequest(self):
+        # wait for a request from any ranks
+        if not self.pendingRequests:
+            if not self.waitRequests():
+                # waiting too log, should quit.
+                errMsg = 'No messages received for 40 minutes. quit'
                 return False,errMsg,None
 
+        self.source, reqData = self.pendingRequests.popleft()
+        # the response goes back via the local queue if the request came from it
+        self.hasMessage = self.source == None or self.comm == None
+        self.numRequests += 1
+        try:
+            # decode
+            data = json.loads(reqData)
+            return True,data['method'],data['params']
+        except:
+            errtype,errvalue = sys.exc_info()[:2]
+            errMsg = 'failed to got proper request with: %s' % traceback.format_exc()
+            return False,errMsg,None
+
 
     # return response 
     def returnResponse(self,rData):
-        if self.hasMessage:
-            try:
-                #data = urllib.urlencode(rData)
-                data = json.dumps(rData)
+        try:
+            #data = urllib.urlencode(rData)
+            data = json.dumps(rData)
+            if self.source == None:
                 self.sendQueue.put(data)
-                return True,None
-            except:
-                errtype,errvalue = sys.exc_info()[:2]
-                errMsg = 'failed to retrun response with: %s' % traceback.format_exc()
-                return False,errMsg,None
-        else:
-            try:
-                #data = urllib.urlencode(rData)
-                data = json.dumps(rData)
-                self.comm.send(data,dest=self.stat.Get_source())
-                return True,None
-            except:
-                errtype,errvalue = sys.exc_info()[:2]
-                errMsg = 'failed to retrun response with: %s' % traceback.format_exc()
-                return False,errMsg,None
+            elif self.comm == None:
+                localRecvQueues[self.source].put(data)
+            else:
+                self.comm.send(data,dest=self.source)
+            return True,None
+        except:
+            errtype,errvalue = sys.exc_info()[:2]
+            errMsg = 'failed to retrun response with: %s' % traceback.format_exc()
+            return False,errMsg,None
 
 
     # get rank of the requester
     def getRequesterRank(self):
-        return self.stat.Get_source() if self.stat else self.nRank
+        return self.source if self.source != None else self.nRank
+
+
+    # get the average number of requests served per wake-up
+    def getCoalescing(self):
+        if self.numWakeups == 0:
+            return 0.0
+        return float(self.numRequests) / self.numWakeups
 
         
     # decrement nRank
@@ -139,8 +224,12 @@ class Receiver:
         try:
             #data = urllib.urlencode(rData)
             data = json.dumps(rData)
-            for i in range(1, self.totalRanks):
-                self.comm.send(data,dest=i)
+            if self.comm:
+                for i in range(1, self.totalRanks):
+                    self.comm.send(data,dest=i)
+            else:
+                for localQueue in localRecvQueues.values():
+                    localQueue.put(data)
             self.sendQueue.put(data)
             return True,None
         except:
@@ -149,8 +238,21 @@ class Receiver:
             return False,errMsg,None
 
 
+    # stop the receiver and tick threads
+    def stop(self):
+        self.stopEvent.set()
+        if self.receiverThread and self.receiverThread.isAlive():
+            try:
+                self.comm.send(None, dest=self.nRank, tag=STOP_TAG)
+                self.receiverThread.join(10)
+            except:
+                if self.logger:
+                    self.logger.debug('failed to stop receiver thread: %s' % traceback.format_exc())
+
+
     def disconnect(self):
         try:
+            self.stop()
             self.comm.Disconnect()
             return True,None
         except:
@@ -179,6 +281,14 @@ class Requester:
         self.recvQueue = sendQueue
         self.sendQueue = recvQueue
 
+        # in non-MPI mode, a requester with a rank other than 0 simulates a remote rank (used for testing):
+        # it gets its own response queue and the Receiver returns the responses to it
+        self.localRank = None
+        if self.nonMPIMode and rank:
+            self.localRank = rank
+            self.recvQueue = Queue.Queue()
+            localRecvQueues[rank] = self.recvQueue
+
     # get rank of itself
     def getRank(self):
         if self.nonMPIMode:
@@ -193,7 +303,9 @@ class Requester:
             data = {'method':method,
                     'params':params}
             reqData = json.dumps(data)
-            if self.getRank() == 0:
+            if self.localRank:
+                self.sendQueue.put((self.localRank, reqData))
+            elif self.getRank() == 0:
                 self.sendQueue.put(reqData)
             else:
                 # send a request ro rank0
@@ -11,11 +11,13 @@ import traceback
 import threading
 import pickle
 import signal
+from collections import deque
 from os.path import abspath as _abspath, join as _join
 
 # logging.basicConfig(filename='Yoda.log', level=logging.DEBUG)
 
 import Interaction,Database,Logger
+from EventStatusLog import EventStatusLog
 from signal_block.signal_block import block_sig, unblock_sig
 #from HPC import EventServer
 
@@ -96,6 +98,7 @@ class Yoda(threading.Thread):
         self.runningJobsEventRanges = {}
         self.finishedJobsEventRanges = {}
         self.stagedOutJobsEventRanges = {}
+        self.eventStatusLogs = {}
 
         self.updateEventRangesToDBTime = None
 
@@ -273,7 +276,10 @@ class Yoda(threading.Thread):
             tmpFile.close()
             # setup database
             # self.db.setupJobsEventTable(self.jobs,eventRangeList)
-            self.readyJobsEventRanges = eventRangeList
+            # ready event ranges are dispatched from the left of a deque per job
+            self.readyJobsEventRanges = {}
+            for jobId in eventRangeList:
+                self.readyJobsEventRanges[jobId] = deque(eventRangeList[jobId])
             for jobId in self.readyJobsEventRanges:
                 self.runningJobsEventRanges[jobId] = {}
                 self.finishedJobsEventRanges[jobId] = []
@@ -333,8 +339,7 @@ class Yoda(threading.Thread):
                     tmpFile.close()
                     self.insertJobsEventRanges(eventRangeList)
                     for jobId in eventRangeList:
-                        for eventRange in eventRangeList[jobId]:
-                            self.readyJobsEventRanges[jobId].append(eventRange)
+                        self.readyJobsEventRanges[jobId].extend(eventRangeList[jobId])
             return True,None
         except:
             errtype,errvalue = sys.exc_info()[:2]
@@ -532,13 +537,12 @@ class Yoda(threading.Thread):
             nRanges = 1
         eventRanges = []
         try:
-            for i in range(nRanges):
-                if len(self.readyJobsEventRanges[jobId]) > 0:
-                    eventRange = self.readyJobsEventRanges[jobId].pop(0)
-                    eventRanges.append(eventRange)
-                    self.runningJobsEventRanges[jobId][eventRange['eventRangeID']] = eventRange
-                else:
-                    break
+            readyEventRanges = self.readyJobsEventRanges[jobId]
+            runningEventRanges = self.runningJobsEventRanges[jobId]
+            for i in range(min(nRanges, len(readyEventRanges))):
+                eventRange = readyEventRanges.popleft()
+                eventRanges.append(eventRange)
+                runningEventRanges[eventRange['eventRangeID']] = eventRange
         except:
             self.tmpLog.warning("Failed to get event ranges: %s" % traceback.format_exc())
             print self.readyJobsEventRanges
@@ -649,83 +653,42 @@ class Yoda(threading.Thread):
         except Exception as e:
             self.tmpLog.debug('updateRunningEventRangesToDB failed: %s, %s' % (str(e), traceback.format_exc()))
 
-    def dumpUpdates(self, jobId, outputs, type=''):
-        #if self.dumpEventOutputs == False:
-        #    return
-        timeNow = datetime.datetime.utcnow()
-        #outFileName = str(jobId) + "_" + timeNow.strftime("%Y-%m-%d-%H-%M-%S-%f") + '.dump' + type
-        outFileName = str(jobId) + "_event_status.dump" + type
-        outFileName = os.path.join(self.globalWorkingDir, outFileName)
-        outFile = open(outFileName + ".new", 'w')
-        self.tmpLog.debug("dumpUpdates: dumpFileName %s" % (outFileName))
-
-        metadataFileName = None
-        metafd = None
-        # if self.dumpEventOutputs:
-        if True:
+    def dumpUpdates(self, jobId, outputs, type='', final=False):
+        # append the new event range updates to the event status log of the job (outputs are removed once written)
+        key = (jobId, type)
+        if key not in self.eventStatusLogs:
+            outFileName = str(jobId) + "_event_status.dump" + type
+            outFileName = os.path.join(self.globalWorkingDir, outFileName)
             metadataFileName = 'metadata-' + os.path.basename(outFileName).split('.dump')[0] + '.xml'
             if self.outputDir:
                 metadataFileName = os.path.join(self.outputDir, metadataFileName)
             else:
                 metadataFileName = os.path.join(self.globalWorkingDir, metadataFileName)
-
-
-            self.tmpLog.debug("dumpUpdates: outputDir %s, metadataFileName %s" % (self.outputDir, metadataFileName))
-            metafd = open(metadataFileName + ".new", "w")
-            metafd.write('<?xml version="1.0" encoding="UTF-8" standalone="no" ?>\n')
-            metafd.write("<!-- Edited By POOL -->\n")
-            metafd.write('<!DOCTYPE POOLFILECATALOG SYSTEM "InMemory">\n')
-            metafd.write("<POOLFILECATALOG>\n")
-
-        for eventRangeID,status,output in outputs:
-            outFile.write('{0} {1} {2} {3}\n'.format(str(jobId), str(eventRangeID), str(status), str(output)))
-
-            if status.startswith("ERR"):
-                status = 'failed'
-
-            if metafd:
-                metafd.write('  <File EventRangeID="%s" Status="%s">\n' % (eventRangeID, status))
-                metafd.write("    <physical>\n")
-                if isinstance(output, (list, tuple)):
-                    for output1 in output:
-                        metafd.write('      <pfn filetype="ROOT_All" name="%s"/>\n' % (str(output1)))
-                else:
-                    for output1 in output.split(",")[:-3]:
-                        metafd.write('      <pfn filetype="ROOT_All" name="%s"/>\n' % (str(output1)))
-                metafd.write("    </physical>\n")
-                metafd.write("  </File>\n")
-
-        outFile.close()
-        if metafd:
-            metafd.write("</POOLFILECATALOG>\n")
-            metafd.close()
-
-        # mv the new file to overwrite the current one
-        command = "mv %s.new %s" % (outFileName, outFileName)
-        retS, retOut = commands.getstatusoutput(command)
-        if retS:
-            self.tmpLog.debug('Failed to execute %s: %s' % (command, retOut))
-
-        if metadataFileName:
-            command = "mv %s.new %s" % (metadataFileName, metadataFileName)
-            retS, retOut = commands.getstatusoutput(command)
-            if retS:
-                self.tmpLog.debug('Failed to execute %s: %s' % (command, retOut))
-
-    def updateFinishedEventRangesToDB(self):
+            self.tmpLog.debug("dumpUpdates: dumpFileName %s, outputDir %s, metadataFileName %s" % (outFileName, self.outputDir, metadataFileName))
+            self.eventStatusLogs[key] = EventStatusLog(jobId, outFileName, metadataFileName)
+        eventStatusLog = self.eventStatusLogs[key]
+
+        # new updates can be appended by other threads while the log is written
+        n = len(outputs)
+        eventStatusLog.append(outputs[:n])
+        del outputs[:n]
+        if final:
+            eventStatusLog.checkpoint()
+
+    def updateFinishedEventRangesToDB(self, final=False):
         try:
             self.tmpLog.debug('start to updateFinishedEventRangesToDB')
 
             for jobId in self.stagedOutJobsEventRanges:
-                if len(self.stagedOutJobsEventRanges[jobId]):
-                    self.dumpUpdates(jobId, self.stagedOutJobsEventRanges[jobId], type='.stagedOut')
+                if len(self.stagedOutJobsEventRanges[jobId]) or final:
+                    self.dumpUpdates(jobId, self.stagedOutJobsEventRanges[jobId], type='.stagedOut', final=final)
                     #for i in self.stagedOutJobsEventRanges[jobId]:
                     #    self.stagedOutJobsEventRanges[jobId].remove(i)
                     #self.stagedOutJobsEventRanges[jobId] = []
 
             for jobId in self.finishedJobsEventRanges:
-                if len(self.finishedJobsEventRanges[jobId]):
-                    self.dumpUpdates(jobId, self.finishedJobsEventRanges[jobId])
+                if len(self.finishedJobsEventRanges[jobId]) or final:
+                    self.dumpUpdates(jobId, self.finishedJobsEventRanges[jobId], final=final)
                     #self.db.updateEventRanges(self.finishedEventRanges)
                     #for i in self.finishedJobsEventRanges[jobId]:
                     #    self.finishedJobsEventRanges[jobId].remove(i)
@@ -744,7 +707,7 @@ class Yoda(threading.Thread):
             self.updateEventRangesToDBTime = time.time()
             #if not final:
             #    self.updateRunningEventRangesToDB()
-            self.updateFinishedEventRangesToDB()
+            self.updateFinishedEventRangesToDB(final=final)
             self.tmpLog.debug('finished to updateEventRangesToDB')
 
 
@@ -761,7 +724,8 @@ class Yoda(threading.Thread):
         metricsReport = {}
         for rank in ranks.keys():
             for key in ranks[rank].keys():
-                if key in ["setupTime", "runningTime", 'totalTime', "cores", "queuedEvents", "processedEvents", "cpuConsumptionTime", 'avgTimePerEvent']:
+                if key in ["setupTime", "runningTime", 'totalTime', "cores", "queuedEvents", "processedEvents", "cpuConsumptionTime", 'avgTimePerEvent',
+                           "stagedFiles", "stagedBytes", "stagingTime", "stagingThroughput"]:
                     if key not in metrics:
                         metrics[key] = 0
                     metrics[key] += ranks[rank][key]
@@ -799,6 +763,11 @@ class Yoda(threading.Thread):
         metricsReport['totalQueuedEvents'] = metrics['queuedEvents']
         metricsReport['totalProcessedEvents'] = metrics['processedEvents']
         metricsReport['avgTimePerEvent'] = metrics['avgTimePerEvent']/ num_ranks
+        # staging metrics of the DroidStagers (the ranks stage out in parallel, the throughputs [MB/s] add up)
+        metricsReport['totalStagedFiles'] = metrics.get('stagedFiles', 0)
+        metricsReport['totalStagedBytes'] = metrics.get('stagedBytes', 0)
+        metricsReport['avgStagingTime'] = metrics.get('stagingTime', 0)/num_ranks
+        metricsReport['totalStagingThroughput'] = metrics.get('stagingThroughput', 0)
 
         for key in metricsReport:
             metricsReport[key] = int(metricsReport[key])
@@ -938,6 +907,8 @@ class Yoda(threading.Thread):
         self.tmpLog.info("post Exec job")
         self.postExecJob()
         self.finishDroids()
+        self.tmpLog.info('served %s requests in %s wake-ups (%.1f requests per wake-up)' % (self.comm.numRequests, self.comm.numWakeups, self.comm.getCoalescing()))
+        self.comm.stop()
         self.tmpLog.info('done')
         
 
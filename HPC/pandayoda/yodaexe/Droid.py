@@ -362,6 +362,8 @@ class Droid(threading.Thread):
             processedEvents = 1
 
         metrics['avgTimePerEvent'] = metrics['totalTime'] * metrics['cores'] / processedEvents
+        if self.__stagerThread:
+            metrics.update(self.__stagerThread.getAccountingMetrics())
 
         return metrics
 
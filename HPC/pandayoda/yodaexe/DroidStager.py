@@ -1,5 +1,6 @@
 import commands
 import datetime
+import errno
 import json
 import logging
 import os
@@ -21,6 +22,7 @@ import pUtil
 from objectstoreSiteMover import objectstoreSiteMover
 from Mover import getInitialTracingReport
 from ThreadPool import ThreadPool
+from TarStreamWriter import TarStreamWriter
 
 class DroidStager(threading.Thread):
     def __init__(self, globalWorkingDir, localWorkingDir, outputs=None, job=None, esJobManager=None, outputDir=None, rank=None, logger=None):
@@ -51,6 +53,14 @@ class DroidStager(threading.Thread):
 
         self.__outputs = outputs
         self.__threadpool = None
+        self.__createdDirs = set()
+
+        # staging metrics (see getAccountingMetrics)
+        self.__metricsLock = threading.Lock()
+        self.__stagedFiles = 0
+        self.__stagedBytes = 0
+        self.__stagingStartTime = None
+        self.__stagingEndTime = None
         self.setup(job)
 
     def setup(self, job):
@@ -81,59 +91,59 @@ class DroidStager(threading.Thread):
                     self.__stageout_threads = self.__cores/8
                 self.__tmpLog.debug("Rank %s: start threadpool with %s threads" % (self.__rank, self.__stageout_threads))
                 self.__threadpool = ThreadPool(self.__stageout_threads)
+            elif not self.__yodaToZip:
+                # copies to the shared file system
+                copy_threads = int(job.get('copy_threads', 4))
+                if copy_threads > 1:
+                    self.__tmpLog.debug("Rank %s: start copy threadpool with %s threads" % (self.__rank, copy_threads))
+                    self.__threadpool = ThreadPool(copy_threads)
 
         except:
             self.__tmpLog.error("Failed to setup Droid stager: %s" % str(traceback.format_exc()))
 
-    def copyOutput(self, output, outputs):
+    def getStageOutFileName(self, filename):
         if self.__outputDir:
-            for filename in outputs:
-                #filename = output.split(",")[0]
-                base_filename = os.path.basename(filename)
-                new_file_name = os.path.join(self.__outputDir, base_filename)
-                is_copied = False
-                try:
-                    os.rename(filename, new_file_name)
-                    is_copied = True
-                except:
-                    self.__tmpLog.debug("Rank %s: failed to move output %s to %s, %s" % (self.__rank, filename, new_file_name, str(traceback.format_exc())))
-                    is_copied = False
-                if not is_copied:
-                    shutil.copy(filename, new_file_name)
-                    os.remove(filename)
-                output = output.replace(filename, new_file_name)
-            return 0, output
+            return os.path.join(self.__outputDir, os.path.basename(filename))
         elif self.__copyOutputToGlobal:
-            for filename in outputs:
-                #filename = output.split(",")[0]
-                base_filename = os.path.basename(filename)
-                new_file_name = os.path.join(self.__globalWorkingDir, base_filename)
-                is_copied = False
-                try:
-                    os.rename(filename, new_file_name)
-                    is_copied = True
-                except:
-                    self.__tmpLog.debug("Rank %s: failed to move output %s to %s, %s" % (self.__rank, filename, new_file_name, str(traceback.format_exc())))
-                    is_copied = False
-                if not is_copied:
-                    shutil.copy(filename, new_file_name)
-                    os.remove(filename)
-                output = output.replace(filename, new_file_name)
-            return 0, output
+            return os.path.join(self.__globalWorkingDir, os.path.basename(filename))
         else:
-            if self.__localWorkingDir == self.__globalWorkingDir:
-                return 0, output
+            return filename.replace(self.__localWorkingDir, self.__globalWorkingDir)
+
+    def makeDirs(self, dirname):
+        # the directories created (or found) are cached to avoid metadata operations on the shared file system
+        if dirname in self.__createdDirs:
+            return
+        try:
+            os.makedirs(dirname)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.__createdDirs.add(dirname)
+
+    def moveFile(self, filename, new_file_name):
+        self.makeDirs(os.path.dirname(new_file_name))
+        try:
+            os.rename(filename, new_file_name)
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                self.__tmpLog.debug("Rank %s: failed to move output %s to %s: %s" % (self.__rank, filename, new_file_name, e))
+            shutil.copyfile(filename, new_file_name)
+            os.remove(filename)
 
+    def copyOutput(self, output, outputs):
+        try:
             for filename in outputs:
-            #filename = output.split(",")[0]
-                new_file_name = filename.replace(self.__localWorkingDir, self.__globalWorkingDir)
-                dirname = os.path.dirname(new_file_name)
-                if not os.path.exists(dirname):
-                     os.makedirs (dirname)
-                shutil.copy(filename, new_file_name)
-                os.remove(filename)
+                #filename = output.split(",")[0]
+                new_file_name = self.getStageOutFileName(filename)
+                if new_file_name == filename:
+                    # the local working dir is the global working dir
+                    continue
+                self.moveFile(filename, new_file_name)
                 output = output.replace(filename, new_file_name)
-            return 0, output
+        except:
+            self.__tmpLog.warning("Rank %s: Droid throws exception when copying outputs: %s" % (self.__rank, traceback.format_exc()))
+            return -1, "Failed to copy outputs"
+        return 0, output
 
     def stageOutToOS(self, outputs):
         ret_status = 0
@@ -197,11 +207,34 @@ class DroidStager(threading.Thread):
             handler.close()
         return 0, outputs
 
+    def addStagingMetrics(self, nFiles, nBytes, startTime):
+        with self.__metricsLock:
+            self.__stagedFiles += nFiles
+            self.__stagedBytes += nBytes
+            if self.__stagingStartTime is None:
+                self.__stagingStartTime = startTime
+            self.__stagingEndTime = time.time()
+
+    def getAccountingMetrics(self):
+        with self.__metricsLock:
+            stagingTime = 0
+            if self.__stagingStartTime is not None:
+                stagingTime = self.__stagingEndTime - self.__stagingStartTime
+            throughput = 0
+            if stagingTime > 0:
+                throughput = self.__stagedBytes / stagingTime / 1024 / 1024
+            return {"stagedFiles": self.__stagedFiles,
+                    "stagedBytes": self.__stagedBytes,
+                    "stagingTime": stagingTime,
+                    "stagingThroughput": throughput}
+
     def stageOut(self, eventRangeID, eventStatus, output, retries=0):
         if eventStatus.startswith("ERR"):
             request = {"jobId": self.__jobId, "eventRangeID": eventRangeID, 'eventStatus': eventStatus, "output": output}
         else:
             outputs = output.split(",")[:-3]
+            startTime = time.time()
+            nBytes = sum([os.path.getsize(filename) for filename in outputs if os.path.exists(filename)])
             if self.__yodaToZip:
                 self.__tmpLog.debug("Rank %s: start to zip outputs: %s" % (self.__rank, outputs))
                 retStatus, retOutput = self.zipOutputs(eventRangeID, eventStatus, outputs)
@@ -233,26 +266,80 @@ class DroidStager(threading.Thread):
                 else:
                     self.__tmpLog.info("Rank %s: finished to copy outputs %s: %s" % (self.__rank, outputs, retOutput))
                     request = {"jobId": self.__jobId, "eventRangeID": eventRangeID, 'eventStatus': eventStatus, "output": retOutput}
+            if retStatus == 0:
+                self.addStagingMetrics(len(outputs), nBytes, startTime)
         if request:
             self.__outputs.put(request)
 
     def bulkZipOutputs(self, outputs):
+        # append the outputs of all event ranges to the zip file at once (one lock, one tar append and one write of the
+        # zip event range file per bulk instead of one tar command per output file)
+        fd = None
+        lockfile = None
+        # the requests keep the original event status if the outputs cannot be zipped
+        requests = {}
+        for i, outputMsg in enumerate(outputs):
+            try:
+                eventRangeID, eventStatus, output = outputMsg
+                requests[i] = {"jobId": self.__jobId, "eventRangeID": eventRangeID, 'eventStatus': eventStatus, "output": output}
+            except:
+                self.__tmpLog.warning("Rank %s: error message: %s" % (self.__rank, traceback.format_exc()))
+
         try:
             while True:
                 fd, lockfile = self.createAtomicLockFile(self.__zipFileName)
                 if fd:
                     break
                 time.sleep(0.1)
-            for outputMsg in outputs:
-                try:
-                    eventRangeID, eventStatus, output = outputMsg
-                    self.stageOut(eventRangeID, eventStatus, output, retries=0)
-                except:
-                    self.__tmpLog.warning("Rank %s: error message: %s" % (self.__rank, traceback.format_exc()))
+
+            startTime = time.time()
+            nBytes = 0
+            zipped = []
+            # a file that cannot be added is removed from the archive again (no partial members), the checksums are not
+            # needed here (the archive is appended to by all ranks and checksummed by the stage-out of the job)
+            tar = TarStreamWriter(self.__zipFileName, checksums=False)
+            try:
+                for i in sorted(requests.keys()):
+                    eventRangeID, eventStatus, output = outputs[i]
+                    if eventStatus.startswith("ERR"):
+                        continue
+                    # the outputs of an event range are added all or none, the outputs added before a failure are
+                    # removed from the archive again and the event range is reported as failed
+                    mark = tar.mark()
+                    try:
+                        files = output.split(",")[:-3]
+                        size = 0
+                        for filename in files:
+                            tar.add(filename)
+                            size += os.path.getsize(filename)
+                        nBytes += size
+                        zipped.append((i, eventRangeID, eventStatus, files))
+                    except:
+                        self.__tmpLog.warning("Rank %s: failed to zip outputs %s: %s" % (self.__rank, output, traceback.format_exc()))
+                        tar.rollback(mark)
+                        requests[i] = {"jobId": self.__jobId, "eventRangeID": eventRangeID, 'eventStatus': 'ERR_ZIP_OUTPUT', "output": output}
+            finally:
+                tar.close()
+
+            nFiles = 0
+            if zipped:
+                handler = open(self.__zipEventRangesName, "a")
+                handler.write("".join(["%s %s %s\n" % (eventRangeID, eventStatus, files) for (i, eventRangeID, eventStatus, files) in zipped]))
+                handler.close()
+                for i, eventRangeID, eventStatus, files in zipped:
+                    for filename in files:
+                        os.remove(filename)
+                    nFiles += len(files)
+                    requests[i] = {"jobId": self.__jobId, "eventRangeID": eventRangeID, 'eventStatus': 'zipped', "output": files}
+                self.addStagingMetrics(nFiles, nBytes, startTime)
+            self.__tmpLog.info("Rank %s: zipped %s outputs of %s event ranges to %s" % (self.__rank, nFiles, len(zipped), self.__zipFileName))
         except:
             self.__tmpLog.warning("Rank %s: error message: %s" % (self.__rank, traceback.format_exc()))
         finally:
-            self.releaseAtomicLockFile(fd, lockfile)
+            if fd:
+                self.releaseAtomicLockFile(fd, lockfile)
+            for i in sorted(requests.keys()):
+                self.__outputs.put(requests[i])
 
     def stop(self):
         self.__stop.set()
@@ -260,26 +347,42 @@ class DroidStager(threading.Thread):
     def isFinished(self):
         return self.__isFinished
 
+    def stageOutList(self, outputs):
+        for outputMsg in outputs:
+            try:
+                eventRangeID, eventStatus, output = outputMsg
+                self.stageOut(eventRangeID, eventStatus, output, retries=0)
+            except:
+                self.__tmpLog.warning("Rank %s: error message: %s" % (self.__rank, traceback.format_exc()))
+
+    def bulkStageOut(self, outputs):
+        if self.__yodaToZip:
+            self.bulkZipOutputs(outputs)
+        elif self.__threadpool and not self.__yodaToOS:
+            # copies: one task per copy thread for the bulk (a task per output costs more than a copy of a small file)
+            nThreads = len(self.__threadpool.workers)
+            for i in range(min(nThreads, len(outputs))):
+                self.__threadpool.add_task(self.stageOutList, outputs[i::nThreads])
+        else:
+            for outputMsg in outputs:
+                try:
+                    eventRangeID, eventStatus, output = outputMsg
+                    if self.__threadpool:
+                        self.__tmpLog.debug("Rank %s: add event output to threadpool: %s" % (self.__rank, outputMsg))
+                        self.__threadpool.add_task(self.stageOut, eventRangeID, eventStatus, output, retries=0)
+                    else:
+                        self.stageOut(eventRangeID, eventStatus, output, retries=0)
+                except:
+                    self.__tmpLog.warning("Rank %s: error message: %s" % (self.__rank, traceback.format_exc()))
+                    continue
+
     def run(self):
         while True:
             try:
                 outputs = self.__esJobManager.getOutputs()
                 if outputs:
                     self.__tmpLog.debug("Rank %s: getOutputs: %s" % (self.__rank, outputs))
-                    if self.__yodaToZip:
-                        self.bulkZipOutputs(outputs)
-                    else:
-                        for outputMsg in outputs:
-                            try:
-                                eventRangeID, eventStatus, output = outputMsg
-                                if self.__threadpool:
-                                    self.__tmpLog.debug("Rank %s: add event output to threadpool: %s" % (self.__rank, outputMsg))
-                                    self.__threadpool.add_task(self.stageOut, eventRangeID, eventStatus, output, retries=0)
-                                else:
-                                    self.stageOut(eventRangeID, eventStatus, output, retries=0)
-                            except:
-                                self.__tmpLog.warning("Rank %s: error message: %s" % (self.__rank, traceback.format_exc()))
-                                continue
+                    self.bulkStageOut(outputs)
             except:
                 self.__tmpLog.error("Rank %s: Stager Thread failed: %s" % (self.__rank, traceback.format_exc()))
             if self.__stop.isSet():
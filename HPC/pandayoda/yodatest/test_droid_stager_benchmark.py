@@ -0,0 +1,96 @@
+# Benchmark for the Droid stager output movement: the former per-file staging (tar -rf per output file in the zip mode,
+# serial copy and remove per output file in the copy mode) against DroidStager (one tar append per bulk of outputs,
+# copies in a thread pool with cached directory creation). The outputs are created in the local working dir (node-local,
+# /dev/shm if available) and moved to the global working dir.
+# usage: PYTHONPATH=<pilot dir>:<HPC dir>:<HPC dir>/pandayoda/yodacore python test_droid_stager_benchmark.py [nOutputs] [outputSize] [bulkSize]
+
+import os
+import sys
+import time
+import Queue
+import shutil
+import commands
+import tempfile
+
+from pandayoda.yodaexe.DroidStager import DroidStager
+
+nOutputs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+outputSize = int(sys.argv[2]) if len(sys.argv) > 2 else 64 * 1024
+bulkSize = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+
+def makeOutputs(localWorkingDir):
+    outputs = []
+    data = "x" * outputSize
+    for i in range(nOutputs):
+        filename = os.path.join(localWorkingDir, "rank_0", "HITS.%06d.pool.root" % (i))
+        f = open(filename, 'w')
+        f.write(data)
+        f.close()
+        outputs.append(("1234-1-1-%s-1" % (i), "finished", "%s,ID:1234-1-1-%s-1,CPU:1,WALL:1" % (filename, i)))
+    return outputs
+
+def formerZip(outputs, zipFileName, zipEventRangesName):
+    for eventRangeID, eventStatus, output in outputs:
+        files = output.split(",")[:-3]
+        for filename in files:
+            commands.getstatusoutput("tar -rf %s --directory=%s %s" % (zipFileName, os.path.dirname(filename), os.path.basename(filename)))
+            os.remove(filename)
+        handler = open(zipEventRangesName, "a")
+        handler.write("%s %s %s\n" % (eventRangeID, eventStatus, files))
+        handler.close()
+
+def formerCopy(outputs, localWorkingDir, globalWorkingDir):
+    for eventRangeID, eventStatus, output in outputs:
+        for filename in output.split(",")[:-3]:
+            new_file_name = filename.replace(localWorkingDir, globalWorkingDir)
+            dirname = os.path.dirname(new_file_name)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            shutil.copy(filename, new_file_name)
+            os.remove(filename)
+
+def run(mode, former):
+    localBase = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    localWorkingDir = tempfile.mkdtemp(dir=localBase)
+    globalWorkingDir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(localWorkingDir, "rank_0"))
+    try:
+        outputs = makeOutputs(localWorkingDir)
+        zipFileName = os.path.join(globalWorkingDir, "outputs.tar")
+        zipEventRangesName = os.path.join(globalWorkingDir, "outputs.eventranges")
+        job = {"JobId": "1234", "yodaToZip": mode == "zip", "zipFileName": zipFileName, "zipEventRangesName": zipEventRangesName}
+        requests = Queue.Queue()
+        stager = DroidStager(globalWorkingDir, localWorkingDir, outputs=requests, job=job, rank=0)
+        try:
+            t0 = time.time()
+            if former and mode == "zip":
+                formerZip(outputs, zipFileName, zipEventRangesName)
+            elif former:
+                formerCopy(outputs, localWorkingDir, globalWorkingDir)
+            else:
+                # as DroidStager.run()
+                for i in range(0, len(outputs), bulkSize):
+                    stager.bulkStageOut(outputs[i:i + bulkSize])
+                if mode == "copy":
+                    stager._DroidStager__threadpool.wait()
+            t = time.time() - t0
+        finally:
+            # the thread pool of the stager is created for the former runs as well, its workers must be stopped
+            if stager._DroidStager__threadpool:
+                stager._DroidStager__threadpool.wait_completion()
+
+        if mode == "zip":
+            nStaged = len(commands.getoutput("tar -tf %s" % (zipFileName)).split())
+        else:
+            nStaged = len([f for f in os.listdir(os.path.join(globalWorkingDir, "rank_0")) if f.startswith("HITS")])
+        print "%s (%s): %.2f s for %d outputs of %d kB (%.1f MB/s), %d staged, %d requests" % \
+            (mode, "former" if former else "DroidStager", t, nOutputs, outputSize / 1024, nOutputs * outputSize / t / 1024 / 1024, nStaged, requests.qsize())
+        if not former:
+            print "  %s" % (stager.getAccountingMetrics())
+    finally:
+        shutil.rmtree(localWorkingDir)
+        shutil.rmtree(globalWorkingDir)
+
+for mode in ["zip", "copy"]:
+    for former in [True, False]:
+        run(mode, former)
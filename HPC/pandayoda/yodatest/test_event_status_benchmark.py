@@ -0,0 +1,73 @@
+# Benchmark for the Yoda event status dump: the former full rewrite of <jobId>_event_status.dump and the metadata XML
+# (with mv) at every dump against the append-only EventStatusLog, for nUpdates event range updates in nDumps dumps.
+# usage: PYTHONPATH=<HPC dir>:<HPC dir>/pandayoda/yodacore python test_event_status_benchmark.py [nUpdates] [nDumps]
+
+import os
+import sys
+import time
+import shutil
+import commands
+import tempfile
+
+from pandayoda.yodacore.EventStatusLog import EventStatusLog, readEventStatusLog, XMLHEADER, XMLTRAILER
+
+nUpdates = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+nDumps = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+jobId = '2800000001'
+
+def makeUpdate(i):
+    eventRangeID = '%s-1-1-%s-1' % (jobId, i)
+    output = '/scratch/yoda/EVNT.%s.pool.root.1,ID:%s,CPU:100,WALL:110' % (i, eventRangeID)
+    return eventRangeID, 'finished', output
+
+def fullRewrite(outFileName, metadataFileName, outputs):
+    # the former Yoda.dumpUpdates
+    outFile = open(outFileName + ".new", 'w')
+    metafd = open(metadataFileName + ".new", "w")
+    metafd.write(XMLHEADER)
+    for eventRangeID, status, output in outputs:
+        outFile.write('{0} {1} {2} {3}\n'.format(str(jobId), str(eventRangeID), str(status), str(output)))
+        metafd.write('  <File EventRangeID="%s" Status="%s">\n' % (eventRangeID, status))
+        metafd.write("    <physical>\n")
+        for output1 in output.split(",")[:-3]:
+            metafd.write('      <pfn filetype="ROOT_All" name="%s"/>\n' % (str(output1)))
+        metafd.write("    </physical>\n")
+        metafd.write("  </File>\n")
+    outFile.close()
+    metafd.write(XMLTRAILER)
+    metafd.close()
+    commands.getstatusoutput("mv %s.new %s" % (outFileName, outFileName))
+    commands.getstatusoutput("mv %s.new %s" % (metadataFileName, metadataFileName))
+
+def run(mode, workDir):
+    outFileName = os.path.join(workDir, "%s_event_status.dump" % jobId)
+    metadataFileName = os.path.join(workDir, "metadata-%s_event_status.xml" % jobId)
+    eventStatusLog = EventStatusLog(jobId, outFileName, metadataFileName) if mode == 'log' else None
+    outputs = []
+    perDump = max(1, nUpdates / nDumps)
+    dumpTimes = []
+    for i in range(nUpdates):
+        outputs.append(makeUpdate(i))
+        if len(outputs) % perDump == 0 or i == nUpdates - 1:
+            t0 = time.time()
+            if eventStatusLog:
+                eventStatusLog.append(outputs)
+                del outputs[:]
+            else:
+                fullRewrite(outFileName, metadataFileName, outputs)
+            dumpTimes.append(time.time() - t0)
+    t0 = time.time()
+    if eventStatusLog:
+        eventStatusLog.close()
+    dumpTimes.append(time.time() - t0)
+    nRecords = len(list(readEventStatusLog(outFileName)))
+    return dumpTimes, nRecords, os.path.getsize(metadataFileName)
+
+for mode in ['full rewrite', 'log']:
+    workDir = tempfile.mkdtemp()
+    try:
+        dumpTimes, nRecords, xmlSize = run(mode, workDir)
+        print "%s: %.2f s for %d updates in %d dumps (last dump %.3f s, max %.3f s), %d records, metadata %d bytes" % \
+            (mode, sum(dumpTimes), nUpdates, nDumps, dumpTimes[-2], max(dumpTimes), nRecords, xmlSize)
+    finally:
+        shutil.rmtree(workDir)
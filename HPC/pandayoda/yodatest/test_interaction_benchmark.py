@@ -0,0 +1,80 @@
+# Microbenchmark for the Yoda request loop (Interaction.Receiver), reporting requests/sec and latency against rank count.
+# Without MPI (default), the Droid ranks are simulated by threads using the non-MPI mode queues:
+#   PYTHONPATH=<HPC dir> python test_interaction_benchmark.py [nRequestsPerRank] [rank counts, e.g. 1,10,100,500]
+# With MPI, rank 0 serves the requests of all other ranks:
+#   mpirun -n <nRanks> python test_interaction_benchmark.py --mpi [nRequestsPerRank]
+
+import sys
+import time
+import threading
+
+from pandayoda.yodacore import Interaction
+
+useMPI = '--mpi' in sys.argv
+args = [arg for arg in sys.argv[1:] if arg != '--mpi']
+nRequestsPerRank = int(args[0]) if len(args) > 0 else 200
+rankCounts = [int(n) for n in args[1].split(',')] if len(args) > 1 else [1, 10, 100, 500]
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def requester(snd, rank, latencies):
+    for i in range(nRequestsPerRank):
+        t0 = time.time()
+        snd.sendRequest('getEventRanges', {'jobId': '1', 'nRanges': 1, 'rank': rank})
+        latencies.append(time.time() - t0)
+    snd.sendRequest('finishDroid', {'state': 'finished', 'rank': rank})
+
+def serve(rsv):
+    while rsv.activeRanks():
+        tmpStat, method, params = rsv.receiveRequest()
+        if not tmpStat:
+            raise Exception(method)
+        if method == 'finishDroid':
+            rsv.decrementNumRank()
+        rsv.returnResponse({'StatusCode': 0, 'eventRanges': []})
+
+def report(nRanks, nRequests, wallTime, latencies, rsv):
+    print "ranks %5d: %7d requests in %6.2f s, %8.0f requests/s, latency p50 %.2f ms, p99 %.2f ms, %.1f requests per wake-up" % \
+        (nRanks, nRequests, wallTime, nRequests / wallTime, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, rsv.getCoalescing())
+
+if useMPI:
+    from mpi4py import MPI
+    comm = MPI.COMM_WORLD
+    if comm.Get_rank() == 0:
+        rsv = Interaction.Receiver()
+        rsv.decrementNumRank()
+        t0 = time.time()
+        serve(rsv)
+        wallTime = time.time() - t0
+        latencies = []
+        for latencies1 in comm.gather([], root=0)[1:]:
+            latencies.extend(latencies1)
+        report(comm.Get_size() - 1, len(latencies), wallTime, latencies, rsv)
+        rsv.stop()
+    else:
+        latencies = []
+        requester(Interaction.Requester(), comm.Get_rank(), latencies)
+        comm.gather(latencies, root=0)
+else:
+    for nRanks in rankCounts:
+        rsv = Interaction.Receiver(nonMPIMode=True)
+        rsv.totalRanks = nRanks
+        latencies = []
+        threads = []
+        for rank in range(1, nRanks + 1):
+            snd = Interaction.Requester(rank=rank, nonMPIMode=True)
+            threads.append(threading.Thread(target=requester, args=(snd, rank, latencies)))
+        t0 = time.time()
+        for thread in threads:
+            thread.start()
+        serve(rsv)
+        wallTime = time.time() - t0
+        for thread in threads:
+            thread.join()
+        report(nRanks, len(latencies), wallTime, latencies, rsv)
+        rsv.stop()
+        Interaction.localRecvQueues.clear()
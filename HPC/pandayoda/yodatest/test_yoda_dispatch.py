@@ -0,0 +1,97 @@
+# Benchmark for the Yoda event range dispatch and the event table in the sqlite backend.
+# Replays event ranges through Yoda.getEventRanges/updateEventRanges for many simulated Droid ranks (no MPI needed).
+# usage: PYTHONPATH=<HPC dir>:<HPC dir>/pandayoda/yodacore python test_yoda_dispatch.py [nEventRanges] [nRanks] [nRangesPerRequest]
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+
+from pandayoda.yodacore import Yoda
+
+nEventRanges = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+nRanks = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+nRangesPerRequest = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+nJobs = 10
+
+def makeEventRanges():
+    jobsEventRanges = {}
+    for i in range(nEventRanges):
+        jobId = str(1000 + i % nJobs)
+        if jobId not in jobsEventRanges:
+            jobsEventRanges[jobId] = []
+        jobsEventRanges[jobId].append({'eventRangeID': '%s-1-1-%s-1' % (jobId, i),
+                                       'startEvent': i,
+                                       'lastEvent': i,
+                                       'LFN': 'EVNT.01461041._000001.pool.root.1',
+                                       'GUID': 'BEA4C016-E37E-0841-A448-8D664E8CD570',
+                                       'scope': 'mc15_13TeV'})
+    return jobsEventRanges
+
+workDir = tempfile.mkdtemp()
+currentDir = os.getcwd()
+os.chdir(workDir)
+try:
+    jobsEventRanges = makeEventRanges()
+    tmpFile = open(os.path.join(workDir, 'JobsEventRanges.json'), 'w')
+    json.dump(jobsEventRanges, tmpFile)
+    tmpFile.close()
+
+    yoda = Yoda.Yoda(workDir, workDir, nonMPIMode=True)
+    # the per request debug messages would dominate the timing
+    yoda.tmpLog.log.setLevel(logging.INFO)
+    # responses go to the local queue, as for rank 0
+    yoda.comm.hasMessage = True
+
+    t0 = time.time()
+    yoda.db.setupJobsEventTable(None, jobsEventRanges)
+    t1 = time.time()
+    print "db: inserted %s event ranges in %.2f s" % (nEventRanges, t1 - t0)
+
+    tmpStat, tmpOut = yoda.makeJobsEventTable()
+    if not tmpStat:
+        raise Exception(tmpOut)
+
+    t0 = time.time()
+    nDispatched = 0
+    nRequests = 0
+    jobIds = sorted(jobsEventRanges.keys())
+    active = True
+    while active:
+        active = False
+        for rank in range(1, nRanks + 1):
+            jobId = jobIds[rank % len(jobIds)]
+            yoda.getEventRanges({'jobId': jobId, 'nRanges': nRangesPerRequest})
+            eventRanges = json.loads(yoda.comm.sendQueue.get())['eventRanges']
+            nRequests += 1
+            if not eventRanges:
+                continue
+            active = True
+            nDispatched += len(eventRanges)
+            yoda.updateEventRanges([{'jobId': jobId,
+                                     'eventRangeID': eventRange['eventRangeID'],
+                                     'eventStatus': 'finished',
+                                     'output': 'output.%s.pool.root,adler32,1234' % eventRange['eventRangeID']} for eventRange in eventRanges])
+            yoda.comm.sendQueue.get()
+    t1 = time.time()
+    print "yoda: dispatched and updated %s event ranges (%s requests from %s ranks) in %.2f s" % (nDispatched, nRequests, nRanks, t1 - t0)
+
+    updates = []
+    for jobId in yoda.finishedJobsEventRanges:
+        updates.extend(yoda.finishedJobsEventRanges[jobId])
+    t0 = time.time()
+    yoda.db.updateEventRanges(updates)
+    t1 = time.time()
+    print "db: updated %s event ranges in %.2f s" % (len(updates), t1 - t0)
+
+    t0 = time.time()
+    yoda.db.dumpUpdates(forceDump=True)
+    t1 = time.time()
+    print "db: dumped %s event ranges in %.2f s" % (len(updates), t1 - t0)
+    yoda.db.close()
+finally:
+    os.chdir(currentDir)
+    shutil.rmtree(workDir)
@@ -0,0 +1,392 @@
+# Class definition:
+#   HTTPSessionPool
+#   In-process HTTP(S) client for the PanDA server communication, used by pUtil._Curl (toServer(), httpConnect(), ..)
+#   Connections are kept alive and reused per server instead of forking a curl process, with a new TLS handshake, for
+#   every call. The SSL context (client certificate/proxy, CA certificates) is created once per set of SSL settings.
+#   request() returns (status, output) like commands.getstatusoutput() of the corresponding curl command: status 0 and
+#   the response body for any HTTP response, or a curl exit code and an error message if no response was received.
+#   As curl --max-time, the timeout is the maximum time of a request (connect, send and response together).
+#   Note: this module must not import pUtil at module level (pUtil imports it)
+
+import os
+import ssl
+import time
+import gzip
+import errno
+import socket
+import select
+import urllib
+import httplib
+import urlparse
+import threading
+from StringIO import StringIO
+
+# curl exit codes, used for the errors
+CURLE_COULDNT_CONNECT = 7
+CURLE_OPERATION_TIMEDOUT = 28
+CURLE_SSL_CONNECT_ERROR = 35
+CURLE_GOT_NOTHING = 52
+CURLE_RECV_ERROR = 56
+
+class HTTPSessionPool(object):
+
+    # private data members
+    __instance = None                      # Singleton instance
+
+    def __new__(cls, *args, **kwargs):
+        """ Override the __new__ method to make the class a singleton """
+
+        if not cls.__instance:
+            cls.__instance = super(HTTPSessionPool, cls).__new__(cls, *args, **kwargs)
+            cls.__instance.__setup()
+
+        return cls.__instance
+
+    @classmethod
+    def isAvailable(cls):
+        """ Can the in-process client be used (SSL contexts require python 2.7.9 or later) """
+
+        return hasattr(ssl, 'SSLContext')
+
+    def __setup(self):
+        """ Create the empty pool (called again in a forked child process) """
+
+        self.__pid = os.getpid()
+        self.__lock = threading.Lock()
+        self.__idle = {}                   # FORMAT: { (scheme, host, port, SSL settings): [connection, ..] }
+        self.__contexts = {}               # FORMAT: { SSL settings: SSL context }
+        self.__counts = {'requests': 0, 'connections': 0}
+
+    def __checkFork(self):
+        """ Do not share the connections of the parent process with a forked child process """
+
+        if self.__pid != os.getpid():
+            self.__setup()
+
+    def __getContext(self, sslsettings):
+        """ Return the SSL context for the SSL settings (cert, key, capath, verify, tlsv1) """
+
+        context = self.__contexts.get(sslsettings)
+        if context:
+            return context
+
+        cert, key, capath, verify, tlsv1 = sslsettings
+        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1 if tlsv1 else ssl.PROTOCOL_SSLv23)
+        if verify:
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.check_hostname = True
+            if capath:
+                context.load_verify_locations(capath=capath)
+            if cert:
+                # as curl --cacert <proxy>
+                try:
+                    context.load_verify_locations(cafile=cert)
+                except (ssl.SSLError, IOError):
+                    pass
+        else:
+            context.verify_mode = ssl.CERT_NONE
+        if cert:
+            context.load_cert_chain(cert, key or None)
+
+        self.__contexts[sslsettings] = context
+
+        return context
+
+    def __getConnection(self, poolkey, connect_timeout):
+        """ Return (connection, reused): an idle connection from the pool or a new one """
+
+        with self.__lock:
+            idle = self.__idle.get(poolkey, [])
+            while idle:
+                connection = idle.pop()
+                if not self.__isClosed(connection):
+                    return connection, True
+                connection.close()
+            self.__counts['connections'] += 1
+
+        scheme, host, port, sslsettings = poolkey
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, port, timeout=connect_timeout, context=self.__getContext(sslsettings))
+        else:
+            connection = httplib.HTTPConnection(host, port, timeout=connect_timeout)
+
+        return connection, False
+
+    def __isClosed(self, connection):
+        """ Has the server closed the idle connection (readable without a request: end of file) """
+
+        try:
+            return bool(select.select([connection.sock], [], [], 0)[0])
+        except (select.error, socket.error, ValueError, TypeError):
+            return True
+
+    def __setTimeout(self, connection, deadline):
+        """ Limit the next socket operation to the time left until the deadline of the request """
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout("Operation timed out (maximum time of the request reached)")
+        connection.sock.settimeout(remaining)
+
+    def __expire(self, connection, expired):
+        """ Stop a request that is still receiving at its deadline (e.g. a response trickling in) """
+
+        expired.set()
+        try:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, socket.error):
+            pass
+
+    def __read(self, connection, response, deadline):
+        """ Read the response body before the deadline """
+
+        chunks = []
+        while True:
+            self.__setTimeout(connection, deadline)
+            chunk = response.read(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+        return "".join(chunks)
+
+    def __isStale(self, e):
+        """ Was a reused connection closed by the server before it sent anything back (not a timeout) """
+
+        if isinstance(e, socket.timeout):
+            return False
+        if isinstance(e, httplib.BadStatusLine):
+            # empty status line (older python versions: "''")
+            return e.line in ["", "''"] or e.line.startswith("No status line received")
+        if isinstance(e, socket.error):
+            return e.errno in [errno.ECONNRESET, errno.EPIPE]
+        return False
+
+    def __releaseConnection(self, poolkey, connection):
+        """ Put a connection back into the pool """
+
+        with self.__lock:
+            self.__idle.setdefault(poolkey, []).append(connection)
+
+    def request(self, method, url, data=None, headers=None, cert='', key='', capath='', verify=True, tlsv1=False,
+                compress=True, connect_timeout=100, timeout=120, retries=0):
+        """
+        Send a GET (data in the query string) or POST (form encoded data) request.
+        timeout is the maximum time of each attempt (curl --max-time), connect_timeout that of the connection setup.
+        A request on a reused connection that the server closed without a response (empty status line, connection
+        reset) is sent again on a new connection, other errors (timeouts included) are retried up to retries times.
+        Return (status, output) as commands.getstatusoutput() of curl
+        """
+
+        self.__checkFork()
+
+        url = urlparse.urlparse(url)
+        scheme = url.scheme or 'http'
+        port = url.port or (443 if scheme == 'https' else 80)
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+
+        body = None
+        if data:
+            if method == 'GET':
+                path += ('&' if '?' in path else '?') + urllib.urlencode(data)
+            else:
+                body = urllib.urlencode(data)
+
+        _headers = {'User-Agent': 'PanDA pilot', 'Accept': '*/*'}
+        if body is not None:
+            _headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if compress:
+            _headers['Accept-Encoding'] = 'gzip'
+        if headers:
+            _headers.update(headers)
+
+        sslsettings = (cert, key, capath, verify, tlsv1) if scheme == 'https' else None
+        poolkey = (scheme, url.hostname, port, sslsettings)
+
+        with self.__lock:
+            self.__counts['requests'] += 1
+
+        attempt = 0
+        while True:
+            deadline = time.time() + timeout
+            try:
+                connection, reused = self.__getConnection(poolkey, min(connect_timeout, timeout))
+            except Exception, e:
+                return CURLE_SSL_CONNECT_ERROR, "SSL settings could not be used: %s" % e
+
+            received = False
+            expired = threading.Event()
+            watchdog = None
+            try:
+                if not reused:
+                    connection.connect()
+                watchdog = threading.Timer(max(0, deadline - time.time()), self.__expire, [connection, expired])
+                watchdog.setDaemon(True)
+                watchdog.start()
+                self.__setTimeout(connection, deadline)
+                connection.request(method, path, body, _headers)
+                self.__setTimeout(connection, deadline)
+                response = connection.getresponse()
+                received = True
+                output = self.__read(connection, response, deadline)
+                if response.getheader('content-encoding', '') == 'gzip':
+                    output = gzip.GzipFile(fileobj=StringIO(output)).read()
+            except Exception, e:
+                if watchdog:
+                    watchdog.cancel()
+                connection.close()
+                if expired.isSet():
+                    e = socket.timeout("Operation timed out (maximum time of the request reached)")
+                elif reused and not received and self.__isStale(e):
+                    # the server closed the idle connection, try again on a new one
+                    continue
+                if attempt < retries:
+                    attempt += 1
+                    time.sleep(min(attempt, 10))
+                    continue
+                return self.__getErrorCode(e), "%s: %s" % (e.__class__.__name__, e)
+
+            watchdog.cancel()
+            if expired.isSet():
+                connection.close()
+                return CURLE_OPERATION_TIMEDOUT, "timeout: Operation timed out (maximum time of the request reached)"
+            if response.will_close:
+                connection.close()
+            else:
+                self.__releaseConnection(poolkey, connection)
+
+            return 0, output
+
+    def __getErrorCode(self, e):
+        """ Return the curl exit code corresponding to the exception """
+
+        if isinstance(e, socket.timeout):
+            return CURLE_OPERATION_TIMEDOUT
+        if isinstance(e, ssl.SSLError) or isinstance(e, ssl.CertificateError):
+            return CURLE_SSL_CONNECT_ERROR
+        if isinstance(e, httplib.BadStatusLine):
+            return CURLE_GOT_NOTHING
+        if isinstance(e, socket.error) and e.errno in [111, 113, 101]: # ECONNREFUSED, EHOSTUNREACH, ENETUNREACH
+            return CURLE_COULDNT_CONNECT
+        if isinstance(e, socket.gaierror):
+            return CURLE_COULDNT_CONNECT
+        return CURLE_RECV_ERROR
+
+    def getCounts(self):
+        """ Return a dictionary with the number of requests and of opened connections """
+
+        with self.__lock:
+            return dict(self.__counts)
+
+    def close(self):
+        """ Close all idle connections """
+
+        with self.__lock:
+            for connections in self.__idle.values():
+                for connection in connections:
+                    connection.close()
+            self.__idle = {}
+
+def benchmark(n=200, threads=1):
+    """
+    Compare the in-process client with the curl command against a local HTTPS stub server (calls/s, latency).
+    usage: python HTTPClient.py [number of calls] [number of concurrent clients]
+    """
+
+    import sys
+    import shutil
+    import tempfile
+    import commands
+    import BaseHTTPServer
+    import SocketServer
+
+    workdir = tempfile.mkdtemp()
+    certfile = os.path.join(workdir, 'server.pem')
+    ec, output = commands.getstatusoutput('openssl req -x509 -newkey rsa:2048 -nodes -days 1 -subj /CN=localhost -keyout %s -out %s' % (certfile, certfile))
+    if ec:
+        print "Failed to create a server certificate: %s" % output
+        return
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        wbufsize = -1                      # send the response in one packet
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.getheader('content-length', 0)))
+            body = 'StatusCode=0&command=NULL'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+        def handle_error(self, request, client_address):
+            pass                           # clients closing their connections
+
+    server = Server(('localhost', 0), Handler)
+    server.socket = ssl.wrap_socket(server.socket, certfile=certfile, server_side=True)
+    serverthread = threading.Thread(target=server.serve_forever)
+    serverthread.setDaemon(True)
+    serverthread.start()
+
+    url = 'https://localhost:%d/server/panda/updateJob' % server.server_address[1]
+    data = {'jobId': '1234567890', 'state': 'running', 'timestamp': time.time(), 'xml': 'x' * 1000}
+    pool = HTTPSessionPool()
+
+    def _session():
+        return pool.request('POST', url, data, capath='', cert=certfile, key=certfile)
+
+    def _curl():
+        configname = os.path.join(workdir, 'curl_%s.config' % threading.currentThread().getName())
+        f = open(configname, 'w')
+        for key in data.keys():
+            f.write('data="%s"\n' % urllib.urlencode({key:data[key]}))
+        f.close()
+        return commands.getstatusoutput('curl --silent --show-error --connect-timeout 100 --max-time 120 --compressed --cacert %s --cert %s --key %s --config %s %s' % (certfile, certfile, certfile, configname, url))
+
+    def _percentile(values, p):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+    def _run(name, function):
+        latencies = []
+        failures = []
+        def _client(ncalls):
+            for i in range(ncalls):
+                t0 = time.time()
+                ec, output = function()
+                latencies.append(time.time() - t0)
+                if ec or 'StatusCode=0' not in output:
+                    failures.append(output)
+        clients = [threading.Thread(target=_client, args=(n // threads,)) for i in range(threads)]
+        t0 = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        walltime = time.time() - t0
+        print "%-8s: %5d calls in %6.2f s, %7.1f calls/s, latency p50 %6.1f ms, p99 %6.1f ms, %d failures" % \
+            (name, len(latencies), walltime, len(latencies) / walltime, _percentile(latencies, 50) * 1000, _percentile(latencies, 99) * 1000, len(failures))
+        if failures:
+            print "first failure: %s" % failures[0]
+
+    try:
+        _run('curl', _curl)
+        _run('session', _session)
+        print "session pool: %s" % pool.getCounts()
+    finally:
+        pool.close()
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+
+    import sys
+    benchmark(*[int(arg) for arg in sys.argv[1:3]])
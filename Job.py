@@ -91,6 +91,8 @@ class Job:
         self.filesAltStageOut = 0          # Number of files staged out to alternative SE (only reported to jobMetrics in alt stage-out mode)
         self.bytesWithoutFAX = 0           # Total size of files transferred without FAX (only reported to jobMetrics in FAX mode)
         self.bytesWithFAX = 0              # Total size of files transferred with FAX (only reported to jobMetrics in FAX mode)
+        self.logCompressionRate = None     # Log tarball creation throughput [MB/s of uncompressed data]
+        self.logCompressionRatio = None    # Uncompressed / compressed size of the log tarball
         self.scopeIn = []                  # Rucio scope for in files
         self.scopeOut = []                 # Rucio scope for out files
         self.scopeLog = []                 # Rucio scope for log file
@@ -12,13 +12,15 @@ from pUtil import tolog, readpar, isLogfileCopied, isAnalysisJob, removeFiles, g
     getMetadata, returnLogMsg, removeLEDuplicates, getPilotlogFilename, remove, getExeErrors, updateJobState, \
     makeJobReport, chdir, addSkippedToPFC, updateMetadata, getJobReport, filterJobReport, timeStamp, \
     getPilotstderrFilename, safe_call, updateXMLWithSURLs, putMetadata, getCmtconfig, getExperiment, getSiteInformation, \
-    timedCommand, updateXMLWithEndpoints
+    updateXMLWithEndpoints
 from FileHandling import addToOSTransferDictionary, getOSTransferDictionaryFilename, getOSTransferDictionary, \
     getWorkDirSizeFilename, getDirSize, storeWorkDirSize, addToJobReport, getJSONDictionary
 from JobState import JobState
 from FileState import FileState
+from DirectorySize import releaseDirectorySize
 from FileStateClient import updateFileState, dumpFileStates
 from JobRecovery import JobRecovery
+from LogTarball import createLogTarball
 from Configuration import Configuration
 
 class JobLog:
@@ -1244,6 +1246,9 @@ class JobLog:
             # Store the measured disk space (the max value will later be sent with the job metrics)
             status = storeWorkDirSize(size, self.__env['pilot_initdir'], job)
 
+        # the work directory is about to be renamed, stop tracking its size
+        releaseDirectorySize(job.workdir)
+
         # input and output files should already be removed from the workdir in child process
         tarballNM = "%s.tar" % (job.newDirNM)
         try:
@@ -1253,34 +1258,60 @@ class JobLog:
         except OSError:
             tolog("!!WARNING!!1400!! Could not move job workdir %s to %s" % (job.workdir, job.newDirNM))
         else:
-            timeout = 55*60
-            # add an echo $? to mask any tar error code - for now - otherwise it can cause the time-out of the tar
-            # to return an error code when we don't want it to, e.g. in evgen jobs that have broken soft links
-            # the pilot should remove the broken links before though. later, the pilot should fail if the log file
-            # is too big
-            cmd = "pwd;tar cvf %s %s --dereference --one-file-system; echo $?" % (tarballNM, job.newDirNM)
-            exitcode, output = timedCommand(cmd, timeout=timeout)
-            if exitcode != 0:
-                tolog("!!WARNING!!4343!! Log file creation failed: %d, %s" % (exitcode, output))
+            # tar and gzip the workdir in a single pass (as tar --dereference --one-file-system; broken soft links,
+            # e.g. in evgen jobs, are skipped). The checksums are calculated while the tarball is written
+            threads, maxFileSize = self.getLogTarballSettings(job)
+
+            def exclude(path, tarinfo):
+                if maxFileSize and tarinfo.size > maxFileSize:
+                    return "larger than %d MB" % (maxFileSize / 1024**2)
+                return None
+
+            try:
+                result = createLogTarball("%s.gz" % (tarballNM), job.newDirNM, exclude=exclude, threads=threads, timeout=55*60)
+            except Exception, e:
+                tolog("!!WARNING!!4343!! Log file creation failed: %s" % (e))
             else:
-                tolog("Tarball created: %s" % (tarballNM))
-                cmd = "gzip -f %s" % (tarballNM)
-                exitcode, output = timedCommand(cmd, timeout=timeout)
-                if exitcode != 0:
-                    tolog("!!WARNING!!4343!! Log file zip failed: %d, %s" % (exitcode, output))
+                tolog("Tarball created: %s.gz (%d files, %d excluded, %d B compressed to %d B in %.1f s, %d thread(s))" %\
+                      (tarballNM, result['files'], result['excluded'], result['size'], result['csize'], result['time'], threads))
+                job.logCompressionRate = result['size'] / max(result['time'], 0.001) / 1024**2
+                job.logCompressionRatio = float(result['size']) / max(result['csize'], 1)
+                try:
+                    os.rename("%s.gz" % (tarballNM), job.logFile)
+                    #command = "cp %s ../" % job.logFile
+                    #os.system(command)
+                except OSError:
+                    tolog("!!WARNING!!1400!! Could not rename gzipped tarball %s" % job.logFile)
                 else:
-                    try:
-                        os.rename("%s.gz" % (tarballNM), job.logFile)
-                        #command = "cp %s ../" % job.logFile
-                        #os.system(command)
-                    except OSError:
-                        tolog("!!WARNING!!1400!! Could not rename gzipped tarball %s" % job.logFile)
-                    else:
-                        tolog("Tarball renamed to %s" % (job.logFile))
-                        status = True
+                    tolog("Tarball renamed to %s" % (job.logFile))
+                    status = True
 
         return status
 
+    def getLogTarballSettings(self, job):
+        """
+        Return the number of compression threads and the max size [B] of a file in the log tarball (0: no limit)
+        catchall settings: log_compression_threads=<n> (default: the job core count, max 8), log_maxfilesize=<MB>
+        """
+
+        threads = 1
+        try:
+            threads = min(8, max(1, int(job.coreCount)))
+        except (TypeError, ValueError):
+            pass
+        maxFileSize = 0
+
+        for entry in readpar('catchall').split(','):
+            try:
+                if entry.startswith('log_compression_threads='):
+                    threads = max(1, int(entry.split('=')[1]))
+                elif entry.startswith('log_maxfilesize='):
+                    maxFileSize = int(entry.split('=')[1]) * 1024**2
+            except ValueError, e:
+                tolog("!!WARNING!!1400!! Invalid log tarball setting in catchall: %s (%s)" % (entry, e))
+
+        return threads, maxFileSize
+
     def removeLockFile(self, workdir, lockfile="LOCKFILE"):
         """ Removal of temporary lock file after successful log registration """
 
@@ -0,0 +1,335 @@
+# Class definition:
+#   JobReport
+#   Cached view of the jobReport.json of a work directory, shared by all consumers (FileHandling, ErrorDiagnosis,
+#   PandaServerClient). The report is parsed once (with unicode to utf-8 conversion) and parsed again only when the file
+#   has changed (mtime, size or inode differ from the parsed version). The accessors return the values used during the
+#   job finalisation (executor CPU times, event counts, DB info, output files, errors); add() updates the cached
+#   dictionary, write() replaces the file atomically. The dictionary returned by getDictionary() must not be modified.
+#   Use getReport(workDir) to get the JobReport object of a work directory. Only the reports of the MAXREPORTS most
+#   recently used work directories are kept (a multi-job pilot would otherwise keep the reports of all its jobs).
+
+import os
+import threading
+
+from pUtil import tolog, convert
+
+FILENAME = "jobReport.json"
+
+class JobReport(object):
+
+    # max number of cached reports
+    MAXREPORTS = 4
+
+    # cached reports, FORMAT: { filename: JobReport object }, and their filenames, least recently used first
+    __reports = {}
+    __order = []
+    __reportsLock = threading.Lock()
+
+    def __init__(self, filename):
+        """ filename: full path of the jobReport """
+
+        self.filename = filename
+        self.__dictionary = {}
+        self.__stat = None                 # (mtime, size, inode) of the parsed version
+        self.__parseCount = 0
+        self.__lock = threading.RLock()
+
+    def getReport(cls, workDir):
+        """ Return the JobReport object of the work directory (created on first use) """
+
+        filename = os.path.join(os.path.abspath(workDir), FILENAME)
+        with cls.__reportsLock:
+            if cls.__reports.has_key(filename):
+                cls.__order.remove(filename)
+            else:
+                cls.__reports[filename] = cls(filename)
+                # remove the least recently used reports
+                while len(cls.__order) >= cls.MAXREPORTS:
+                    del cls.__reports[cls.__order.pop(0)]
+            cls.__order.append(filename)
+            return cls.__reports[filename]
+    getReport = classmethod(getReport)
+
+    def __getStat(self):
+        """ Return (mtime, size, inode) of the file, None if it does not exist """
+
+        try:
+            s = os.stat(self.filename)
+        except OSError:
+            return None
+        return s.st_mtime, s.st_size, s.st_ino
+
+    def exists(self):
+        """ Does the jobReport exist? """
+
+        return os.path.exists(self.filename)
+
+    def getParseCount(self):
+        """ Return the number of times the file has been parsed """
+
+        return self.__parseCount
+
+    def getDictionary(self):
+        """ Return the jobReport dictionary ({} if the file does not exist or cannot be read), parse the file if it has changed """
+
+        with self.__lock:
+            stat = self.__getStat()
+            if stat is None:
+                tolog("!!WARNING!!1111!! File %s does not exist" % (self.filename))
+                self.__dictionary = {}
+                self.__stat = None
+            elif stat != self.__stat:
+                self.__dictionary = self.__parse()
+                self.__stat = stat
+
+            return self.__dictionary
+
+    def __parse(self):
+        """ Read the dictionary with unicode to utf-8 conversion """
+
+        from json import load
+        self.__parseCount += 1
+        try:
+            f = open(self.filename, 'r')
+            try:
+                dictionary = load(f)
+            finally:
+                f.close()
+        except Exception, e:
+            tolog("!!WARNING!!2222!! Failed to load json dictionary from %s: %s" % (self.filename, e))
+            return {}
+
+        if not isinstance(dictionary, dict) or dictionary == {}:
+            tolog("!!WARNING!!2995!! Load function returned empty JSON dictionary: %s" % (self.filename))
+            return {}
+        try:
+            dictionary = convert(dictionary)
+        except Exception, e:
+            tolog("!!WARNING!!2996!! Failed to convert dictionary from unicode to utf-8: %s" % (e))
+
+        return dictionary
+
+    def add(self, key, value, section=None, subsection=None, write=True):
+        """ Add the key with value to the jobReport (to the given section and subsection), return True if added """
+        # Note: several keys can be added with write=False before a single write()
+
+        with self.__lock:
+            dictionary = self.getDictionary()
+            if dictionary == {}:
+                tolog("jobReport not available, will not add new key: %s" % (key))
+                return False
+
+            if section:
+                if not dictionary.has_key(section):
+                    tolog("!!WARNING!!2324!! jobReport does not have section=%s in the expected location; will not add key=%s" % (section, key))
+                    return False
+                if subsection:
+                    if not dictionary[section].has_key(subsection):
+                        tolog("!!WARNING!!2325!! jobReport does not have subsection=%s in the expected location; will not add key=%s" % (subsection, key))
+                        return False
+                    dictionary[section][subsection][key] = value
+                else:
+                    dictionary[section][key] = value
+            else:
+                dictionary[key] = value
+
+            if write:
+                return self.write()
+            return True
+
+    def write(self):
+        """ Replace the jobReport with the cached dictionary (the cache stays valid), return True if written """
+
+        from json import dump
+        with self.__lock:
+            tmpName = self.filename + ".tmp"
+            try:
+                fp = open(tmpName, "w")
+                try:
+                    dump(self.__dictionary, fp, sort_keys=True, indent=4, separators=(',', ': '))
+                finally:
+                    fp.close()
+                os.rename(tmpName, self.filename)
+            except Exception, e:
+                tolog("!!WARNING!!2323!! Failed to write updated jobReport %s: %s" % (self.filename, e))
+                return False
+            self.__stat = self.__getStat()
+            tolog("Wrote dictionary to file %s" % (self.filename))
+
+            return True
+
+    def getVersion(self):
+        """ Return the reportVersion (None if not available) """
+
+        return self.getDictionary().get('reportVersion')
+
+    def getExecutors(self):
+        """ Return the resource dictionary of the executors, FORMAT: { executor name: { 'cpuTime': .., 'nevents': .., .. } } """
+
+        dictionary = self.getDictionary()
+        if dictionary == {}:
+            return {}
+        if not dictionary.has_key('resource'):
+            tolog("No such key: resource")
+            return {}
+        if not dictionary['resource'].has_key('executor'):
+            tolog("No such key: executor")
+            return {}
+
+        return dictionary['resource']['executor']
+
+    def __sumExecutorValues(self, key, total):
+        """ Add up the values of the key over all executors """
+
+        for name, executor in self.getExecutors().iteritems(): # "RAWtoESD", ..
+            if executor.has_key(key):
+                try:
+                    total += executor[key]
+                except TypeError:
+                    pass
+            else:
+                tolog("Format %s has no such key: %s" % (name, key))
+
+        return total
+
+    def getCPUTime(self):
+        """ Return the total CPU time [s] of all executors """
+
+        return self.__sumExecutorValues('cpuTime', 0L)
+
+    def getDBInfo(self):
+        """ Return the total DB time [s] and DB data of all executors """
+
+        return self.__sumExecutorValues('dbTime', 0), self.__sumExecutorValues('dbData', 0L)
+
+    def getNumberOfEvents(self):
+        """ Return the number of events per executor, FORMAT: { executor name: nevents } """
+
+        nEvents = {}
+        for name, executor in self.getExecutors().iteritems():
+            if executor.has_key('nevents'):
+                nEvents[name] = executor['nevents']
+            else:
+                tolog("Format %s has no such key: nevents" % (name))
+
+        return nEvents
+
+    def getOutputFiles(self):
+        """ Return the subFiles dictionaries of all output files, FORMAT: [ { 'name': .., 'nentries': .., 'file_guid': .. }, .. ] """
+
+        dictionary = self.getDictionary()
+        if dictionary == {}:
+            return []
+        if not dictionary.has_key('files'):
+            tolog("No such key: files")
+            return []
+        if not dictionary['files'].has_key('output'):
+            tolog("No such key: output")
+            return []
+
+        subFiles = []
+        for f_dictionary in dictionary['files']['output']:
+            if f_dictionary.has_key('subFiles'):
+                subFiles += f_dictionary['subFiles']
+            else:
+                tolog("No such key: subFiles")
+
+        return subFiles
+
+    def getErrors(self):
+        """ Return the error messages of the first executor """
+        # WARNING: Currently compatible with version <= 0.9.4
+
+        errors = []
+        dictionary = self.getDictionary()
+        if dictionary.has_key('reportVersion'):
+            tolog("Scanning jobReport (v %s) for error info" % dictionary['reportVersion'])
+        else:
+            tolog("WARNING: jobReport does not have the reportVersion key")
+
+        if dictionary.has_key('executor'):
+            try:
+                error_details = dictionary['executor'][0]['logfileReport']['details']['ERROR']
+            except Exception, e:
+                tolog("WARNING: Aborting jobReport scan: %s"% (e))
+            else:
+                try:
+                    for m in error_details:
+                        errors.append(m['message'])
+                except Exception, e:
+                    tolog("!!WARNING!!1113!! Did not get a list object: %s" % (e))
+        else:
+            tolog("WARNING: jobReport does not have the executor key (aborting)")
+
+        return errors
+
+def getReport(workDir):
+    """ Return the JobReport object of the work directory """
+
+    return JobReport.getReport(workDir)
+
+def benchmark(nExecutors=20, nFiles=2000, nErrors=5000):
+    """
+    Measure the job finalisation reads of a multi-step jobReport (getNumberOfEvents, getDBInfo, getCPUTimes,
+    extractOutputFilesFromJSON, processJobReport, addToJobReport) with a json.load per consumer (the former functions)
+    and with the cached JobReport.
+    usage: python JobReport.py [number of executors] [number of output files] [number of error messages]
+    """
+
+    import json
+    import time
+    import shutil
+    import tempfile
+
+    workDir = tempfile.mkdtemp()
+    try:
+        executors = {}
+        for i in range(nExecutors):
+            executors['step%d' % (i)] = {'cpuTime': 100 + i, 'nevents': 1000, 'dbData': 1000000L, 'dbTime': 1.5, 'wallTime': 200}
+        report = {'reportVersion': '1.0.0',
+                  'resource': {'executor': executors, 'machine': {}},
+                  'files': {'output': [{'subFiles': [{'name': 'AOD.%06d.pool.root' % (i), 'nentries': 100, 'file_guid': '%032X' % (i)} for i in range(nFiles)]}]},
+                  'executor': [{'logfileReport': {'details': {'ERROR': [{'message': 'error message %d %s' % (i, 'x' * 200), 'count': 1} for i in range(nErrors)]}}}]}
+        filename = os.path.join(workDir, FILENAME)
+        f = open(filename, 'w')
+        json.dump(report, f, sort_keys=True, indent=4, separators=(',', ': '))
+        f.close()
+
+        def _load():
+            f = open(filename)
+            try:
+                return convert(json.load(f))
+            finally:
+                f.close()
+
+        # former finalisation: one parse per consumer and a read-modify-write for the added key
+        t0 = time.time()
+        for i in range(5):
+            _load()
+        d = _load()
+        d['resource']['machine']['benchmark'] = {}
+        f = open(filename, 'w')
+        json.dump(d, f, sort_keys=True, indent=4, separators=(',', ': '))
+        f.close()
+        t1 = time.time()
+
+        jobReport = getReport(workDir)
+        nEvents = max(jobReport.getNumberOfEvents().values())
+        dbTime, dbData = jobReport.getDBInfo()
+        cpuTime = jobReport.getCPUTime()
+        outputFiles = jobReport.getOutputFiles()
+        errors = jobReport.getErrors()
+        jobReport.add('benchmark', {}, section='resource', subsection='machine')
+        t2 = time.time()
+
+        print "jobReport: %d bytes, %d executors, %d output files, %d errors" % (os.path.getsize(filename), nExecutors, len(outputFiles), len(errors))
+        print "one parse per consumer: %.3f s (6 parses)" % (t1 - t0)
+        print "cached JobReport:       %.3f s (%d parse(s)), nEvents %d, cpuTime %d, dbTime %.1f, dbData %d" % \
+            (t2 - t1, jobReport.getParseCount(), nEvents, cpuTime, dbTime, dbData)
+    finally:
+        shutil.rmtree(workDir)
+
+if __name__ == "__main__":
+
+    import sys
+    benchmark(*[int(arg) for arg in sys.argv[1:4]])
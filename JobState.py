@@ -1,7 +1,12 @@
 import os
+import cPickle
 import commands
 from pUtil import tolog
 from FileHandling import getExtension
+from StateJournal import StateJournal
+
+# the objects of the job state file
+OBJECTS = ['job', 'site', 'node']
 
 class JobState:
     """
@@ -9,7 +14,12 @@ class JobState:
     When the job is running, the file jobState-<JobID>.[pickle|json]
     is created which contains the state of the Site, Job and Node
     objects. The job state file is updated at every heartbeat.
+    The pickle file is a StateJournal: a snapshot of the objects followed by
+    deltas with the object attributes that have changed since the previous update.
     """
+
+    # FORMAT: { filename: [journal, { 'job': (class, { attribute: pickled value }), .., 'recoveryAttempt': n }] }
+    __journals = {}
     def __init__(self):
         """ Default init """
         self.job = None            # Job class object
@@ -69,9 +79,8 @@ class JobState:
                     tolog("Imported json load")
                     importedLoad = True
             else:
-                from pickle import load
-                importedLoad = True
-                tolog("Imported pickle load")
+                fp.close()
+                return self.getJournal()
 
             if importedLoad:
                 # load the dictionary from file
@@ -90,6 +99,26 @@ class JobState:
 
         return status
 
+    def getJournal(self):
+        """ Read the job state from a journal (snapshot and deltas) """
+
+        snapshot, deltas = StateJournal(self.filename).read()
+        if not snapshot:
+            tolog("JOBSTATE FAILURE: JobState could not deserialize file: %s" % self.filename)
+            return False
+
+        # apply the changed attributes in the order of the updates
+        for delta in deltas:
+            for name in OBJECTS:
+                if delta.has_key(name) and snapshot.get(name):
+                    snapshot[name].__dict__.update(delta[name])
+            if delta.has_key('recoveryAttempt'):
+                snapshot['recoveryAttempt'] = delta['recoveryAttempt']
+        self.objectDictionary = snapshot
+        tolog("Managed to load object dictionary (%d update(s) applied)" % (len(deltas)))
+
+        return True
+
     def getCurrentFilename(self):
         """ return the current file name """
 
@@ -137,7 +166,7 @@ class JobState:
             if "json" in self.filename:
                 from json import dump
             else:
-                from pickle import dump
+                return self.putJournal(objectDictionary)
             try:
                 fp = open(self.filename, "w")
             except Exception, e:
@@ -159,6 +188,65 @@ class JobState:
                                                                                                         
         return status
 
+    def putJournal(self, objectDictionary):
+        """ Append the changed object attributes to the job state journal (a new snapshot is written when needed) """
+
+        try:
+            # pickle the attributes one by one to find the changed ones
+            state = {'recoveryAttempt': objectDictionary['recoveryAttempt']}
+            for name in OBJECTS:
+                obj = objectDictionary[name]
+                state[name] = (obj.__class__, dict([(key, cPickle.dumps(value, 2)) for key, value in obj.__dict__.items()]))
+        except Exception, e:
+            tolog("JOBSTATE FAILURE: Could not encode data to job state file: %s, %s" % (self.filename, str(e)))
+            return False
+
+        entry = self.__journals.get(self.filename)
+        if not entry:
+            entry = [StateJournal(self.filename), None]
+            self.__journals[self.filename] = entry
+        journal, written = entry
+
+        try:
+            delta = self.getDelta(written, state, objectDictionary)
+            if delta == {} and os.path.exists(self.filename):
+                # nothing has changed, only update the modification time (used by the job recovery)
+                os.utime(self.filename, None)
+            elif delta is None or not journal.append(delta):
+                journal.writeSnapshot(objectDictionary)
+        except Exception, e:
+            tolog("JOBSTATE FAILURE: Could not write job state file: %s, %s" % (self.filename, str(e)))
+            _cmd = "whoami; ls -lF %s" % (self.filename)
+            tolog("Executing command: %s" % (_cmd))
+            ec, rs = commands.getstatusoutput(_cmd)
+            tolog("%d, %s" % (ec, rs))
+            entry[1] = None
+            return False
+        entry[1] = state
+
+        return True
+
+    def getDelta(self, written, state, objectDictionary):
+        """ Return the changed object attributes { 'job': { attribute: value }, .. }, None if a snapshot is needed """
+
+        if not written:
+            return None
+
+        delta = {}
+        for name in OBJECTS:
+            cls, attributes = state[name]
+            _cls, _attributes = written[name]
+            if cls != _cls or [key for key in _attributes.keys() if not attributes.has_key(key)]:
+                # the object was replaced or an attribute was removed
+                return None
+            changed = dict([(key, objectDictionary[name].__dict__[key]) for key, value in attributes.items() if _attributes.get(key) != value])
+            if changed:
+                delta[name] = changed
+        if state['recoveryAttempt'] != written['recoveryAttempt']:
+            delta['recoveryAttempt'] = state['recoveryAttempt']
+
+        return delta
+
     def rename(self, site, job):
         """
         Rename the job state file. Should only be called for
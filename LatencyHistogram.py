@@ -0,0 +1,76 @@
+# Class definition:
+#   LatencyHistogram
+#   Histogram of latencies with logarithmic buckets (1 ms .. 10 s), used for the message handling between the pilot and
+#   the payload in RunJobEvent (handoff of event ranges to AthenaMP, message handling in the listeners).
+#   Thread-safe; percentiles are approximated by the upper bound of the bucket that contains them.
+
+import threading
+
+class LatencyHistogram(object):
+
+    # upper bucket bounds [s], the last bucket holds the larger values
+    BOUNDS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0]
+
+    def __init__(self, name):
+        """ name: label used in the summary """
+
+        self.name = name
+        self.__lock = threading.Lock()
+        self.__counts = [0] * (len(self.BOUNDS) + 1)
+        self.__n = 0
+        self.__total = 0.0
+        self.__max = 0.0
+
+    def add(self, latency):
+        """ Add a latency [s] """
+
+        i = 0
+        while i < len(self.BOUNDS) and latency > self.BOUNDS[i]:
+            i += 1
+        with self.__lock:
+            self.__counts[i] += 1
+            self.__n += 1
+            self.__total += latency
+            self.__max = max(self.__max, latency)
+
+    def getCount(self):
+        """ Return the number of latencies """
+
+        return self.__n
+
+    def getMean(self):
+        """ Return the mean latency [s] """
+
+        with self.__lock:
+            return self.__total / self.__n if self.__n else 0.0
+
+    def getPercentile(self, percentile):
+        """ Return the upper bound of the bucket holding the given percentile [s] (the max latency for the last bucket) """
+
+        with self.__lock:
+            if not self.__n:
+                return 0.0
+            rank = self.__n * percentile / 100.0
+            n = 0
+            for i, count in enumerate(self.__counts):
+                n += count
+                if n >= rank and count:
+                    return min(self.BOUNDS[i], self.__max) if i < len(self.BOUNDS) else self.__max
+
+            return self.__max
+
+    def __str__(self):
+        """ Return a one-line summary """
+
+        with self.__lock:
+            buckets = []
+            for i, count in enumerate(self.__counts):
+                if count:
+                    label = "<%g ms" % (self.BOUNDS[i] * 1000) if i < len(self.BOUNDS) else ">%g ms" % (self.BOUNDS[-1] * 1000)
+                    buckets.append("%s: %d" % (label, count))
+            n, total, maxLatency = self.__n, self.__total, self.__max
+        if not n:
+            return "%s: no messages" % (self.name)
+
+        return "%s: %d message(s), mean %.1f ms, p50 <= %.1f ms, p95 <= %.1f ms, max %.1f ms [%s]" %\
+               (self.name, n, total / n * 1000, self.getPercentile(50) * 1000, self.getPercentile(95) * 1000, maxLatency * 1000, ", ".join(buckets))
@@ -0,0 +1,297 @@
+# Class definition:
+#   LogScanner
+#   Single pass scanner of payload log files for a set of named patterns. The patterns are combined into one alternation
+#   that is searched in the memory mapped file; for every matching line all patterns are tested on the line, then the
+#   search continues with the next line. Only the count, the first and the last KEEP matching lines of every pattern and
+#   the last TAILLINES lines of the file are kept. The scan is incremental: scan() resumes from the end of the last
+#   complete line of the previous scan, and the state can be saved and loaded (see scanPayloadStdout()), so that the
+#   payload stdout is scanned during the Monitor checks and only the remainder is scanned during the job finalisation.
+#   A final scan also scans a last line without a newline (e.g. the payload was killed while writing it); this line is
+#   not included in the saved state, so it is scanned again (completed) if the file grows.
+
+import os
+import re
+import mmap
+import json
+import tempfile
+from collections import deque
+
+from pUtil import tolog
+
+# patterns for the payload stdout, FORMAT: [ (name, regular expression), .. ]
+PAYLOADPATTERNS = [
+    ('badalloc', r'St9bad_alloc|std::bad_alloc'),
+    ('eventsprocessed', r'events processed so far'),
+    ('sqlitelocking', r'prepare 5 database is locked.*Error SQLiteStatement|Error SQLiteStatement.*prepare 5 database is locked'),
+    ('wrongarchitecture', r'cling::DynamicLibraryManager::loadLibrary\(\):(?=.*GLIBC)(?=.*not found)'),
+    ('jobreport', r'Job Report produced by'),
+    ]
+
+class LogScanner(object):
+
+    # default settings
+    KEEP = 10                              # number of first and last matching lines kept per pattern
+    TAILLINES = 20                         # number of lines kept from the end of the file
+
+    def __init__(self, patterns, keep=KEEP, tailLines=TAILLINES):
+        """ patterns: list of (name, regular expression) """
+
+        self.patterns = [(name, regex) for (name, regex) in patterns]
+        self.keep = keep
+        self.tailLines = tailLines
+        self.__compiled = [(name, re.compile(regex)) for (name, regex) in self.patterns]
+        # (the patterns are not wrapped in groups, which would make the search several times slower)
+        self.__combined = re.compile('|'.join([regex for (name, regex) in self.patterns]), re.M)
+        self.reset()
+
+    def reset(self):
+        """ Forget all findings (the next scan starts at the beginning of the file) """
+
+        self.filename = None
+        self.inode = None
+        self.offset = 0                    # end of the last complete line scanned
+        self.__counts = dict.fromkeys([name for (name, regex) in self.patterns], 0)
+        self.__first = dict([(name, []) for (name, regex) in self.patterns])
+        self.__last = dict([(name, deque(maxlen=self.keep)) for (name, regex) in self.patterns])
+        self.__tail = []
+
+    def scan(self, filename, final=False):
+        """
+        Scan the file from the end of the previous scan until the end of the last complete line, return self.
+        final: scan until the end of the file (the file is complete, the last line may not end with a newline)
+        """
+
+        try:
+            s = os.stat(filename)
+        except OSError, e:
+            tolog("!!WARNING!!1299!! Cannot scan %s: %s" % (filename, e))
+            return self
+
+        # start again if the file has been replaced or truncated
+        if filename != self.filename or s.st_ino != self.inode or s.st_size < self.offset:
+            self.reset()
+            self.filename = filename
+            self.inode = s.st_ino
+        if s.st_size == self.offset:
+            return self
+
+        f = open(filename, 'r')
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            # the last line is scanned once it is complete (or in the final scan)
+            if final:
+                end = len(buf)
+            else:
+                end = buf.rfind('\n', self.offset) + 1
+            if end > self.offset:
+                self.__scan(buf, self.offset, end)
+                self.__updateTail(buf, end)
+                self.offset = end
+        finally:
+            buf.close()
+
+        return self
+
+    def __scan(self, buf, pos, end):
+        """ Search for the patterns between pos and end (both at the beginning of a line) """
+
+        search = self.__combined.search
+        while pos < end:
+            m = search(buf, pos, end)
+            if not m:
+                break
+            start = buf.rfind('\n', pos, m.start()) + 1
+            if start == 0:
+                start = pos
+            stop = buf.find('\n', m.end(), end)
+            if stop < 0:
+                stop = end
+            line = buf[start:stop]
+            for name, cp in self.__compiled:
+                if cp.search(line):
+                    self.__counts[name] += 1
+                    if len(self.__first[name]) < self.keep:
+                        self.__first[name].append((start, line))
+                    else:
+                        self.__last[name].append((start, line))
+            pos = stop + 1
+
+    def __updateTail(self, buf, end):
+        """ Keep the last lines before end """
+
+        start = end - 1
+        for i in range(self.tailLines):
+            start = buf.rfind('\n', self.offset, start)
+            if start < 0:
+                break
+        if start < 0:
+            # fewer lines than tailLines have been added since the previous scan
+            self.__tail = (self.__tail + self.__splitLines(buf[self.offset:end]))[-self.tailLines:]
+        else:
+            self.__tail = self.__splitLines(buf[start + 1:end])
+
+    def __splitLines(self, data):
+        """ Split data into lines (the last line may not end with a newline) """
+
+        lines = data.split('\n')
+        if data.endswith('\n'):
+            del lines[-1]
+        return lines
+
+    def getCount(self, name):
+        """ Return the number of lines matching the pattern """
+
+        return self.__counts[name]
+
+    def getMatches(self, name):
+        """ Return the kept (offset, line) of the lines matching the pattern (the first and the last KEEP lines) """
+
+        return self.__first[name] + list(self.__last[name])
+
+    def getLines(self, name):
+        """ Return the kept lines matching the pattern """
+
+        return [line for (offset, line) in self.getMatches(name)]
+
+    def getLastLine(self, name):
+        """ Return the last line matching the pattern ("" if none) """
+
+        matches = self.getMatches(name)
+        if matches:
+            return matches[-1][1]
+        return ""
+
+    def getTail(self):
+        """ Return the last lines of the scanned part of the file (including a last line without newline after a final scan) """
+
+        return list(self.__tail)
+
+    def save(self, stateFile):
+        """ Save the state of the scanner (replaced atomically) """
+
+        # the lines are stored as latin-1 so that any byte sequence can be written to the JSON file
+        _decode = lambda matches: [(offset, line.decode('latin-1')) for (offset, line) in matches]
+        state = {'patterns': self.patterns, 'filename': self.filename, 'inode': self.inode, 'offset': self.offset,
+                 'counts': self.__counts,
+                 'first': dict([(name, _decode(first)) for (name, first) in self.__first.iteritems()]),
+                 'last': dict([(name, _decode(last)) for (name, last) in self.__last.iteritems()]),
+                 'tail': [line.decode('latin-1') for line in self.__tail]}
+        # the temporary file is unique, the Monitor and the job finalisation can save the state at the same time
+        tmpName = None
+        try:
+            fd, tmpName = tempfile.mkstemp(prefix=os.path.basename(stateFile) + ".", suffix=".tmp", dir=os.path.dirname(stateFile) or ".")
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump(state, f)
+            finally:
+                f.close()
+            os.rename(tmpName, stateFile)
+        except (IOError, OSError, ValueError), e:
+            tolog("!!WARNING!!1299!! Cannot save log scanner state: %s" % (e))
+            if tmpName and os.path.exists(tmpName):
+                os.remove(tmpName)
+
+    def load(self, stateFile):
+        """ Restore the state of the scanner, return True if restored (the patterns must be the same) """
+
+        try:
+            f = open(stateFile, 'r')
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            tolog("!!WARNING!!1299!! Cannot load log scanner state: %s" % (e))
+            return False
+        if [tuple(p) for p in state['patterns']] != self.patterns or not state['filename']:
+            return False
+
+        _encode = lambda matches: [(offset, line.encode('latin-1')) for (offset, line) in matches]
+        self.reset()
+        self.filename = state['filename'].encode('utf-8')
+        self.inode = state['inode']
+        self.offset = state['offset']
+        for name, regex in self.patterns:
+            self.__counts[name] = state['counts'][name]
+            self.__first[name] = _encode(state['first'][name])
+            self.__last[name].extend(_encode(state['last'][name]))
+        self.__tail = [line.encode('latin-1') for line in state['tail']]
+
+        return True
+
+def getStateFilename(filename):
+    """ Return the name of the scanner state file of a log file """
+
+    return os.path.join(os.path.dirname(filename), ".%s.scan" % (os.path.basename(filename)))
+
+def scanPayloadStdout(filename, patterns=PAYLOADPATTERNS, final=False):
+    """
+    Scan the payload stdout incrementally (resume from the saved state), save the state and return the scanner.
+    final: also scan a last line without newline (after the state has been saved), for the checks after the payload
+    """
+
+    scanner = LogScanner(patterns)
+    stateFile = getStateFilename(filename)
+    if os.path.exists(stateFile):
+        scanner.load(stateFile)
+    scanner.scan(filename)
+    scanner.save(stateFile)
+    if final:
+        scanner.scan(filename, final=True)
+
+    return scanner
+
+def benchmark(filename=None, size=500):
+    """
+    Compare the former grep passes over the payload stdout (one per check, every pattern on every line) with a single
+    LogScanner pass, for a generated stdout of size MB (or the given file).
+    usage: python LogScanner.py [file name or size in MB]
+    """
+
+    import time
+    import tempfile
+    from pUtil import grep
+
+    tmpName = None
+    if not filename:
+        fd, tmpName = tempfile.mkstemp(suffix=".txt")
+        f = os.fdopen(fd, 'w')
+        other = "CaloCellMaker           INFO  ordinary log line with some numbers 12345 6789 and more text abcdefgh\n" * 9
+        n = size * 1024 * 1024 / (len(other) + 120)
+        for i in range(n):
+            f.write(other)
+            f.write("AthenaEventLoopMgr   INFO   ===>>>  done processing event #%d, run #284500 %d events processed so far  <<<===\n" % (i, i + 1))
+        f.write("Job Report produced by Athena\nJob Report produced by Athena\nExitCode 0\n")
+        f.close()
+        filename = tmpName
+
+    try:
+        print "payload stdout: %s (%d MB)" % (filename, os.path.getsize(filename) / 1024 / 1024)
+
+        t0 = time.time()
+        grep(["events processed so far"], filename)
+        grep(["St9bad_alloc", "std::bad_alloc"], filename)
+        grep(["prepare 5 database is locked"], filename)
+        grep(["Job Report produced by"], filename)
+        t1 = time.time()
+        scanner = LogScanner(PAYLOADPATTERNS).scan(filename)
+        t2 = time.time()
+
+        print "grep passes (4):  %.2f s" % (t1 - t0)
+        print "LogScanner pass:  %.2f s, %s" % (t2 - t1, ", ".join(["%s: %d" % (name, scanner.getCount(name)) for (name, regex) in PAYLOADPATTERNS]))
+        print "last events line: %s" % (scanner.getLastLine('eventsprocessed'))
+    finally:
+        if tmpName:
+            os.remove(tmpName)
+
+if __name__ == "__main__":
+
+    import sys
+    args = sys.argv[1:2]
+    if args and args[0].isdigit():
+        benchmark(size=int(args[0]))
+    else:
+        benchmark(*args)
@@ -0,0 +1,305 @@
+# This module contains the creation of the job log tarball (JobLog.createLogFile()), used instead of 'tar cvf' followed
+# by 'gzip -f' (two full passes over the log files and the tarball). The tarball is written in a single pass: the tar
+# stream is compressed while it is built, optionally by several threads (blocks of the stream are compressed in
+# parallel and concatenated, as pigz does), and the adler32 and md5 checksums of the compressed file are calculated
+# while it is written and stored in the Checksum cache, so the log stage-out does not read the file again.
+# The tarball corresponds to 'tar cf --dereference --one-file-system': links are followed, directories on other
+# file systems are not descended into. A regular file is stored once: further paths to the same file (hard links, or
+# symlinks that are followed) are added as hard link members to the first one (tarfile does not do this when it follows
+# links). Files can be excluded from the tarball with an exclude function.
+# A timeout limits the time spent on the tarball (as the former timed tar command), it is checked before every file
+# and every block read from a file.
+
+import os
+import time
+import zlib
+import struct
+import hashlib
+import tarfile
+import threading
+from Queue import Queue
+from collections import deque
+
+from pUtil import tolog
+from Checksum import setCachedChecksums
+
+class LogTarballTimeout(Exception):
+    """ The log tarball could not be created within the timeout """
+    pass
+
+class ParallelGzipWriter(object):
+    """
+    File-like object that writes a gzip file. With threads > 1 the data is split into blocks that are compressed
+    in parallel (each block is a separate deflate stream ended with a sync flush, the result is a standard gzip file)
+    """
+
+    BLOCKSIZE = 1024 * 1024                # uncompressed block size for the parallel compression
+
+    def __init__(self, filename, compresslevel=6, threads=1):
+        """ Create the gzip file """
+
+        self.filename = filename
+        self.compresslevel = compresslevel
+        self.threads = max(1, threads)
+
+        self.size = 0                      # uncompressed size
+        self.csize = 0                     # compressed size
+        self.__crc = zlib.crc32("")
+        self.__adler32 = 1
+        self.__md5 = hashlib.md5()
+        self.__file = open(filename, 'wb')
+
+        # gzip header: magic, deflate, no flags, mtime, no extra flags, unix
+        self.__output("\037\213\010\000" + struct.pack("<I", int(time.time())) + "\000\003")
+
+        if self.threads == 1:
+            self.__compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        else:
+            self.__compressor = None
+            self.__blocks = []             # data for the next block
+            self.__blocksize = 0
+            self.__pending = deque()       # FORMAT: [[threading.Event, compressed data or exception], ..] in stream order
+            self.__queue = Queue()
+            self.__workers = []
+            for i in range(self.threads):
+                worker = threading.Thread(target=self.__compressBlocks, name="ParallelGzipWriter-%d" % (i))
+                worker.setDaemon(True)
+                worker.start()
+                self.__workers.append(worker)
+
+    def __output(self, data):
+        """ Write compressed data to the file and add it to the checksums """
+
+        if data:
+            self.__file.write(data)
+            self.__adler32 = zlib.adler32(data, self.__adler32)
+            self.__md5.update(data)
+            self.csize += len(data)
+
+    def __compressBlocks(self):
+        """ Worker thread: compress the queued blocks (zlib releases the GIL while compressing) """
+
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                break
+            data, last, result = item
+            try:
+                compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+                result[1] = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+            except Exception, e:
+                result[1] = e
+            result[0].set()
+
+    def __submit(self, last=False):
+        """ Queue the collected data as a block for compression """
+
+        result = [threading.Event(), None]
+        self.__pending.append(result)
+        self.__queue.put(("".join(self.__blocks), last, result))
+        self.__blocks = []
+        self.__blocksize = 0
+
+        # write the finished blocks in order, keep at most two blocks per thread in memory
+        while self.__pending and (self.__pending[0][0].isSet() or len(self.__pending) > 2 * self.threads or last):
+            self.__pending[0][0].wait()
+            event, data = self.__pending.popleft()
+            if isinstance(data, Exception):
+                raise data
+            self.__output(data)
+
+    def write(self, data):
+        """ Compress and write data """
+
+        self.__crc = zlib.crc32(data, self.__crc)
+        self.size += len(data)
+        if self.__compressor:
+            self.__output(self.__compressor.compress(data))
+        else:
+            self.__blocks.append(data)
+            self.__blocksize += len(data)
+            if self.__blocksize >= self.BLOCKSIZE:
+                self.__submit()
+
+    def close(self):
+        """ Finish the compression, close the file and return its checksums {'adler32': .., 'md5': ..} """
+
+        try:
+            if self.__compressor:
+                self.__output(self.__compressor.flush())
+            else:
+                self.__submit(last=True)
+            self.__output(struct.pack("<II", self.__crc & 0xffffffffL, self.size & 0xffffffffL))
+        finally:
+            if not self.__compressor:
+                for worker in self.__workers:
+                    self.__queue.put(None)
+            self.__file.close()
+
+        asum = self.__adler32
+        if asum < 0:
+            asum += 2**32
+        checksums = {'adler32': "%08x" % asum, 'md5': self.__md5.hexdigest()}
+        setCachedChecksums(self.filename, checksums)
+
+        return checksums
+
+class PaddedFile(object):
+    """ Read-only file that returns zeros after the end of the file (a file that shrinks while it is added to the tarball) """
+
+    def __init__(self, path, deadline=None):
+        self.path = path
+        self.deadline = deadline
+        self.__file = open(path, 'rb')
+        self.shrunk = False
+
+    def read(self, size):
+        if self.deadline and time.time() > self.deadline:
+            raise LogTarballTimeout("timeout while reading %s" % (self.path))
+        data = self.__file.read(size)
+        if len(data) < size:
+            self.shrunk = True
+            data += tarfile.NUL * (size - len(data))
+        return data
+
+    def close(self):
+        self.__file.close()
+
+def createLogTarball(filename, directory, exclude=None, compresslevel=6, threads=1, timeout=None):
+    """
+    Create the gzipped tarball filename from directory (member names are relative to the current directory, as for tar).
+    exclude: function (path, tarinfo) that returns the reason to leave out a file, or None.
+    timeout: max time [s] to create the tarball, LogTarballTimeout is raised (and the partial tarball removed) after it.
+    Return a dictionary with the number of added and excluded files, the uncompressed and compressed size [B], the
+    checksums of the tarball and the time it took [s]
+    """
+
+    t0 = time.time()
+    deadline = t0 + timeout if timeout else None
+    nfiles = 0
+    excluded = []
+
+    gz = ParallelGzipWriter(filename, compresslevel=compresslevel, threads=threads)
+    tar = tarfile.open(fileobj=gz, mode='w|', format=tarfile.GNU_FORMAT, dereference=True)
+    try:
+        root_dev = os.stat(directory).st_dev
+        visited = set()            # (st_dev, st_ino) of the directories, followed links can point back up
+        members = {}               # FORMAT: { (st_dev, st_ino): name of the first member of a regular file }
+        paths = [directory]
+        while paths:
+            if deadline and time.time() > deadline:
+                raise LogTarballTimeout("%d files added, %d paths left" % (nfiles, len(paths)))
+            path = paths.pop()
+            try:
+                tarinfo = tar.gettarinfo(path)
+            except (OSError, IOError), e:
+                # e.g. a broken link
+                tolog("!!WARNING!!4343!! Cannot add %s to the log tarball: %s" % (path, e))
+                continue
+            if tarinfo is None:
+                tolog("Skipping %s (unsupported file type)" % (path))
+                continue
+
+            if tarinfo.isreg():
+                reason = exclude(path, tarinfo) if exclude else None
+                if reason:
+                    tolog("Excluding %s from the log tarball: %s" % (path, reason))
+                    excluded.append(path)
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError, e:
+                    tolog("!!WARNING!!4343!! Cannot add %s to the log tarball: %s" % (path, e))
+                    continue
+                key = (st.st_dev, st.st_ino)
+                if key in members:
+                    # the data is already in the tarball
+                    tarinfo.type = tarfile.LNKTYPE
+                    tarinfo.linkname = members[key]
+                    tarinfo.size = 0
+                    tar.addfile(tarinfo)
+                    nfiles += 1
+                    continue
+                try:
+                    f = PaddedFile(path, deadline)
+                except IOError, e:
+                    tolog("!!WARNING!!4343!! Cannot add %s to the log tarball: %s" % (path, e))
+                    continue
+                try:
+                    tar.addfile(tarinfo, f)
+                finally:
+                    f.close()
+                if f.shrunk:
+                    tolog("!!WARNING!!4343!! File %s has shrunk while being added to the log tarball (padded with zeros)" % (path))
+                members[key] = tarinfo.name
+            else:
+                tar.addfile(tarinfo)
+            nfiles += 1
+
+            if tarinfo.isdir():
+                st = os.stat(path)
+                if st.st_dev != root_dev:
+                    tolog("Not descending into %s (other file system)" % (path))
+                elif (st.st_dev, st.st_ino) not in visited:
+                    visited.add((st.st_dev, st.st_ino))
+                    try:
+                        names = sorted(os.listdir(path), reverse=True)
+                    except OSError, e:
+                        tolog("!!WARNING!!4343!! Cannot read directory %s: %s" % (path, e))
+                    else:
+                        paths.extend([os.path.join(path, name) for name in names])
+    except LogTarballTimeout, e:
+        # the partial tarball is removed (it is closed below)
+        tolog("!!WARNING!!4343!! Log tarball not finished after %d s, removing %s: %s" % (timeout, filename, e))
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        raise
+    finally:
+        tar.close()
+        checksums = gz.close()
+
+    return {'files': nfiles, 'excluded': len(excluded), 'size': gz.size, 'csize': gz.csize, 'checksums': checksums, 'time': time.time() - t0}
+
+def benchmark(directory, threads=4):
+    """
+    Compare the tarball creation with 'tar cvf' + 'gzip -f' for a directory.
+    usage: python LogTarball.py <directory> [threads]
+    """
+
+    import shutil
+    import tempfile
+    import commands
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        directory = os.path.abspath(directory)
+        cwd = os.getcwd()
+        os.chdir(os.path.dirname(directory))
+        try:
+            tarball = os.path.join(tmpdir, "former.tar")
+            t0 = time.time()
+            commands.getstatusoutput("tar cvf %s %s --dereference --one-file-system; gzip -f %s" % (tarball, os.path.basename(directory), tarball))
+            t1 = time.time()
+            results = []
+            for n in sorted(set([1, threads])):
+                results.append((n, createLogTarball(os.path.join(tmpdir, "log-%d.tgz" % (n)), os.path.basename(directory), threads=n)))
+        finally:
+            os.chdir(cwd)
+
+        print "tar cvf + gzip -f:            %8.2f s (%d bytes)" % (t1 - t0, os.path.getsize(tarball + ".gz"))
+        for n, result in results:
+            print "createLogTarball, %d thread(s): %8.2f s (%d bytes, %.1f MB/s)" % (n, result['time'], result['csize'], result['size'] / result['time'] / 1024**2)
+            ec, rs = commands.getstatusoutput("tar tzf %s | wc -l" % (os.path.join(tmpdir, "log-%d.tgz" % (n))))
+            print "  verified with tar tzf: exit code %d, %s members" % (ec, rs.strip())
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+
+    import sys
+    if len(sys.argv) < 2:
+        print benchmark.__doc__
+    else:
+        benchmark(sys.argv[1], *[int(arg) for arg in sys.argv[2:3]])
@@ -0,0 +1,141 @@
+# Class definition:
+#   LogWriter
+#   Buffered writer for the pilot log, used by pUtil.tolog()
+#   Log lines are appended to a buffer and written to the log file(s) in batches by a background thread, so that
+#   the log file is opened once per batch instead of once per line. The buffer is flushed synchronously when it is full,
+#   at exit, on request (flushLog() in pUtil, e.g. from signal handlers and before os._exit()/exec) and after fork.
+#   The buffer is a deque and the writer thread polls it: queuing a line takes no lock, so tolog() can be called from a
+#   signal handler that interrupted the main thread while it was queuing a line.
+#   Note: this module must not import pUtil (pUtil imports it)
+
+import os
+import time
+import json
+import atexit
+import threading
+from collections import deque
+
+class LogWriter(object):
+
+    # private data members
+    __instance = None                      # Singleton instance
+
+    def __new__(cls, *args, **kwargs):
+        """ Override the __new__ method to make the class a singleton """
+
+        if not cls.__instance:
+            cls.__instance = super(LogWriter, cls).__new__(cls, *args, **kwargs)
+            cls.__instance.__jsonFilename = os.environ.get('PILOT_JSON_LOG', None)
+            cls.__instance.__setup()
+            atexit.register(cls.__instance.flush)
+
+        return cls.__instance
+
+    def __setup(self, maxsize=10000, interval=1.0):
+        """ Create the queue and the writer thread (called again in a forked child process) """
+
+        self.__pid = os.getpid()
+        self.__buffer = deque()             # append() and popleft() are atomic
+        self.__maxsize = maxsize
+        self.__lock = threading.RLock()     # serializes the file writes
+        self.__interval = interval          # max time [s] a line stays in the buffer
+        self.__thread = threading.Thread(target=self.__run, name="LogWriter")
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def __checkFork(self):
+        """ Restart the writer in a forked child process (the thread is not inherited; queued lines belong to the parent) """
+
+        if self.__pid != os.getpid():
+            self.__setup(interval=self.__interval)
+
+    def setJSONFilename(self, filename):
+        """ Also write every log line as a JSON record to filename (None to switch off; default: $PILOT_JSON_LOG) """
+
+        self.__jsonFilename = filename
+
+    def getJSONFilename(self):
+        """ Return the name of the JSON lines log file (None if not used) """
+
+        return self.__jsonFilename
+
+    def write(self, filename, t, pid, module_name, msg):
+        """ Queue a log line for filename, using the pUtil.tolog() line format """
+
+        self.__checkFork()
+
+        record = None
+        if self.__jsonFilename:
+            record = json.dumps({'time': t, 'pid': pid, 'module': module_name.strip(), 'message': msg})
+
+        self.__put((filename, "%s|%i|%s| %s\n" % (t, pid, module_name, msg), record))
+
+    def append(self, filename, txt):
+        """ Queue a raw text for filename """
+
+        self.__checkFork()
+        self.__put((filename, txt, None))
+
+    def __put(self, item):
+        """ Append an item to the buffer (no lock is taken, safe in signal handlers) """
+
+        self.__buffer.append(item)
+        if len(self.__buffer) >= self.__maxsize:
+            # the writer thread cannot keep up, write the queued lines from this thread
+            self.flush()
+
+    def flush(self):
+        """ Write all queued lines to file """
+
+        if self.__pid != os.getpid():
+            return
+
+        with self.__lock:
+            items = []
+            while True:
+                try:
+                    items.append(self.__buffer.popleft())
+                except IndexError:
+                    break
+            self.__writeItems(items)
+
+    def __writeItems(self, items):
+        """ Append the items to their files, opening each file once """
+
+        if not items:
+            return
+
+        # keep the order of the lines, group consecutive lines for the same file
+        batches = []
+        records = []
+        for filename, txt, record in items:
+            if batches and batches[-1][0] == filename:
+                batches[-1][1].append(txt)
+            else:
+                batches.append((filename, [txt]))
+            if record:
+                records.append(record + "\n")
+        if records and self.__jsonFilename:
+            batches.append((self.__jsonFilename, records))
+
+        for filename, lines in batches:
+            try:
+                f = open(filename, 'a')
+                try:
+                    f.write("".join(lines))
+                finally:
+                    f.close()
+            except Exception, e:
+                if "No such file" in str(e):
+                    pass
+                else:
+                    print "WARNING: Exception caught: %s" % e
+
+    def __run(self):
+        """ Writer thread: write the queued lines every interval """
+
+        pid = self.__pid
+        while pid == os.getpid():
+            time.sleep(self.__interval)
+            if self.__buffer:
+                self.flush()
@@ -0,0 +1,323 @@
+# Class definition:
+#   MemorySampler
+#   In-pilot sampler of the memory usage of the payload process tree (used instead of the VmPeak post-processing of the
+#   PerfMon files when no memory monitor utility is executed, see Experiment::shouldExecuteUtility()).
+#   The VMEM, PSS, RSS and swap of all processes in the tree are read from /proc/<pid>/statm and /proc/<pid>/smaps_rollup
+#   (summed over the mappings in /proc/<pid>/smaps on kernels without smaps_rollup) every interval seconds. RSS is not
+#   used in place of PSS (the pages shared by the forked workers would be counted once per worker): a sample for which
+#   PSS cannot be read does not contribute to maxPSS/avgPSS, without any such sample they are -1 in the summary and the
+#   Monitor skips the memory limit check.
+#   The samples are appended to a time-series file in the format of the memory monitor text output, the max and average
+#   values are calculated incrementally and written to a summary JSON file in the format of the memory monitor summary
+#   file, which is read by the Monitor for the memory limit check and by PandaServerClient for the job updates.
+#   All values are in kB.
+
+import os
+import json
+import time
+
+from pUtil import tolog, readpar
+from ProcessTable import ProcessTable
+from StoppableThread import StoppableThread
+from WakeupEvent import WakeupEvent
+
+OUTPUTFILE = "memory_sampler_output.txt"
+SUMMARYFILE = "memory_sampler_summary.json"
+
+class MemorySampler(StoppableThread):
+
+    # default settings
+    INTERVAL = 10                          # seconds between two samples
+    SUMMARYINTERVAL = 60                   # seconds between two updates of the summary file
+
+    def __init__(self, workdir, interval=INTERVAL, summaryInterval=SUMMARYINTERVAL):
+        """ workdir: directory for the time-series and summary files """
+
+        StoppableThread.__init__(self, target=self.sampleLoop, name='MemorySampler')
+        self.setDaemon(True)
+
+        self.workdir = workdir
+        self.interval = interval
+        self.summaryInterval = summaryInterval
+        self.__pid = None
+        self.__wakeup = WakeupEvent()
+        self.__pagesize = 4
+        try:
+            self.__pagesize = os.sysconf(os.sysconf_names['SC_PAGE_SIZE']) / 1024
+        except Exception:
+            pass
+
+        # incrementally updated statistics, FORMAT: { 'VMEM': value, 'PSS': value, 'RSS': value, 'Swap': value }
+        self.__n = 0
+        self.__max = dict.fromkeys(['VMEM', 'PSS', 'RSS', 'Swap'], 0)
+        self.__total = dict.fromkeys(['VMEM', 'PSS', 'RSS', 'Swap'], 0)
+        self.__sampleTime = 0.0            # time spent reading /proc [s], for the overhead report
+        self.__nPSS = 0                    # number of samples with PSS (PSS could be read for every process)
+        self.__warnedPSS = False
+
+    def setPid(self, pid):
+        """ Set the pid of the root of the process tree (e.g. the next payload command) """
+
+        self.__pid = pid
+
+    def stop(self):
+        """ Stop the sampling loop (the summary file is written before the thread ends) """
+
+        StoppableThread.stop(self)
+        self.__wakeup.set()
+
+    def getSampleCount(self):
+        """ Return the number of samples """
+
+        return self.__n
+
+    def getSampleTime(self):
+        """ Return the time spent taking the samples [s] """
+
+        return self.__sampleTime
+
+    def sampleLoop(self):
+        """ Thread: take a sample every interval seconds until the thread is stopped """
+
+        try:
+            output = open(os.path.join(self.workdir, OUTPUTFILE), 'a')
+        except IOError, e:
+            tolog("!!WARNING!!4545!! Memory sampler cannot create the output file: %s" % (e))
+            return
+
+        tolog("Memory sampler started (interval: %d s)" % (self.interval))
+        if output.tell() == 0:
+            output.write("Time\tVMEM\tPSS\tRSS\tSwap\n")
+        lastSummary = time.time()
+        try:
+            while not self.stopped():
+                values = self.sample()
+                if values:
+                    output.write("%d\t%d\t%d\t%d\t%d\n" % ((int(time.time()),) + values))
+                    output.flush()
+                if time.time() - lastSummary >= self.summaryInterval:
+                    self.writeSummary()
+                    lastSummary = time.time()
+                self.__wakeup.wait(self.interval)
+        finally:
+            output.close()
+            self.writeSummary()
+            self.__wakeup.close()
+            tolog("Memory sampler stopped after %d sample(s) (%.3f s spent sampling)" % (self.__n, self.__sampleTime))
+
+    def sample(self):
+        """ Read the memory of the process tree and update the statistics, return (VMEM, PSS, RSS, Swap) or None """
+
+        if not self.__pid:
+            return None
+
+        t0 = time.time()
+        vmem = pss = rss = swap = 0
+        found = False
+        for pid in ProcessTable().getSubtree(self.__pid):
+            values = readMemory(pid, self.__pagesize)
+            if values:
+                found = True
+                vmem += values[0]
+                if values[1] is None or pss < 0:
+                    pss = -1
+                else:
+                    pss += values[1]
+                rss += values[2]
+                swap += values[3]
+        self.__sampleTime += time.time() - t0
+
+        # the process tree has finished (e.g. between two payload commands)
+        if not found:
+            return None
+
+        self.__n += 1
+        values = [('VMEM', vmem), ('RSS', rss), ('Swap', swap)]
+        if pss >= 0:
+            self.__nPSS += 1
+            values.append(('PSS', pss))
+        elif not self.__warnedPSS:
+            tolog("!!WARNING!!4545!! Memory sampler cannot read the PSS of all payload processes (sample not used for maxPSS)")
+            self.__warnedPSS = True
+        for key, value in values:
+            self.__total[key] += value
+            if value > self.__max[key]:
+                self.__max[key] = value
+
+        return vmem, pss, rss, swap
+
+    def getSummary(self):
+        """ Return the max and average values in the format of the memory monitor summary ({} if there are no samples) """
+
+        if not self.__n:
+            return {}
+
+        summary = { "Max": {}, "Avg": {} }
+        for key in ['VMEM', 'RSS', 'Swap']:
+            summary["Max"]["max%s" % (key)] = self.__max[key]
+            summary["Avg"]["avg%s" % (key)] = int(float(self.__total[key]) / self.__n)
+        if self.__nPSS:
+            summary["Max"]["maxPSS"] = self.__max['PSS']
+            summary["Avg"]["avgPSS"] = int(float(self.__total['PSS']) / self.__nPSS)
+        else:
+            summary["Max"]["maxPSS"] = summary["Avg"]["avgPSS"] = -1
+
+        return summary
+
+    def writeSummary(self):
+        """ Write the summary file (replaced atomically, so that it can be read at any time) """
+
+        summary = self.getSummary()
+        if not summary:
+            return
+
+        filename = os.path.join(self.workdir, SUMMARYFILE)
+        try:
+            f = open(filename + ".tmp", 'w')
+            try:
+                json.dump(summary, f)
+            finally:
+                f.close()
+            os.rename(filename + ".tmp", filename)
+        except (IOError, OSError), e:
+            tolog("!!WARNING!!4545!! Memory sampler cannot write the summary file: %s" % (e))
+
+def readMemory(pid, pagesize=4):
+    """
+    Return (VMEM, PSS, RSS, Swap) [kB] of a process, None if the process does not exist (any longer).
+    PSS is None if neither /proc/<pid>/smaps_rollup nor /proc/<pid>/smaps can be read
+    """
+
+    try:
+        f = open("/proc/%d/statm" % (pid), 'r')
+        try:
+            fields = f.read().split()
+        finally:
+            f.close()
+        vmem = int(fields[0]) * pagesize
+        rss = int(fields[1]) * pagesize
+
+        try:
+            f = open("/proc/%d/smaps_rollup" % (pid), 'r')
+        except IOError:
+            # older kernel: the values are summed over all mappings
+            try:
+                f = open("/proc/%d/smaps" % (pid), 'r')
+            except IOError:
+                f = None
+        if not f:
+            swap = 0
+            f = open("/proc/%d/status" % (pid), 'r')
+            try:
+                for line in f:
+                    if line.startswith('VmSwap:'):
+                        swap = int(line.split()[1])
+            finally:
+                f.close()
+            return vmem, None, rss, swap
+
+        pss = rss = swap = 0
+        try:
+            for line in f:
+                if line.startswith('Pss:'):
+                    pss += int(line.split()[1])
+                elif line.startswith('Rss:'):
+                    rss += int(line.split()[1])
+                elif line.startswith('Swap:'):
+                    swap += int(line.split()[1])
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError, IndexError):
+        # the process has finished, is a zombie or belongs to another user
+        return None
+
+    return vmem, pss, rss, swap
+
+def getSamplingInterval(default=0):
+    """ Return the memory sampling interval [s] (0: no sampling), catchall setting: memory_sampling_interval=<s> """
+
+    interval = default
+    for entry in readpar('catchall').split(','):
+        if entry.startswith('memory_sampling_interval='):
+            try:
+                interval = int(entry.split('=')[1])
+            except ValueError, e:
+                tolog("!!WARNING!!4545!! Invalid memory sampling interval in catchall: %s (%s)" % (entry, e))
+
+    return interval
+
+def readSummary(workdir):
+    """ Return the summary dictionary of the memory sampler ({} if there is no summary file) """
+
+    filename = os.path.join(workdir, SUMMARYFILE)
+    if not os.path.exists(filename):
+        return {}
+    try:
+        f = open(filename, 'r')
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError), e:
+        tolog("!!WARNING!!4545!! Cannot read memory sampler summary %s: %s" % (filename, e))
+        return {}
+
+def getUtilityNode(summary):
+    """ Return the memory values for the job update (see Experiment::getUtilityInfo()) """
+
+    node = {}
+    if summary:
+        node['maxRSS'] = summary['Max']['maxRSS']
+        node['maxVMEM'] = summary['Max']['maxVMEM']
+        node['maxSWAP'] = summary['Max']['maxSwap']
+        if summary['Max']['maxPSS'] >= 0:
+            node['maxPSS'] = summary['Max']['maxPSS']
+        node['avgRSS'] = summary['Avg']['avgRSS']
+        node['avgVMEM'] = summary['Avg']['avgVMEM']
+        node['avgSWAP'] = summary['Avg']['avgSwap']
+        if summary['Avg']['avgPSS'] >= 0:
+            node['avgPSS'] = summary['Avg']['avgPSS']
+
+    return node
+
+def benchmark(nprocs=20, nsamples=100):
+    """
+    Measure the sampler overhead: the CPU and wall time per sample for a process tree of nprocs processes, compared with
+    the former 'ps' based point check of the process tree memory.
+    usage: python MemorySampler.py [number of processes] [number of samples]
+    """
+
+    import shutil
+    import tempfile
+    import commands
+    import subprocess
+
+    workdir = tempfile.mkdtemp()
+    root = subprocess.Popen("for i in $(seq %d); do sleep 600 & done; wait" % (nprocs - 1), shell=True)
+    try:
+        time.sleep(1)
+        sampler = MemorySampler(workdir)
+        sampler.setPid(root.pid)
+
+        c0, t0 = os.times()[0:2], time.time()
+        for i in range(nsamples):
+            values = sampler.sample()
+        c1, t1 = os.times()[0:2], time.time()
+        for i in range(nsamples):
+            commands.getoutput("ps -o vsz=,rss= --ppid %d --pid %d" % (root.pid, root.pid))
+        t2 = time.time()
+
+        print "process tree: %d processes, VMEM %d kB, PSS %d kB, RSS %d kB, Swap %d kB" % ((len(ProcessTable().getSubtree(root.pid)),) + values)
+        print "memory sampler: %.2f ms wall, %.2f ms cpu per sample" % ((t1 - t0) * 1000 / nsamples, (c1[0] + c1[1] - c0[0] - c0[1]) * 1000 / nsamples)
+        print "ps point check: %.2f ms wall per check" % ((t2 - t1) * 1000 / nsamples)
+        print "overhead at the default interval (%d s): %.4f%% of one core" % (MemorySampler.INTERVAL, (t1 - t0) / nsamples / MemorySampler.INTERVAL * 100)
+        print sampler.getSummary()
+    finally:
+        commands.getoutput("pkill -P %d sleep" % (root.pid))
+        root.wait()
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+
+    import sys
+    benchmark(*[int(arg) for arg in sys.argv[1:3]])
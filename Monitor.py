@@ -23,6 +23,8 @@ from WatchDog import WatchDog
 from PilotTCPServer import PilotTCPServer
 from UpdateHandler import UpdateHandler
 from RunJobFactory import RunJobFactory
+from MemorySampler import readSummary
+from LogScanner import scanPayloadStdout
 from FileHandling import updatePilotErrorReport, getDirSize, storeWorkDirSize, getOsTimesTuple, readFile, get_files, tail, find_latest_modified_file
 
 import inspect
@@ -110,6 +112,7 @@ class Monitor:
         for k in self.__env['jobDic'].keys():
             # get list of log files
             fileList = glob("%s/log.*" % (self.__env['jobDic'][k][1].workdir))
+            stdoutList = []
 
             # is this a multi-trf job?
             nJobs = self.__env['jobDic'][k][1].jobPars.count("\n") + 1
@@ -122,6 +125,7 @@ class Monitor:
 
                 # add the primary stdout file to the fileList
                 fileList.append(filename)
+                stdoutList.append(filename)
 
             # now loop over all files and check each individually (any large enough file will fail the job)
             for filename in fileList:
@@ -162,6 +166,13 @@ class Monitor:
                                     ec = pUtil.removeFiles(self.__env['jobDic'][k][1].workdir, self.__env['jobDic'][k][1].inFiles)
                         else:
                             pUtil.tolog("Payload stdout (%s) within allowed size limit (%d B): %d B" % (_stdout, self.__env['localsizelimit_stdout']*1024, fsize))
+
+                            # scan the new part of the payload stdout (the job finalisation only scans the remainder)
+                            if filename in stdoutList:
+                                try:
+                                    scanPayloadStdout(filename)
+                                except Exception, e:
+                                    pUtil.tolog("!!WARNING!!1999!! Failed to scan %s: %s" % (filename, e))
                 else:
                     pUtil.tolog("(Skipping file size check of payload stdout file (%s) since it has not been created yet)" % (_stdout))
 
@@ -309,7 +320,8 @@ class Monitor:
     def __check_memory_usage(self):
         """
         Every minute check the memory usage of the payload
-        Note: requires that the memory monitoring tool is executed (as specified in Experiment::shouldExecuteUtility())
+        Note: the values come from the memory monitoring tool (if it is executed, as specified in Experiment::shouldExecuteUtility())
+        or otherwise from the memory sampler (MemorySampler)
         """
 
         if (int(time.time()) - self.__env['curtime_mem']) > 60:
@@ -317,64 +329,67 @@ class Monitor:
 
             # get the experiment object and check if the memory utility should be used
             thisExperiment = pUtil.getExperiment(self.__env['experiment'])
-            if thisExperiment.shouldExecuteUtility():
-                for k in self.__env['jobDic'].keys():
+            useUtility = thisExperiment.shouldExecuteUtility()
+            for k in self.__env['jobDic'].keys():
 
-                    # Get the maxPSS value from the memory monitor
+                # Get the maxPSS value from the memory monitor (or from the memory sampler of the RunJob process)
+                if useUtility:
                     summary_dictionary = thisExperiment.getMemoryValues(self.__env['jobDic'][k][1].workdir, self.__env['pilot_initdir'])
-                    try:
-                        maxPSS_int = summary_dictionary['Max']['maxPSS']
-                    except Exception, e:
-                        if summary_dictionary != {}:
-                            pUtil.tolog("!!WARNING!!3434!! Could not extract maxPSS value from: %s" % str(summary_dictionary))
+                else:
+                    summary_dictionary = readSummary(self.__env['jobDic'][k][1].workdir)
+                try:
+                    maxPSS_int = summary_dictionary['Max']['maxPSS']
+                except Exception, e:
+                    if summary_dictionary != {}:
+                        pUtil.tolog("!!WARNING!!3434!! Could not extract maxPSS value from: %s" % str(summary_dictionary))
+                    else:
+                        # Normally this means that the memory output file has not been produced yet, so skip it
+                        pass 
+                    maxPSS_int = -1
+
+                # Only proceed if values are set (-1 also when the memory sampler could not read the PSS)
+                if maxPSS_int != -1:
+                    maxRSS = pUtil.readpar('maxrss')  # string
+                    if maxRSS:
+                        # correction for SCORE/4CORE/nCORE jobs on UCORE queues
+                        try:
+                            pUtil.tolog('job.coreCount=%f' % float(self.__env['jobDic'][k][1].coreCount))
+                            pUtil.tolog('schedconfig.corecount=%f' % float(pUtil.readpar('corecount')))
+                            scale = float(self.__env['jobDic'][k][1].coreCount) / float(pUtil.readpar('corecount'))
+                            pUtil.tolog('scale=%f' % scale)
+                        except Exception as e:
+                            pUtil.tolog('!!WARNING!!9910!! Exception caught: %s' % e)
+                            scale = 1
+                        try:
+                            maxRSS_int = 2 * int(maxRSS * scale) * 1024  # Convert to int and kB
+                        except Exception, e:
+                            pUtil.tolog("!!WARNING!!9900!! Unexpected value for maxRSS: %s" % e)
                         else:
-                            # Normally this means that the memory output file has not been produced yet, so skip it
-                            pass 
-                        maxPSS_int = -1
-
-                    # Only proceed if values are set
-                    if maxPSS_int != -1:
-                        maxRSS = pUtil.readpar('maxrss')  # string
-                        if maxRSS:
-                            # correction for SCORE/4CORE/nCORE jobs on UCORE queues
-                            try:
-                                pUtil.tolog('job.coreCount=%f' % float(self.__env['jobDic'][k][1].coreCount))
-                                pUtil.tolog('schedconfig.corecount=%f' % float(pUtil.readpar('corecount')))
-                                scale = float(self.__env['jobDic'][k][1].coreCount) / float(pUtil.readpar('corecount'))
-                                pUtil.tolog('scale=%f' % scale)
-                            except Exception as e:
-                                pUtil.tolog('!!WARNING!!9910!! Exception caught: %s' % e)
-                                scale = 1
-                            try:
-                                maxRSS_int = 2 * int(maxRSS * scale) * 1024  # Convert to int and kB
-                            except Exception, e:
-                                pUtil.tolog("!!WARNING!!9900!! Unexpected value for maxRSS: %s" % e)
-                            else:
-                                # Compare the maxRSS with the maxPSS from memory monitor
-                                if maxRSS_int > 0:
-                                    if maxPSS_int > 0:
-                                        if maxPSS_int > maxRSS_int:
-                                            pilotErrorDiag = "Job has exceeded the memory limit %d kB > %d kB (2*schedconfig.maxrss)" % (maxPSS_int, maxRSS_int)
-                                            pUtil.tolog("!!WARNING!!9902!! %s" % (pilotErrorDiag))
-
-                                            # Create a lockfile to let RunJob know that it should not restart the memory monitor after it has been killed
-                                            pUtil.createLockFile(False, self.__env['jobDic'][k][1].workdir, lockfile="MEMORYEXCEEDED")
-
-                                            # Kill the job
-                                            killProcesses(self.__env['jobDic'][k][0], self.__env['jobDic'][k][1].pgrp)
-                                            self.__env['jobDic'][k][1].result[0] = "failed"
-                                            self.__env['jobDic'][k][1].currentState = self.__env['job'].result[0]
-                                            self.__env['jobDic'][k][1].result[2] = self.__error.ERR_PAYLOADEXCEEDMAXMEM
-                                            self.__env['jobDic'][k][1].pilotErrorDiag = pilotErrorDiag
-                                        else:
-                                            pUtil.tolog("Max memory (maxPSS) used by the payload is within the allowed limit: %d kB (2*maxRSS=%d kB, scale=%f)" % (maxPSS_int, maxRSS_int, scale))
+                            # Compare the maxRSS with the maxPSS from memory monitor
+                            if maxRSS_int > 0:
+                                if maxPSS_int > 0:
+                                    if maxPSS_int > maxRSS_int:
+                                        pilotErrorDiag = "Job has exceeded the memory limit %d kB > %d kB (2*schedconfig.maxrss)" % (maxPSS_int, maxRSS_int)
+                                        pUtil.tolog("!!WARNING!!9902!! %s" % (pilotErrorDiag))
+
+                                        # Create a lockfile to let RunJob know that it should not restart the memory monitor after it has been killed
+                                        pUtil.createLockFile(False, self.__env['jobDic'][k][1].workdir, lockfile="MEMORYEXCEEDED")
+
+                                        # Kill the job
+                                        killProcesses(self.__env['jobDic'][k][0], self.__env['jobDic'][k][1].pgrp)
+                                        self.__env['jobDic'][k][1].result[0] = "failed"
+                                        self.__env['jobDic'][k][1].currentState = self.__env['job'].result[0]
+                                        self.__env['jobDic'][k][1].result[2] = self.__error.ERR_PAYLOADEXCEEDMAXMEM
+                                        self.__env['jobDic'][k][1].pilotErrorDiag = pilotErrorDiag
                                     else:
-                                        pUtil.tolog("!!WARNING!!9903!! Unexpected MemoryMonitor maxPSS value: %d" % (maxPSS_int))
+                                        pUtil.tolog("Max memory (maxPSS) used by the payload is within the allowed limit: %d kB (2*maxRSS=%d kB, scale=%f)" % (maxPSS_int, maxRSS_int, scale))
+                                else:
+                                    pUtil.tolog("!!WARNING!!9903!! Unexpected MemoryMonitor maxPSS value: %d" % (maxPSS_int))
+                    else:
+                        if maxRSS == 0 or maxRSS == "0":
+                            pUtil.tolog("schedconfig.maxrss set to 0 (no memory checks will be done)")
                         else:
-                            if maxRSS == 0 or maxRSS == "0":
-                                pUtil.tolog("schedconfig.maxrss set to 0 (no memory checks will be done)")
-                            else:
-                                pUtil.tolog("!!WARNING!!9904!! schedconfig.maxrss is not set")
+                            pUtil.tolog("!!WARNING!!9904!! schedconfig.maxrss is not set")
 
             # update the time for checking memory
             self.__env['curtime_mem'] = int(time.time())
@@ -1536,6 +1551,7 @@ class Monitor:
                     # start the RunJob* subprocess
                     pUtil.chdir(self.__env['jobDic']["prod"][1].workdir)
                     sys.path.insert(1,".")
+                    pUtil.flushLog()
                     os.execvpe(self.__env['pyexe'], jobargs, os.environ)
 
             # Control variables for looping jobs
@@ -1922,6 +1938,7 @@ class Monitor:
                         break
                 jobargs[i+1] = '%s' % monthread.port
                 pUtil.tolog("jobargs=%s" % (jobargs))
+                pUtil.flushLog()
                 os.execvpe(self.__env['pyexe'], jobargs, os.environ)
 
             # Control variables for looping jobs
@@ -16,6 +16,7 @@ from pUtil import createPoolFileCatalog, tolog, addToSkipped, removeDuplicates,
      getCopyprefixLists, getExperiment, getSiteInformation, stripDQ2FromLFN, extractPattern, dumpFile, updateInputFileWithTURLs, getPilotVersion
 from FileHandling import getExtension, getTracingReportFilename, readJSON, getHashedBucketEndpoint, getDirectAccess, useDirectAccessWAN
 from FileStateClient import updateFileState, dumpFileStates
+from ReplicaCache import getReplicaCache
 from RunJobUtilities import updateCopysetups
 from SysLog import sysLog, dumpSysLogTail
 
@@ -568,7 +569,7 @@ def getReplicasLFC(guids, lfchost):
 
     return ec, pilotErrorDiag, replica_list
 
-def getReplicaDictionary(thisExperiment, guids, lfn_dict, scope_dict, replicas_dict, host):
+def getReplicaDictionary(thisExperiment, guids, lfn_dict, scope_dict, replicas_dict, host, workdir=None):
     """ Return a replica dictionary from the LFC or via Rucio methods """
 
     error = PilotErrors()
@@ -576,7 +577,7 @@ def getReplicaDictionary(thisExperiment, guids, lfn_dict, scope_dict, replicas_d
 
     # Is there an alternative to using LFC lookups?
     if thisExperiment.willDoAlternativeFileLookups():
-        ec, pilotErrorDiag, replicas_dict = getReplicaDictionaryRucio(lfn_dict, scope_dict, replicas_dict, host)
+        ec, pilotErrorDiag, replicas_dict = getReplicaDictionaryRucio(lfn_dict, scope_dict, replicas_dict, host, workdir=workdir)
     else:
         # Get file replicas directly from LFC
         try:
@@ -643,7 +644,7 @@ def getFiletypeAndRSE(surl, surl_dictionary):
 
     return filetype, rse
 
-def getReplicaDictionaryRucio(lfn_dict, scope_dict, replicas_dic, host):
+def getReplicaDictionaryRucio(lfn_dict, scope_dict, replicas_dic, host, workdir=None):
     """ Create a dictionary of the guids and replica objects """
 
     pilotErrorDiag = ""
@@ -654,7 +655,7 @@ def getReplicaDictionaryRucio(lfn_dict, scope_dict, replicas_dic, host):
     tolog("file_dictionary=%s" % (file_dictionary))
 
     # then get the replica dictionary from Rucio
-    rucio_replica_dictionary, rucio_surl_dictionary, pilotErrorDiag = getRucioReplicaDictionary(host, file_dictionary)
+    rucio_replica_dictionary, rucio_surl_dictionary, pilotErrorDiag = getRucioReplicaDictionary(host, file_dictionary, workdir=workdir)
     tolog("rucio_replica_dictionary=%s" % str(rucio_replica_dictionary))
     tolog("rucio_surl_dictionary=%s" % str(rucio_surl_dictionary))
 
@@ -3950,7 +3951,7 @@ def getCatalogFileList(thisExperiment, guid_token_dict, lfchost, analysisJob, wo
     guids = guid_token_dict.keys()
 
     # Get the replicas list for all guids
-    ec, pilotErrorDiag, replicas_dict = getReplicaDictionary(thisExperiment, guids, lfn_dict, scope_dict, replicas_dict, lfchost)
+    ec, pilotErrorDiag, replicas_dict = getReplicaDictionary(thisExperiment, guids, lfn_dict, scope_dict, replicas_dict, lfchost, workdir=workdir)
     if ec != 0:
         return error.ERR_FAILEDLFCGETREP, pilotErrorDiag, file_dict, xml_source, replicas_dict, surl_filetype_dictionary, copytool_dictionary
 
@@ -4979,7 +4980,7 @@ def getGUIDForLFN(file_dictionary, scope_lfn):
 
     return guid
 
-def getRucioReplicaDictionary(cat, file_dictionary):
+def getRucioReplicaDictionary(cat, file_dictionary, workdir=None):
     """ Get the Rucio replica dictionary """
 
     # return: replica_dictionary, surl_dictionary
@@ -5000,12 +5001,23 @@ def getRucioReplicaDictionary(cat, file_dictionary):
     scope_lfn_list = getScopeLFNListFromDictionary(file_dictionary)
 
     if scope_lfn_list != []:
-        from rucio.client import Client
-        c = Client()
+        # Look up the replicas resolved by previous jobs first
+        cache = getReplicaCache(workdir, tag="getRucioReplicaDictionary")
+        cached = {}
+        if cache:
+            cached = cache.lookup(["%s:%s" % (e['scope'], e['name']) for e in scope_lfn_list])
+            scope_lfn_list = [e for e in scope_lfn_list if "%s:%s" % (e['scope'], e['name']) not in cached]
 
         # Get the replica list
         try:
-            replicas_list = c.list_replicas(scope_lfn_list, schemes=['srm','gsiftp'])
+            replicas_list = []
+            if scope_lfn_list != []:
+                from rucio.client import Client
+                c = Client()
+
+                replicas_list = list(c.list_replicas(scope_lfn_list, schemes=['srm','gsiftp']))
+                if cache:
+                    cache.store(dict([("%s:%s" % (r.get('scope'), r.get('name')), r) for r in replicas_list]))
         except:
             import sys
             excType, excValue = sys.exc_info()[:2]  # skip the traceback info to avoid possible circular reference
@@ -5013,6 +5025,7 @@ def getRucioReplicaDictionary(cat, file_dictionary):
             pilotErrorDiag = "list_replicas() failed: %s" % (excValue)
             tolog("!!WARNING!!2235!! %s" % (pilotErrorDiag))
         else:
+            replicas_list = cached.values() + replicas_list
             if replicas_list != None and replicas_list != []:
                 # Loop over all replicas
                 for r in replicas_list:
@@ -0,0 +1,309 @@
+# Class definition:
+#   OutputZipBuilder
+#   Incremental builder of the output zip (tar) file and the zip event ranges file of an HPC event service job
+#   (RunJobHpcEvent.zipOutputs()) from the event status dump written by Yoda (<jobId>_event_status.dump). build() reads
+#   the complete records appended to the dump since the previous build and streams the outputs of the finished event
+#   ranges into the archive (TarStreamWriter: one stat per file, adler32 and md5 calculated while the archive is
+#   written), so that the archive can be built during the run; finish() adds the remaining records and closes the
+#   archive. The builders of different jobs are independent and can run in parallel threads.
+#   The dump offset and the sizes of the archive and the event ranges file are saved after every build (<zip>.state),
+#   a builder of a restarted pilot truncates both files to the saved sizes and continues from the saved offset. The
+#   output files are removed once the state including them has been saved. If a build fails, the builder goes back to
+#   the saved state (the records of the failed build are added again by the next build).
+
+import os
+import json
+import threading
+
+from pUtil import tolog
+from TarStreamWriter import TarStreamWriter
+from HPC.pandayoda.yodacore.EventStatusLog import readEventStatusLogFrom
+
+class OutputZipBuilder(object):
+
+    def __init__(self, eventStatusFile, zipFileName, zipEventRangesName):
+        """ eventStatusFile: event status dump of the job (the .backup file is used if it does not exist) """
+
+        self.eventStatusFile = eventStatusFile
+        self.zipFileName = zipFileName
+        self.zipEventRangesName = zipEventRangesName
+        self.stateFile = zipFileName + ".state"
+
+        self.offset = 0                    # end of the last record added
+        self.inode = None                  # inode of the dump
+        self.nRecords = 0                  # number of records added
+        self.nFiles = 0                    # number of files added
+
+        self.__tar = None
+        self.__zipEventRangesSize = 0
+        self.__lock = threading.Lock()
+
+    def getEventStatusFile(self):
+        """ Return the event status dump (or its backup), None if neither exists """
+
+        for filename in [self.eventStatusFile, self.eventStatusFile + ".backup"]:
+            if os.path.exists(filename):
+                return filename
+        return None
+
+    def isZipped(self):
+        """ Has the archive been finished (by this or a previous pilot)? """
+
+        return os.path.exists(self.eventStatusFile + ".zipped")
+
+    def __open(self):
+        """ Open the archive, continue from the saved state if available """
+
+        state = None
+        if os.path.exists(self.stateFile):
+            try:
+                f = open(self.stateFile)
+                try:
+                    state = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, ValueError), e:
+                tolog("!!WARNING!!1299!! Cannot load zip state %s (will rebuild the archive): %s" % (self.stateFile, e))
+                state = None
+
+        if state and os.path.exists(self.zipFileName) and os.path.getsize(self.zipFileName) >= state['zipSize'] and \
+           os.path.exists(self.zipEventRangesName) and os.path.getsize(self.zipEventRangesName) >= state['zipEventRangesSize']:
+            tolog("Continuing zip file %s from dump offset %s" % (self.zipFileName, state['offset']))
+            self.__truncate(self.zipFileName, state['zipSize'])
+            self.__truncate(self.zipEventRangesName, state['zipEventRangesSize'])
+            self.offset = state['offset']
+            self.inode = state['inode']
+            self.__zipEventRangesSize = state['zipEventRangesSize']
+        else:
+            tolog("Creating zip/tar file: %s" % (self.zipFileName))
+            for filename in [self.zipFileName, self.zipEventRangesName]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+            open(self.zipEventRangesName, 'w').close()
+
+        self.__tar = TarStreamWriter(self.zipFileName)
+
+    def __truncate(self, filename, size):
+        """ Remove the data written after the saved state """
+
+        f = open(filename, 'r+b')
+        try:
+            f.truncate(size)
+        finally:
+            f.close()
+
+    def __saveState(self):
+        """ Save the dump offset and the sizes of the archive and the event ranges file (replaced atomically) """
+
+        state = {'offset': self.offset, 'inode': self.inode, 'zipSize': self.__tar.flush(),
+                 'zipEventRangesSize': self.__zipEventRangesSize}
+        f = open(self.stateFile + ".tmp", 'w')
+        try:
+            json.dump(state, f)
+        finally:
+            f.close()
+        os.rename(self.stateFile + ".tmp", self.stateFile)
+
+    def build(self):
+        """ Add the records appended to the dump since the previous build, return the number of records added """
+
+        with self.__lock:
+            try:
+                return self.__build()
+            except:
+                self.__rollback()
+                raise
+
+    def __rollback(self):
+        """ Discard the records added since the saved state, the next build reopens the archive at the saved state (lock is held) """
+
+        tolog("!!WARNING!!1299!! Zip build of %s failed, going back to the last saved state" % (self.zipFileName))
+        if self.__tar:
+            self.__tar.abort()
+            self.__tar = None
+        self.offset = 0
+        self.inode = None
+        self.__zipEventRangesSize = 0
+
+    def __build(self):
+        """ Add the new records (the lock is held) """
+
+        if self.isZipped():
+            return 0
+        eventStatusFile = self.getEventStatusFile()
+        if not eventStatusFile:
+            return 0
+        if not self.__tar:
+            self.__open()
+
+        # start again at the beginning of the dump if it has been replaced or truncated (new Yoda run)
+        s = os.stat(eventStatusFile)
+        if self.inode != s.st_ino or s.st_size < self.offset:
+            if self.offset:
+                tolog("!!WARNING!!1299!! Event status dump %s has been replaced, reading it from the beginning" % (eventStatusFile))
+            self.offset = 0
+            self.inode = s.st_ino
+        if s.st_size == self.offset:
+            return 0
+
+        lines = []
+        added = []
+        offset = self.offset
+        for offset, (jobId, eventRangeID, status, output) in readEventStatusLogFrom(eventStatusFile, self.offset):
+            if status.startswith("ERR"):
+                status = 'failed'
+            if status == 'failed':
+                lines.append("%s %s %s\n" % (eventRangeID, status, output))
+            if not status == 'finished':
+                continue
+            for out in output.split(",")[:-3]:
+                try:
+                    self.__tar.add(out)
+                except (IOError, OSError), e:
+                    tolog("File %s cannot be added: %s" % (out, e))
+                    continue
+                added.append(out)
+            lines.append("%s %s %s\n" % (eventRangeID, status, output))
+        nRecords = len(lines)
+
+        if lines:
+            data = "".join(lines)
+            f = open(self.zipEventRangesName, 'a')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            self.__zipEventRangesSize += len(data)
+        self.offset = offset
+        self.__saveState()
+
+        # the files are only removed once they are in the saved part of the archive
+        for out in added:
+            try:
+                os.remove(out)
+            except OSError, e:
+                tolog("!!WARNING!!1299!! Failed to remove %s: %s" % (out, e))
+        self.nRecords += nRecords
+        self.nFiles += len(added)
+
+        return nRecords
+
+    def finish(self):
+        """ Add the remaining records and close the archive, return its checksums {'adler32': .., 'md5': ..} (None if not zipped) """
+
+        with self.__lock:
+            if self.isZipped():
+                tolog("Event status dump file %s exist. It's already zipped." % (self.eventStatusFile + ".zipped"))
+                return None
+            eventStatusFile = self.getEventStatusFile()
+            if not eventStatusFile:
+                tolog("Event status dump file %s (and backup) doesn't exist." % (self.eventStatusFile))
+                return None
+
+            try:
+                self.__build()
+            except:
+                self.__rollback()
+                raise
+            checksums = self.__tar.close()
+            self.__tar = None
+            tolog("Zip finished (%d event ranges, %d files), Rename %s to %s" % (self.nRecords, self.nFiles, eventStatusFile, self.eventStatusFile + ".zipped"))
+            os.rename(eventStatusFile, self.eventStatusFile + ".zipped")
+            os.remove(self.stateFile)
+
+            return checksums
+
+def benchmark(nJobs=4, nEventRanges=2000, outputSize=64 * 1024, threads=4):
+    """
+    Compare the former zipping (tarfile.add per output file, one job after the other, after the run) with the
+    OutputZipBuilder (streamed archive with checksums, jobs in parallel), building the archives during the run
+    (half of the event ranges) or at the end only.
+    usage: python OutputZipBuilder.py [number of jobs] [event ranges per job] [output size] [threads]
+    """
+
+    import time
+    import shutil
+    import tarfile
+    import tempfile
+    from ThreadPool import ThreadPool
+    from Checksum import calculateChecksum
+    from HPC.pandayoda.yodacore.EventStatusLog import readEventStatusLog
+
+    def _makeOutputs(workDir, jobId, first, last):
+        data = "x" * outputSize
+        f = open(os.path.join(workDir, "%s_event_status.dump" % (jobId)), 'a')
+        for i in range(first, last):
+            filename = os.path.join(workDir, "HITS.%s.%06d.pool.root" % (jobId, i))
+            out = open(filename, 'w')
+            out.write(data)
+            out.close()
+            f.write("%s %s-1-1-%s-1 finished %s,ID:%s-1-1-%s-1,CPU:1,WALL:1\n" % (jobId, jobId, i, filename, jobId, i))
+        f.close()
+
+    def _formerZip(workDir, jobId):
+        # the former RunJobHpcEvent.zipOutputs() followed by the adler32 calculation of the stage-out
+        eventstatus = os.path.join(workDir, "%s_event_status.dump" % (jobId))
+        zipFileName = os.path.join(workDir, "EventService_premerge_%s.tar" % (jobId))
+        tar = tarfile.open(zipFileName, 'w')
+        zipEventRange = open(os.path.join(workDir, "EventService_premerge_eventranges_%s.txt" % (jobId)), 'w')
+        for jobId, eventRangeID, status, output in readEventStatusLog(eventstatus):
+            for out in output.split(",")[:-3]:
+                if not os.path.exists(out):
+                    continue
+                tar.add(out, arcname=os.path.basename(out))
+                os.remove(out)
+            zipEventRange.write("%s %s %s\n" % (eventRangeID, status, output))
+        tar.close()
+        zipEventRange.close()
+        os.rename(eventstatus, eventstatus + ".zipped")
+        return calculateChecksum(zipFileName)
+
+    def _builders(workDir):
+        return [OutputZipBuilder(os.path.join(workDir, "%s_event_status.dump" % (jobId)),
+                                 os.path.join(workDir, "EventService_premerge_%s.tar" % (jobId)),
+                                 os.path.join(workDir, "EventService_premerge_eventranges_%s.txt" % (jobId))) for jobId in range(nJobs)]
+
+    def _run(mode, workDir):
+        jobIds = range(nJobs)
+        duringRun = 0.0
+        for jobId in jobIds:
+            _makeOutputs(workDir, jobId, 0, nEventRanges / 2)
+        builders = _builders(workDir)
+        threadpool = ThreadPool(threads)
+        if mode == "during the run":
+            t0 = time.time()
+            for builder in builders:
+                threadpool.add_task(builder.build)
+            threadpool.wait()
+            duringRun = time.time() - t0
+        for jobId in jobIds:
+            _makeOutputs(workDir, jobId, nEventRanges / 2, nEventRanges)
+
+        # after the run
+        results = []
+        t0 = time.time()
+        if mode == "former":
+            for jobId in jobIds:
+                results.append(_formerZip(workDir, jobId))
+        else:
+            for builder in builders:
+                threadpool.add_task(lambda builder: results.append(builder.finish()['adler32']), builder)
+            threadpool.wait()
+        atEnd = time.time() - t0
+        threadpool.wait_completion()
+
+        return duringRun, atEnd, sorted(results)
+
+    for mode in ["former", "at the end", "during the run"]:
+        workDir = tempfile.mkdtemp()
+        try:
+            duringRun, atEnd, checksums = _run(mode, workDir)
+            print "%-15s: %.2f s after the run (%.2f s during the run) for %d jobs x %d event ranges of %d kB, adler32 %s" % \
+                (mode, atEnd, duringRun, nJobs, nEventRanges, outputSize / 1024, ",".join(checksums))
+        finally:
+            shutil.rmtree(workDir)
+
+if __name__ == "__main__":
+
+    import sys
+    benchmark(*[int(arg) for arg in sys.argv[1:5]])
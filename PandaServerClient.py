@@ -11,6 +11,9 @@ from pUtil import tolog, readpar, timeStamp, getBatchSystemJobID, getCPUmodel, P
     getSiteInformation, getExperiment, readStringFromFile, merge_dictionaries, updateXMLWithEndpoints, isAnalysisJob
 from JobState import JobState
 from FileStateClient import getFilesOfState
+from ReplicaCache import getReplicaCacheCounters
+from MemorySampler import readSummary, getUtilityNode
+from JobReport import getReport
 from FileHandling import getOSTransferDictionaryFilename, getOSTransferDictionary, getHighestPriorityError
 
 class PandaServerClient:
@@ -138,6 +141,9 @@ class PandaServerClient:
 
         if job.external_stageout_time:
             jobMetrics += self.jobMetric(key="ExStageoutTime", value=job.external_stageout_time)
+        if job.logCompressionRate:
+            jobMetrics += self.jobMetric(key="logCompressionRate", value="%.1f" % (job.logCompressionRate))
+            jobMetrics += self.jobMetric(key="logCompressionRatio", value="%.2f" % (job.logCompressionRatio))
         # hpc status
         #if job.mode:
         #    jobMetrics += self.jobMetric(key="mode", value=job.mode)
@@ -188,6 +194,12 @@ class PandaServerClient:
         if job.dbData != "":
             jobMetrics += self.jobMetric(key="dbData", value=job.dbData)
 
+        # replica cache hits and misses of the stage-in
+        replicaCacheHits, replicaCacheMisses = getReplicaCacheCounters(site.workdir, job.jobId)
+        if replicaCacheHits or replicaCacheMisses:
+            jobMetrics += self.jobMetric(key="replicaCacheHits", value=replicaCacheHits)
+            jobMetrics += self.jobMetric(key="replicaCacheMisses", value=replicaCacheMisses)
+
         # machine and job features, max disk space used by the payload
         jobMetrics += workerNode.addToJobMetrics(job.result[0], self.__pilot_initdir, job.jobId)
 
@@ -464,11 +476,13 @@ class PandaServerClient:
         else:
             node['cpuConsumptionUnit'] = getCPUmodel()
 
-        # Add the utility info if it is available
+        # Add the utility info if it is available (otherwise the values from the memory sampler, if it was used)
         thisExperiment = getExperiment(job.experiment)
         if thisExperiment.shouldExecuteUtility():
             utility_node = thisExperiment.getUtilityInfo(job.workdir, self.__pilot_initdir, allowTxtFile=True)
             node = merge_dictionaries(node, utility_node)
+        else:
+            node = merge_dictionaries(node, getUtilityNode(readSummary(job.workdir)))
 
         return node
 
@@ -688,29 +702,20 @@ class PandaServerClient:
             tolog("Trying alternative location: %s" % (_filename))
 
         if os.path.exists(_filename):
-            # Now check the version
-            try:
-                f = open(_filename, 'r')
-            except Exception, e:
-                tolog("!!WARNING!!2233!! Could not open %s: %s" % (_filename, e))
+            # Now verify that the version is at least 1.0.0 (the jobReport is parsed once, see JobReport)
+            version = getReport(os.path.dirname(_filename)).getVersion()
+            if not version:
+                filenamePayloadMetadata = "%s/metadata-%s.xml.PAYLOAD" % (workdir, jobId)
+                tolog("reportVersion not found in jobReport, using default metadata XML file")
             else:
-                # Now verify that the version is at least 1.0.0
-                from json import load
-                try:
-                    jobReport_dict = load(f)
-                    version = jobReport_dict['reportVersion']
-                except Exception, e:
-                    filenamePayloadMetadata = "%s/metadata-%s.xml.PAYLOAD" % (workdir, jobId)
-                    tolog("reportVersion not found in jobReport, using default metadata XML file")
+                v = '1.0.0'
+                if self.isAGreaterOrEqualToB(version, v):
+                    tolog("Will send metadata file %s since version %s is >= %s" % (_filename, version, v))
+                    filenamePayloadMetadata = _filename
                 else:
-                    v = '1.0.0'
-                    if self.isAGreaterOrEqualToB(version, v):
-                        tolog("Will send metadata file %s since version %s is >= %s" % (_filename, version, v))
-                        filenamePayloadMetadata = _filename
-                    else:
-                        filenamePayloadMetadata = "%s/metadata-%s.xml.PAYLOAD" % (workdir, jobId)
-                        tolog('Metadata version in file %s is too old (%s < %s), will send old XML file %s' % \
-                                  (os.path.basename(_filename), version, v, os.path.basename(filenamePayloadMetadata)))
+                    filenamePayloadMetadata = "%s/metadata-%s.xml.PAYLOAD" % (workdir, jobId)
+                    tolog('Metadata version in file %s is too old (%s < %s), will send old XML file %s' % \
+                              (os.path.basename(_filename), version, v, os.path.basename(filenamePayloadMetadata)))
         else:
             # Use default metadata file
             tolog("Did not find %s" % (_filename))
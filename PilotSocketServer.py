@@ -0,0 +1,181 @@
+# Class definition:
+#   PilotSocketServer
+#   Local Unix socket stand-in for PilotYamplServer with the same interface (alive(), send(), receive(timeout)), for
+#   payloads and test set-ups without yampl. Messages are exchanged over a SOCK_SEQPACKET socket in the abstract
+#   namespace (one message per packet); several clients can connect, a message is sent to the client that sent the
+#   last received message (as for a yampl server socket). receive() blocks in select() until a message arrives.
+
+import time
+import socket
+import select
+
+from pUtil import tolog
+
+MAXMESSAGESIZE = 1024 * 1024
+
+class PilotSocketServer(object):
+    """ Unix socket server used to send messages from runEvent to the payload """
+
+    def __init__(self, name='PilotSocketServer', socketname='EventService_EventRanges', context='local'):
+        """ Constructor, setting initial variables (context is not used) """
+
+        self.srv = None
+        self.clients = []
+        self.peer = None
+
+        try:
+            self.srv = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            self.srv.bind(getAddress(socketname))
+            self.srv.listen(64)
+        except Exception, e:
+            tolog("!!WARNING!!2222!! Could not create Unix server socket: %s" % (e))
+            self.srv = None
+        else:
+            tolog("Created a Unix server socket")
+
+    def alive(self):
+        """ Is the server alive? """
+
+        if self.srv:
+            return True
+        else:
+            return False
+
+    def send(self, message):
+        """ Send a message to the client that sent the last message """
+
+        if self.alive() and self.peer:
+            self.peer.send(message)
+        else:
+            tolog("!!WARNING!!2221!! No client connected to the Unix server socket - cannot send message")
+
+    def receive(self, timeout=0):
+        """
+        Receive a message, wait up to timeout seconds for it to arrive.
+        Return the size (-1 if no message has arrived) and the message
+        """
+
+        if not self.alive():
+            tolog("!!WARNING!!2221!! Unix server socket not available (not created) - cannot receive any messages")
+            return 0, ""
+
+        deadline = time.time() + timeout
+        while True:
+            readable, writable, failed = select.select([self.srv] + self.clients, [], [], max(0, deadline - time.time()))
+            for sock in readable:
+                if sock is self.srv:
+                    client, address = self.srv.accept()
+                    self.clients.append(client)
+                    continue
+                buf = sock.recv(MAXMESSAGESIZE)
+                if not buf:
+                    # the client has disconnected
+                    self.clients.remove(sock)
+                    sock.close()
+                    if sock is self.peer:
+                        self.peer = None
+                    continue
+                self.peer = sock
+                return len(buf), buf
+            if time.time() >= deadline:
+                return -1, ""
+
+    def close(self):
+        """ Close the server and client sockets """
+
+        for sock in self.clients + [self.srv]:
+            if sock:
+                sock.close()
+        self.srv = None
+        self.clients = []
+        self.peer = None
+
+def getAddress(socketname):
+    """ Return the socket address for a channel name (abstract namespace) """
+
+    return "\0%s" % (socketname)
+
+def benchmark(n=200, work=0.05):
+    """
+    Compare the event range handoff of the former polling loops (100 ms naps) with the blocking receive and the
+    WakeupEvent handoff, using a mock payload that asks for n event ranges and works work seconds on each.
+    usage: python PilotSocketServer.py [number of event ranges] [work time per event range]
+    """
+
+    import threading
+    from WakeupEvent import WakeupEvent
+    from LatencyHistogram import LatencyHistogram
+
+    def _payload(socketname):
+        # mock AthenaMP: ask for an event range, process it, report the output
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        client.connect(getAddress(socketname))
+        client.send("Ready for events")
+        while True:
+            msg = client.recv(MAXMESSAGESIZE)
+            if not msg or msg == "No more events":
+                break
+            time.sleep(work)
+            client.send("/tmp/out.pool.root_%s,ID:%s,CPU:1,WALL:1" % (msg, msg))
+            client.send("Ready for events")
+        client.close()
+
+    def _run(polling):
+        socketname = "PilotSocketServer-benchmark-%s-%f" % (polling, time.time())
+        server = PilotSocketServer(socketname=socketname)
+        ready = WakeupEvent()
+        state = {'readyTime': None, 'stop': False}
+        handoff = LatencyHistogram("handoff (%s)" % ("polling" if polling else "blocking"))
+
+        def _listener():
+            while not state['stop']:
+                if polling:
+                    size, buf = server.receive()
+                    while size == -1 and not state['stop']:
+                        time.sleep(0.1)
+                        size, buf = server.receive()
+                else:
+                    size, buf = server.receive(timeout=1)
+                if buf == "Ready for events":
+                    state['readyTime'] = time.time()
+                    ready.set()
+                if polling:
+                    time.sleep(0.1)
+
+        listener = threading.Thread(target=_listener)
+        listener.setDaemon(True)
+        listener.start()
+        payload = threading.Thread(target=_payload, args=(socketname,))
+        payload.start()
+
+        t0 = time.time()
+        for i in range(n + 1):
+            while not ready.isSet():
+                if polling:
+                    time.sleep(0.1)
+                else:
+                    ready.wait(1)
+            ready.clear()
+            if i == n:
+                server.send("No more events")
+            else:
+                handoff.add(time.time() - state['readyTime'])
+                server.send(str(i))
+        payload.join()
+        t = time.time() - t0
+        state['stop'] = True
+        listener.join()
+        server.close()
+        ready.close()
+
+        return t, handoff
+
+    for polling in [True, False]:
+        t, handoff = _run(polling)
+        print "%s: %.2f s for %d event ranges (%.2f s of work)" % ("polling loops " if polling else "blocking receive", t, n, n * work)
+        print "  %s" % (handoff)
+
+if __name__ == "__main__":
+
+    import sys
+    benchmark(*[float(arg) if i else int(arg) for i, arg in enumerate(sys.argv[1:3])])
@@ -1,3 +1,4 @@
+import time
 import yampl
 import signal
 from pUtil import tolog
@@ -39,11 +40,26 @@ class PilotYamplServer(object):
         else:
             tolog("!!WARNING!!2221!! Yampl server not available (not created) - cannot send Yampl message")
 
-    def receive(self):
-        """ Receive a yampl message """
+    def receive(self, timeout=0):
+        """
+        Receive a yampl message, wait up to timeout seconds for it to arrive.
+        Return the size (-1 if no message has arrived) and the message
+        """
 
         if self.alive():
             size, buf = self.srv.try_recv_raw()
+
+            # the yampl bindings have no receive with time-out, poll with an increasing interval (0.5 .. 50 ms)
+            if size == -1 and timeout > 0:
+                deadline = time.time() + timeout
+                nap = 0.0005
+                while size == -1:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        break
+                    time.sleep(min(nap, left))
+                    nap = min(2 * nap, 0.05)
+                    size, buf = self.srv.try_recv_raw()
         else:
             tolog("!!WARNING!!2221!! Yampl server not available (not created) - cannot receive any Yampl messages")
             buf = ""
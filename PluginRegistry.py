@@ -0,0 +1,164 @@
+# Class definition:
+#   PluginRegistry
+#   Registry of plugin classes (experiments, site information, RunJob classes, event services, site movers) used by the
+#   factories instead of importing all plugin modules up front. A plugin is registered with its name and the module and
+#   class that implement it; the module is imported when the plugin is first requested, and the import time is recorded
+#   (see getImportTimes()). getInstance() creates one instance of a plugin class per process and caches it.
+
+import os
+import sys
+import time
+import threading
+import traceback
+
+from pUtil import tolog
+
+class PluginRegistry(object):
+
+    # all registries (for the import time report)
+    __registries = []
+
+    def __init__(self, name, plugins=[]):
+        """
+        name: name of the registry (used in messages)
+        plugins: list of (plugin name, module[, class name]) tuples, the class name defaults to the module name
+        """
+
+        self.name = name
+        self.__names = []                  # plugin names in registration order
+        self.__plugins = {}                # FORMAT: { plugin name: (module, class name) }
+        self.__classes = {}                # FORMAT: { plugin name: class } (imported plugins)
+        self.__instances = {}              # FORMAT: { plugin name: (pid, instance) }
+        self.__importTimes = {}            # FORMAT: { plugin name: import time [s] }
+        self.__lock = threading.RLock()
+
+        for plugin in plugins:
+            self.register(*plugin)
+        PluginRegistry.__registries.append(self)
+
+    def register(self, name, module, classname=None):
+        """ Register a plugin (the module is not imported) """
+
+        with self.__lock:
+            if not self.__plugins.has_key(name):
+                self.__names.append(name)
+            self.__plugins[name] = (module, classname or module.split('.')[-1])
+            if self.__classes.has_key(name):
+                del self.__classes[name]
+
+    def getNames(self):
+        """ Return the names of the registered plugins """
+
+        return list(self.__names)
+
+    def isLoaded(self, name):
+        """ Has the module of the plugin been imported? """
+
+        return self.__classes.has_key(name)
+
+    def getClass(self, name):
+        """ Return the plugin class, import its module if necessary (raises ValueError for unknown or broken plugins) """
+
+        with self.__lock:
+            if self.__classes.has_key(name):
+                return self.__classes[name]
+            if not self.__plugins.has_key(name):
+                raise ValueError('%s: No such class: "%s"' % (self.name, name))
+
+            module, classname = self.__plugins[name]
+            t0 = time.time()
+            try:
+                __import__(module)
+                pluginClass = getattr(sys.modules[module], classname)
+            except Exception, e:
+                tolog("!!WARNING!!1114!! %s: Failed to import %s from %s: %s" % (self.name, classname, module, traceback.format_exc()))
+                raise ValueError('%s: Failed to import class "%s" for "%s": %s' % (self.name, classname, name, e))
+            self.__importTimes[name] = time.time() - t0
+            self.__classes[name] = pluginClass
+
+            return pluginClass
+
+    def getInstance(self, name):
+        """ Return the instance of the plugin class for this process, create it if necessary """
+
+        with self.__lock:
+            if self.__instances.has_key(name):
+                pid, instance = self.__instances[name]
+                if pid == os.getpid():
+                    return instance
+            instance = self.getClass(name)()
+            self.__instances[name] = (os.getpid(), instance)
+
+            return instance
+
+    def loadAll(self):
+        """ Import all plugins (the former behaviour of the factories), ignore broken plugins """
+
+        for name in self.getNames():
+            try:
+                self.getClass(name)
+            except ValueError:
+                pass
+
+    def getImportTimes(self):
+        """ Return a list of (plugin name, module, import time [s]) for the imported plugins """
+
+        with self.__lock:
+            return [(name, self.__plugins[name][0], self.__importTimes[name]) for name in self.__names if self.__importTimes.has_key(name)]
+
+    def getRegistries(cls):
+        """ Return all registries """
+
+        return list(cls.__registries)
+    getRegistries = classmethod(getRegistries)
+
+def getImportTimes():
+    """ Return a list of (registry name, plugin name, module, import time [s]) for all imported plugins """
+
+    importTimes = []
+    for registry in PluginRegistry.getRegistries():
+        importTimes += [(registry.name, name, module, t) for (name, module, t) in registry.getImportTimes()]
+
+    return importTimes
+
+def reportImportTimes():
+    """ Log the import time breakdown of the plugins """
+
+    importTimes = getImportTimes()
+    tolog("Imported %d plugin(s) in %.3f s" % (len(importTimes), sum([t for (r, n, m, t) in importTimes])))
+    for registry, name, module, t in sorted(importTimes, key=lambda x: -x[3]):
+        tolog("  %.3f s: %s (%s, %s)" % (t, module, registry, name))
+
+def benchmark(experiment="ATLAS", n=5):
+    """
+    Measure the time from the pilot start until the first getJob() call (importing pilot.py and resolving the experiment
+    and site information plugins, as runMain() does before getJob()), with the lazy plugin registries and with all
+    plugins imported up front (the former factories). Every measurement runs in a new python process.
+    usage: python PluginRegistry.py [experiment] [number of runs]
+    """
+
+    import commands
+
+    script = "import sys, time; t0 = time.time(); sys.path.insert(0, %r); import pilot, pUtil, PluginRegistry;" % (os.path.dirname(os.path.abspath(__file__)))
+    script += " LOAD pUtil.getExperiment(%r); pUtil.getSiteInformation(%r);" % (experiment, experiment)
+    script += " t = time.time() - t0; print 'RESULT', t, len(sys.modules), ';'.join(['%s:%f' % (m, s) for (r, n, m, s) in PluginRegistry.getImportTimes()])"
+
+    for label, load in [("lazy plugin registries", ""), ("all plugins imported", "[r.loadAll() for r in PluginRegistry.PluginRegistry.getRegistries()];")]:
+        times = []
+        for i in range(n):
+            ec, output = commands.getstatusoutput("%s -c \"%s\"" % (sys.executable, script.replace("LOAD", load)))
+            lines = [line for line in output.split('\n') if line.startswith('RESULT')]
+            if ec or not lines:
+                print "%s: failed (exit code %d): %s" % (label, ec, output[-1000:])
+                break
+            result = lines[0].split()
+            times.append(float(result[1]))
+        if times:
+            print "%s: %.3f s to first getJob (best of %d, %s modules loaded)" % (label, min(times), len(times), result[2])
+            breakdown = sorted([(float(s), m) for (m, s) in [item.split(':') for item in result[3].split(';') if item]], reverse=True)
+            for s, m in breakdown[:5]:
+                print "  %.3f s: %s" % (s, m)
+
+if __name__ == "__main__":
+
+    benchmark(*[int(arg) if i else arg for i, arg in enumerate(sys.argv[1:3])])
@@ -0,0 +1,227 @@
+import os
+import commands
+
+class ProcessTable:
+    """
+    Snapshot of the process table.
+    The table is built from a single pass over /proc/*/stat (or a single ps call on systems without /proc), and
+    indexed by pid and by parent pid, so that all questions about a process tree (membership, CPU time, RSS,
+    zombie state) can be answered from the same snapshot without forking a new ps for every process in the tree.
+    Call refresh() to take a new snapshot.
+
+    Process dictionary format (one per pid):
+      { 'pid': pid, 'ppid': ppid, 'pgrp': pgrp, 'state': state, 'comm': comm,
+        'utime': utime, 'stime': stime, 'cutime': cutime, 'cstime': cstime, 'rss': rss }
+    where the CPU times are in seconds and rss is in kB.
+    """
+
+    def __init__(self, proc="/proc"):
+        """ Default initialization """
+
+        self.__proc = proc
+        self.__processes = {} # pid -> process dictionary
+        self.__children = {}  # ppid -> [child pids]
+        self.__hz = 100.0
+        self.__pagesize = 4096
+
+        try:
+            self.__hz = float(os.sysconf(os.sysconf_names['SC_CLK_TCK']))
+            self.__pagesize = os.sysconf(os.sysconf_names['SC_PAGE_SIZE'])
+        except Exception:
+            pass
+
+        self.refresh()
+
+    def refresh(self):
+        """ Take a new snapshot of the process table """
+
+        self.__processes = {}
+        self.__children = {}
+
+        if os.path.isdir(self.__proc):
+            self.__readProc()
+        else:
+            self.__readPs()
+
+        for pid, process in self.__processes.iteritems():
+            self.__children.setdefault(process['ppid'], []).append(pid)
+        for pids in self.__children.itervalues():
+            pids.sort()
+
+    def __readProc(self):
+        """ Read all /proc/<pid>/stat files """
+
+        try:
+            entries = os.listdir(self.__proc)
+        except OSError:
+            entries = []
+
+        for entry in entries:
+            if not entry.isdigit():
+                continue
+            try:
+                f = open(os.path.join(self.__proc, entry, "stat"), "r")
+                try:
+                    line = f.read()
+                finally:
+                    f.close()
+            except (IOError, OSError):
+                # the process disappeared after the directory listing
+                continue
+
+            process = self.parseStat(line)
+            if process:
+                self.__processes[process['pid']] = process
+
+    def parseStat(self, line):
+        """ Convert a /proc/<pid>/stat line to a process dictionary (None if the line cannot be interpreted) """
+
+        # the command name is put in parenthesis and may contain both spaces and parenthesis
+        start = line.find('(')
+        end = line.rfind(')')
+        if start == -1 or end == -1:
+            return None
+
+        fields = line[end + 2:].split()
+        try:
+            process = { 'pid': int(line[:start]),
+                        'comm': line[start + 1:end],
+                        'state': fields[0],
+                        'ppid': int(fields[1]),
+                        'pgrp': int(fields[2]),
+                        'utime': int(fields[11]) / self.__hz,
+                        'stime': int(fields[12]) / self.__hz,
+                        'cutime': int(fields[13]) / self.__hz,
+                        'cstime': int(fields[14]) / self.__hz,
+                        'rss': int(fields[21]) * self.__pagesize / 1024 }
+        except (ValueError, IndexError):
+            process = None
+
+        return process
+
+    def __readPs(self):
+        """ Fallback for systems without /proc: read the process table with one ps call """
+
+        ec, output = commands.getstatusoutput("ps -eo pid,ppid,pgid,stat,rss,time,comm")
+        if ec != 0:
+            return
+
+        for line in output.split('\n')[1:]:
+            fields = line.split(None, 6)
+            try:
+                cputime = 0
+                for part in fields[5].replace('-', ':').split(':'):
+                    cputime = cputime * 60 + float(part)
+                process = { 'pid': int(fields[0]),
+                            'ppid': int(fields[1]),
+                            'pgrp': int(fields[2]),
+                            'state': fields[3][0],
+                            'rss': int(fields[4]),
+                            'utime': cputime,
+                            'stime': 0.0,
+                            'cutime': 0.0,
+                            'cstime': 0.0,
+                            'comm': fields[6] }
+            except (ValueError, IndexError):
+                continue
+            self.__processes[process['pid']] = process
+
+    def getPids(self):
+        """ Return all pids in the snapshot """
+
+        return self.__processes.keys()
+
+    def getProcess(self, pid):
+        """ Return the process dictionary for pid (None if pid is not in the snapshot) """
+
+        return self.__processes.get(pid, None)
+
+    def getChildren(self, pid):
+        """ Return the pids of the direct children of pid """
+
+        return list(self.__children.get(pid, []))
+
+    def getSubtree(self, pid):
+        """
+        Return the pids of pid and all its descendants.
+        The parent comes before its children (depth first), i.e. the same order as processes.findProcessesInGroup()
+        has always used. pid itself is always included, even if it is not (or no longer) in the snapshot.
+        """
+
+        pids = []
+        stack = [pid]
+        seen = set()
+        while stack:
+            _pid = stack.pop()
+            if _pid in seen:
+                continue
+            seen.add(_pid)
+            pids.append(_pid)
+            # push in reverse order so that the lowest pid is visited first
+            stack.extend(reversed(self.__children.get(_pid, [])))
+
+        return pids
+
+    def isInSubtree(self, pid, root):
+        """ Return True if pid is root or one of its descendants """
+
+        visited = set()
+        while pid is not None and pid not in visited:
+            if pid == root:
+                return True
+            visited.add(pid)
+            process = self.__processes.get(pid, None)
+            if not process or process['ppid'] == pid:
+                break
+            pid = process['ppid']
+
+        return False
+
+    def isZombie(self, pid):
+        """ Return True if pid is a zombie process """
+
+        process = self.__processes.get(pid, None)
+        return process is not None and process['state'] == 'Z'
+
+    def getZombies(self, root):
+        """ Return the pids of all zombie processes in the subtree of root """
+
+        return [pid for pid in self.getSubtree(root) if self.isZombie(pid)]
+
+    def getCPUTime(self, root, children=True, reaped=True):
+        """
+        Return the CPU consumption time (user+system, in seconds) for root, summed over its subtree if children is True.
+        With reaped=True, the CPU time of already terminated and waited-for children (cutime+cstime) is included
+        as well, since such processes are no longer visible in the process table.
+        """
+
+        if children:
+            pids = self.getSubtree(root)
+        else:
+            pids = [root]
+
+        cputime = 0.0
+        for pid in pids:
+            process = self.__processes.get(pid, None)
+            if process:
+                cputime += process['utime'] + process['stime']
+                if reaped:
+                    cputime += process['cutime'] + process['cstime']
+
+        return cputime
+
+    def getRSS(self, root, children=True):
+        """ Return the resident set size (kB) for root, summed over its subtree if children is True """
+
+        if children:
+            pids = self.getSubtree(root)
+        else:
+            pids = [root]
+
+        rss = 0
+        for pid in pids:
+            process = self.__processes.get(pid, None)
+            if process:
+                rss += process['rss']
+
+        return rss
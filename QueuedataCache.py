@@ -0,0 +1,119 @@
+# Class definition:
+#   QueuedataCache
+#   Process-wide cache of parsed queuedata files, used by SiteInformation.readpar() and getField()
+#   A queuedata file is read and parsed once; the parsed fields are kept in a dictionary until the file changes
+#   on disk (modification time, size or inode) or the cache is explicitly invalidated (e.g. by replaceQueuedataField()).
+#   The cache also counts how often each field is read, to show which queuedata lookups are the most frequent.
+
+import os
+import re
+import threading
+
+from pUtil import tolog
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class QueuedataCache(object):
+
+    # private data members
+    __instance = None                      # Singleton instance
+
+    def __new__(cls, *args, **kwargs):
+        """ Override the __new__ method to make the class a singleton """
+
+        if not cls.__instance:
+            cls.__instance = super(QueuedataCache, cls).__new__(cls, *args, **kwargs)
+            cls.__instance.__entries = {}  # FORMAT: { filename: [(st_mtime, st_size, st_ino), parsed queuedata] }
+            cls.__instance.__counts = {}   # FORMAT: { field: number of reads }
+            cls.__instance.__lock = threading.RLock()
+
+        return cls.__instance
+
+    def parse(self, s, containsJson=False):
+        """ Parse a queuedata string and return the dictionary of fields """
+
+        if containsJson:
+            return json.loads(s)
+
+        # queuedata is a string on the form par1=value1|par2=value2|...
+        # a value runs until the next |par= separator (values can contain |-signs, e.g. appdir)
+        dictionary = {}
+        matches = list(re.finditer("(^|\|)([^\|=]+)=", s))
+        for i, match in enumerate(matches):
+            if i + 1 < len(matches):
+                value = s[match.end():matches[i + 1].start()]
+            else:
+                value = s[match.end():]
+            dictionary[match.group(2)] = value.split('\n')[0]
+
+        return dictionary
+
+    def getQueuedata(self, filename):
+        """ Return the parsed queuedata dictionary for filename (None if the file cannot be read or parsed) """
+
+        try:
+            st = os.stat(filename)
+        except OSError:
+            self.invalidate(filename)
+            return None
+        key = (st.st_mtime, st.st_size, st.st_ino)
+
+        with self.__lock:
+            entry = self.__entries.get(filename, None)
+            if entry and entry[0] == key:
+                return entry[1]
+
+            try:
+                fh = open(filename)
+            except Exception, e:
+                tolog("!!WARNING!!2999!! Could not read queuedata file: %s" % str(e))
+                return None
+            try:
+                s = fh.read()
+            finally:
+                fh.close()
+
+            if s == "":
+                queuedata = {}
+            else:
+                try:
+                    queuedata = self.parse(s, containsJson=filename.endswith("json"))
+                except Exception, e:
+                    tolog("!!WARNING!!2999!! Could not parse queuedata file %s: %s" % (filename, e))
+                    return None
+
+            self.__entries[filename] = [key, queuedata]
+
+            return queuedata
+
+    def countAccess(self, field):
+        """ Increase the access counter for field """
+
+        with self.__lock:
+            self.__counts[field] = self.__counts.get(field, 0) + 1
+
+    def invalidate(self, filename=None):
+        """ Forget the parsed queuedata for filename (or for all files if filename is not set) """
+
+        with self.__lock:
+            if filename:
+                self.__entries.pop(filename, None)
+            else:
+                self.__entries = {}
+
+    def getAccessCounts(self):
+        """ Return a copy of the field access counter dictionary """
+
+        with self.__lock:
+            return dict(self.__counts)
+
+    def dumpAccessCounts(self, n=10):
+        """ Write the n most frequently read queuedata fields to the log """
+
+        counts = self.getAccessCounts()
+        if counts:
+            top = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:n]
+            tolog("Queuedata field reads (total %d): %s" % (sum(counts.values()), ", ".join(["%s=%d" % item for item in top])))
@@ -0,0 +1,204 @@
+# Class definition:
+#   ReplicaCache
+#   On-disk cache of Rucio replica look-ups, used by JobMover.resolve_replicas() and Mover.getRucioReplicaDictionary()
+#   The replicas returned by Rucio list_replicas() are stored per scope:lfn in a JSON file in the pilot work directory
+#   (or $PILOT_REPLICA_CACHE, e.g. to share the cache between the pilots on a node), so that the jobs of a multi-job pilot
+#   and retried stage-ins do not query the catalogue again for the same files. Entries expire after a time-to-live and
+#   the least recently used entries are removed when the cache is full. The file is locked while it is read and updated,
+#   the cache can be used by several processes at the same time.
+#   Cache settings are read from the catchall field of queuedata: replica_cache_ttl=<seconds> (0 switches the cache off)
+#   and replica_cache_size=<max number of entries>.
+
+import os
+import time
+import fcntl
+
+from pUtil import tolog
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class ReplicaCache(object):
+
+    # default settings
+    TTL = 1800                             # time-to-live of an entry [s]
+    MAXSIZE = 20000                        # max number of entries
+
+    def __init__(self, filename, ttl=TTL, maxsize=MAXSIZE, tag=""):
+        """ filename: cache file, tag: name of the query type (replicas of different queries are kept apart) """
+
+        self.filename = filename
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.tag = tag
+        self.hits = 0
+        self.misses = 0
+
+    def __load(self):
+        """ Read the cache file (returns an empty cache if the file does not exist or cannot be parsed) """
+
+        try:
+            f = open(self.filename)
+        except IOError:
+            return {}
+        try:
+            try:
+                return json.load(f)
+            except Exception, e:
+                tolog("!!WARNING!!2999!! Replica cache file %s cannot be parsed, will be recreated: %s" % (self.filename, e))
+                return {}
+        finally:
+            f.close()
+
+    def __save(self, data):
+        """ Write the cache file (atomically, via a temporary file) """
+
+        tmpname = "%s.%d.tmp" % (self.filename, os.getpid())
+        try:
+            f = open(tmpname, 'w')
+            try:
+                json.dump(data, f)
+            finally:
+                f.close()
+            os.rename(tmpname, self.filename)
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+    def __update(self, function):
+        """ Call function(entries) with the entries of this tag while the cache file is locked, save the changes """
+
+        try:
+            lockfile = open(self.filename + ".lock", 'a')
+        except IOError, e:
+            tolog("!!WARNING!!2999!! Replica cache is not available: %s" % e)
+            return None
+        try:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+            data = self.__load()
+            entries = data.setdefault(self.tag, {})
+            ret = function(entries)
+            try:
+                self.__save(data)
+            except Exception, e:
+                tolog("!!WARNING!!2999!! Failed to write replica cache file %s: %s" % (self.filename, e))
+            return ret
+        finally:
+            lockfile.close() # releases the lock
+
+    def lookup(self, keys):
+        """
+        Bulk look-up of replicas.
+        keys: list of scope:lfn strings
+        Return a dictionary { key: replica } of the keys found in the cache (missing and expired keys are left out)
+        """
+
+        now = time.time()
+
+        def _lookup(entries):
+            found = {}
+            # FORMAT: { key: [store time, last access time, replica] }
+            for key in entries.keys():
+                if now - entries[key][0] > self.ttl:
+                    del entries[key]
+            for key in keys:
+                entry = entries.get(key)
+                if entry:
+                    entry[1] = now
+                    found[key] = entry[2]
+            return found
+
+        found = self.__update(_lookup) or {}
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        tolog("Replica cache: %d/%d file(s) found in %s" % (len(found), len(keys), self.filename))
+
+        return found
+
+    def store(self, replicas):
+        """ Add replicas, a dictionary { scope:lfn: replica }, to the cache """
+
+        if not replicas:
+            return
+
+        now = time.time()
+
+        def _store(entries):
+            for key, replica in replicas.iteritems():
+                entries[key] = [now, now, replica]
+            # remove the least recently used entries
+            if len(entries) > self.maxsize:
+                for key in sorted(entries.keys(), key=lambda k: entries[k][1])[:len(entries) - self.maxsize]:
+                    del entries[key]
+
+        self.__update(_store)
+
+    def invalidate(self, keys):
+        """ Remove entries from the cache (e.g. when a replica turned out to be unusable) """
+
+        def _invalidate(entries):
+            for key in keys:
+                entries.pop(key, None)
+
+        self.__update(_invalidate)
+
+    def getCounters(self):
+        """ Return the number of cache hits and misses of this object """
+
+        return self.hits, self.misses
+
+def getReplicaCache(workDir, tag=""):
+    """ Return a ReplicaCache for the pilot work directory (or None if switched off in catchall) """
+
+    from pUtil import readpar
+
+    settings = {}
+    for catchall in (readpar('catchall') or '').split(','):
+        if '=' in catchall:
+            settings[catchall.split('=')[0].strip()] = catchall.split('=')[1].strip()
+
+    try:
+        ttl = int(settings.get('replica_cache_ttl', ReplicaCache.TTL))
+        maxsize = int(settings.get('replica_cache_size', ReplicaCache.MAXSIZE))
+    except ValueError, e:
+        tolog("!!WARNING!!2999!! Invalid replica cache setting in catchall: %s (using default values)" % e)
+        ttl, maxsize = ReplicaCache.TTL, ReplicaCache.MAXSIZE
+
+    filename = os.environ.get('PILOT_REPLICA_CACHE', '')
+    if not filename and workDir:
+        filename = os.path.join(workDir, "replica_cache.json")
+    if not filename or ttl <= 0 or maxsize <= 0:
+        return None
+
+    return ReplicaCache(filename, ttl=ttl, maxsize=maxsize, tag=tag)
+
+def updateReplicaCacheCounters(workDir, jobId, hits, misses):
+    """ Add the cache hits and misses of a job to its counter file (read by getReplicaCacheCounters()) """
+
+    filename = os.path.join(workDir, "replicaCache-%s.json" % jobId)
+    counters = getReplicaCacheCounters(workDir, jobId)
+    try:
+        f = open(filename, 'w')
+        try:
+            json.dump({'hits': counters[0] + hits, 'misses': counters[1] + misses}, f)
+        finally:
+            f.close()
+    except IOError, e:
+        tolog("!!WARNING!!2999!! Failed to write replica cache counters: %s" % e)
+
+def getReplicaCacheCounters(workDir, jobId):
+    """ Return the replica cache (hits, misses) of a job """
+
+    try:
+        f = open(os.path.join(workDir, "replicaCache-%s.json" % jobId))
+        try:
+            counters = json.load(f)
+        finally:
+            f.close()
+        return counters.get('hits', 0), counters.get('misses', 0)
+    except Exception:
+        return 0, 0
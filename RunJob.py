@@ -25,10 +25,12 @@ from JobRecovery import JobRecovery
 from FileStateClient import updateFileStates, dumpFileStates
 from ErrorDiagnosis import ErrorDiagnosis # import here to avoid issues seen at BU with missing module
 from PilotErrors import PilotErrors
+from QueuedataCache import QueuedataCache
 from shutil import copy2
 from FileHandling import tail, getExtension, extractOutputFiles, getDestinationDBlockItems, getDirectAccess, writeFile, readFile
 from EventRanges import downloadEventRanges
 from processes import get_cpu_consumption_time
+from MemorySampler import MemorySampler, getSamplingInterval
 
 # remove logguid, debuglevel - not needed
 # relabelled -h, queuename to -b (debuglevel not used)
@@ -521,7 +523,9 @@ class RunJob(object):
 
         self.cleanup(job, rf=rf)
         sys.stderr.close()
+        QueuedataCache().dumpAccessCounts()
         tolog("RunJob (payload wrapper) has finished")
+        pUtil.flushLog()
         # change to sys.exit?
         os._exit(job.result[2]) # pilotExitCode, don't confuse this with the overall pilot exit code,
                                 # which doesn't get reported back to panda server anyway
@@ -953,6 +957,12 @@ class RunJob(object):
 
         res_tuple = (0, 'Undefined')
 
+        # Sample the memory of the payload unless a memory monitor utility is used (replaces the VmPeak post-processing)
+        memory_sampler = None
+        interval = getSamplingInterval(default=0 if thisExperiment.shouldExecuteUtility() else MemorySampler.INTERVAL)
+        if interval > 0:
+            memory_sampler = MemorySampler(job.workdir, interval=interval)
+
         multi_trf = self.isMultiTrf(runCommandList)
         _stdout = job.stdout
         _stderr = job.stderr
@@ -1009,6 +1019,12 @@ class RunJob(object):
                     path = os.path.join(job.workdir, 'cpid.txt')
                     if writeFile(path, str(main_subprocess.pid)):
                         tolog("Wrote cpid=%s to file %s" % (main_subprocess.pid, path))
+
+                    # Sample the memory of the new process tree
+                    if memory_sampler:
+                        memory_sampler.setPid(main_subprocess.pid)
+                        if not memory_sampler.isAlive():
+                            memory_sampler.start()
                     time.sleep(2)
 
                     # Start the utility if required
@@ -1094,6 +1110,17 @@ class RunJob(object):
                     tolog("Job command %d/%d failed: res = %s" % (current_job_number, number_of_jobs, str(res_tuple)))
                     break
 
+        # Stop the memory sampler and use its values instead of the VmPeak values from the PerfMon files [MB]
+        if memory_sampler and memory_sampler.isAlive():
+            memory_sampler.stop()
+            memory_sampler.join()
+            summary = memory_sampler.getSummary()
+            if summary:
+                job.vmPeakMax = summary['Max']['maxVMEM'] / 1024
+                job.vmPeakMean = summary['Avg']['avgVMEM'] / 1024
+                job.RSSMean = summary['Avg']['avgRSS'] / 1024
+                tolog("Memory sampler: %s" % str(summary))
+
         t1 = os.times()
         cpuconsumptiontime = get_cpu_consumption_time(t0)
         job.cpuConsumptionTime = int(cpuconsumptiontime)
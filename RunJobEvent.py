@@ -41,8 +41,15 @@ from pUtil import tolog, isAnalysisJob, readpar, createLockFile, getDatasetDict,
      getSiteInformation, getGUID
 from FileHandling import getExtension, addToOSTransferDictionary, getCPUTimes, getReplicaDictionaryFromXML, writeFile
 from EventRanges import downloadEventRanges, updateEventRange, updateEventRanges
+from EventRangePrefetcher import EventRangePrefetcher
+from EventRangeUpdater import EventRangeUpdater
+from EventRangeRegistry import EventRangeRegistry
+from WakeupEvent import WakeupEvent
+from LatencyHistogram import LatencyHistogram
+from TarStreamWriter import TarStreamWriter
 from movers.base import BaseSiteMover
 from processes import get_cpu_consumption_time
+from ProcessTable import ProcessTable
 
 try:
     from PilotYamplServer import PilotYamplServer as MessageServer
@@ -77,16 +84,17 @@ class RunJobEvent(RunJob):
     __output_files = []                          # A list of all files that have been successfully staged-out, used by createFileMetadata()
     __guid_list = []                             # Keep track of downloaded GUIDs
     __lfn_list = []                              # Keep track of downloaded LFNs
-    __eventRange_dictionary = {}                 # eventRange_dictionary[event_range_id] = [path, cpu, wall]
-    __eventRangeID_dictionary = {}               # eventRangeID_dictionary[event_range_id] = True (corr. output file has been transferred)
-    __stageout_queue = []                        # Queue for files to be staged-out; files are added as they arrive and removed after they have been staged-out
+    __eventRanges = EventRangeRegistry()         # Event ranges, their output files, the stage-out queue and the event counters
     __pfc_path = ""                              # The path to the pool file catalog
     __message_server_payload = None              # Message server for the payload
     __message_server_prefetcher = None           # Message server for Prefetcher
     __message_thread_payload = None              # Thread for listening to messages from the payload
     __message_thread_prefetcher = None           # Thread for listening to messages from the Prefetcher
     __status = True                              # Global job status; will be set to False if an event range or stage-out fails
-    __athenamp_is_ready = False                  # True when an AthenaMP worker is ready to process an event range
+    __athenamp_is_ready = WakeupEvent()          # Set when an AthenaMP worker is ready to process an event range
+    __athenamp_ready_time = None                 # Time when the AthenaMP worker became ready (for the handoff latency)
+    __handoffLatency = LatencyHistogram("Event range handoff")  # Time from 'Ready for events' until the event range was sent
+    __messageLatency = {}                        # FORMAT: { message type: LatencyHistogram } (payload message handling time)
     __prefetcher_is_ready = False                # True when Prefetcher is ready to receive an event range
     __prefetcher_has_finished = False            # True when Prefetcher has updated an event range which then should be sent to AthenaMP
     __asyncOutputStager_thread = None            #
@@ -102,7 +110,7 @@ class RunJobEvent(RunJob):
     __yamplChannelNamePrefetcher = None          # Yampl channel name used by the Prefetcher
     __useEventIndex = True                       # Should Event Index be used? If not, a TAG file will be created
     __tokenextractor_input_list_filenane = ""    #
-    __sending_event_range = False                # True while event range is being sent to payload
+    __event_range_sent = WakeupEvent(True)       # Cleared while event range is being sent to payload
     __current_event_range = ""                   # Event range being sent to payload
     __updated_lfn = ""                           # Updated LFN sent from the Prefetcher
     __useTokenExtractor = False                  # Should the TE be used?
@@ -118,16 +126,20 @@ class RunJobEvent(RunJob):
     __max_wait_for_one_event = 360	# 6 hours, 360 minutes
     __min_events = 1
     __allowPrefetchEvents = True
+    __esPrefetchLow = None                       # Event range prefetch buffer watermarks (None: based on job.coreCount)
+    __esPrefetchHigh = None
+    __eventRangePrefetcher = None                # EventRangePrefetcher thread
+    __esUpdateDelay = EventRangeUpdater.MAXDELAY # Max time an event range status update is kept pending [s]
+    __esUpdateRanges = EventRangeUpdater.MAXRANGES # Max number of event ranges per status update
+    __eventRangeUpdater = None                   # EventRangeUpdater thread
+    __zipWriter = None                           # TarStreamWriter of the current output zip file
+    __zipEventRangesFile = None                  # Open zip event range file
 
     # calculate cpu time, os.times() doesn't report correct value for preempted jobs
     __childProcs = []
     __child_cpuTime = {}
 
-    # record processed events
-    __nEvents = 0
-    __nEventsW = 0
-    __nEventsFailed = 0
-    __nEventsFailedStagedOut = 0
+    # record stage-out failures (the processed events are counted by __eventRanges)
     __nStageOutFailures = 0
     __nStageOutSuccessAfterFailure = 0
     __isLastStageOutFailed = False
@@ -150,17 +162,18 @@ class RunJobEvent(RunJob):
     # Getter and setter methods
 
     def getNEvents(self):
-        return self.__nEvents, self.__nEventsW, self.__nEventsFailed, self.__nEventsFailedStagedOut
+        return self.__eventRanges.getCounts()
 
     def getSubStatus(self):
-        if not self.__eventRangeID_dictionary:
+        if not self.__eventRanges.hasEventRanges():
             return 'no_events'
         if self.__esFatalCode:
             return 'pilot_fatal'
-        if self.__nEventsFailed:
-            if self.__nEventsFailed < self.__nEventsW:
+        nEvents, nEventsW, nEventsFailed, nEventsFailedStagedOut = self.getNEvents()
+        if nEventsFailed:
+            if nEventsFailed < nEventsW:
                 return 'partly_failed'
-            elif self.__nEventsW == 0:
+            elif nEventsW == 0:
                 return 'all_failed' # 'all_failed'
             else:
                 return 'mostly_failed'
@@ -182,19 +195,20 @@ class RunJobEvent(RunJob):
         return retStr
 
     def setFinalESStatus(self, job):
-        if self.__nEventsW < 1 and self.__nStageOutFailures >= 3:
+        nEvents, nEventsW, nEventsFailed, nEventsFailedStagedOut = self.getNEvents()
+        if nEventsW < 1 and self.__nStageOutFailures >= 3:
             job.subStatus = 'pilot_failed'
             job.pilotErrorDiag = "Too many stageout failures. (%s)" % self.getStageOutDetail()
             job.result[0] = "failed"
             job.result[2] = self.__error.ERR_ESRECOVERABLE
             job.jobState = "failed"
-        elif not self.__eventRangeID_dictionary:
+        elif not self.__eventRanges.hasEventRanges():
             job.subStatus = 'pilot_noevents'  # 'no_events'
             job.pilotErrorDiag = "Pilot got no events"
             job.result[0] = "failed"
             job.result[2] = self.__error.ERR_NOEVENTS
             job.jobState = "failed"
-        elif self.__eventRangeID_dictionary and self.__nEventsW < 1:
+        elif nEventsW < 1:
             job.subStatus = 'pilot_failed'  # 'no_running_events'
             job.pilotErrorDiag = "Pilot didn't run any events"
             job.result[0] = "failed"
@@ -206,22 +220,22 @@ class RunJobEvent(RunJob):
             job.result[0] = "failed"
             job.result[2] = self.__esFatalCode
             job.jobState = "failed"
-        elif self.__nEventsFailed:
-            if self.__nEventsW == 0:
+        elif nEventsFailed:
+            if nEventsW == 0:
                 job.subStatus = 'pilot_failed' # all failed
-                job.pilotErrorDiag = "All events failed. (%s, other failure: %s)" % (self.getStageOutDetail(), self.__nEventsFailed - self.__nEventsFailedStagedOut)
+                job.pilotErrorDiag = "All events failed. (%s, other failure: %s)" % (self.getStageOutDetail(), nEventsFailed - nEventsFailedStagedOut)
                 job.result[0] = "failed"
                 job.result[2] = self.__error.ERR_ESRECOVERABLE
                 job.jobState = "failed"
-            elif self.__nEventsFailed < self.__nEventsW:
+            elif nEventsFailed < nEventsW:
                 job.subStatus = 'partly_failed'
-                job.pilotErrorDiag = "Part of events failed. (%s, other failure: %s)" % (self.getStageOutDetail(), self.__nEventsFailed - self.__nEventsFailedStagedOut)
+                job.pilotErrorDiag = "Part of events failed. (%s, other failure: %s)" % (self.getStageOutDetail(), nEventsFailed - nEventsFailedStagedOut)
                 job.result[0] = "failed"
                 job.result[2] = self.__error.ERR_ESRECOVERABLE
                 job.jobState = "failed"
             else:
                 job.subStatus = 'mostly_failed' 
-                job.pilotErrorDiag = "Most of events failed. (%s, other failure: %s)" % (self.getStageOutDetail(), self.__nEventsFailed - self.__nEventsFailedStagedOut)
+                job.pilotErrorDiag = "Most of events failed. (%s, other failure: %s)" % (self.getStageOutDetail(), nEventsFailed - nEventsFailedStagedOut)
                 job.result[0] = "failed"
                 job.result[2] = self.__error.ERR_ESRECOVERABLE
                 job.jobState = "failed"
@@ -448,34 +462,24 @@ class RunJobEvent(RunJob):
         self.__updated_lfn = updated_lfn
 
     def getEventRangeDictionary(self):
-        """ Getter for __eventRange_dictionary """
+        """ Return a dictionary { event_range_id: [paths, cpu, wall] } of the event ranges with output """
 
-        return self.__eventRange_dictionary
-
-    def setEventRangeDictionary(self, eventRange_dictionary):
-        """ Setter for __eventRange_dictionary """
-
-        self.__eventRange_dictionary = eventRange_dictionary
+        return self.__eventRanges.getOutputs()
 
     def getEventRangeIDDictionary(self):
-        """ Getter for __eventRangeID_dictionary """
-
-        return self.__eventRangeID_dictionary
-
-    def setEventRangeIDDictionary(self, eventRangeID_dictionary):
-        """ Setter for __eventRangeID_dictionary """
+        """ Return a dictionary { event_range_id: True if the event range has a final status } """
 
-        self.__eventRangeID_dictionary = eventRangeID_dictionary
+        return self.__eventRanges.getEventRangeIDs()
 
     def getStageOutQueue(self):
-        """ Getter for __stageout_queue """
+        """ Return a list of the output paths waiting for the stage-out """
 
-        return self.__stageout_queue
+        return self.__eventRanges.getStageOutQueue()
 
-    def setStageOutQueue(self, stageout_queue):
-        """ Setter for __stageout_queue """
+    def isStageOutIdle(self):
+        """ Is the stage-out queue empty with no stage-out in progress? """
 
-        self.__stageout_queue = stageout_queue
+        return self.__eventRanges.isStageOutIdle()
 
     def getPoolFileCatalogPath(self):
         """ Getter for __pfc_path """
@@ -530,12 +534,24 @@ class RunJobEvent(RunJob):
     def isAthenaMPReady(self):
         """ Getter for __athenamp_is_ready """
 
-        return self.__athenamp_is_ready
+        return self.__athenamp_is_ready.isSet()
 
     def setAthenaMPIsReady(self, athenamp_is_ready):
-        """ Setter for __athenamp_is_ready """
+        """ Setter for __athenamp_is_ready (resetting it after an event range has been sent records the handoff latency) """
+
+        if athenamp_is_ready:
+            self.__athenamp_ready_time = time.time()
+            self.__athenamp_is_ready.set()
+        else:
+            self.__athenamp_is_ready.clear()
+            if self.__athenamp_ready_time:
+                self.__handoffLatency.add(time.time() - self.__athenamp_ready_time)
+                self.__athenamp_ready_time = None
+
+    def waitForAthenaMPReady(self, timeout):
+        """ Wait at most timeout seconds for an AthenaMP worker to be ready, return True if it is """
 
-        self.__athenamp_is_ready = athenamp_is_ready
+        return self.__athenamp_is_ready.wait(timeout)
 
     def isPrefetcherReady(self):
         """ Getter for __prefetcher_is_ready """
@@ -641,14 +657,50 @@ class RunJobEvent(RunJob):
         self.__status = status
 
     def isSendingEventRange(self):
-        """ Getter for __sending_event_range """
+        """ Is an event range being sent to the payload? """
 
-        return self.__sending_event_range
+        return not self.__event_range_sent.isSet()
 
     def setSendingEventRange(self, sending_event_range):
-        """ Setter for __sending_event_range """
+        """ Setter for __event_range_sent (cleared while an event range is being sent) """
+
+        if sending_event_range:
+            self.__event_range_sent.clear()
+        else:
+            self.__event_range_sent.set()
+
+    def closeWakeupEvents(self):
+        """ Close the pipes of the wakeup events (once the message threads have been stopped) """
+
+        self.__athenamp_is_ready.close()
+        self.__event_range_sent.close()
+
+    def addMessageLatency(self, buf, latency):
+        """ Add the handling time of a payload message to the histogram of its message type """
+
+        if "Ready for events" in buf:
+            message_type = "Ready for events"
+        elif buf.startswith('/'):
+            message_type = "Output file"
+        elif buf.startswith('['):
+            message_type = "Updated event range"
+        elif buf.startswith('ERR'):
+            message_type = "Error"
+        else:
+            message_type = "Other"
+        if not self.__messageLatency.has_key(message_type):
+            self.__messageLatency[message_type] = LatencyHistogram("%s messages" % (message_type))
+        self.__messageLatency[message_type].add(latency)
 
-        self.__sending_event_range = sending_event_range
+    def reportMessageLatencies(self, job):
+        """ Log the latency histograms of the payload messages and add the event range handoff latency to the job metrics """
+
+        tolog(str(self.__handoffLatency))
+        for message_type in sorted(self.__messageLatency.keys()):
+            tolog(str(self.__messageLatency[message_type]))
+        if self.__handoffLatency.getCount():
+            job.yodaJobMetrics['esHandoffLatencyMean'] = int(self.__handoffLatency.getMean() * 1000)
+            job.yodaJobMetrics['esHandoffLatencyP95'] = int(self.__handoffLatency.getPercentile(95) * 1000)
 
     def getCurrentEventRange(self):
         """ Getter for __current_event_range """
@@ -669,6 +721,102 @@ class RunJobEvent(RunJob):
         """ Getter for __min_events """
         return self.__min_events
 
+    def getEventRangePrefetcher(self):
+        """ Getter for __eventRangePrefetcher """
+
+        return self.__eventRangePrefetcher
+
+    def setEventRangePrefetcher(self, eventRangePrefetcher):
+        """ Setter for __eventRangePrefetcher """
+
+        self.__eventRangePrefetcher = eventRangePrefetcher
+
+    def createEventRangePrefetcher(self, job, event_ranges=None):
+        """ Create and start the event range prefetcher (returns None if switched off) """
+
+        if not self.__allowPrefetchEvents:
+            return None
+
+        try:
+            coreCount = max(1, int(job.coreCount))
+        except:
+            coreCount = 1
+        low = self.__esPrefetchLow
+        if low is None:
+            low = coreCount
+        high = self.__esPrefetchHigh
+        if high is None:
+            high = 2 * max(low, coreCount)
+        if high <= 0:
+            tolog("Event range prefetcher is switched off")
+            return None
+
+        tolog("Starting event range prefetcher (low watermark: %d, high watermark: %d)" % (low, high))
+        self.__eventRangePrefetcher = EventRangePrefetcher(job, self.getPanDAServer(), low, high, event_ranges=event_ranges)
+        self.__eventRangePrefetcher.start()
+
+        return self.__eventRangePrefetcher
+
+    def stopEventRangePrefetcher(self, job):
+        """ Stop the event range prefetcher, return the unused event ranges and add the saved idle worker time to the job metrics """
+
+        if not self.__eventRangePrefetcher:
+            return
+
+        self.__eventRangePrefetcher.stop()
+        self.__eventRangePrefetcher.join(5)
+
+        # the prefetched event ranges that were not sent to AthenaMP (soft/hard kill, abort) are failed as recoverable,
+        # so that the server hands them out again
+        event_ranges = self.__eventRangePrefetcher.drain()
+        if event_ranges:
+            tolog("Returning %d prefetched event range(s) that were not processed" % (len(event_ranges)))
+            try:
+                updater = self.getEventRangeUpdater()
+                for event_range in event_ranges:
+                    updater.add(event_range['eventRangeID'], 'failed', errorCode=self.__error.ERR_ESRECOVERABLE)
+                if not updater.flush():
+                    tolog("!!WARNING!!2999!! Failed to return the prefetched event ranges, the update will be sent again later")
+            except:
+                tolog("!!WARNING!!2222!! Caught exception: %s" % (traceback.format_exc()))
+
+        counts = self.__eventRangePrefetcher.getCounts()
+        tolog("Event range prefetcher: %d download(s), %d event range(s), %d not used, %d wait(s) for a download (%.1f s), saved idle worker time: %.1f s" %\
+              (counts['downloads'], counts['ranges'], counts['returned'], counts['waits'], counts['waitTime'], counts['savedTime']))
+
+        if not job.yodaJobMetrics:
+            job.yodaJobMetrics = {}
+        job.yodaJobMetrics['esPrefetchSavedWorkerSeconds'] = int(round(counts['savedTime']))
+        job.yodaJobMetrics['esPrefetchWaits'] = counts['waits']
+
+    def getEventRangeUpdater(self):
+        """ Return the event range status updater (created and started at the first call) """
+
+        if not self.__eventRangeUpdater:
+            journal = os.path.join(self.__job.workdir, "eventRangeUpdates-%s.json" % (self.__job.jobId))
+            self.__eventRangeUpdater = EventRangeUpdater(self.__job.jobId, self.getPanDAServer(), pandaProxySecretKey=self.__job.pandaProxySecretKey,
+                                                         journal=journal, maxRanges=self.__esUpdateRanges, maxDelay=self.__esUpdateDelay,
+                                                         callback=self.checkSoftMessage)
+            self.__eventRangeUpdater.start()
+
+        return self.__eventRangeUpdater
+
+    def flushEventRangeUpdates(self):
+        """ Send the pending event range updates now (signal handler) """
+
+        if self.__eventRangeUpdater:
+            try:
+                if not self.__eventRangeUpdater.flush(blocking=False):
+                    tolog("!!WARNING!!2999!! %d event range update(s) are left in the journal" % (self.__eventRangeUpdater.getPendingCount()))
+            except:
+                tolog("!!WARNING!!2222!! Caught exception: %s" % (traceback.format_exc()))
+
+    def stopEventRangeUpdater(self):
+        """ Stop the event range status updater (sends the pending updates) """
+
+        if self.__eventRangeUpdater:
+            self.__eventRangeUpdater.stop()
+
     def shouldBeAborted(self):
         """ Should the job be aborted? """
 
@@ -1206,6 +1354,7 @@ class RunJobEvent(RunJob):
         self.cleanup(rf=rf)
         sys.stderr.close()
         tolog("RunJobEvent (payload wrapper) has finished")
+        pUtil.flushLog()
 
         # change to sys.exit?
         os._exit(self.__job.result[2]) # pilotExitCode, don't confuse this with the overall pilot exit code,
@@ -1403,6 +1552,26 @@ class RunJobEvent(RunJob):
                         name, value = catchall.split('=')
                         self.__min_events = int(value)
             tolog("Minimal events requirement: %s events" % self.__min_events)
+
+            if "es_prefetch_" in catchalls:
+                for catchall in catchalls.split(","):
+                    if 'es_prefetch_low=' in catchall:
+                        name, value = catchall.split('=')
+                        self.__esPrefetchLow = int(value)
+                    if 'es_prefetch_high=' in catchall:
+                        name, value = catchall.split('=')
+                        self.__esPrefetchHigh = int(value)
+                tolog("Event range prefetch watermarks: low=%s, high=%s" % (self.__esPrefetchLow, self.__esPrefetchHigh))
+
+            if "es_update_" in catchalls:
+                for catchall in catchalls.split(","):
+                    if 'es_update_delay=' in catchall:
+                        name, value = catchall.split('=')
+                        self.__esUpdateDelay = int(value)
+                    if 'es_update_ranges=' in catchall:
+                        name, value = catchall.split('=')
+                        self.__esUpdateRanges = int(value)
+            tolog("Event range status updates: max %s event ranges, max delay %s s" % (self.__esUpdateRanges, self.__esUpdateDelay))
         except:
             tolog("Failed to init zip cofnig: %s" % traceback.format_exc())
 
@@ -1656,13 +1825,7 @@ class RunJobEvent(RunJob):
     def getEventRangeID(self, filename):
         """ Return the event range id for the corresponding output file """
 
-        event_range_id = ""
-        for event_range in self.__eventRange_dictionary.keys():
-            if self.__eventRange_dictionary[event_range][0] == filename:
-                event_range_id = event_range
-                break
-
-        return event_range_id
+        return self.__eventRanges.getEventRangeID(filename)
 
     def transferToObjectStore(self, outputFileInfo, metadata_fname):
         """ Transfer the output file to the object store """
@@ -1955,30 +2118,79 @@ class RunJobEvent(RunJob):
 
         # FORMAT:  outputFileInfo = {'<full path>/filename.ext': (fsize, checksum, guid), ...}
         # The dictionary will only contain info about a single file
+        # The zip file is kept open until closeZipOutput() is called
 
         ec = 0
         pilotErrorDiag = ""
 
+        if not output_name:
+            output_name = self.__job.outputZipName
+
         # Extract all information from the dictionary
         for path in paths:
-            if output_name:
-                command = "tar -rf " + output_name + " --directory=%s %s" %(os.path.dirname(path), os.path.basename(path))
-            else:
-                command = "tar -rf " + self.__job.outputZipName + " --directory=%s %s" %(os.path.dirname(path), os.path.basename(path))
-            tolog("Adding file to zip: %s" % command)
-            ec, pilotErrorDiag = commands.getstatusoutput(command)
-            tolog("status: %s, output: %s\n" % (ec, pilotErrorDiag))
-            if ec:
+            tolog("Adding file to zip: %s (%s)" % (path, output_name))
+            try:
+                if not self.__zipWriter or self.__zipWriter.filename != output_name:
+                    self.closeZipOutput()
+                    self.__zipWriter = TarStreamWriter(output_name)
+                self.__zipWriter.add(path)
+            except Exception, e:
+                ec = -1
+                pilotErrorDiag = str(e)
                 tolog("Failed to zip %s: %s, %s" % (path, ec, pilotErrorDiag))
                 return ec, pilotErrorDiag
 
         # tolog("Adding event range to zip event range file: %s %s" % (event_range_id, paths))
-        handler = open(self.__job.outputZipEventRangesName, "a")
-        handler.write("%s %s\n" % (event_range_id, paths))
-        handler.close()
+        if not self.__zipEventRangesFile:
+            self.__zipEventRangesFile = open(self.__job.outputZipEventRangesName, "a")
+        self.__zipEventRangesFile.write("%s %s\n" % (event_range_id, paths))
+        self.__zipEventRangesFile.flush()
 
         return ec, pilotErrorDiag
 
+    def closeZipOutput(self):
+        """ Close the current zip file (before it is staged out) and the zip event range file """
+
+        ec = 0
+        pilotErrorDiag = ""
+
+        if self.__zipWriter:
+            try:
+                self.__zipWriter.close()
+            except Exception, e:
+                ec = -1
+                pilotErrorDiag = "Failed to close zip file %s: %s" % (self.__zipWriter.filename, e)
+                tolog("!!WARNING!!2222!! %s" % (pilotErrorDiag))
+            self.__zipWriter = None
+        if self.__zipEventRangesFile:
+            self.__zipEventRangesFile.close()
+            self.__zipEventRangesFile = None
+
+        return ec, pilotErrorDiag
+
+    def failZipOutput(self, output_name, output_eventRanges, pilotErrorDiag):
+        """ Report the event ranges of a zip file that could not be closed as failed, the incomplete zip file is not staged out """
+
+        tolog("!!WARNING!!2222!! Zip file %s is incomplete, will not stage it out: %s" % (output_name, pilotErrorDiag))
+        if output_name and os.path.exists(output_name):
+            try:
+                os.remove(output_name)
+            except OSError, e:
+                tolog("!!WARNING!!2222!! Failed to remove %s: %s" % (output_name, e))
+
+        eventRanges = []
+        for eventRangeID in output_eventRanges:
+            self.__eventRanges.setStatus(eventRangeID, 'failed')
+            eventRanges.append({'eventRangeID': eventRangeID, 'eventStatus': 'failed', 'objstoreID': -1, 'errorCode': self.__error.ERR_STAGEOUTFAILED})
+        for chunkEventRanges in pUtil.chunks(eventRanges, 100):
+            status, output = updateEventRanges(chunkEventRanges, jobId = self.__job.jobId, url=self.getPanDAServer(), version=1, pandaProxySecretKey = self.__job.pandaProxySecretKey)
+            tolog("Update Event ranges status: %s, output: %s" % (status, output))
+            self.checkSoftMessage(output)
+
+        self.__isLastStageOutFailed = True
+        self.__nStageOutFailures += 1
+        self.__nStageOutSuccessAfterFailure = 0
+
     def getPathConvention(self, taskId, jobId):
         # __multipleBuckets:
         # 1: final path will be atlaseventservice_<pathConvention>
@@ -2005,11 +2217,15 @@ class RunJobEvent(RunJob):
             tolog("The PanDA server has issued a hard kill command for this job - AthenaMP will be killed (current event range will be aborted)")
             self.setAbort()
             self.setToBeKilled()
+            if self.__eventRangePrefetcher:
+                self.__eventRangePrefetcher.stop()
             if job:
                 job.subStatus = 'pilot_killed'
         if (msg and "softkill" in msg) or (job and pUtil.checkLockFile(job.workdir, "SOFTKILL")):
             tolog("The PanDA server has issued a soft kill command for this job - current event range will be allowed to finish")
             self.__isKilled = True
+            if self.__eventRangePrefetcher:
+                self.__eventRangePrefetcher.stop()
             self.sendMessage("No more events")
             if job:
                 job.subStatus = 'softkilled'
@@ -2073,8 +2289,7 @@ class RunJobEvent(RunJob):
             if errorCode:
                 eventRanges = []
                 for eventRangeID in output_eventRanges:
-                    self.__nEventsFailed += 1
-                    self.__nEventsFailedStagedOut += 1
+                    self.__eventRanges.setStatus(eventRangeID, 'failed')
                     eventRanges.append({'eventRangeID': eventRangeID, 'eventStatus': status, 'objstoreID': os_bucket_id, 'errorCode': errorCode})
 
                 for chunkEventRanges in pUtil.chunks(eventRanges, 100):
@@ -2091,7 +2306,7 @@ class RunJobEvent(RunJob):
 
                 eventRanges = []
                 for eventRangeID in output_eventRanges:
-                    self.__nEventsW += 1
+                    self.__eventRanges.setStatus(eventRangeID, 'finished')
                     eventRanges.append({'eventRangeID': eventRangeID, 'eventStatus': status})
 
                 numEvents = len(eventRanges)
@@ -2171,8 +2386,7 @@ class RunJobEvent(RunJob):
             if errorCode:
                 eventRanges = []
                 for eventRangeID in output_eventRanges:
-                    self.__nEventsFailed += 1
-                    self.__nEventsFailedStagedOut += 1
+                    self.__eventRanges.setStatus(eventRangeID, 'failed')
                     eventRanges.append({'eventRangeID': eventRangeID, 'eventStatus': status, 'objstoreID': os_bucket_id, 'errorCode': errorCode})
 
                 for chunkEventRanges in pUtil.chunks(eventRanges, 100):
@@ -2183,7 +2397,7 @@ class RunJobEvent(RunJob):
             else:
                 eventRanges = []
                 for eventRangeID in output_eventRanges:
-                    self.__nEventsW += 1
+                    self.__eventRanges.setStatus(eventRangeID, 'finished')
                     eventRanges.append({'eventRangeID': eventRangeID, 'eventStatus': status})
 
                 for chunkEventRanges in pUtil.chunks(eventRanges, 100):
@@ -2257,6 +2471,8 @@ class RunJobEvent(RunJob):
 
     def updateRemainingEventRanges(self):
         try:
+            if self.__eventRangeUpdater:
+                self.__eventRangeUpdater.flush()
             eventrangesToBeUpdated = self.__eventrangesToBeUpdated
             self.__eventrangesToBeUpdated = []
             for i in range(len(eventrangesToBeUpdated)):
@@ -2296,17 +2512,20 @@ class RunJobEvent(RunJob):
                 update_event_ranges_time = time.time()
                 self.updateRemainingEventRanges()
 
-            if len(self.__stageout_queue) > 0 and (time.time() > run_time + sleep_time or first_observe_iskilled):
+            if self.__eventRanges.getStageOutQueueLength() > 0 and (time.time() > run_time + sleep_time or first_observe_iskilled):
                 tolog('Sleeped time: %s, is killed: %s' % (sleep_time, self.__isKilled))
                 if first_observe_iskilled:
                     first_observe_iskilled = False
-                if not finished_first_upload and len(self.__stageout_queue) < self.__job.coreCount:
+                if not finished_first_upload and self.__eventRanges.getStageOutQueueLength() < self.__job.coreCount:
                     tolog("Wait 1 minute for every core to finish one event.")
                     time.sleep(60)
                 tolog("Asynchronous output stager thread working")
                 run_time = time.time()
                 if not self.__esToZip:
-                    for paths in self.__stageout_queue:
+                    while True:
+                        paths = self.__eventRanges.popStageOut()
+                        if paths is None:
+                            break
                         # Create the output file metadata (will be sent to server)
                         tolog("Preparing to stage-out file %s" % (paths))
                         event_range_id = self.getEventRangeID(paths)
@@ -2317,11 +2536,7 @@ class RunJobEvent(RunJob):
                                 ec, pilotErrorDiag, os_bucket_id = self.stage_out_es(self.__job, event_range_id, paths)
                             except Exception, e:
                                 tolog("!!WARNING!!2222!! Caught exception: %s" % (traceback.format_exc()))
-                                tolog("Removing %s from stage-out queue to prevent endless loop" % (paths))
-                                self.__stageout_queue.remove(paths)
                             else:
-                                tolog("Removing %s from stage-out queue" % (paths))
-                                self.__stageout_queue.remove(paths)
                                 tolog("Adding %s to output file list" % (paths))
                                 for fpath in paths:
                                     self.__output_files.append(fpath)
@@ -2329,43 +2544,27 @@ class RunJobEvent(RunJob):
                                 errorCode = None
                                 if ec == 0:
                                     status = 'finished'
-                                    self.__nEventsW += 1
                                 else:
                                     status = 'failed'
-                                    self.__nEventsFailed += 1
-                                    self.__nEventsFailedStagedOut += 1
                                     errorCode = self.__error.ERR_STAGEOUTFAILED
 
                                     # Update the global status field in case of failure
                                     self.setStatus(False)
+                                self.__eventRanges.setStatus(event_range_id, status)
 
                                 try:
-                                    # Time to update the server
-                                    msg = updateEventRange(event_range_id, self.__eventRange_dictionary[event_range_id], self.__job.jobId, status=status, os_bucket_id=os_bucket_id, errorCode=errorCode, pandaProxySecretKey=self.__job.pandaProxySecretKey)
-
-                                    # Did the updateEventRange back channel contain an instruction?
-                                    if msg == "tobekilled":
-                                        tolog("The PanDA server has issued a hard kill command for this job - AthenaMP will be killed (current event range will be aborted)")
-                                        self.setAbort()
-                                        self.setToBeKilled()
-                                        job = self.getJob()
-                                        if job:
-                                            job.subStatus = 'pilot_killed'
-                                    if msg == "softkill":
-                                        tolog("The PanDA server has issued a soft kill command for this job - current event range will be allowed to finish")
-                                        self.sendMessage("No more events")
-                                        self.setAbort()
-                                        job = self.getJob()
-                                        if job:
-                                            job.subStatus = 'pilot_killed'
+                                    # The server is updated in bulk, back channel instructions are handled by checkSoftMessage()
+                                    self.getEventRangeUpdater().add(event_range_id, status, os_bucket_id=os_bucket_id, errorCode=errorCode)
                                 except:
                                     tolog("!!WARNING!!2222!! Caught exception: %s" % (traceback.format_exc()))
                 else:
                     output_name = None
                     output_eventRange_id = None
                     output_eventRanges = {}
-                    while len(self.__stageout_queue) > 0:
-                        paths = self.__stageout_queue.pop()
+                    while True:
+                        paths = self.__eventRanges.popStageOut()
+                        if paths is None:
+                            break
                         #tolog("Pop %s from stage-out queue" % (paths))
 
                         # Create the output file metadata (will be sent to server)
@@ -2387,14 +2586,22 @@ class RunJobEvent(RunJob):
                                 for fpath in paths:
                                     self.__output_files.append(fpath)
                                 # tolog("output_files = %s" % (self.__output_files))
-                    tolog("Files %s are zipped to %s" % (output_eventRanges, output_name))
-                    self.stageOutZipFiles_new(output_name, output_eventRanges, output_eventRange_id)
+                    ec, pilotErrorDiag = self.closeZipOutput()
+                    if ec:
+                        self.failZipOutput(output_name, output_eventRanges, pilotErrorDiag)
+                    else:
+                        tolog("Files %s are zipped to %s" % (output_eventRanges, output_name))
+                        self.stageOutZipFiles_new(output_name, output_eventRanges, output_eventRange_id)
                     finished_first_upload = True
                 self.syncStagedOutESFileStatus()
             time.sleep(1)
           except:
                tolog("!!WARNING!!2222!! Caught exception: %s" % (traceback.format_exc()))
+          finally:
+               # the outputs taken from the queue are no longer in flight (staged out, failed or lost to an exception)
+               self.__eventRanges.stageOutFinished()
         self.updateRemainingEventRanges()
+        self.stopEventRangeUpdater()
         tolog("Asynchronous output stager thread has been stopped")
 
     @mover.use_newmover(asynchronousOutputStager_new)
@@ -2408,11 +2615,14 @@ class RunJobEvent(RunJob):
         while not self.__asyncOutputStager_thread.stopped():
           try:
             sleep_time = self.__asyncOutputStager_thread_sleep_time
-            if len(self.__stageout_queue) > 0 and time.time() > run_time + sleep_time:
+            if self.__eventRanges.getStageOutQueueLength() > 0 and time.time() > run_time + sleep_time:
                 tolog("Asynchronous output stager thread working")
                 run_time = time.time()
                 if not self.__esToZip:
-                    for paths in self.__stageout_queue:
+                    while True:
+                        paths = self.__eventRanges.popStageOut()
+                        if paths is None:
+                            break
                         # Create the output file metadata (will be sent to server)
                         tolog("Preparing to stage-out file %s" % (paths))
                         event_range_id = self.getEventRangeID(paths)
@@ -2436,8 +2646,6 @@ class RunJobEvent(RunJob):
                                 if not ec == 0:
                                     break
 
-                            tolog("Removing %s from stage-out queue" % (paths))
-                            self.__stageout_queue.remove(paths)
                             tolog("Adding %s to output file list" % (paths))
                             for fpath in paths:
                                 self.__output_files.append(fpath)
@@ -2445,21 +2653,19 @@ class RunJobEvent(RunJob):
                             errorCode = None
                             if ec == 0:
                                 status = 'finished'
-                                self.__nEventsW += 1
                             else:
                                 status = 'failed'
-                                self.__nEventsFailed += 1
-                                self.__nEventsFailedStagedOut += 1
                                 errorCode = self.__error.ERR_STAGEOUTFAILED
 
                                 # Update the global status field in case of failure
                                 self.setStatus(False)
 
                                 # Note: the rec pilot must update the server appropriately
+                            self.__eventRanges.setStatus(event_range_id, status)
 
                             try:
                                 # Time to update the server
-                                msg = updateEventRange(event_range_id, self.__eventRange_dictionary[event_range_id], self.__job.jobId, status=status, os_bucket_id=os_bucket_id, errorCode=errorCode, pandaProxySecretKey=self.__job.pandaProxySecretKey)
+                                msg = updateEventRange(event_range_id, self.__eventRanges.getOutput(event_range_id), self.__job.jobId, status=status, os_bucket_id=os_bucket_id, errorCode=errorCode, pandaProxySecretKey=self.__job.pandaProxySecretKey)
 
                                 # Did the updateEventRange back channel contain an instruction?
                                 if msg == "tobekilled":
@@ -2482,8 +2688,10 @@ class RunJobEvent(RunJob):
                     output_name = None
                     output_eventRange_id = None
                     output_eventRanges = {}
-                    while len(self.__stageout_queue) > 0:
-                        paths = self.__stageout_queue.pop()
+                    while True:
+                        paths = self.__eventRanges.popStageOut()
+                        if paths is None:
+                            break
                         tolog("Pop %s from stage-out queue" % (paths))
 
                         # Create the output file metadata (will be sent to server)
@@ -2505,12 +2713,18 @@ class RunJobEvent(RunJob):
                                 for fpath in paths:
                                     self.__output_files.append(fpath)
                                 # tolog("output_files = %s" % (self.__output_files))
-                    tolog("Files %s are zipped to %s" % (output_eventRanges, output_name))
-                    self.stageOutZipFiles(output_name, output_eventRanges, output_eventRange_id)
+                    ec, pilotErrorDiag = self.closeZipOutput()
+                    if ec:
+                        self.failZipOutput(output_name, output_eventRanges, pilotErrorDiag)
+                    else:
+                        tolog("Files %s are zipped to %s" % (output_eventRanges, output_name))
+                        self.stageOutZipFiles(output_name, output_eventRanges, output_eventRange_id)
 
             time.sleep(1)
           except:
                tolog("!!WARNING!!2222!! Caught exception: %s" % (traceback.format_exc()))
+          finally:
+               self.__eventRanges.stageOutFinished()
         tolog("Asynchronous output stager thread has been stopped")
 
     def payloadListener(self):
@@ -2522,28 +2736,22 @@ class RunJobEvent(RunJob):
         while not self.__message_thread_payload.stopped():
 
             try:
-                # Receive a message
+                # Receive a message (wait at most one second at a time, so that a stopped thread is noticed)
                 tolog("Waiting for a new message")
-                size, buf = self.__message_server_payload.receive()
+                size, buf = self.__message_server_payload.receive(timeout=1)
                 while size == -1 and not self.__message_thread_payload.stopped():
-                    time.sleep(0.1)
-                    size, buf = self.__message_server_payload.receive()
+                    size, buf = self.__message_server_payload.receive(timeout=1)
+                t0 = time.time()
                 tolog("Received new message from Payload: %s" % (buf))
+                message = buf
 
-                max_wait = 600
-                i = 0
-                if self.__sending_event_range:
+                if self.isSendingEventRange():
                     tolog("Will wait for current event range to finish being sent (pilot not yet ready to process new request)")
-                while self.__sending_event_range:
                     # Wait until previous send event range has completed (to avoid racing condition), but wait maximum 60 seconds then fail job
-                    time.sleep(0.1)
-                    if i > max_wait:
+                    if not self.__event_range_sent.wait(60):
                         # Abort with error
                         buf = "ERR_FATAL_STUCK_SENDING %s: Stuck sending event range to payload; new message: %s" % (self.__current_event_range, buf)
-                        break
-                    i += 1
-                if i > 0:
-                    tolog("Delayed %d s for send message to complete" % (i*10))
+                    tolog("Delayed %.1f s for send message to complete" % (time.time() - t0))
 
 #                if not "Ready for" in buf:
 #                    if self.__eventRangeID_dictionary.keys():
@@ -2561,22 +2769,17 @@ class RunJobEvent(RunJob):
                 if "Ready for events" in buf:
                     buf = ""
                     #tolog("AthenaMP is ready for events")
-                    self.__athenamp_is_ready = True
+                    self.setAthenaMPIsReady(True)
 
                 elif buf.startswith('/'):
                     # tolog("Received file and process info from client: %s" % (buf))
 
-                    self.__nEvents += 1
-
                     # Extract the information from the message
                     paths, event_range_id, cpu, wall = self.interpretMessage(buf)
-                    if paths and paths not in self.__stageout_queue:
-                        # Add the extracted info to the event range dictionary
-                        self.__eventRange_dictionary[event_range_id] = [paths, cpu, wall]
 
-                        # Add the file to the stage-out queue
-                        self.__stageout_queue.append(paths)
-                        # tolog("File %s has been added to the stage-out queue (length = %d)" % (paths, len(self.__stageout_queue)))
+                    # Add the extracted info to the event range registry and the file to the stage-out queue
+                    self.__eventRanges.addOutput(event_range_id, paths, cpu, wall)
+                    # tolog("File %s has been added to the stage-out queue (length = %d)" % (paths, self.__eventRanges.getStageOutQueueLength()))
 
                 elif buf.startswith('['):
                     tolog("Received an updated event range message from Prefetcher: %s" % (buf))
@@ -2617,7 +2820,7 @@ class RunJobEvent(RunJob):
                             error_code = self.__error.ERR_UNKNOWN
 
                         # Time to update the server
-                        self.__nEventsFailed += 1
+                        self.__eventRanges.setStatus(event_range_id, event_status, stagedOut=False)
                         msg = updateEventRange(event_range_id, [], self.__job.jobId, status=event_status, errorCode=error_code, pandaProxySecretKey=self.__job.pandaProxySecretKey)
                         if msg != "":
                             tolog("!!WARNING!!2145!! Problem with updating event range: %s" % (msg))
@@ -2635,9 +2838,11 @@ class RunJobEvent(RunJob):
 
                 else:
                     tolog("Pilot received message:%s" % buf)
+
+                if size != -1:
+                    self.addMessageLatency(message, time.time() - t0)
             except Exception, e:
                 tolog("Caught exception:%s" % e)
-            time.sleep(0.1)
 
         tolog("Payload listener has finished")
 
@@ -2652,10 +2857,9 @@ class RunJobEvent(RunJob):
             try:
                 # Receive a message
                 # tolog("Waiting for a new message")
-                size, buf = self.__message_server_prefetcher.receive()
+                size, buf = self.__message_server_prefetcher.receive(timeout=1)
                 while size == -1 and not self.__message_thread_prefetcher.stopped():
-                    time.sleep(1)
-                    size, buf = self.__message_server_prefetcher.receive()
+                    size, buf = self.__message_server_prefetcher.receive(timeout=1)
                 tolog("Received new message from Prefetcher: %s" % (buf))
 
                 # Interpret the message and take the appropriate action
@@ -2706,7 +2910,7 @@ class RunJobEvent(RunJob):
                             error_code = self.__error.ERR_UNKNOWN
 
                         # Time to update the server
-                        self.__nEventsFailed += 1
+                        self.__eventRanges.setStatus(event_range_id, event_status, stagedOut=False)
                         msg = updateEventRange(event_range_id, [], self.__job.jobId, status=event_status, errorCode=error_code)
                         if msg != "":
                             tolog("!!WARNING!!2145!! Problem with updating event range: %s" % (msg))
@@ -3222,25 +3426,17 @@ class RunJobEvent(RunJob):
     def areAllOutputFilesTransferred(self):
         """ Verify whether all files have been staged out or not """
 
-        status = True
-        for eventRangeID in self.__eventRangeID_dictionary.keys():
-            if self.__eventRangeID_dictionary[eventRangeID] == False:
-                status = False
-                break
-
-        return status
+        return self.__eventRanges.allDone()
 
     def addEventRangeIDsToDictionary(self, currentEventRangeIDs):
         """ Add the latest eventRangeIDs list to the total event range id dictionary """
 
-        # The eventRangeID_dictionary is used to keep track of which output files have been returned from AthenaMP
-        # (eventRangeID_dictionary[eventRangeID] = False means that the corresponding output file has not been created/transferred yet)
+        # The event range registry is used to keep track of which output files have been returned from AthenaMP
+        # (an event range without final status means that the corresponding output file has not been created/transferred yet)
         # This is necessary since otherwise the pilot will not know what has been processed completely when the "No more events"
         # message arrives from the server
 
-        for eventRangeID in currentEventRangeIDs:
-            if not self.__eventRangeID_dictionary.has_key(eventRangeID):
-                self.__eventRangeID_dictionary[eventRangeID] = False
+        self.__eventRanges.addEventRangeIDs(currentEventRangeIDs)
 
     def getProperInputFileName(self, input_files):
         """ Return the first non TAG file name in the input file list """
@@ -3259,67 +3455,35 @@ class RunJobEvent(RunJob):
 
         return filename
 
-    def findChildProcesses(self,pid):
-        command = "/bin/ps -e --no-headers -o pid -o ppid -o fname"
-        status,output = commands.getstatusoutput(command)
-        #print "ps output: %s" % output
+    def findChildProcesses(self, pid, table=None):
+        """ Return the pids of the direct children of pid """
 
-        pieces = []
-        result = []
-        for line in output.split("\n"):
-            pieces= line.split()
-            try:
-                value=int(pieces[1])
-            except Exception,e:
-                #print "trouble interpreting ps output %s: \n %s" % (e,pieces)
-                continue
-            if value==pid:
-                try:
-                    job=int(pieces[0])
-                except ValueError,e:
-                    #print "trouble interpreting ps output %s: \n %s" % (e,pieces[0])
-                    continue
-                result.append(job)
-        return result
-
-    def getChildren(self, pid):
-        #self.__childProcs = []
-        if pid not in self.__childProcs:
-            self.__childProcs.append(pid)
-        childProcs = self.findChildProcesses(pid)
-        for child in childProcs:
-            self.getChildren(child)
-
-    def getCPUConsumptionTimeFromProcPid(self, pid):
-        try:
-            if not os.path.exists(os.path.join('/proc/', str(pid), 'stat')):
-                return 0
-            with open(os.path.join('/proc/', str(pid), 'stat'), 'r') as pidfile:
-                proctimes = pidfile.readline()
-                # get utime from /proc/<pid>/stat, 14 item
-                utime = proctimes.split(' ')[13]
-                # get stime from proc/<pid>/stat, 15 item
-                stime = proctimes.split(' ')[14]
-                # count total process used time
-                proctotal = int(utime) + int(stime)
-            return(float(proctotal))
-        except:
-            #tolog("Failed to get cpu consumption time for pid %s: %s" % (pid, traceback.format_exc()))
-            return 0
+        if not table:
+            table = ProcessTable()
+        return table.getChildren(pid)
+
+    def getChildren(self, pid, table=None):
+        """ Add pid and all its descendants to the child process list, using a single process table snapshot """
+
+        if not table:
+            table = ProcessTable()
+        for process in table.getSubtree(pid):
+            if process not in self.__childProcs:
+                self.__childProcs.append(process)
 
     def getCPUConsumptionTimeFromProc(self, processId):
         cpuConsumptionTime = 0L
         try:
-            CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
             if processId:
+                table = ProcessTable()
                 self.__childProcs = []
                 self.__child_cpuTime = {}
-                self.getChildren(processId)
+                self.getChildren(processId, table=table)
                 for process in self.__childProcs:
                     if process not in self.__child_cpuTime.keys():
                         self.__child_cpuTime[process] = 0
                 for process in self.__child_cpuTime.keys():
-                    cpuTime = self.getCPUConsumptionTimeFromProcPid(process) / CLOCK_TICKS
+                    cpuTime = table.getCPUTime(process, children=False, reaped=False)
                     # if cpuTime > self.__child_cpuTime[process]:
                     # process can return a small value if it's killed
                     self.__child_cpuTime[process] = cpuTime
@@ -3560,6 +3724,10 @@ if __name__ == "__main__":
                 runJob.setGlobalErrorCode(error.ERR_KILLSIGNAL)
             runJob.setFailureCode(runJob.getGlobalErrorCode())
 
+            # send the event range updates held back for the bulk update (the journal is left for the job recovery
+            # if the update fails or another update is being sent)
+            runJob.flushEventRangeUpdates()
+
             runJob.setAsyncOutputStagerSleepTime(sleep_time=0)
             runJob.asynchronousOutputStager()
 
@@ -3930,11 +4098,16 @@ if __name__ == "__main__":
                 tolog("Got less events(%s events) than minimal requirement(%s events). will finish this job directly" % (len(first_event_ranges), runJob.getMinEvents()))
                 runJob.failJob(0, error.ERR_TOOFEWEVENTS, job, pilotErrorDiag="Got less events(%s events) than minimal requirement(%s events)" % (len(first_event_ranges), runJob.getMinEvents()))
 
-            # Get the current list of eventRangeIDs
-            currentEventRangeIDs = runJob.extractEventRangeIDs(first_event_ranges)
+            # Keep downloading event ranges in the background, ahead of the AthenaMP requests
+            # (the first event ranges are handed out from the prefetch buffer)
+            if runJob.createEventRangePrefetcher(job, event_ranges=first_event_ranges):
+                first_event_ranges = None
+            else:
+                # Get the current list of eventRangeIDs
+                currentEventRangeIDs = runJob.extractEventRangeIDs(first_event_ranges)
 
-            # Store the current event range id's in the total event range id dictionary
-            runJob.addEventRangeIDsToDictionary(currentEventRangeIDs)
+                # Store the current event range id's in the total event range id dictionary
+                runJob.addEventRangeIDsToDictionary(currentEventRangeIDs)
 
         # Create and start the AthenaMP process
         t0 = os.times()
@@ -3961,7 +4134,7 @@ if __name__ == "__main__":
 
         k = 0
         max_wait = runJob.getMaxWaitOneEvent()
-        nap = 0.1
+        nap = 1
         eventRangeFilesDictionary = {}
         time_to_calculate_cuptime = time.time()
         while True:
@@ -3988,6 +4161,9 @@ if __name__ == "__main__":
                 if first_event_ranges:
                     event_ranges = first_event_ranges
                     first_event_ranges = None
+                elif runJob.getEventRangePrefetcher():
+                    # Get the event ranges from the prefetch buffer (waits for the download if the buffer is empty)
+                    event_ranges = runJob.getEventRangePrefetcher().get(job.coreCount)
                 else:
                     # Pilot will download some event ranges from the Event Server
                     message = downloadEventRanges(job.jobId, job.jobsetID, job.taskID, job.pandaProxySecretKey, numRanges=job.coreCount, url=runJob.getPanDAServer())
@@ -4138,10 +4314,11 @@ if __name__ == "__main__":
                     runJob.setSendingEventRange(True)
                     runJob.setCurrentEventRange(currentEventRangeIDs[j])
                     runJob.sendMessage(str([event_range]))
-                    runJob.setSendingEventRange(False)
 
-                    # Set the boolean to false until AthenaMP is again ready for processing more events
+                    # Set the boolean to false until AthenaMP is again ready for processing more events. This must
+                    # happen before the payload listener is released, otherwise its next "Ready for events" is lost
                     runJob.setAthenaMPIsReady(False)
+                    runJob.setSendingEventRange(False)
 
                     # Wait until AthenaMP is ready to receive another event range
                     w = 0
@@ -4162,12 +4339,12 @@ if __name__ == "__main__":
                             tolog("Aborting AthenaMP loop")
                             break
 
-                        # Take a nap
-                        if i%600 == 0:
-                            tolog("Event range loop iteration #%d" % (i/600))
+                        # Wait for AthenaMP to ask for the next event range (returns as soon as it does)
+                        if i%60 == 0:
+                            tolog("Event range loop iteration #%d" % (i/60))
                         i += 1
                         w += 1
-                        time.sleep(nap)
+                        runJob.waitForAthenaMPReady(nap)
 
                         # Is AthenaMP still running?
                         if athenaMPProcess.poll() is not None:
@@ -4243,10 +4420,10 @@ if __name__ == "__main__":
                     tolog("Aborting AthenaMP waiting loop")
                     break
 
-                time.sleep(0.1)
+                runJob.waitForAthenaMPReady(nap)
 
-                if k%600 == 0:
-                    tolog("AthenaMP waiting loop iteration #%d" % (k/600))
+                if k%60 == 0:
+                    tolog("AthenaMP waiting loop iteration #%d" % (k/60))
                 k += 1
 
                 # Is AthenaMP still running?
@@ -4281,6 +4458,10 @@ if __name__ == "__main__":
                         tolog("!!WARNING!!2322!! %s (aborting monitoring loop)" % (job.pilotErrorDiag))
                         break
 
+        # Stop the event range downloads
+        runJob.stopEventRangePrefetcher(job)
+        runJob.reportMessageLatencies(job)
+
         # Wait for AthenaMP to finish
         kill = False
         tolog("Will now wait for AthenaMP to finish")
@@ -4383,25 +4564,19 @@ if __name__ == "__main__":
         runJob.setAsyncOutputStagerSleepTime(sleep_time=0)
 
         while not runJob.areAllOutputFilesTransferred():
-            if len(runJob.getStageOutQueue()) == 0:
-                tolog("No files in stage-out queue, no point in waiting for transfers since AthenaMP has finished (job is failed)")
+            if runJob.isStageOutIdle():
+                tolog("No files in stage-out queue or being staged out, no point in waiting for transfers since AthenaMP has finished (job is failed)")
                 break
 
             tolog("Will wait for a maximum of %d seconds for file transfers to finish (so far waited %d seconds)" % (maxtime, time.time() - starttime))
             tolog("stage-out queue: %s" % (runJob.getStageOutQueue()))
-            if (len(runJob.getStageOutQueue())) > 0 and (time.time() - starttime > maxtime):
+            if time.time() - starttime > maxtime:
                 tolog("Aborting stage-out thread (timeout)")
                 break
             time.sleep(30)
 
         job.external_stageout_time = time.time() - athenaMP_finished_at
 
-        job.subStatus = runJob.getSubStatus()
-        job.nEvents, job.nEventsW, job.nEventsFailed, job.nEventsFailedStagedOut = runJob.getNEvents()
-        tolog("nevents = %s, neventsW = %s, neventsFailed = %s, nEventsFailedStagedOut=%s" % (job.nEvents, job.nEventsW, job.nEventsFailed, job.nEventsFailedStagedOut))
-        # agreed to only report stagedout events to panda
-        job.nEvents = job.nEventsW
-
         # replace the default job output file list which is anyway not correct
         # (it is only used by AthenaMP for generating output file names)
 #        job.outFiles = output_files
@@ -4435,6 +4610,13 @@ if __name__ == "__main__":
         tolog("Stopping stage-out thread")
         runJob.stopAsyncOutputStagerThread()
         runJob.joinAsyncOutputStagerThread()
+
+        # the event counters are final once the stager has finished its last stage-out
+        job.subStatus = runJob.getSubStatus()
+        job.nEvents, job.nEventsW, job.nEventsFailed, job.nEventsFailedStagedOut = runJob.getNEvents()
+        tolog("nevents = %s, neventsW = %s, neventsFailed = %s, nEventsFailedStagedOut=%s" % (job.nEvents, job.nEventsW, job.nEventsFailed, job.nEventsFailedStagedOut))
+        # agreed to only report stagedout events to panda
+        job.nEvents = job.nEventsW
 #        asyncOutputStager_thread.stop()
 #        asyncOutputStager_thread.join()
 #        runJob.setAsyncOutputStagerThread(asyncOutputStager_thread)
@@ -4467,6 +4649,7 @@ if __name__ == "__main__":
         if runJob.usePrefetcher():
             runJob.stopMessageThreadPrefetcher()
             runJob.joinMessageThreadPrefetcher()
+        runJob.closeWakeupEvents()
 
         # Rename the metadata produced by the payload
         # if not pUtil.isBuildJob(outs):
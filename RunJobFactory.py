@@ -3,64 +3,31 @@
 #   This class is used to generate Experiment class objects corresponding to a given "experiment"
 #   Based the on Factory Design Pattern
 #   Note: not compatible with Singleton Design Pattern due to the subclassing
-
-import traceback
-import pUtil
-
-
-from types import TypeType
-from RunJob import RunJob
-from RunJobEvent import RunJobEvent
-from RunJobHPC import RunJobHPC
-try:
-    from RunJobTitan import RunJobTitan
-except:
-    pUtil.tolog("Failed to import RunJobTitan: %s" % traceback.format_exc())
-
-try:
-    from RunJobHopper import RunJobHopper
-except:
-    pUtil.tolog("Failed to import RunJobHopper: %s" % traceback.format_exc())
-
-try:
-    from RunJobEdison import RunJobEdison
-except:
-    pUtil.tolog("Failed to import RunJobEdison: %s" % traceback.format_exc())
-
-try:
-    from RunJobAnselm import RunJobAnselm
-except:
-    pUtil.tolog("Failed to import RunJobAnselm: %s" % traceback.format_exc())
-
-try:
-    from RunJobArgo import RunJobArgo
-except:
-    pUtil.tolog("Failed to import RunJobArgo: %s" % traceback.format_exc())
-
-from RunJobNormal import RunJobNormal
-from RunJobHpcEvent import RunJobHpcEvent
-from RunJobHpcarcEvent import RunJobHpcarcEvent
+#   The RunJob modules are only imported when the RunJob type is requested (see PluginRegistry)
+
+from PluginRegistry import PluginRegistry
+
+# RunJob type (as returned by getRunJob()) and module of all RunJob classes
+runJobs = PluginRegistry("RunJobFactory", [
+    ("RunJob", "RunJob"),
+    ("RunJobEvent", "RunJobEvent"),
+    ("HPC", "RunJobHPC"),
+    ("RunJobTitan", "RunJobTitan"),
+    ("RunJobHopper", "RunJobHopper"),
+    ("RunJobEdison", "RunJobEdison"),
+    ("RunJobAnselm", "RunJobAnselm"),
+    ("RunJobArgo", "RunJobArgo"),
+    ("Normal2", "RunJobNormal"),
+    ("RunJobHpcEvent", "RunJobHpcEvent"),
+    ("RunJobHpcarcEvent", "RunJobHpcarcEvent"),
+    ])
 
 class RunJobFactory(object):
 
     def newRunJob(self, _type="generic"):
-        """ Generate a new site information object """
-
-
-
-        # get all classes
-        runJobClasses = [j for (i,j) in globals().iteritems() if isinstance(j, TypeType) and issubclass(j, RunJob)]
-        
-        # loop over all subclasses
-        for runJobClass in runJobClasses:
-            si = runJobClass()
-
-            # return the matching RunJob class
-            if si.getRunJob() == _type:
-                return runJobClass
+        """ Return the RunJob class for the given type """
 
-        # if no class was found, raise an error
-        raise ValueError('RunJobFactory: No such class: "%s"' % (_type))
+        return runJobs.getClass(_type)
 
 if __name__ == "__main__":
 
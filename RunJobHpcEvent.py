@@ -13,6 +13,7 @@ import shutil
 import subprocess
 import sys
 import time
+import threading
 import traceback
 
 # Import relevant python/pilot modules
@@ -38,6 +39,7 @@ import EventRanges
 
 from GetJob import GetJob
 from HPC.HPCManager import HPCManager
+from OutputZipBuilder import OutputZipBuilder
 
 class RunJobHpcEvent(RunJob):
 
@@ -85,6 +87,10 @@ class RunJobHpcEvent(RunJob):
         self.__yoda_to_zip = False
         self.__es_to_zip = False
         self.__stageout_status = False
+        self.__zipBuilders = {}
+        self.__zipBuildersLock = threading.Lock()
+        self.__zipThreadpool = None
+        self.__zipBuilding = set()         # ids of the jobs with a zip build in the thread pool
 
         # for recovery
         self.__jobStateFile = None
@@ -718,6 +724,7 @@ class RunJobHpcEvent(RunJob):
             self.failOneJob(transExitCode, pilotExitCode, job, ins=job.inFiles, pilotErrorDiag=pilotErrorDiag, updatePanda=updatePanda)
         if firstJob:
             self.failOneJob(transExitCode, pilotExitCode, firstJob, ins=firstJob.inFiles, pilotErrorDiag=pilotErrorDiag, updatePanda=updatePanda)
+        pUtil.flushLog()
         os._exit(pilotExitCode)
 
     def stageInHPCJobs(self):
@@ -1310,53 +1317,66 @@ class RunJobHpcEvent(RunJob):
         except:
             tolog("Failed in check job metrics: %s" % traceback.format_exc())
 
-    def zipOutputs(self, job, zipEventRangeName, zipFileName):
-        eventstatus = str(job.jobId) + "_event_status.dump"
-        if os.path.exists(eventstatus + ".zipped"):
-            tolog("Event status dump file %s exist. It's already zipped." % eventstatus + ".zipped")
+    def getZipBuilder(self, job, zipEventRangeName, zipFileName):
+        """ Return the output zip builder of the job (created on first use) """
+
+        with self.__zipBuildersLock:
+            if job.jobId not in self.__zipBuilders:
+                eventstatus = str(job.jobId) + "_event_status.dump"
+                self.__zipBuilders[job.jobId] = OutputZipBuilder(eventstatus, zipFileName, zipEventRangeName)
+            return self.__zipBuilders[job.jobId]
+
+    def zipOutputs(self, job, zipEventRangeName, zipFileName, final=True):
+        """ Add the outputs of the finished event ranges to the zip file (close it if final), return the checksums if closed """
+
+        builder = self.getZipBuilder(job, zipEventRangeName, zipFileName)
+        if final:
+            return builder.finish()
+        nRecords = builder.build()
+        if nRecords:
+            tolog("Added %s event ranges to zip file %s" % (nRecords, zipFileName))
+        return None
+
+    def zipOutputsDuringRun(self):
+        """
+        Add the outputs finished so far to the zip files of all jobs (in parallel, without waiting for the builds).
+        A job is skipped while its previous build is still running
+        """
+
+        if not self.__es_to_zip:
             return
-        if not os.path.exists(eventstatus):
-            tolog("Event status dump file %s doesn't exist. checking backup file" % eventstatus)
-            eventstatus = eventstatus + ".backup"
-            if not os.path.exists(eventstatus):
-                tolog("Event status backup dump file %s doesn't exist." % eventstatus)
-                return
+        if self.__zipThreadpool is None:
+            self.__zipThreadpool = ThreadPool(self.__stageout_threads)
+        else:
+            # collect the results of the finished builds
+            self.__zipThreadpool.is_empty()
+        for jobId in self.__jobs:
+            job = self.__jobs[jobId]['job']
+            if job.outputZipName and job.outputZipEventRangesName:
+                with self.__zipBuildersLock:
+                    if jobId in self.__zipBuilding:
+                        continue
+                    self.__zipBuilding.add(jobId)
+                self.__zipThreadpool.add_task(self.zipOutputsTask, job)
 
-        file = open(eventstatus)
-        import tarfile
-        tar = tarfile.open(zipFileName, 'w')
-        zipEventRange = open(zipEventRangeName, 'w')
+    def zipOutputsTask(self, job):
+        """ Thread pool task of zipOutputsDuringRun(): build the zip file of a job, failures are logged """
 
-        tolog("Creating zip/tar file: %s" % zipFileName)
-        for line in file:
-            #tolog("line: %s" % line)
-            try:
-                # jobId, eventRangeID,status,output = line.split(" ")
-                jobId = line.split(" ")[0]
-                eventRangeID = line.split(" ")[1]
-                status = line.split(" ")[2]
-                output = line.split(" ")[3]
-                if status.startswith("ERR"):
-                    status = 'failed'
-            except:
-                tolog("Failed to parse %s at line: %s: %s" % (eventstatus, line, traceback.format_exc()))
-            if status == 'failed':
-                zipEventRange.write("%s %s %s\n" % (eventRangeID, status, output))
-            if not status == 'finished':
-                continue
-            outputs = output.split(",")[:-3]
-            for out in outputs:
-                #tolog("Adding file: %s" % out)
-                if not os.path.exists(out):
-                    tolog("File %s doesn't exist" % out)
-                    continue
-                tar.add(out, arcname=os.path.basename(out))
-                os.remove(out)
-            zipEventRange.write("%s %s %s\n" % (eventRangeID, status, output))
-        tar.close()
-        zipEventRange.close()
-        tolog("Zip finished, Rename %s to %s" % (eventstatus, eventstatus + ".zipped"))
-        os.rename(eventstatus, eventstatus + ".zipped")
+        try:
+            self.zipOutputs(job, job.outputZipEventRangesName, job.outputZipName, final=False)
+        except:
+            tolog("!!WARNING!!1299!! Failed to zip outputs of job %s (will retry from the last saved state): %s" % (job.jobId, traceback.format_exc()))
+        finally:
+            with self.__zipBuildersLock:
+                self.__zipBuilding.discard(job.jobId)
+
+    def waitZipOutputsDuringRun(self):
+        """ Wait for the zip builds started during the run and stop their thread pool """
+
+        if self.__zipThreadpool is not None:
+            tolog("Waiting for the zip builds started during the run")
+            self.__zipThreadpool.wait_completion()
+            self.__zipThreadpool = None
 
     def stageOutZipFile(self, job, espath, os_bucket_id):
         try:
@@ -1366,8 +1386,9 @@ class RunJobHpcEvent(RunJob):
             zipFileName = job.outputZipName
             zipEventRangeName = job.outputZipEventRangesName
             tolog("Checking zip file: %s" % zipFileName)
+            checksums = None
             if self.__es_to_zip:
-                self.zipOutputs(job, zipEventRangeName, zipFileName)
+                checksums = self.zipOutputs(job, zipEventRangeName, zipFileName)
 
             if zipFileName is None or (not os.path.exists(zipFileName)):
                 tolog("Zip file %s doesn't exits, will not stage out." % (zipFileName))
@@ -1395,7 +1416,12 @@ class RunJobHpcEvent(RunJob):
                 return
 
             report = getInitialTracingReport(userid=job.prodUserID, sitename=self.__jobSite.sitename, dsname=dsname, eventType="objectstore", analysisJob=False, jobId=job.jobId, jobDefId=job.jobDefinitionID, dn=job.prodUserID)
-            ret_status, pilotErrorDiag, surl, size, checksum, arch_type = self.__siteMover.put_data(zipFileName, espath, lfn=os.path.basename(zipFileName), report=report, token=None, experiment='ATLAS')
+            # the checksums of a zip file built by this pilot are known (and cached), the file is not read again
+            fsize, fchecksum = 0, 0
+            if checksums:
+                fsize, fchecksum = os.path.getsize(zipFileName), checksums['adler32']
+                tolog("Zip file %s size: %s, adler32: %s" % (zipFileName, fsize, fchecksum))
+            ret_status, pilotErrorDiag, surl, size, checksum, arch_type = self.__siteMover.put_data(zipFileName, espath, fsize=fsize, fchecksum=fchecksum, lfn=os.path.basename(zipFileName), report=report, token=None, experiment='ATLAS')
             if ret_status == 0:
                 eventRanges = []
                 self.__jobs[job.jobId]['job'].outputZipBucketID = os_bucket_id
@@ -1434,6 +1460,7 @@ class RunJobHpcEvent(RunJob):
 
     def stageOutZipFiles(self):
         try:
+            self.waitZipOutputsDuringRun()
             siteInfo = getSiteInformation(self.getExperiment())
             # get the copy tool
             setup = siteInfo.getCopySetup(stageIn=False)
@@ -1497,6 +1524,11 @@ class RunJobHpcEvent(RunJob):
                     time_start = time.time()
                     tolog("HPCManager Job stat: %s" % state)
                     self.checkJobMetrics()
+                    # build the zip files during the run, the outputs left are zipped after the run
+                    try:
+                        self.zipOutputsDuringRun()
+                    except:
+                        tolog("Failed to zip outputs: %s" % traceback.format_exc())
                 #if state and state == 'Running' and state != old_state:
                 #    self.updateAllJobsState('running', self.__hpcStatue, updatePanda=True)
 
@@ -14,6 +14,7 @@ from pUtil import tolog, readpar, verifySetupCommand, getSiteInformation, extrac
 from FileStateClient import updateFileState
 from SiteInformation import SiteInformation
 from configSiteMover import config_sm
+from Checksum import getCachedChecksum
 
 CMD_CHECKSUM = config_sm.COMMAND_MD5
 
@@ -147,6 +148,10 @@ class S3ObjectstoreSiteMover(SiteMover.SiteMover):
                 return PilotErrors.ERR_FAILEDADLOCAL, errorLog, size, checksum
             else:
                 self.log("Got adler32 checksum: %s" % (checksum))
+        elif getCachedChecksum(fileName, 'md5'):
+            # calculated while the file was written (output zip files)
+            checksum = getCachedChecksum(fileName, 'md5')
+            self.log("Got cached md5 checksum: %s" % (checksum))
         else:
             _cmd = '%s %s' % (CMD_CHECKSUM, fileName)
             self.log("Executing command: %s" % (_cmd))
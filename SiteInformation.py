@@ -15,6 +15,7 @@ from pUtil import tolog, replace, getDirectAccessDic
 from pUtil import getExperiment as getExperimentObject
 from FileHandling import getExtension, readJSON, writeJSON, getJSONDictionary, getDirectAccess
 from PilotErrors import PilotErrors
+from QueuedataCache import QueuedataCache
 
 try:
     import json
@@ -67,22 +68,17 @@ class SiteInformation(object):
             return self.getField(par, queuename=queuename)
 
         # Use olf queuedata version
+        # (the file is only read and parsed again if it has changed since the last call)
         fileName = self.getQueuedataFileName(alt=alt)
-        try:
-            fh = open(fileName)
-        except:
-            try:
-                # Try without the path
-                fh = open(os.path.basename(fileName))
-            except Exception, e:
-                tolog("!!WARNING!!2999!! Could not read queuedata file: %s" % str(e))
-                fh = None
-        if fh:
-            #
-            queuedata = fh.read()
-            fh.close()
-            if queuedata != "":
-                value = self.getpar(par, queuedata, containsJson=fileName.endswith("json"))
+        cache = QueuedataCache()
+        queuedata = cache.getQueuedata(fileName)
+        if queuedata is None:
+            # Try without the path
+            fileName = os.path.basename(fileName)
+            queuedata = cache.getQueuedata(fileName)
+        if queuedata:
+            cache.countAccess(par)
+            value = self.getParameter(par, queuedata, containsJson=fileName.endswith("json"))
 
         # repair JSON issue
         if value == None:
@@ -90,40 +86,24 @@ class SiteInformation(object):
 
         return value
 
-    def getpar(self, par, s, containsJson=False):
-        """ Extract par from s """
+    def getParameter(self, par, queuedata, containsJson=False):
+        """ Extract par from the parsed queuedata dictionary """
 
         parameter_value = ""
-        if containsJson:
-            # queuedata is a json string
-            from json import loads
-            pars = loads(s)
-            if pars.has_key(par):
-                parameter_value = pars[par]
-                if type(parameter_value) == unicode: # avoid problem with unicode for strings
-                    parameter_value = parameter_value.encode('ascii')
-            else:
-                tolog("WARNING: Could not find parameter %s in queuedata" % (par))
-                parameter_value = ""
-        else:
-            # queuedata is a string on the form par1=value1|par2=value2|...
-            matches = re.findall("(^|\|)([^\|=]+)=",s)
-            for tmp,tmpPar in matches:
-                if tmpPar == par:
-                    patt = "%s=(.*)" % par
-                    idx = matches.index((tmp,tmpPar))
-                    if idx+1 == len(matches):
-                        patt += '$'
-                    else:
-                        patt += "\|%s=" % matches[idx+1][1]
-                    mat = re.search(patt,s)
-                    if mat:
-                        parameter_value = mat.group(1)
-                    else:
-                        parameter_value = ""
+        if queuedata.has_key(par):
+            parameter_value = queuedata[par]
+            if type(parameter_value) == unicode: # avoid problem with unicode for strings
+                parameter_value = parameter_value.encode('ascii')
+        elif containsJson:
+            tolog("WARNING: Could not find parameter %s in queuedata" % (par))
 
         return parameter_value
 
+    def getpar(self, par, s, containsJson=False):
+        """ Extract par from s """
+
+        return self.getParameter(par, QueuedataCache().parse(s, containsJson=containsJson), containsJson=containsJson)
+
     def getQueuedataFileName(self, useExtension=None, check=True, alt=False, version=0, queuename=None, os_bucket_id=-1):
         """ Define the queuedata filename """
         # alt: alternative extension
@@ -192,6 +172,7 @@ class SiteInformation(object):
                     status = True
             else:
                 tolog("!!WARNING!!1999!! Failed to change %s to: %s" % (field, value))
+        QueuedataCache().invalidate(queuedata_filename)
 
         return status
 
@@ -1818,9 +1799,11 @@ class SiteInformation(object):
         tolog("queuedata file: %s" % filename)
         if os.path.exists(filename):
 
-            # Load the dictionary
-            dictionary = readJSON(filename)
-            if dictionary != {}:
+            # Load the dictionary (only parsed again if the file has changed since the last call)
+            cache = QueuedataCache()
+            dictionary = cache.getQueuedata(filename)
+            if dictionary:
+                cache.countAccess(field)
                 # Get the entry for queuename
                 try:
                     _queuename = dictionary.keys()[0]
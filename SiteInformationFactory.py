@@ -3,33 +3,31 @@
 #   This class is used to generate SiteInformation class objects corresponding to a given "experiment"
 #   Based the on Factory Design Pattern
 #   Note: not compatible with Singleton Design Pattern due to the subclassing
+#   The site information modules are only imported when the experiment is requested (see PluginRegistry)
 
-from types import TypeType
-from SiteInformation import SiteInformation
-from ATLASSiteInformation import ATLASSiteInformation
-from AMSTaiwanSiteInformation import AMSTaiwanSiteInformation
-from CMSSiteInformation import CMSSiteInformation
-from NordugridATLASSiteInformation import NordugridATLASSiteInformation
-from OtherSiteInformation import OtherSiteInformation
+from PluginRegistry import PluginRegistry
+
+# experiment name (as returned by getExperiment()) and module of all site information classes
+siteInformations = PluginRegistry("SiteInformationFactory", [
+    ("generic", "SiteInformation"),
+    ("ATLAS", "ATLASSiteInformation"),
+    ("AMSTaiwan", "AMSTaiwanSiteInformation"),
+    ("CMS", "CMSSiteInformation"),
+    ("Nordugrid-ATLAS", "NordugridATLASSiteInformation"),
+    ("Other", "OtherSiteInformation"),
+    ])
 
 class SiteInformationFactory(object):
 
     def newSiteInformation(self, experiment):
-        """ Generate a new site information object """
-
-        # get all classes
-        siteInformationClasses = [j for (i,j) in globals().iteritems() if isinstance(j, TypeType) and issubclass(j, SiteInformation)]
+        """ Return the site information class for the given experiment """
 
-        # loop over all subclasses
-        for siteInformationClass in siteInformationClasses:
-            si = siteInformationClass()
+        return siteInformations.getClass(experiment)
 
-            # return the matching experiment class
-            if si.getExperiment() == experiment:
-                return siteInformationClass
+    def getSiteInformation(self, experiment):
+        """ Return the site information object for the given experiment (one per process) """
 
-        # if no class was found, raise an error
-        raise ValueError('SiteInformationFactory: No such class: "%s"' % (experiment))
+        return siteInformations.getInstance(experiment)
 
 if __name__ == "__main__":
 
@@ -14,6 +14,7 @@ from PilotErrors import PilotErrors
 from timed_command import timed_command
 from configSiteMover import config_sm
 from FileHandling import getExtension, getTracingReportFilename, writeJSON
+from Checksum import calculateChecksum
 
 PERMISSIONS_DIR = config_sm.PERMISSIONS_DIR
 PERMISSIONS_FILE = config_sm.PERMISSIONS_FILE
@@ -1181,16 +1182,22 @@ class SiteMover(object):
         # get the checksum
         if csumtype == "adler32":
             tolog("Executing adler32() for file: %s" % (fname))
-            from movers import base
-            m = base.BaseSiteMover()
-            fchecksum, _ = m.calc_file_checksum(fname)
-            #fchecksum = SiteMover.adler32(fname)
+            fchecksum = SiteMover.adler32(fname)
             if fchecksum == '00000001': # "%08x" % 1L
                 pilotErrorDiag = "Adler32 failed (returned 1)"
                 tolog("!!WARNING!!2999!! %s" % (pilotErrorDiag))
                 return error.ERR_FAILEDADLOCAL, pilotErrorDiag, fsize, 0
             else:
                 tolog("Got adler32 checksum: %s" % (fchecksum))
+        elif CMD_CHECKSUM == "md5sum":
+            tolog("Calculating md5 checksum for file: %s" % (fname))
+            try:
+                fchecksum = calculateChecksum(fname, "md5")
+            except Exception, e:
+                pilotErrorDiag = "Error calculating md5 checksum: %s" % (e)
+                tolog("!!WARNING!!2999!! %s" % (pilotErrorDiag))
+                return error.ERR_FAILEDMD5LOCAL, pilotErrorDiag, fsize, 0
+            tolog("Got checksum: %s" % (fchecksum))
         else:
             _cmd = '%s %s' % (CMD_CHECKSUM, fname)
             tolog("Executing command: %s" % (_cmd))
@@ -1330,46 +1337,18 @@ class SiteMover(object):
     def calc_adler32(file_name):
         """ calculate the checksum for a file with the zlib.adler32 algorithm """
 
-        val = 1
-        blockSize = 32 * 1024 * 1024
-        with open(file_name) as fp:
-            while True:
-                data = fp.read(blockSize)
-                if not data:
-                    break
-                val = zlib.adler32(data, val)
-        if val < 0:
-            val += 2 ** 32
-        return hex(val)[2:10].zfill(8).lower()
+        return calculateChecksum(file_name, "adler32")
     calc_adler32 = staticmethod(calc_adler32)
 
     def adler32(filename):
         """ calculate the checksum for a file with the zlib.adler32 algorithm """
         # note: a failed file open will return '1'
 
-        import zlib
-        # default adler32 starting value
-        sum1 = 1L
-
         try:
-            f = open(filename, 'rb')
+            sum2 = calculateChecksum(filename, "adler32")
         except Exception, e:
-            tolog("!!WARNING!!2999!! Could not open file: %s" % (filename))
-        else:
-            try:
-                for line in f:
-                    sum1 = zlib.adler32(line, sum1)
-            except Exception, e:
-                tolog("!!WARNING!!2777!! Exception caught in zlib.adler32: %s" % (e))
-
-            f.close()
-
-        # correct for bug 32 bit zlib
-        if sum1 < 0:
-            sum1 = sum1 + 2**32
-
-        # convert to hex
-        sum2 = "%08x" % sum1
+            tolog("!!WARNING!!2999!! Could not calculate adler32 checksum for file %s: %s" % (filename, e))
+            sum2 = "%08x" % 1L
 
         return str(sum2)
 
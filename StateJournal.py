@@ -0,0 +1,185 @@
+# Class definition:
+#   StateJournal
+#   Append-only journal used for the job and file state files (JobState, FileState) instead of rewriting the whole
+#   pickle file on every update. The first record of the file is a full snapshot in the former file format (a plain
+#   pickle, so the file can still be read with pickle.load() by an older pilot, which then sees the snapshot), each
+#   following record is a delta that the owner of the journal applies to the snapshot.
+#   A delta is appended with a single write; a torn record at the end of the file (pilot killed during the write) is
+#   ignored when the journal is read. Snapshots are written to a temporary file which is renamed to the journal (atomic),
+#   this also compacts the journal when it has more than maxRecords deltas.
+
+import os
+import cPickle
+from cStringIO import StringIO
+
+from pUtil import tolog
+
+class StateJournal(object):
+
+    # default settings
+    MAXRECORDS = 200                       # max number of deltas before the journal is compacted
+
+    def __init__(self, filename, maxRecords=MAXRECORDS):
+        """ filename: the journal file """
+
+        self.filename = filename
+        self.maxRecords = maxRecords
+        self.__offset = None               # end of the last record written or read, None if unknown
+        self.__nrecords = 0                # number of deltas after the snapshot
+
+    def getTempFilename(self):
+        """ Return the name of the temporary file for snapshots (hidden, so that jobState-*/fileState-* globs do not see it) """
+
+        return os.path.join(os.path.dirname(self.filename), ".%s.tmp" % (os.path.basename(self.filename)))
+
+    def read(self):
+        """ Return the snapshot and the list of deltas, (None, []) if the journal does not exist or cannot be read """
+
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except IOError, e:
+            tolog("Could not read journal %s: %s" % (self.filename, e))
+            return None, []
+
+        buf = StringIO(data)
+        records = []
+        offset = 0
+        while offset < len(data):
+            try:
+                records.append(cPickle.load(buf))
+            except Exception, e:
+                # the rest of the file is a torn record, it will be overwritten by the next write
+                tolog("!!WARNING!!1000!! Ignoring %d byte(s) at the end of journal %s: %s" % (len(data) - offset, self.filename, e))
+                break
+            offset = buf.tell()
+
+        self.__offset = offset
+        if not records:
+            self.__nrecords = 0
+            return None, []
+        self.__nrecords = len(records) - 1
+
+        return records[0], records[1:]
+
+    def writeSnapshot(self, snapshot):
+        """ Replace the journal with a snapshot (raises an exception if the snapshot cannot be written) """
+
+        data = cPickle.dumps(snapshot, 2)
+        tmpname = self.getTempFilename()
+        f = open(tmpname, 'wb')
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmpname, self.filename)
+
+        self.__offset = len(data)
+        self.__nrecords = 0
+
+    def append(self, delta):
+        """
+        Append a delta to the journal. Return False if the journal needs a new snapshot instead
+        (no snapshot written or read yet, journal modified by another process, or too many deltas)
+        """
+
+        if self.__offset is None or self.__nrecords >= self.maxRecords:
+            return False
+        try:
+            if os.path.getsize(self.filename) != self.__offset:
+                return False
+        except OSError:
+            return False
+
+        data = cPickle.dumps(delta, 2)
+        f = open(self.filename, 'ab')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+        self.__offset += len(data)
+        self.__nrecords += 1
+
+        return True
+
+def benchmark(n=1000):
+    """
+    Compare the job and file state updates with the former pickle files: n job state updates (heartbeats, one field
+    changed each time) and n file state updates (stage-in of n/2 input files, two state changes per file).
+    usage: python StateJournal.py [number of updates]
+    """
+
+    import time
+    import pickle
+    import shutil
+    import tempfile
+
+    from Job import Job
+    from Site import Site
+    from Node import Node
+    from JobState import JobState
+    from FileState import FileState
+
+    workdir = tempfile.mkdtemp()
+    try:
+        job = Job()
+        job.jobId = "1234567890"
+        site = Site()
+        site.workdir = workdir
+        node = Node()
+        files = ["EVNT.%08d.pool.root.1" % (i) for i in range(n / 2)]
+
+        # former job state file: the whole object dictionary is pickled on every update
+        filename = os.path.join(workdir, "former-jobState.pickle")
+        t0 = time.time()
+        for i in range(n):
+            job.cpuConsumptionTime = i
+            fp = open(filename, "w")
+            pickle.dump({'job': job, 'site': site, 'node': node, 'recoveryAttempt': 0}, fp)
+            fp.close()
+        t1 = time.time()
+        for i in range(n):
+            job.cpuConsumptionTime = i
+            JobState().put(job, site, node)
+        t2 = time.time()
+        JS = JobState()
+        JS.get(JS.getFilename(workdir, job.jobId))
+        assert JS.decode()[0].cpuConsumptionTime == n - 1
+
+        # former file state file: the whole dictionary is pickled on every update
+        filename = os.path.join(workdir, "former-fileState.pickle")
+        states = dict([(f, ['not_transferred', 'copy_to_scratch']) for f in files])
+        t3 = time.time()
+        for f in files:
+            for state in ['transferred', 'direct_access']:
+                states[f] = [state, 'copy_to_scratch']
+                fp = open(filename, "w")
+                pickle.dump(states, fp)
+                fp.close()
+        t4 = time.time()
+        FileState(workDir=workdir, jobId=job.jobId, ftype="input").resetStates(files, ftype="input")
+        FS = FileState(workDir=workdir, jobId=job.jobId, ftype="input")
+        t5 = time.time()
+        for f in files:
+            for state in ['transferred', 'direct_access']:
+                FS.putState(f, [state, 'copy_to_scratch'])
+        t6 = time.time()
+        assert FileState(workDir=workdir, jobId=job.jobId, ftype="input").fileStateDictionary == FS.fileStateDictionary
+
+        print "job state,  former pickle:  %8.2f ms per update" % ((t1 - t0) * 1000.0 / n)
+        print "job state,  journal:        %8.2f ms per update" % ((t2 - t1) * 1000.0 / n)
+        print "file state, former pickle:  %8.2f ms per update (%d files)" % ((t4 - t3) * 1000.0 / n, len(files))
+        print "file state, journal:        %8.2f ms per update (%d files)" % ((t6 - t5) * 1000.0 / n, len(files))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+
+    import sys
+    benchmark(*[int(arg) for arg in sys.argv[1:2]])
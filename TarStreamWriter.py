@@ -0,0 +1,245 @@
+# Class definition:
+#   TarStreamWriter
+#   Tar archive writer for the event service output zipping (RunJobEvent.zipOutput(), OutputZipBuilder), used instead
+#   of one 'tar -rf <archive> --directory=<dir> <file>' command per output file (every append rescans the archive).
+#   The archive is kept open while files are added, the files are appended at the end of the archive, and the adler32
+#   and md5 checksums of the archive are calculated while it is written (and stored in the Checksum cache when the
+#   archive is closed, so that the stage-out does not read the archive again).
+#   The archive is byte-identical to the one written by GNU tar -rf (GNU format, member names without directory,
+#   names longer than 100 characters in ././@LongLink members, archive padded to 10240 byte records).
+
+import os
+import pwd
+import grp
+import copy
+import stat
+import zlib
+import tarfile
+import hashlib
+
+from pUtil import tolog
+from Checksum import setCachedChecksums
+
+BLOCKSIZE = tarfile.BLOCKSIZE              # 512
+RECORDSIZE = tarfile.RECORDSIZE            # 20 blocks, GNU tar default blocking factor
+BUFSIZE = 1024 * 1024
+
+class TarStreamWriter(object):
+
+    # user and group names, FORMAT: { uid: name }, { gid: name } (the lookups can be slow with a remote user database)
+    __unames = {}
+    __gnames = {}
+
+    def __init__(self, filename, checksums=True):
+        """
+        Open the archive (files are appended to an existing archive).
+        checksums: calculate the checksums of the archive (the existing members are read once for them)
+        """
+
+        self.filename = filename
+        self.checksums = checksums
+        self.__adler32 = 1
+        self.__md5 = hashlib.md5()
+        self.__nmembers = 0
+
+        self.__offset = 0
+
+        offset = 0
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            offset = self.__getEndOffset(filename)
+        self.__file = open(filename, 'r+b' if offset else 'wb')
+        if offset:
+            # the existing members are part of the checksum, the end-of-archive blocks are overwritten
+            if checksums:
+                self.__updateChecksums(self.__file, offset)
+            else:
+                self.__offset = offset
+            self.__file.seek(offset)
+            self.__file.truncate()
+
+    def __getEndOffset(self, filename):
+        """ Return the offset of the end-of-archive marker of an existing archive """
+
+        tf = tarfile.open(filename, 'r')
+        try:
+            for tarinfo in tf:
+                pass
+            return tf.offset
+        finally:
+            tf.close()
+
+    def __updateChecksums(self, f, size):
+        """ Read size bytes from f into the checksums """
+
+        f.seek(0)
+        while size > 0:
+            data = f.read(min(BUFSIZE, size))
+            if not data:
+                break
+            self.__write(data, write=False)
+            size -= len(data)
+
+    def __write(self, data, write=True):
+        """ Write data to the archive and add it to the checksums """
+
+        if write:
+            self.__file.write(data)
+        if self.checksums:
+            self.__adler32 = zlib.adler32(data, self.__adler32)
+            self.__md5.update(data)
+        self.__offset += len(data)
+
+    def __getTarInfo(self, path, arcname):
+        """ Return the TarInfo of a regular file or symbolic link (not dereferenced, as GNU tar) """
+
+        st = os.lstat(path)
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.mode = stat.S_IMODE(st.st_mode)
+        tarinfo.uid = st.st_uid
+        tarinfo.gid = st.st_gid
+        tarinfo.mtime = int(st.st_mtime)
+        if stat.S_ISREG(st.st_mode):
+            tarinfo.type = tarfile.REGTYPE
+            tarinfo.size = st.st_size
+        elif stat.S_ISLNK(st.st_mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = os.readlink(path)
+        else:
+            raise IOError("Cannot add %s to the archive: not a regular file" % (path))
+        tarinfo.uname = self.__getName(self.__unames, pwd.getpwuid, st.st_uid)
+        tarinfo.gname = self.__getName(self.__gnames, grp.getgrgid, st.st_gid)
+
+        return tarinfo
+
+    def __getName(self, names, lookup, id):
+        """ Return the user or group name of the id (looked up once, "" if unknown) """
+
+        if not names.has_key(id):
+            try:
+                names[id] = lookup(id)[0]
+            except KeyError:
+                names[id] = ""
+
+        return names[id]
+
+    def __getHeaderBlock(self, tarinfo):
+        """ Return the header block of a member (names of at most 100 characters) as written by GNU tar """
+
+        buf = tarinfo.tobuf(tarfile.GNU_FORMAT)
+
+        # GNU tar leaves devmajor/devminor empty for regular files and links, update the header checksum
+        buf = buf[:329] + tarfile.NUL * 16 + buf[345:]
+        chksum = tarfile.calc_chksums(buf)[0]
+
+        return buf[:148] + "%06o\0 " % chksum + buf[156:]
+
+    def __getLongNameHeader(self, name, type):
+        """ Return the ././@LongLink member of a long member name (type L) or link name (type K) as written by GNU tar """
+
+        tarinfo = tarfile.TarInfo("././@LongLink")
+        tarinfo.type = type
+        tarinfo.mode = 0644
+        tarinfo.size = len(name) + 1
+        tarinfo.uname = "root"
+        tarinfo.gname = "root"
+        buf = self.__getHeaderBlock(tarinfo) + name + tarfile.NUL
+        remainder = len(buf) % BLOCKSIZE
+        if remainder:
+            buf += tarfile.NUL * (BLOCKSIZE - remainder)
+
+        return buf
+
+    def __getHeader(self, tarinfo):
+        """ Return the header blocks of a member as written by GNU tar """
+
+        buf = ""
+        if len(tarinfo.linkname) > tarfile.LENGTH_LINK or len(tarinfo.name) > tarfile.LENGTH_NAME:
+            if len(tarinfo.linkname) > tarfile.LENGTH_LINK:
+                buf += self.__getLongNameHeader(tarinfo.linkname, tarfile.GNUTYPE_LONGLINK)
+            if len(tarinfo.name) > tarfile.LENGTH_NAME:
+                buf += self.__getLongNameHeader(tarinfo.name, tarfile.GNUTYPE_LONGNAME)
+            # the member header holds the truncated names
+            tarinfo = copy.copy(tarinfo)
+            tarinfo.name = tarinfo.name[:tarfile.LENGTH_NAME]
+            tarinfo.linkname = tarinfo.linkname[:tarfile.LENGTH_LINK]
+
+        return buf + self.__getHeaderBlock(tarinfo)
+
+    def add(self, path, arcname=None):
+        """ Append a file to the archive (arcname: member name, default: the file name without directory) """
+
+        if not arcname:
+            arcname = os.path.basename(path)
+
+        tarinfo = self.__getTarInfo(path, arcname)
+
+        # state before the member, restored if the file cannot be added
+        state = self.mark()
+        try:
+            self.__write(self.__getHeader(tarinfo))
+            if tarinfo.isreg():
+                f = open(path, 'rb')
+                try:
+                    size = tarinfo.size
+                    while size > 0:
+                        data = f.read(min(BUFSIZE, size))
+                        if not data:
+                            raise IOError("File %s has shrunk while being added to the archive" % (path))
+                        self.__write(data)
+                        size -= len(data)
+                finally:
+                    f.close()
+                remainder = tarinfo.size % BLOCKSIZE
+                if remainder:
+                    self.__write(tarfile.NUL * (BLOCKSIZE - remainder))
+        except:
+            self.rollback(state)
+            raise
+
+        self.__nmembers += 1
+
+    def mark(self):
+        """ Return the current position in the archive, see rollback() """
+
+        return (self.__offset, self.__adler32, self.__md5.copy(), self.__nmembers)
+
+    def rollback(self, mark):
+        """ Remove the members added since mark() from the archive """
+
+        self.__offset, self.__adler32, md5, self.__nmembers = mark
+        self.__md5 = md5.copy()
+        self.__file.seek(self.__offset)
+        self.__file.truncate()
+
+    def flush(self):
+        """ Flush the added files to the archive (the end-of-archive marker is written by close()), return the archive size """
+
+        self.__file.flush()
+
+        return self.__offset
+
+    def abort(self):
+        """ Close the archive without the end-of-archive marker (the caller discards or truncates it) """
+
+        self.__file.close()
+
+    def close(self):
+        """ Write the end-of-archive marker, close the archive and return its checksums {'adler32': .., 'md5': ..} (None without checksums) """
+
+        self.__write(tarfile.NUL * (2 * BLOCKSIZE))
+        remainder = self.__offset % RECORDSIZE
+        if remainder:
+            self.__write(tarfile.NUL * (RECORDSIZE - remainder))
+        self.__file.close()
+        if not self.checksums:
+            tolog("Closed archive %s (%d file(s) added)" % (self.filename, self.__nmembers))
+            return None
+
+        asum = self.__adler32
+        if asum < 0:
+            asum += 2**32
+        checksums = {'adler32': "%08x" % asum, 'md5': self.__md5.hexdigest()}
+        setCachedChecksums(self.filename, checksums)
+        tolog("Closed archive %s (%d file(s) added, adler32: %s)" % (self.filename, self.__nmembers, checksums['adler32']))
+
+        return checksums
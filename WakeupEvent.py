@@ -0,0 +1,94 @@
+# Class definition:
+#   WakeupEvent
+#   Replacement for threading.Event with a wait(timeout) that returns as soon as the event is set. In python 2,
+#   Event.wait(timeout) and Condition.wait(timeout) poll the lock with naps of up to 50 ms, so every handoff between two
+#   threads is delayed by up to 50 ms. WakeupEvent blocks in select() on a pipe that set() writes to instead.
+#   The pipe is created on first use, so the object can be created at import time (e.g. as a class attribute).
+
+import os
+import time
+import fcntl
+import errno
+import select
+import threading
+
+class WakeupEvent(object):
+
+    def __init__(self, flag=False):
+        """ Create the event (set if flag is True) """
+
+        self.__flag = flag
+        self.__lock = threading.Lock()
+        self.__pipe = None
+
+    def __getPipe(self):
+        """ Return the pipe (read and write end), create it if necessary (lock must be held) """
+
+        if not self.__pipe:
+            self.__pipe = os.pipe()
+            for fd in self.__pipe:
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            if self.__flag:
+                os.write(self.__pipe[1], "x")
+
+        return self.__pipe
+
+    def isSet(self):
+        """ Is the event set? """
+
+        return self.__flag
+
+    def set(self):
+        """ Set the event and wake up the waiting threads """
+
+        with self.__lock:
+            if not self.__flag:
+                self.__flag = True
+                os.write(self.__getPipe()[1], "x")
+
+    def clear(self):
+        """ Reset the event """
+
+        with self.__lock:
+            if self.__flag:
+                self.__flag = False
+                try:
+                    while os.read(self.__getPipe()[0], 4096):
+                        pass
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+
+    def wait(self, timeout=None):
+        """ Wait until the event is set, at most timeout seconds. Return True if the event is set """
+
+        if self.__flag:
+            return True
+        with self.__lock:
+            fd = self.__getPipe()[0]
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not self.__flag:
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+            try:
+                select.select([fd], [], [], remaining)
+            except select.error, e:
+                # interrupted by a signal, wait for the remaining time
+                if e.args[0] != errno.EINTR:
+                    raise
+
+        return self.__flag
+
+    def close(self):
+        """ Close the pipe """
+
+        with self.__lock:
+            if self.__pipe:
+                for fd in self.__pipe:
+                    os.close(fd)
+                self.__pipe = None
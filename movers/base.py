@@ -10,6 +10,7 @@ import time
 from subprocess import Popen, PIPE, STDOUT
 
 from pUtil import tolog #
+from Checksum import calculateChecksum
 from PilotErrors import PilotErrors, PilotException
 from Node import Node
 
@@ -676,21 +677,16 @@ class BaseSiteMover(object):
             raise an exception if input filename is not exist/readable
         """
 
-        from zlib import adler32
+        return calculateChecksum(filename, "adler32")
 
-        asum = 1 # default adler32 starting value
-        BLOCKSIZE = 64*1024*1024 # read buffer, 64 Mb
-
-        with open(filename, 'rb') as f:
-            while True:
-                data = f.read(BLOCKSIZE)
-                if not data:
-                   break
-                asum = adler32(data, asum)
-                if asum < 0:
-                  asum += 2**32
+    @classmethod
+    def calc_md5sum_checksum(self, filename):
+        """
+            calculate the md5 checksum for a file (in-process, no md5sum subprocess)
+            raise an exception if input filename is not exist/readable
+        """
 
-        return "%08x" % asum # convert to hex
+        return calculateChecksum(filename, "md5")
 
 
     @classmethod
@@ -701,6 +697,9 @@ class BaseSiteMover(object):
             raise an exception if input filename is not exist/readable
         """
 
+        if command == 'md5sum' and not (cmd or setup or pattern):
+            return self.calc_md5sum_checksum(filename)
+
         if not cmd:
             cmd = "%s %s" % (command, filename)
         if setup:
@@ -12,13 +12,16 @@ from . import getSiteMover
 from .trace_report import TraceReport
 
 from FileStateClient import updateFileState, dumpFileStates
+from ReplicaCache import getReplicaCache, updateReplicaCacheCounters
 from PilotErrors import PilotException, PilotErrors
 
 from pUtil import tolog, get_metadata_from_xml
 
 import sys
 import os
+import copy
 import time
+import threading
 import traceback
 from random import shuffle, uniform
 from subprocess import Popen, PIPE, STDOUT
@@ -40,6 +43,9 @@ class JobMover(object):
     MAX_STAGEIN_RETRY = 5
     MAX_STAGEOUT_RETRY = 10
 
+    MAX_STAGEIN_THREADS = 10  # max number of concurrent stage-in transfers
+    MAX_STAGEOUT_THREADS = 10 # max number of concurrent stage-out transfers
+
     _stageoutretry = 2 # default value
     _stageinretry = 2  # devault value
 
@@ -163,6 +169,56 @@ class JobMover(object):
             turl = pfns[endpoint][0]
         return turl
 
+    def invalidate_replicas(self, files):
+        """
+            Remove the replicas of files from the replica cache
+        """
+
+        cache = getReplicaCache(self.workDir, tag='resolve_replicas')
+        if cache:
+            cache.invalidate(['%s:%s' % (e.scope, e.lfn) for e in files])
+
+    def list_replicas(self, files):
+        """
+            Query Rucio for the replicas of files
+            :return: list of replicas as returned by Rucio list_replicas()
+        """
+
+        from rucio.client import Client
+        c = Client()
+
+        ## for the time being until Rucio bug with geo-ip sorting is resolved
+        ## do apply either simple query list_replicas() without geoip sort to resolve LAN replicas in case of directaccesstype=[None, LAN]
+        # otherwise in case of directaccesstype=WAN mode do query geo sorted list_replicas() with location data passed
+
+        bquery = {'schemes':['srm', 'root', 'davs', 'gsiftp', 'https'],
+                  'dids': [dict(scope=e.scope, name=e.lfn) for e in files]
+                 }
+
+        allowRemoteInputs = True in set(e.allowRemoteInputs for e in files)
+
+        try:
+            query = bquery.copy()
+            #if allowRemoteInputs:
+            location = self.detect_client_location()
+            if not location:
+                raise Exception("Failed to get client location")
+            query.update(sort='geoip', client_location=location)
+
+            try:
+                self.log('Call rucio.list_replicas() with query=%s' % query)
+                replicas = c.list_replicas(**query)
+            except TypeError, e:
+                if query == bquery:
+                    raise
+                self.log("WARNING: Detected outdated Rucio list_replicas(), cannot do geoip-sorting: %s .. fallback to old list_replicas() call" % e)
+                replicas = c.list_replicas(**bquery)
+
+            return list(replicas)
+
+        except Exception, e:
+            raise PilotException("Failed to get replicas from Rucio: %s" % e, code=PilotErrors.ERR_FAILEDLFCGETREPS)
+
     def detect_client_location(self):
         """
         Open a UDP socket to a machine on the internet, to get the local IPv4 and IPv6
@@ -242,41 +298,23 @@ class JobMover(object):
         if not xfiles: # no files for replica look-up
             return files
 
-        # load replicas from Rucio
-        from rucio.client import Client
-        c = Client()
-
-        ## for the time being until Rucio bug with geo-ip sorting is resolved
-        ## do apply either simple query list_replicas() without geoip sort to resolve LAN replicas in case of directaccesstype=[None, LAN]
-        # otherwise in case of directaccesstype=WAN mode do query geo sorted list_replicas() with location data passed
-
-        bquery = {'schemes':['srm', 'root', 'davs', 'gsiftp', 'https'],
-                  'dids': [dict(scope=e.scope, name=e.lfn) for e in xfiles]
-                 }
-
-        allowRemoteInputs = True in set(e.allowRemoteInputs for e in xfiles)
-
-        try:
-            query = bquery.copy()
-            #if allowRemoteInputs:
-            location = self.detect_client_location()
-            if not location:
-                raise Exception("Failed to get client location")
-            query.update(sort='geoip', client_location=location)
-
-            try:
-                self.log('Call rucio.list_replicas() with query=%s' % query)
-                replicas = c.list_replicas(**query)
-            except TypeError, e:
-                if query == bquery:
-                    raise
-                self.log("WARNING: Detected outdated Rucio list_replicas(), cannot do geoip-sorting: %s .. fallback to old list_replicas() call" % e)
-                replicas = c.list_replicas(**bquery)
+        # look up the replicas resolved by previous jobs/attempts first
+        cache = getReplicaCache(self.workDir, tag='resolve_replicas')
+        replicas = []
+        if cache:
+            cached = cache.lookup(['%s:%s' % (e.scope, e.lfn) for e in xfiles])
+            replicas = cached.values()
+            qfiles = [e for e in xfiles if '%s:%s' % (e.scope, e.lfn) not in cached]
+            updateReplicaCacheCounters(self.workDir, self.job.jobId, *cache.getCounters())
+        else:
+            qfiles = xfiles
 
-        except Exception, e:
-            raise PilotException("Failed to get replicas from Rucio: %s" % e, code=PilotErrors.ERR_FAILEDLFCGETREPS)
+        if qfiles:
+            qreplicas = self.list_replicas(qfiles)
+            if cache:
+                cache.store(dict(('%s:%s' % (r.get('scope'), r.get('name')), r) for r in qreplicas))
+            replicas += qreplicas
 
-        replicas = list(replicas)
         self.log("replicas received from Rucio: %s" % replicas)
 
         files_lfn = dict(((e.scope, e.lfn), e) for e in xfiles)
@@ -613,306 +651,537 @@ class JobMover(object):
                     fdata.allowRemoteInputs = True
                 self.log("check direct access for lfn=%s: allow_directaccess=%s, fdata.is_directaccess()=%s => is_directaccess=%s, allowRemoteInputs=%s" % (fdata.lfn, allow_directaccess, fdata.is_directaccess(ensure_replica=False), is_directaccess, fdata.allowRemoteInputs))
 
-        sitemover_objects = {}
-        is_replicas_resolved = False
-
         # remember the original tracing choise
         useTracingService = self.useTracingService
 
+        # state shared by the transfers of all files
+        ctx = {'files': files, 'remain_files': remain_files, 'maxinputsize': maxinputsize, 'allow_directaccess': allow_directaccess,
+               'is_replicas_resolved': False, 'lock': threading.RLock()}
+
+        results = None
+        nthreads = self.get_stagein_threads(remain_files)
+        if nthreads > 1:
+            results = self.stagein_files_concurrently(remain_files, protocols, ctx, nthreads, skip_transfer_failure)
+
+        sitemover_objects = {}
+
         for fnum, fdata in enumerate(remain_files, 1):
 
-            self.log('INFO: prepare to transfer (stage-in) %s/%s file: lfn=%s' % (fnum, nfiles, fdata.lfn))
+            if results is None:
+                ret = self.stagein_file(fdata, fnum, nfiles, protocols, sitemover_objects, self.trace_report, ctx)
+            else: # process the results of the concurrent transfers in the same order as the serial transfers
+                ret = results[fnum - 1]
+                if ret is None: # not started since the transfer of another file failed
+                    continue
+                if ret.get('exc_info'):
+                    exc_info = ret['exc_info']
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                ret = ret['result']
 
-            is_directaccess = allow_directaccess and fdata.is_directaccess(ensure_replica=False) #fdata.turl is not defined at this point
-            #self.log("check direct access: allow_directaccess=%s, fdata.is_directaccess()=%s => is_directaccess=%s" % (allow_directaccess, fdata.is_directaccess(ensure_replica=False), is_directaccess))
+            _transferred_files, _failed_transfers, bad_copytools = ret
+            transferred_files += _transferred_files
+            failed_transfers += _failed_transfers
 
-            bad_copytools = True
+            if fdata.status == 'error' and ctx['is_replicas_resolved']: # the replicas may be outdated, do not reuse them
+                self.invalidate_replicas([fdata])
 
-            for protnum, dat in enumerate(protocols, 1):
+            if fdata.status == 'error' and not skip_transfer_failure:
+                self.log('stage-in of file (%s/%s) with lfn=%s failed: code=%s .. skip transferring remaining files..' % (fnum, nfiles, fdata.lfn, fdata.status_code))
+                dumpFileStates(self.workDir, self.job.jobId, ftype="input")
+                status_code = fdata.status_code if fdata.status_code != PilotErrors.ERR_UNKNOWN else PilotErrors.ERR_STAGEINFAILED
+                raise PilotException("STAGEIN FAILED: %s: lfn=%s, error=%s" % (PilotErrors.getErrorStr(status_code), fdata.lfn, getattr(fdata, 'status_message', '')), code=status_code, state='STAGEIN_FILE_FAILED')
 
-                if fdata.status in ['remote_io', 'transferred', 'no_transfer']: ## success
-                    break
+            if bad_copytools:
+                raise PilotException("STAGEIN FAILED: bad copytools: no supported copytools", code=PilotErrors.ERR_NOSTORAGE, state='STAGEIN_BAD_COPYTOOLS')
 
-                copytool, copysetup = dat.get('copytool'), dat.get('copysetup')
+        self.log('INFO: all input files have been successfully processed')
 
-                # switch off tracing if copytool=rucio, as this is handled internally by rucio
-                #if copytool == 'rucio':
-                #    self.useTracingService = False
-                #else:
-                #    # re-activate tracing in case rucio is not used for staging
-                #    self.useTracingService = useTracingService
+        dumpFileStates(self.workDir, self.job.jobId, ftype="input")
 
-                try:
-                    sitemover = sitemover_objects.get(copytool)
-                    if not sitemover:
-                        sitemover = getSiteMover(copytool)(copysetup, workDir=self.job.workdir)
-                        sitemover_objects.setdefault(copytool, sitemover)
+        #self.log('transferred_files= %s' % transferred_files)
+        self.log('Summary of transferred files:')
+        for e in transferred_files:
+            self.log(" -- %s" % e)
 
-                        sitemover.trace_report = self.trace_report
-                        sitemover.ddmconf = self.ddmconf # self.si.resolveDDMConf([]) # quick workaround  ###
-                        sitemover.setup()
-                    if dat.get('resolve_scheme'):
-                        dat['scheme'] = sitemover.schemes
-                        self.log("is_directaccess=%s" % is_directaccess)
-                        self.log("self.job.usePrefetcher=%s"%str(self.job.usePrefetcher))
-                        dat.pop('primary_scheme', None)
-                        if is_directaccess or self.job.usePrefetcher:
-                            if dat['scheme'] and dat['scheme'][0] != self.remoteinput_allowed_schemas[0]:  ## ensure that root:// is coming first in allowed schemas required for further resolve_replica()
-                                dat['scheme'] = self.remoteinput_allowed_schemas + dat['scheme'] ## add supported schema for direct access
-                            self.log("INFO: prepare direct access mode: force to extend accepted protocol schemes to use direct access, schemes=%s" % dat['scheme'])
-                            dat['primary_scheme'] = self.direct_input_allowed_schemas  ## will be used to look up first the replicas allowed for direct access mode
+        if failed_transfers:
+            self.log('Summary of failed transfers:')
+            for e in failed_transfers:
+                self.log(" -- %s" % e)
 
-                except Exception, e:
-                    self.log('WARNING: Failed to get SiteMover: %s .. skipped .. try to check next available protocol, current protocol details=%s' % (e, dat))
-                    self.trace_report.update(protocol=copytool, clientState='BAD_COPYTOOL', stateReason=str(e)[:500])
-                    self.sendTrace(self.trace_report)
-                    continue
+        self.log("stagein finished")
 
-                bad_copytools = False
+        if not self.job.usePrefetcher:
+            self.job.print_infiles()
 
-                if sitemover.require_replicas and not is_replicas_resolved:
-                    self.log("mover resolving replicas")
-                    self.resolve_replicas(files) ## do populate fspec.replicas for each entry in files
-                    is_replicas_resolved = True
+        return transferred_files, failed_transfers
 
-                self.log("Copy command [stage-in]: %s, sitemover=%s" % (copytool, sitemover))
-                self.log("Copy setup   [stage-in]: %s" % copysetup)
+    def stagein_file(self, fdata, fnum, nfiles, protocols, sitemover_objects, trace_report, ctx):
+        """
+            Transfer (stage-in) one file: try the protocols one after another, with retries for each protocol
+            :param sitemover_objects: cache of site mover instances (per copytool) to be used
+            :param trace_report: trace report of the file transfer
+            :param ctx: state shared by the transfers of all files of stagein_real()
+            :return: (transferred_files, failed_transfers, bad_copytools)
+        """
 
-                self.trace_report.update(protocol=copytool, filesize=fdata.filesize)
+        transferred_files, failed_transfers = [], []
+        nprotocols = len(protocols)
 
-                updateFileState(fdata.lfn, self.workDir, self.job.jobId, mode="file_state", state="not_transferred", ftype="input")
+        self.log('INFO: prepare to transfer (stage-in) %s/%s file: lfn=%s' % (fnum, nfiles, fdata.lfn))
 
-                self.log("[stage-in] Prepare to get_data: [%s/%s]-protocol=%s, fspec=%s" % (protnum, nprotocols, dat, fdata))
+        is_directaccess = ctx['allow_directaccess'] and fdata.is_directaccess(ensure_replica=False) #fdata.turl is not defined at this point
+        #self.log("check direct access: allow_directaccess=%s, fdata.is_directaccess()=%s => is_directaccess=%s" % (allow_directaccess, fdata.is_directaccess(ensure_replica=False), is_directaccess))
 
-                try:
-                    r = sitemover.resolve_replica(fdata, dat, ddm=self.ddmconf.get(fdata.ddmendpoint))
-                except Exception, e:
-                    if sitemover.require_replicas:
-                        self.log("resolve_replica() failed for [%s/%s]-protocol.. skipped.. will check next available protocol, error=%s" % (protnum, nprotocols, e))
-                        self.trace_report.update(clientState='NO_REPLICA', stateReason=str(e))
-                        self.sendTrace(self.trace_report)
-                        continue
-                    r = {}
-
-                # quick stub: propagate changes to FileSpec
-                if r.get('surl'):
-                    fdata.surl = r['surl'] # TO BE CLARIFIED if it's still used and need
-                if r.get('pfn'):
-                    fdata.turl = r['pfn']
-                if r.get('ddmendpoint'):
-                    fdata.ddmendpoint = r['ddmendpoint']
-
-                self.log("[stage-in] found replica to be used: ddmendpoint=%s, pfn=%s" % (fdata.ddmendpoint, fdata.turl))
-
-                # check if protocol and found replica belong to same site
-                if dat.get('ddm'):
-                    protocol_site = self.ddmconf.get(dat.get('ddm'), {}).get('site')
-                    replica_site = self.ddmconf.get(fdata.ddmendpoint, {}).get('site')
-
-                    if protocol_site != replica_site:
-                        if fdata.allowRemoteInputs is None or not fdata.allowRemoteInputs:
-                            self.log('INFO: cross-sites checks: protocol_site=%s and replica_site=%s mismatched and remote inputs is not allowed.. skip file processing for copytool=%s' % (protocol_site, replica_site, copytool))
-                            continue
-                        else:
-                            self.log('INFO: cross-sites checks: protocol_site=%s and replica_site=%s mismatched but remote inputs is allowed.. keep processing for copytool=%s' % (protocol_site, replica_site, copytool))
-
-                # fill trace details
-                localSite = os.environ.get('DQ2_LOCAL_SITE_ID', None)
-                localSite = localSite if localSite else fdata.ddmendpoint
-                self.trace_report.update(localSite=localSite, remoteSite=fdata.ddmendpoint)
-                self.trace_report.update(filename=fdata.lfn, guid=fdata.guid.replace('-', ''))
-                self.trace_report.update(scope=fdata.scope, dataset=fdata.prodDBlock)
-
-                # check direct access
-                if fdata.is_directaccess() and is_directaccess: # direct access mode, no transfer required
-                    updateFileState(fdata.turl, self.workDir, self.job.jobId, mode="file_state", state="direct_access", ftype="input")
-                    fdata.status = 'remote_io'
-                    updateFileState(fdata.lfn, self.workDir, self.job.jobId, mode="transfer_mode", state=fdata.status, ftype="input")
-                    self.log("Direct access mode will be used for lfn=%s .. skip transfer for this file" % fdata.lfn)
-                    self.trace_report.update(url=fdata.turl, clientState='FOUND_ROOT', stateReason='direct_access')
-                    self.sendTrace(self.trace_report)
-                    continue
-                else:
-                    self.log('Direct access will not be user for lfn=%s since fdata.is_directaccess()=%s, is_directaccess=%s' % (fdata.lfn, fdata.is_directaccess(), is_directaccess))
-
-                # check prefetcher (the turl must be saved for prefetcher to use)
-                # note: for files to be prefetched, there's no entry for the file_state, so the updateFileState needs
-                # to be called twice (or update the updateFileState function to allow list arguments)
-                # also update the file_state for the existing entry (could also be removed?)
-                # note also that at least one file still needs to be staged in, or AthenaMP will not start
-                if self.job.usePrefetcher and self.job.eventService:
-                    updateFileState(fdata.turl, self.workDir, self.job.jobId, mode="file_state", state="prefetch", ftype="input")
-                    fdata.status = 'remote_io'
-                    updateFileState(fdata.turl, self.workDir, self.job.jobId, mode="transfer_mode", state=fdata.status, ftype="input")
-                    self.log("Added TURL to file state dictionary: %s" % fdata.turl)
-                    #updateFileState(fdata.lfn, self.workDir, self.job.jobId, mode="transfer_mode", state="no_transfer", ftype="input")
-                    self.trace_report.update(url=fdata.turl, clientState='FOUND_ROOT', stateReason='prefetch')
-                    self.sendTrace(self.trace_report)
-                    continue  # - if we continue here, the the file will not be staged in, but AthenaMP needs it so we still need to stage it in
+        bad_copytools = True
 
-                # apply site-mover custom job-specific checks for stage-in
-                try:
-                    is_stagein_allowed = sitemover.is_stagein_allowed(fdata, self.job)
-                    if not is_stagein_allowed:
-                        reason = 'SiteMover does not allow stage-in operation for the job'
-                except PilotException, e:
-                    is_stagein_allowed = False
-                    reason = e
-                except Exception:
-                    raise
-                if not is_stagein_allowed:
-                    self.log("WARNING: sitemover=%s does not allow stage-in transfer for this job, lfn=%s with reason=%s.. skip transfer the file" % (sitemover.getID(), fdata.lfn, reason))
-                    failed_transfers.append(reason)
-                    self.trace_report.update(clientState='STAGEIN_NOTALLOWED', stateReason='skip stagein file')
-                    self.sendTrace(self.trace_report)
+        # each file gets its own copy of the protocol settings, they are modified below depending on the file
+        for protnum, dat in enumerate([dict(e) for e in protocols], 1):
+
+            if fdata.status in ['remote_io', 'transferred', 'no_transfer']: ## success
+                break
+
+            copytool, copysetup = dat.get('copytool'), dat.get('copysetup')
+
+            # switch off tracing if copytool=rucio, as this is handled internally by rucio
+            #if copytool == 'rucio':
+            #    self.useTracingService = False
+            #else:
+            #    # re-activate tracing in case rucio is not used for staging
+            #    self.useTracingService = useTracingService
+
+            try:
+                sitemover = sitemover_objects.get(copytool)
+                if not sitemover:
+                    sitemover = getSiteMover(copytool)(copysetup, workDir=self.job.workdir)
+                    sitemover_objects.setdefault(copytool, sitemover)
+
+                    sitemover.ddmconf = self.ddmconf # self.si.resolveDDMConf([]) # quick workaround  ###
+                    sitemover.setup()
+                sitemover.trace_report = trace_report
+                if dat.get('resolve_scheme'):
+                    dat['scheme'] = sitemover.schemes
+                    self.log("is_directaccess=%s" % is_directaccess)
+                    self.log("self.job.usePrefetcher=%s"%str(self.job.usePrefetcher))
+                    dat.pop('primary_scheme', None)
+                    if is_directaccess or self.job.usePrefetcher:
+                        if dat['scheme'] and dat['scheme'][0] != self.remoteinput_allowed_schemas[0]:  ## ensure that root:// is coming first in allowed schemas required for further resolve_replica()
+                            dat['scheme'] = self.remoteinput_allowed_schemas + dat['scheme'] ## add supported schema for direct access
+                        self.log("INFO: prepare direct access mode: force to extend accepted protocol schemes to use direct access, schemes=%s" % dat['scheme'])
+                        dat['primary_scheme'] = self.direct_input_allowed_schemas  ## will be used to look up first the replicas allowed for direct access mode
+
+            except Exception, e:
+                self.log('WARNING: Failed to get SiteMover: %s .. skipped .. try to check next available protocol, current protocol details=%s' % (e, dat))
+                trace_report.update(protocol=copytool, clientState='BAD_COPYTOOL', stateReason=str(e)[:500])
+                self.sendTrace(trace_report)
+                continue
+
+            bad_copytools = False
+
+            if sitemover.require_replicas:
+                with ctx['lock']:
+                    if not ctx['is_replicas_resolved']:
+                        self.log("mover resolving replicas")
+                        self.resolve_replicas(ctx['files']) ## do populate fspec.replicas for each entry in files
+                        ctx['is_replicas_resolved'] = True
+
+            self.log("Copy command [stage-in]: %s, sitemover=%s" % (copytool, sitemover))
+            self.log("Copy setup   [stage-in]: %s" % copysetup)
+
+            trace_report.update(protocol=copytool, filesize=fdata.filesize)
+
+            updateFileState(fdata.lfn, self.workDir, self.job.jobId, mode="file_state", state="not_transferred", ftype="input")
+
+            self.log("[stage-in] Prepare to get_data: [%s/%s]-protocol=%s, fspec=%s" % (protnum, nprotocols, dat, fdata))
+
+            try:
+                r = sitemover.resolve_replica(fdata, dat, ddm=self.ddmconf.get(fdata.ddmendpoint))
+            except Exception, e:
+                if sitemover.require_replicas:
+                    self.log("resolve_replica() failed for [%s/%s]-protocol.. skipped.. will check next available protocol, error=%s" % (protnum, nprotocols, e))
+                    trace_report.update(clientState='NO_REPLICA', stateReason=str(e))
+                    self.sendTrace(trace_report)
                     continue
+                r = {}
+
+            # quick stub: propagate changes to FileSpec
+            if r.get('surl'):
+                fdata.surl = r['surl'] # TO BE CLARIFIED if it's still used and need
+            if r.get('pfn'):
+                fdata.turl = r['pfn']
+            if r.get('ddmendpoint'):
+                fdata.ddmendpoint = r['ddmendpoint']
+
+            self.log("[stage-in] found replica to be used: ddmendpoint=%s, pfn=%s" % (fdata.ddmendpoint, fdata.turl))
+
+            # check if protocol and found replica belong to same site
+            if dat.get('ddm'):
+                protocol_site = self.ddmconf.get(dat.get('ddm'), {}).get('site')
+                replica_site = self.ddmconf.get(fdata.ddmendpoint, {}).get('site')
+
+                if protocol_site != replica_site:
+                    if fdata.allowRemoteInputs is None or not fdata.allowRemoteInputs:
+                        self.log('INFO: cross-sites checks: protocol_site=%s and replica_site=%s mismatched and remote inputs is not allowed.. skip file processing for copytool=%s' % (protocol_site, replica_site, copytool))
+                        continue
+                    else:
+                        self.log('INFO: cross-sites checks: protocol_site=%s and replica_site=%s mismatched but remote inputs is allowed.. keep processing for copytool=%s' % (protocol_site, replica_site, copytool))
+
+            # fill trace details
+            localSite = os.environ.get('DQ2_LOCAL_SITE_ID', None)
+            localSite = localSite if localSite else fdata.ddmendpoint
+            trace_report.update(localSite=localSite, remoteSite=fdata.ddmendpoint)
+            trace_report.update(filename=fdata.lfn, guid=fdata.guid.replace('-', ''))
+            trace_report.update(scope=fdata.scope, dataset=fdata.prodDBlock)
+
+            # check direct access
+            if fdata.is_directaccess() and is_directaccess: # direct access mode, no transfer required
+                updateFileState(fdata.turl, self.workDir, self.job.jobId, mode="file_state", state="direct_access", ftype="input")
+                fdata.status = 'remote_io'
+                updateFileState(fdata.lfn, self.workDir, self.job.jobId, mode="transfer_mode", state=fdata.status, ftype="input")
+                self.log("Direct access mode will be used for lfn=%s .. skip transfer for this file" % fdata.lfn)
+                trace_report.update(url=fdata.turl, clientState='FOUND_ROOT', stateReason='direct_access')
+                self.sendTrace(trace_report)
+                continue
+            else:
+                self.log('Direct access will not be user for lfn=%s since fdata.is_directaccess()=%s, is_directaccess=%s' % (fdata.lfn, fdata.is_directaccess(), is_directaccess))
+
+            # check prefetcher (the turl must be saved for prefetcher to use)
+            # note: for files to be prefetched, there's no entry for the file_state, so the updateFileState needs
+            # to be called twice (or update the updateFileState function to allow list arguments)
+            # also update the file_state for the existing entry (could also be removed?)
+            # note also that at least one file still needs to be staged in, or AthenaMP will not start
+            if self.job.usePrefetcher and self.job.eventService:
+                updateFileState(fdata.turl, self.workDir, self.job.jobId, mode="file_state", state="prefetch", ftype="input")
+                fdata.status = 'remote_io'
+                updateFileState(fdata.turl, self.workDir, self.job.jobId, mode="transfer_mode", state=fdata.status, ftype="input")
+                self.log("Added TURL to file state dictionary: %s" % fdata.turl)
+                #updateFileState(fdata.lfn, self.workDir, self.job.jobId, mode="transfer_mode", state="no_transfer", ftype="input")
+                trace_report.update(url=fdata.turl, clientState='FOUND_ROOT', stateReason='prefetch')
+                self.sendTrace(trace_report)
+                continue  # - if we continue here, the the file will not be staged in, but AthenaMP needs it so we still need to stage it in
+
+            # apply site-mover custom job-specific checks for stage-in
+            try:
+                is_stagein_allowed = sitemover.is_stagein_allowed(fdata, self.job)
+                if not is_stagein_allowed:
+                    reason = 'SiteMover does not allow stage-in operation for the job'
+            except PilotException, e:
+                is_stagein_allowed = False
+                reason = e
+            except Exception:
+                raise
+            if not is_stagein_allowed:
+                self.log("WARNING: sitemover=%s does not allow stage-in transfer for this job, lfn=%s with reason=%s.. skip transfer the file" % (sitemover.getID(), fdata.lfn, reason))
+                failed_transfers.append(reason)
+                trace_report.update(clientState='STAGEIN_NOTALLOWED', stateReason='skip stagein file')
+                self.sendTrace(trace_report)
+                continue
 
-                # verify file sizes and available space for stagein
-                sitemover.check_availablespace(maxinputsize, [e for e in remain_files if e.status not in ['remote_io', 'transferred']])
+            # verify file sizes and available space for stagein
+            sitemover.check_availablespace(ctx['maxinputsize'], [e for e in ctx['remain_files'] if e.status not in ['remote_io', 'transferred']])
 
-                self.trace_report.update(catStart=time.time())  ## is this metric still needed? LFC catalog
+            trace_report.update(catStart=time.time())  ## is this metric still needed? LFC catalog
 
-                self.log("[stage-in] Preparing copy for lfn=%s using copytool=%s: mover=%s" % (fdata.lfn, copytool, sitemover))
+            self.log("[stage-in] Preparing copy for lfn=%s using copytool=%s: mover=%s" % (fdata.lfn, copytool, sitemover))
 
-                # set environment for objectstore
-                if fdata.ddmendpoint in self.objectstorekeys and self.objectstorekeys[fdata.ddmendpoint]['status']:
-                    os.environ['S3_ACCESS_KEY'] = self.objectstorekeys[fdata.ddmendpoint]['S3_ACCESS_KEY']
-                    os.environ['S3_SECRET_KEY'] = self.objectstorekeys[fdata.ddmendpoint]['S3_SECRET_KEY']
-                    os.environ['S3_IS_SECURE'] = str(self.objectstorekeys[fdata.ddmendpoint]['S3_IS_SECURE'])
-                else:
-                    if 'S3_ACCESS_KEY' in os.environ: del os.environ['S3_ACCESS_KEY']
-                    if 'S3_SECRET_KEY' in os.environ: del os.environ['S3_SECRET_KEY']
-                    if 'S3_IS_SECURE' in os.environ: del os.environ['S3_IS_SECURE']
-                self.log("Environment S3_ACCESS_KEY=%s" % os.environ.get('S3_ACCESS_KEY', None))
-
-                #dumpFileStates(self.workDir, self.job.jobId, ftype="input")
-
-                # loop over multple stage-in attempts
-                for _attempt in xrange(1, self.stageinretry + 1):
-                    if _attempt > 1: # if not first stage-in attempt, take a nap before next attempt
-                        sleep_time = self.calc_stagein_sleeptime()
-                        self.log(" -- Waiting %d seconds before next stage-in attempt for file=%s --" % (sleep_time, fdata.lfn))
-                        time.sleep(sleep_time)
+            # set environment for objectstore
+            if fdata.ddmendpoint in self.objectstorekeys and self.objectstorekeys[fdata.ddmendpoint]['status']:
+                os.environ['S3_ACCESS_KEY'] = self.objectstorekeys[fdata.ddmendpoint]['S3_ACCESS_KEY']
+                os.environ['S3_SECRET_KEY'] = self.objectstorekeys[fdata.ddmendpoint]['S3_SECRET_KEY']
+                os.environ['S3_IS_SECURE'] = str(self.objectstorekeys[fdata.ddmendpoint]['S3_IS_SECURE'])
+            else:
+                if 'S3_ACCESS_KEY' in os.environ: del os.environ['S3_ACCESS_KEY']
+                if 'S3_SECRET_KEY' in os.environ: del os.environ['S3_SECRET_KEY']
+                if 'S3_IS_SECURE' in os.environ: del os.environ['S3_IS_SECURE']
+            self.log("Environment S3_ACCESS_KEY=%s" % os.environ.get('S3_ACCESS_KEY', None))
 
-                    self.log("Get attempt %s/%s for file (%s/%s) with lfn=%s .. sitemover=%s" % (_attempt, self.stageinretry, fnum, nfiles, fdata.lfn, sitemover))
+            #dumpFileStates(self.workDir, self.job.jobId, ftype="input")
 
-                    fdata.retries = _attempt - 1
-                    if _attempt > 1: # if not first stage-in attempt, try to use different ddm protocols
-                        try:
-                            new_replica = sitemover.resolve_replica(fdata, dat)
-                        except Exception, e:
-                            self.log("Failed to resolve new replica for attempts=%s, error=%s" % (_attempt, e))
-                            new_replica = None
+            # loop over multple stage-in attempts
+            for _attempt in xrange(1, self.stageinretry + 1):
+                if _attempt > 1: # if not first stage-in attempt, take a nap before next attempt
+                    sleep_time = self.calc_stagein_sleeptime()
+                    self.log(" -- Waiting %d seconds before next stage-in attempt for file=%s --" % (sleep_time, fdata.lfn))
+                    time.sleep(sleep_time)
 
-                        if new_replica and new_replica.get('ddmendpoint') == fdata.ddmendpoint:
-                            if new_replica.get('surl'):
-                                fdata.surl = new_replica['surl'] # TO BE CLARIFIED if it's still used and need
-                            if new_replica.get('pfn'):
-                                fdata.turl = new_replica['pfn']
+                self.log("Get attempt %s/%s for file (%s/%s) with lfn=%s .. sitemover=%s" % (_attempt, self.stageinretry, fnum, nfiles, fdata.lfn, sitemover))
 
+                fdata.retries = _attempt - 1
+                if _attempt > 1: # if not first stage-in attempt, try to use different ddm protocols
                     try:
-                        result = sitemover.get_data(fdata)
-                        fdata.status = 'transferred' # mark as successful
-                        fdata.status_code = 0
-                        if result.get('ddmendpoint'):
-                            fdata.ddmendpoint = result.get('ddmendpoint')
-                        if result.get('surl'):
-                            fdata.surl = result.get('surl')
-                        if result.get('pfn'):
-                            fdata.turl = result.get('pfn')
+                        new_replica = sitemover.resolve_replica(fdata, dat)
+                    except Exception, e:
+                        self.log("Failed to resolve new replica for attempts=%s, error=%s" % (_attempt, e))
+                        new_replica = None
 
-                        #self.trace_report.update(url=fdata.surl) ###
-                        self.trace_report.update(url=fdata.turl) ###
-                        # for files without replication registered in rucio, the filesize need to be got from local file
-                        self.trace_report.update(filesize=fdata.filesize)
+                    if new_replica and new_replica.get('ddmendpoint') == fdata.ddmendpoint:
+                        if new_replica.get('surl'):
+                            fdata.surl = new_replica['surl'] # TO BE CLARIFIED if it's still used and need
+                        if new_replica.get('pfn'):
+                            fdata.turl = new_replica['pfn']
 
-                        break # transferred successfully
-                    except PilotException, e:
-                        result = e
-                        self.log(traceback.format_exc())
-                    except Exception, e:
-                        result = PilotException("stageIn failed with error=%s" % e, code=PilotErrors.ERR_STAGEINFAILED, state='STAGEIN_ATTEMPT_FAILED')
-                        self.log(traceback.format_exc())
-                        self.log('WARNING: Error in copying file (fspec %s/%s) (protocol %s/%s) (attempt %s/%s) (exception): skip further retry (if any)' % (fnum, nfiles, protnum, nprotocols, _attempt, self.stageinretry))
-                        break
+                try:
+                    result = sitemover.get_data(fdata)
+                    fdata.status = 'transferred' # mark as successful
+                    fdata.status_code = 0
+                    if result.get('ddmendpoint'):
+                        fdata.ddmendpoint = result.get('ddmendpoint')
+                    if result.get('surl'):
+                        fdata.surl = result.get('surl')
+                    if result.get('pfn'):
+                        fdata.turl = result.get('pfn')
+
+                    #trace_report.update(url=fdata.surl) ###
+                    trace_report.update(url=fdata.turl) ###
+                    # for files without replication registered in rucio, the filesize need to be got from local file
+                    trace_report.update(filesize=fdata.filesize)
+
+                    break # transferred successfully
+                except PilotException, e:
+                    result = e
+                    self.log(traceback.format_exc())
+                except Exception, e:
+                    result = PilotException("stageIn failed with error=%s" % e, code=PilotErrors.ERR_STAGEINFAILED, state='STAGEIN_ATTEMPT_FAILED')
+                    self.log(traceback.format_exc())
+                    self.log('WARNING: Error in copying file (fspec %s/%s) (protocol %s/%s) (attempt %s/%s) (exception): skip further retry (if any)' % (fnum, nfiles, protnum, nprotocols, _attempt, self.stageinretry))
+                    break
 
-                    self.log('WARNING: Error in copying file (fspec %s/%s) (protocol %s/%s) (attempt %s/%s): %s' % (fnum, nfiles, protnum, nprotocols, _attempt, self.stageinretry, result))
+                self.log('WARNING: Error in copying file (fspec %s/%s) (protocol %s/%s) (attempt %s/%s): %s' % (fnum, nfiles, protnum, nprotocols, _attempt, self.stageinretry, result))
 
-                    accepted_codes = [PilotErrors.ERR_GETADMISMATCH, PilotErrors.ERR_GETMD5MISMATCH, PilotErrors.ERR_GETWRONGSIZE, PilotErrors.ERR_NOSUCHFILE]
-                    if isinstance(result, PilotException) and result.code in accepted_codes:
-                        self.log("[stage-in] WARNING: BAD input file detected at storage side (code=%s).. will skip all remaining retry attempts (if any) .." % result.code)
-                        break
+                accepted_codes = [PilotErrors.ERR_GETADMISMATCH, PilotErrors.ERR_GETMD5MISMATCH, PilotErrors.ERR_GETWRONGSIZE, PilotErrors.ERR_NOSUCHFILE]
+                if isinstance(result, PilotException) and result.code in accepted_codes:
+                    self.log("[stage-in] WARNING: BAD input file detected at storage side (code=%s).. will skip all remaining retry attempts (if any) .." % result.code)
+                    break
 
-                if not isinstance(result, PilotException): # transferred successfully
+            if not isinstance(result, PilotException): # transferred successfully
 
-                    # finalize and send trace report
-                    self.trace_report.update(clientState='DONE', stateReason='OK', timeEnd=time.time())
-                    self.sendTrace(self.trace_report)
+                # finalize and send trace report
+                trace_report.update(clientState='DONE', stateReason='OK', timeEnd=time.time())
+                self.sendTrace(trace_report)
 
-                    updateFileState(fdata.lfn, self.workDir, self.job.jobId, mode="file_state", state="transferred", ftype="input")
-                    dumpFileStates(self.workDir, self.job.jobId, ftype="input")
+                updateFileState(fdata.lfn, self.workDir, self.job.jobId, mode="file_state", state="transferred", ftype="input")
+                dumpFileStates(self.workDir, self.job.jobId, ftype="input")
 
-                    ## self.updateSURLDictionary(guid, surl, self.workDir, self.job.jobId) # FIX ME LATER
+                ## self.updateSURLDictionary(guid, surl, self.workDir, self.job.jobId) # FIX ME LATER
 
-                    fdat = result.copy()
-                    #fdat.update(lfn=lfn, pfn=pfn, guid=guid, surl=surl)
-                    transferred_files.append(fdat)
-                else:
-                    fdata.status = 'error'
-                    fdata.status_code = result.code
-                    fdata.status_message = result.message
-                    self.trace_report.update(clientState=result.state or 'STAGEIN_ATTEMPT_FAILED', stateReason=result.message, timeEnd=time.time())
-                    self.sendTrace(self.trace_report)
-                    failed_transfers.append(result)
+                fdat = result.copy()
+                #fdat.update(lfn=lfn, pfn=pfn, guid=guid, surl=surl)
+                transferred_files.append(fdat)
+            else:
+                fdata.status = 'error'
+                fdata.status_code = result.code
+                fdata.status_message = result.message
+                trace_report.update(clientState=result.state or 'STAGEIN_ATTEMPT_FAILED', stateReason=result.message, timeEnd=time.time())
+                self.sendTrace(trace_report)
+                failed_transfers.append(result)
+
+                badfile_codes = [PilotErrors.ERR_GETADMISMATCH, PilotErrors.ERR_GETMD5MISMATCH, PilotErrors.ERR_GETWRONGSIZE, PilotErrors.ERR_NOSUCHFILE]
+                if fdata.status_code in badfile_codes:
+                    break
 
-                    badfile_codes = [PilotErrors.ERR_GETADMISMATCH, PilotErrors.ERR_GETMD5MISMATCH, PilotErrors.ERR_GETWRONGSIZE, PilotErrors.ERR_NOSUCHFILE]
-                    if fdata.status_code in badfile_codes:
-                        break
+            # TEMPORARY: SHOULD BE REMOVED IF DIRECT I/O ACTUALLY WORKS WITH ATHENAMP, WHICH IT SEEMS IT DOESN'T
+            # AS OF NOW, THE INITIAL INPUT FILE IS STILL TRANSFERRED, OTHERWISE ATHENAMP FAILS IMMEDIATELY SINCE
+            # IT DOESN'T FIND THE INPUT FILE
+            # check prefetcher (no transfer is required, but the turl must be saved for prefetcher to use)
+            # note: for files to be prefetched, there's no entry for the file_state, so the updateFileState needs
+            # to be called twice (or update the updateFileState function to allow list arguments)
+            # also update the file_state for the existing entry (could also be removed?)
+            #if self.job.prefetcher:
+            #    updateFileState(fdata.turl, self.workDir, self.job.jobId, mode="file_state", state="prefetch", ftype="input")
+            #    fdata.status = 'remote_io'
+            #    updateFileState(fdata.turl, self.workDir, self.job.jobId, mode="transfer_mode", state=fdata.status, ftype="input")
+            #    self.log("Prefetcher will be used for turl=%s .. skip transfer for this file" % fdata.turl)
+            #    updateFileState(fdata.lfn, self.workDir, self.job.jobId, mode="transfer_mode", state="no_transfer", ftype="input")
+            #    continue
+
+        return transferred_files, failed_transfers, bad_copytools
+
+    def get_catchall_value(self, name, default=None):
+        """
+            Get the value of a name=value setting from the catchall field of queuedata
+            (comma separated list, e.g. catchall="stagein_threads=4,stageout_threads=2")
+        """
 
-                # TEMPORARY: SHOULD BE REMOVED IF DIRECT I/O ACTUALLY WORKS WITH ATHENAMP, WHICH IT SEEMS IT DOESN'T
-                # AS OF NOW, THE INITIAL INPUT FILE IS STILL TRANSFERRED, OTHERWISE ATHENAMP FAILS IMMEDIATELY SINCE
-                # IT DOESN'T FIND THE INPUT FILE
-                # check prefetcher (no transfer is required, but the turl must be saved for prefetcher to use)
-                # note: for files to be prefetched, there's no entry for the file_state, so the updateFileState needs
-                # to be called twice (or update the updateFileState function to allow list arguments)
-                # also update the file_state for the existing entry (could also be removed?)
-                #if self.job.prefetcher:
-                #    updateFileState(fdata.turl, self.workDir, self.job.jobId, mode="file_state", state="prefetch", ftype="input")
-                #    fdata.status = 'remote_io'
-                #    updateFileState(fdata.turl, self.workDir, self.job.jobId, mode="transfer_mode", state=fdata.status, ftype="input")
-                #    self.log("Prefetcher will be used for turl=%s .. skip transfer for this file" % fdata.turl)
-                #    updateFileState(fdata.lfn, self.workDir, self.job.jobId, mode="transfer_mode", state="no_transfer", ftype="input")
-                #    continue
+        values = {}
+        for catchall in (self.si.readpar('catchall') or '').split(','):
+            if '=' in catchall:
+                values[catchall.split('=')[0].strip()] = catchall.split('=')[1].strip()
 
-            if fdata.status == 'error' and not skip_transfer_failure:
-                self.log('stage-in of file (%s/%s) with lfn=%s failed: code=%s .. skip transferring remaining files..' % (fnum, nfiles, fdata.lfn, fdata.status_code))
-                dumpFileStates(self.workDir, self.job.jobId, ftype="input")
-                status_code = fdata.status_code if fdata.status_code != PilotErrors.ERR_UNKNOWN else PilotErrors.ERR_STAGEINFAILED
-                raise PilotException("STAGEIN FAILED: %s: lfn=%s, error=%s" % (PilotErrors.getErrorStr(status_code), fdata.lfn, getattr(fdata, 'status_message', '')), code=status_code, state='STAGEIN_FILE_FAILED')
+        return values.get(name, default)
 
-            if bad_copytools:
-                raise PilotException("STAGEIN FAILED: bad copytools: no supported copytools", code=PilotErrors.ERR_NOSTORAGE, state='STAGEIN_BAD_COPYTOOLS')
+    def get_stagein_threads(self, files):
+        """
+            Resolve the number of files to be transferred concurrently (catchall setting stagein_threads, default=1)
+            :return: number of threads, 1 means that the files are transferred one after another
+        """
 
-        self.log('INFO: all input files have been successfully processed')
+        try:
+            nthreads = int(self.get_catchall_value('stagein_threads', 1))
+        except ValueError, e:
+            self.log("WARNING: invalid stagein_threads value in catchall: %s .. ignored" % e)
+            nthreads = 1
 
-        dumpFileStates(self.workDir, self.job.jobId, ftype="input")
+        # objectstore keys are passed to the copytools through the environment of the pilot
+        if nthreads > 1 and [e for e in self.objectstorekeys.itervalues() if e.get('status')]:
+            self.log("stage-in: objectstore files are transferred one after another")
+            nthreads = 1
 
-        #self.log('transferred_files= %s' % transferred_files)
-        self.log('Summary of transferred files:')
-        for e in transferred_files:
-            self.log(" -- %s" % e)
+        nthreads = max(1, min(nthreads, len(files), self.MAX_STAGEIN_THREADS))
+        self.log("stage-in: number of concurrent transfers=%s" % nthreads)
 
-        if failed_transfers:
-            self.log('Summary of failed transfers:')
-            for e in failed_transfers:
-                self.log(" -- %s" % e)
+        return nthreads
 
-        self.log("stagein finished")
+    def stagein_files_concurrently(self, files, protocols, ctx, nthreads, skip_transfer_failure):
+        """
+            Transfer the files with nthreads concurrent stage-in transfers, the largest files are started first.
+            No new transfer is started after a transfer failed (unless skip_transfer_failure is set).
+            :return: list of results in the order of files: {'result': stagein_file() return value} or {'exc_info': exception info}
+                     or None if the file was not processed
+        """
 
-        if not self.job.usePrefetcher:
-            self.job.print_infiles()
+        from ThreadPool import ThreadPool
 
-        return transferred_files, failed_transfers
+        nfiles = len(files)
+        results = [None] * nfiles
+        abort = threading.Event()
+        workers = threading.local()
+
+        def _stagein(index):
+            if abort.isSet():
+                return
+            fdata = files[index]
+            # site movers and trace reports are not shared between transfers running at the same time
+            if not hasattr(workers, 'sitemover_objects'):
+                workers.sitemover_objects = {}
+            try:
+                ret = self.stagein_file(fdata, index + 1, nfiles, protocols, workers.sitemover_objects, copy.copy(self.trace_report), ctx)
+                results[index] = {'result': ret}
+                if ret[2] or (fdata.status == 'error' and not skip_transfer_failure):
+                    abort.set()
+            except:
+                results[index] = {'exc_info': sys.exc_info()}
+                abort.set()
+
+        order = sorted(range(nfiles), key=lambda i: files[i].filesize or 0, reverse=True)
+        self.log("stage-in: will transfer %s files with %s threads, order=%s" % (nfiles, nthreads, [files[i].lfn for i in order]))
+
+        # short poll timeout: the idle workers are joined when all transfers are done
+        threadpool = ThreadPool(nthreads, poll_timeout=0.1)
+        for index in order:
+            threadpool.add_task(_stagein, index)
+        threadpool.wait_completion()
+
+        return results
+
+    def get_stageout_threads(self, files):
+        """
+            Resolve the number of files to be transferred concurrently (catchall setting stageout_threads, default=1)
+            :return: number of threads, 1 means that the files are transferred one after another
+        """
+
+        try:
+            nthreads = int(self.get_catchall_value('stageout_threads', 1))
+        except ValueError, e:
+            self.log("WARNING: invalid stageout_threads value in catchall: %s .. ignored" % e)
+            nthreads = 1
+
+        # objectstore keys are passed to the copytools through the environment of the pilot
+        if nthreads > 1 and [e for e in self.objectstorekeys.itervalues() if e.get('status')]:
+            self.log("stage-out: objectstore files are transferred one after another")
+            nthreads = 1
+
+        nthreads = max(1, min(nthreads, len(files), self.MAX_STAGEOUT_THREADS))
+        self.log("stage-out: number of concurrent transfers=%s" % nthreads)
+
+        return nthreads
+
+    def stageout_files_concurrently(self, files, ctx, nthreads, skip_transfer_failure):
+        """
+            Transfer the files with nthreads concurrent stage-out transfers.
+            The number of transfers to the same ddmendpoint is limited by the catchall setting stageout_threads_per_ddm (default=nthreads),
+            the files of the different ddmendpoints are interleaved and the largest files are started first.
+            The missing local checksums are calculated by a helper thread ahead of the transfers.
+            No new transfer is started after a transfer failed (unless skip_transfer_failure is set).
+            :return: list of results in the order of files: {'result': stageout_file() return value} or {'exc_info': exception info}
+                     or None if the file was not processed
+        """
+
+        from ThreadPool import ThreadPool
+        from Checksum import calculateChecksums
+
+        try:
+            nddmthreads = int(self.get_catchall_value('stageout_threads_per_ddm', nthreads))
+        except ValueError, e:
+            self.log("WARNING: invalid stageout_threads_per_ddm value in catchall: %s .. ignored" % e)
+            nddmthreads = nthreads
+        nddmthreads = max(1, min(nddmthreads, nthreads))
+
+        nfiles = len(files)
+        results = [None] * nfiles
+        abort = threading.Event()
+        workers = threading.local()
+
+        # transfer order: largest files first, round robin over the ddmendpoints
+        ddmorder = {}
+        for index in sorted(range(nfiles), key=lambda i: files[i].filesize or 0, reverse=True):
+            ddmorder.setdefault(files[index].ddmendpoint, []).append(index)
+        ddmslots = dict([ddm, threading.Semaphore(nddmthreads)] for ddm in ddmorder)
+        order, queues = [], [list(e) for e in ddmorder.itervalues()]
+        while [e for e in queues if e]:
+            for indexes in queues:
+                if indexes:
+                    order.append(indexes.pop(0))
+
+        self.log("stage-out: will transfer %s files with %s threads (max %s per ddmendpoint), order=%s" % (nfiles, nthreads, nddmthreads, [files[i].lfn for i in order]))
+
+        def _checksums():
+            for index in order:
+                if abort.isSet():
+                    break
+                fspec = files[index]
+                if fspec.get_checksum()[0]: # already known (from the metadata file)
+                    continue
+                pfn = fspec.pfn if fspec.pfn else os.path.join(self.job.workdir, fspec.lfn)
+                try:
+                    calculateChecksums(pfn) # cached, the site mover will find the values
+                except Exception, e:
+                    self.log("WARNING: failed to calculate local checksum of %s: %s .. skipped" % (pfn, e))
+
+        def _stageout(index):
+            if abort.isSet():
+                return
+            fdata = files[index]
+            # site movers and trace reports are not shared between transfers running at the same time
+            if not hasattr(workers, 'sitemover_objects'):
+                workers.sitemover_objects = {}
+            ddmslot = ddmslots[fdata.ddmendpoint]
+            ddmslot.acquire()
+            try:
+                if abort.isSet():
+                    return
+                ret = self.stageout_file(fdata, index + 1, nfiles, workers.sitemover_objects, copy.copy(self.trace_report), ctx)
+                results[index] = {'result': ret}
+                if ret[2] or (fdata.status == 'error' and not skip_transfer_failure):
+                    abort.set()
+            except:
+                results[index] = {'exc_info': sys.exc_info()}
+                abort.set()
+            finally:
+                ddmslot.release()
+
+        checksum_thread = threading.Thread(target=_checksums, name="StageoutChecksums")
+        checksum_thread.setDaemon(True)
+        checksum_thread.start()
+
+        # short poll timeout: the idle workers are joined when all transfers are done
+        threadpool = ThreadPool(nthreads, poll_timeout=0.1)
+        for index in order:
+            threadpool.add_task(_stageout, index)
+        threadpool.wait_completion()
+
+        abort.set() # the remaining checksums are not needed anymore
+        checksum_thread.join()
+
+        return results
 
     def _prepare_destinations(self, files, activities):
         """
@@ -1173,197 +1442,237 @@ class JobMover(object):
                     self.log(msg)
                     raise PilotException(msg, code=PilotErrors.ERR_NOSTORAGE, state="NO_COPYTOOLS")
 
-        sitemover_objects = {}
-
-        remain_files = [e for e in ddmfiles.get(ddmendpoint) if e.status not in ['transferred']]
+        # files of all ddmendpoints, in the original order
+        remain_files = [e for e in files if e.status not in ['transferred']]
         nfiles = len(remain_files)
 
         # remember the original tracing choise
         useTracingService = self.useTracingService
 
+        # state shared by the transfers of all files
+        ctx = {'activity': activity, 'ddmprotocols': ddmprotocols, 'surl_protocols': surl_protocols, 'lock': threading.RLock()}
+
+        results = None
+        nthreads = self.get_stageout_threads(remain_files)
+        if nthreads > 1:
+            results = self.stageout_files_concurrently(remain_files, ctx, nthreads, skip_transfer_failure)
+
+        sitemover_objects = {}
+
         for fnum, fdata in enumerate(remain_files, 1):
 
-            self.log('INFO: prepare to transfer (stage-out) %s/%s file: lfn=%s, fspec.ddmendpoint=%s, activity=%s' % (fnum, nfiles, fdata.lfn, fdata.ddmendpoint, activity))
+            if results is None:
+                ret = self.stageout_file(fdata, fnum, nfiles, sitemover_objects, self.trace_report, ctx)
+            else: # process the results of the concurrent transfers in the same order as the serial transfers
+                ret = results[fnum - 1]
+                if ret is None: # not started since the transfer of another file failed
+                    continue
+                if ret.get('exc_info'):
+                    exc_info = ret['exc_info']
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                ret = ret['result']
 
-            ddmendpoint = fdata.ddmendpoint
-            iprotocols = ddmprotocols.get(fdata.ddmendpoint)
-            nprotocols = len(iprotocols)
+            _transferred_files, _failed_transfers, bad_copytools = ret
+            transferred_files += _transferred_files
+            failed_transfers += _failed_transfers
 
-            bad_copytools = True
+            if fdata.status == 'error' and not skip_transfer_failure:
+                self.log('[stage-out] [%s] failed to transfer file (%s/%s) with lfn=%s: code=%s .. skip transferring of remaining data..' % (activity, fnum, nfiles, fdata.lfn, fdata.status_code))
+                dumpFileStates(self.workDir, self.job.jobId, ftype="output")
+                status_code = fdata.status_code if fdata.status_code != PilotErrors.ERR_UNKNOWN else PilotErrors.ERR_STAGEOUTFAILED
+                raise PilotException("STAGEOUT FAILED: %s: lfn=%s, error=%s" % (PilotErrors.getErrorStr(status_code), fdata.lfn, getattr(fdata, 'status_message', '')), code=status_code, state='STAGEOUT_FILE_FAILED')
 
-            for protnum, dat in enumerate(iprotocols, 1):
+            if bad_copytools:
+                raise PilotException("STAGEOUT FAILED: bad copytools: no supported copytools", code=PilotErrors.ERR_NOSTORAGE, state='STAGEOUT_BAD_COPYTOOLS')
 
-                if fdata.status in ['transferred']:
-                    break
 
-                self.log('[stage-out] [%s]: checking protocol-%s/%s to transfer file %s/%s: lfn=%s, copytools=%s' % (activity, protnum, nprotocols, fnum, nfiles, fdata.lfn, dat.get('copytools', [])))
+        dumpFileStates(self.workDir, self.job.jobId, ftype="output")
 
-                for cpsettings in dat.get('copytools', []):
+        self.log('Summary of transferred files:')
+        for e in transferred_files:
+            self.log(" -- %s" % e)
 
-                    if fdata.status in ['transferred']:
-                        break
+        if failed_transfers:
+            self.log('Summary of failed transfers:')
+            for e in failed_transfers:
+                self.log(" -- %s" % e)
 
-                    copytool, copysetup = cpsettings.get('copytool'), cpsettings.get('copysetup')
+        self.log("stageout finished")
+        self.job.print_files(files)
 
-                    # switch off tracing if copytool=rucio, as this is handled internally by rucio
-                    #if copytool == 'rucio':
-                    #    self.useTracingService = False
-                    #else:
-                    #    # re-activate tracing in case rucio is not used for staging
-                    #    self.useTracingService = useTracingService
+        return transferred_files, failed_transfers
 
-                    try:
-                        sitemover = sitemover_objects.get(copytool)
-                        if not sitemover:
-                            sitemover = getSiteMover(copytool)(copysetup, workDir=self.job.workdir)
-                            sitemover_objects.setdefault(copytool, sitemover)
-
-                            sitemover.trace_report = self.trace_report
-                            sitemover.protocol = dat # ## ?
-                            sitemover.ddmconf = self.ddmconf # quick workaround  ###
-                            sitemover.setup()
-                        if dat.get('resolve_scheme'):
-                            dat['scheme'] = sitemover.schemes
-                    except Exception, e:
-                        self.log('WARNING: Failed to get SiteMover: %s .. skipped .. try to check next available protocol, current protocol details=%s' % (e, dat))
-                        self.trace_report.update(protocol=copytool, clientState='BAD_COPYTOOL', stateReason=str(e)[:500])
-                        self.sendTrace(self.trace_report)
-                        continue
 
-                    bad_copytools = False
+    def stageout_file(self, fdata, fnum, nfiles, sitemover_objects, trace_report, ctx):
+        """
+            Transfer (stage-out) one file: try the protocols of its ddmendpoint one after another, with retries for each copytool
+            :param sitemover_objects: cache of site mover instances (per copytool) to be used
+            :param trace_report: trace report of the file transfer
+            :param ctx: state shared by the transfers of all files of stageout()
+            :return: (transferred_files, failed_transfers, bad_copytools)
+        """
 
-                    if dat.get('scheme'): # filter protocols by accepted scheme from copytool
-                        should_skip = True
-                        for scheme in dat.get('scheme'):
-                            if dat['se'].startswith(scheme):
-                                should_skip = False
-                                break
-                        if should_skip:
-                            self.log("[stage-out] [%s] protocol=%s of ddmendpoint=%s is skipped since copytool=%s is not in the list of allowed (local) destinations, accepted schemes=%s" % (activity, dat['se'], ddmendpoint, copytool, dat['scheme']))
+        transferred_files, failed_transfers = [], []
+        activity, surl_protocols = ctx['activity'], ctx['surl_protocols']
 
-                            continue
+        self.log('INFO: prepare to transfer (stage-out) %s/%s file: lfn=%s, fspec.ddmendpoint=%s, activity=%s' % (fnum, nfiles, fdata.lfn, fdata.ddmendpoint, activity))
 
-                    self.log("Copy command [stage-out][%s]: %s, sitemover=%s" % (activity, copytool, sitemover))
-                    self.log("Copy setup   [stage-out][%s]: %s" % (activity, copysetup))
+        ddmendpoint = fdata.ddmendpoint
+        iprotocols = ctx['ddmprotocols'].get(fdata.ddmendpoint)
+        nprotocols = len(iprotocols)
 
-                    localSite = os.environ.get('DQ2_LOCAL_SITE_ID', None)
-                    localSite = localSite if localSite else ddmendpoint
-                    self.trace_report.update(protocol=copytool, localSite=localSite, remoteSite=ddmendpoint)
+        bad_copytools = True
 
-                    # validate se value?
-                    se, se_path = dat.get('se', ''), dat.get('path', '')
+        # each file gets its own copy of the protocol settings, they are modified below depending on the copytool
+        for protnum, dat in enumerate([dict(e) for e in iprotocols], 1):
 
-                    if not fdata.surl:
-                        # job is passing here for possible JOB specific processing
-                        fdata.surl = sitemover.getSURL(surl_protocols[fdata.ddmendpoint].get('se'),
-                                                       surl_protocols[fdata.ddmendpoint].get('path'),
-                                                       fdata.scope,
-                                                       fdata.lfn,
-                                                       self.job,
-                                                       pathConvention=fdata.pathConvention,
-                                                       ddmEndpoint=fdata.ddmendpoint)
+            if fdata.status in ['transferred']:
+                break
 
-                    updateFileState(fdata.lfn, self.workDir, self.job.jobId, mode="file_state", state="not_transferred", ftype="output")
+            self.log('[stage-out] [%s]: checking protocol-%s/%s to transfer file %s/%s: lfn=%s, copytools=%s' % (activity, protnum, nprotocols, fnum, nfiles, fdata.lfn, dat.get('copytools', [])))
 
-                    # job is passing here for possible JOB specific processing
-                    fdata.turl = sitemover.getSURL(se, se_path, fdata.scope, fdata.lfn, self.job, pathConvention=fdata.pathConvention, ddmEndpoint=fdata.ddmendpoint)
+            for cpsettings in dat.get('copytools', []):
 
-                    self.log("[stage-out] [%s] resolved SURL=%s to be used for lfn=%s, ddmendpoint=%s" % (activity, fdata.surl, fdata.lfn, fdata.ddmendpoint))
-                    self.log("[stage-out] [%s] resolved TURL=%s to be used for lfn=%s, ddmendpoint=%s" % (activity, fdata.turl, fdata.lfn, fdata.ddmendpoint))
-                    self.log("[stage-out] [%s] Prepare to put_data: ddmendpoint=%s, %s/%s-protocol=%s, fspec=%s" % (activity, ddmendpoint, protnum, nprotocols, dat, fdata))
+                if fdata.status in ['transferred']:
+                    break
 
-                    self.trace_report.update(catStart=time.time(), filename=fdata.lfn, guid=fdata.guid.replace('-', '') if fdata.guid else None)
-                    self.trace_report.update(scope=fdata.scope, dataset=fdata.destinationDblock, url=fdata.turl)
-                    self.trace_report.update(filesize=fdata.filesize)
+                copytool, copysetup = cpsettings.get('copytool'), cpsettings.get('copysetup')
 
-                    self.log("[stage-out] [%s] Preparing copy for lfn=%s using copytool=%s: mover=%s" % (activity, fdata.lfn, copytool, sitemover))
-                    #dumpFileStates(self.workDir, self.job.jobId, ftype="output")
+                # switch off tracing if copytool=rucio, as this is handled internally by rucio
+                #if copytool == 'rucio':
+                #    self.useTracingService = False
+                #else:
+                #    # re-activate tracing in case rucio is not used for staging
+                #    self.useTracingService = useTracingService
 
-                    # loop over multple stage-out attempts
-                    for _attempt in xrange(1, self.stageoutretry + 1):
-                        if _attempt > 1: # if not first stage-out attempt, take a nap before next attempt
-                            sleep_time = self.calc_stageout_sleeptime(_attempt)
-                            self.log(" -- Waiting %d seconds before next stage-out attempt for file=%s --" % (sleep_time, fdata.lfn))
-                            time.sleep(sleep_time)
+                try:
+                    sitemover = sitemover_objects.get(copytool)
+                    if not sitemover:
+                        sitemover = getSiteMover(copytool)(copysetup, workDir=self.job.workdir)
+                        sitemover_objects.setdefault(copytool, sitemover)
 
-                        self.log("Put attempt %s/%s for file (%s/%s) with lfn=%s .. sitemover=%s" % (_attempt, self.stageoutretry, fnum, nfiles, fdata.lfn, sitemover))
+                        sitemover.protocol = dat # ## ?
+                        sitemover.ddmconf = self.ddmconf # quick workaround  ###
+                        sitemover.setup()
+                    sitemover.trace_report = trace_report
+                    if dat.get('resolve_scheme'):
+                        dat['scheme'] = sitemover.schemes
+                except Exception, e:
+                    self.log('WARNING: Failed to get SiteMover: %s .. skipped .. try to check next available protocol, current protocol details=%s' % (e, dat))
+                    trace_report.update(protocol=copytool, clientState='BAD_COPYTOOL', stateReason=str(e)[:500])
+                    self.sendTrace(trace_report)
+                    continue
 
-                        try:
-                            result = sitemover.put_data(fdata)
-                            fdata.status = 'transferred' # mark as successful
-                            fdata.status_code = 0
-                            if result.get('surl'):
-                                fdata.surl = result.get('surl')
-                            #if result.get('pfn'):
-                            #    fdata.turl = result.get('pfn')
+                bad_copytools = False
 
-                            #self.trace_report.update(url=fdata.surl) ###
-                            self.trace_report.update(url=fdata.turl) ###
+                if dat.get('scheme'): # filter protocols by accepted scheme from copytool
+                    should_skip = True
+                    for scheme in dat.get('scheme'):
+                        if dat['se'].startswith(scheme):
+                            should_skip = False
+                            break
+                    if should_skip:
+                        self.log("[stage-out] [%s] protocol=%s of ddmendpoint=%s is skipped since copytool=%s is not in the list of allowed (local) destinations, accepted schemes=%s" % (activity, dat['se'], ddmendpoint, copytool, dat['scheme']))
 
-                            # finalize and send trace report
-                            self.trace_report.update(clientState='DONE', stateReason='OK', timeEnd=time.time())
-                            self.sendTrace(self.trace_report)
+                        continue
 
-                            updateFileState(fdata.lfn, self.workDir, self.job.jobId, mode="file_state", state="transferred", ftype="output")
-                            dumpFileStates(self.workDir, self.job.jobId, ftype="output")
+                self.log("Copy command [stage-out][%s]: %s, sitemover=%s" % (activity, copytool, sitemover))
+                self.log("Copy setup   [stage-out][%s]: %s" % (activity, copysetup))
 
-                            self.updateSURLDictionary(fdata.guid, fdata.surl, self.workDir, self.job.jobId) # FIXME LATER: isolate later
+                localSite = os.environ.get('DQ2_LOCAL_SITE_ID', None)
+                localSite = localSite if localSite else ddmendpoint
+                trace_report.update(protocol=copytool, localSite=localSite, remoteSite=ddmendpoint)
 
-                            fdat = result.copy()
-                            #fdat.update(lfn=lfn, pfn=pfn, guid=guid, surl=surl)
-                            transferred_files.append(fdat)
-
-                            break # transferred successfully
-                        except PilotException, e:
-                            result = e
-                            self.log(traceback.format_exc())
-                            if e.code == PilotErrors.ERR_FILEEXIST: ## skip further attempts
-                                self.log('INFO: Error in copying file (fspec %s/%s) (protocol %s/%s) (attempt %s/%s): File already exist: skip further retries (if any)' % (fnum, nfiles, protnum, nprotocols, _attempt, self.stageoutretry))
-                                break
-                        except Exception, e:
-                            result = PilotException("stageOut failed with error=%s" % e, code=PilotErrors.ERR_STAGEOUTFAILED, state="STAGEOUT_ATTEMPT_FAILED")
-                            self.log(traceback.format_exc())
-                            self.log('WARNING: Error in copying file (fspec %s/%s) (protocol %s/%s) (attempt %s/%s) (exception): skip further retries (if any)' % (fnum, nfiles, protnum, nprotocols, _attempt, self.stageoutretry))
-                            break
+                # validate se value?
+                se, se_path = dat.get('se', ''), dat.get('path', '')
 
-                        self.log('WARNING: Error in copying file (fspec %s/%s) (protocol %s/%s) (attempt %s/%s): %s' % (fnum, nfiles, protnum, nprotocols, _attempt, self.stageoutretry, result))
+                if not fdata.surl:
+                    # job is passing here for possible JOB specific processing
+                    fdata.surl = sitemover.getSURL(surl_protocols[fdata.ddmendpoint].get('se'),
+                                                   surl_protocols[fdata.ddmendpoint].get('path'),
+                                                   fdata.scope,
+                                                   fdata.lfn,
+                                                   self.job,
+                                                   pathConvention=fdata.pathConvention,
+                                                   ddmEndpoint=fdata.ddmendpoint)
 
-                    if isinstance(result, Exception): # failed transfer
-                        fdata.status = 'error'
-                        fdata.status_code = result.code
-                        fdata.status_message = result.message
+                updateFileState(fdata.lfn, self.workDir, self.job.jobId, mode="file_state", state="not_transferred", ftype="output")
 
-                        self.trace_report.update(clientState=result.state or 'STAGEOUT_ATTEMPT_FAILED', stateReason=result.message, timeEnd=time.time())
-                        self.sendTrace(self.trace_report)
+                # job is passing here for possible JOB specific processing
+                fdata.turl = sitemover.getSURL(se, se_path, fdata.scope, fdata.lfn, self.job, pathConvention=fdata.pathConvention, ddmEndpoint=fdata.ddmendpoint)
 
-                        failed_transfers.append(result)
+                self.log("[stage-out] [%s] resolved SURL=%s to be used for lfn=%s, ddmendpoint=%s" % (activity, fdata.surl, fdata.lfn, fdata.ddmendpoint))
+                self.log("[stage-out] [%s] resolved TURL=%s to be used for lfn=%s, ddmendpoint=%s" % (activity, fdata.turl, fdata.lfn, fdata.ddmendpoint))
+                self.log("[stage-out] [%s] Prepare to put_data: ddmendpoint=%s, %s/%s-protocol=%s, fspec=%s" % (activity, ddmendpoint, protnum, nprotocols, dat, fdata))
 
+                trace_report.update(catStart=time.time(), filename=fdata.lfn, guid=fdata.guid.replace('-', '') if fdata.guid else None)
+                trace_report.update(scope=fdata.scope, dataset=fdata.destinationDblock, url=fdata.turl)
+                trace_report.update(filesize=fdata.filesize)
 
-            if fdata.status == 'error' and not skip_transfer_failure:
-                self.log('[stage-out] [%s] failed to transfer file (%s/%s) with lfn=%s: code=%s .. skip transferring of remaining data..' % (activity, fnum, nfiles, fdata.lfn, fdata.status_code))
-                dumpFileStates(self.workDir, self.job.jobId, ftype="output")
-                status_code = fdata.status_code if fdata.status_code != PilotErrors.ERR_UNKNOWN else PilotErrors.ERR_STAGEOUTFAILED
-                raise PilotException("STAGEOUT FAILED: %s: lfn=%s, error=%s" % (PilotErrors.getErrorStr(status_code), fdata.lfn, getattr(fdata, 'status_message', '')), code=status_code, state='STAGEOUT_FILE_FAILED')
+                self.log("[stage-out] [%s] Preparing copy for lfn=%s using copytool=%s: mover=%s" % (activity, fdata.lfn, copytool, sitemover))
+                #dumpFileStates(self.workDir, self.job.jobId, ftype="output")
 
-            if bad_copytools:
-                raise PilotException("STAGEOUT FAILED: bad copytools: no supported copytools", code=PilotErrors.ERR_NOSTORAGE, state='STAGEOUT_BAD_COPYTOOLS')
+                # loop over multple stage-out attempts
+                for _attempt in xrange(1, self.stageoutretry + 1):
+                    if _attempt > 1: # if not first stage-out attempt, take a nap before next attempt
+                        sleep_time = self.calc_stageout_sleeptime(_attempt)
+                        self.log(" -- Waiting %d seconds before next stage-out attempt for file=%s --" % (sleep_time, fdata.lfn))
+                        time.sleep(sleep_time)
 
+                    self.log("Put attempt %s/%s for file (%s/%s) with lfn=%s .. sitemover=%s" % (_attempt, self.stageoutretry, fnum, nfiles, fdata.lfn, sitemover))
 
-        dumpFileStates(self.workDir, self.job.jobId, ftype="output")
+                    try:
+                        result = sitemover.put_data(fdata)
+                        fdata.status = 'transferred' # mark as successful
+                        fdata.status_code = 0
+                        if result.get('surl'):
+                            fdata.surl = result.get('surl')
+                        #if result.get('pfn'):
+                        #    fdata.turl = result.get('pfn')
 
-        self.log('Summary of transferred files:')
-        for e in transferred_files:
-            self.log(" -- %s" % e)
+                        #trace_report.update(url=fdata.surl) ###
+                        trace_report.update(url=fdata.turl) ###
 
-        if failed_transfers:
-            self.log('Summary of failed transfers:')
-            for e in failed_transfers:
-                self.log(" -- %s" % e)
+                        # finalize and send trace report
+                        trace_report.update(clientState='DONE', stateReason='OK', timeEnd=time.time())
+                        self.sendTrace(trace_report)
 
-        self.log("stageout finished")
-        self.job.print_files(files)
+                        updateFileState(fdata.lfn, self.workDir, self.job.jobId, mode="file_state", state="transferred", ftype="output")
+                        dumpFileStates(self.workDir, self.job.jobId, ftype="output")
 
-        return transferred_files, failed_transfers
+                        with ctx['lock']:
+                            self.updateSURLDictionary(fdata.guid, fdata.surl, self.workDir, self.job.jobId) # FIXME LATER: isolate later
+
+                        fdat = result.copy()
+                        #fdat.update(lfn=lfn, pfn=pfn, guid=guid, surl=surl)
+                        transferred_files.append(fdat)
+
+                        break # transferred successfully
+                    except PilotException, e:
+                        result = e
+                        self.log(traceback.format_exc())
+                        if e.code == PilotErrors.ERR_FILEEXIST: ## skip further attempts
+                            self.log('INFO: Error in copying file (fspec %s/%s) (protocol %s/%s) (attempt %s/%s): File already exist: skip further retries (if any)' % (fnum, nfiles, protnum, nprotocols, _attempt, self.stageoutretry))
+                            break
+                    except Exception, e:
+                        result = PilotException("stageOut failed with error=%s" % e, code=PilotErrors.ERR_STAGEOUTFAILED, state="STAGEOUT_ATTEMPT_FAILED")
+                        self.log(traceback.format_exc())
+                        self.log('WARNING: Error in copying file (fspec %s/%s) (protocol %s/%s) (attempt %s/%s) (exception): skip further retries (if any)' % (fnum, nfiles, protnum, nprotocols, _attempt, self.stageoutretry))
+                        break
+
+                    self.log('WARNING: Error in copying file (fspec %s/%s) (protocol %s/%s) (attempt %s/%s): %s' % (fnum, nfiles, protnum, nprotocols, _attempt, self.stageoutretry, result))
+
+                if isinstance(result, Exception): # failed transfer
+                    fdata.status = 'error'
+                    fdata.status_code = result.code
+                    fdata.status_message = result.message
+
+                    trace_report.update(clientState=result.state or 'STAGEOUT_ATTEMPT_FAILED', stateReason=result.message, timeEnd=time.time())
+                    self.sendTrace(trace_report)
+
+                    failed_transfers.append(result)
+
+        return transferred_files, failed_transfers, bad_copytools
 
 
     def put_outfiles(self, files): # old function : TO BE DEPRECATED ...
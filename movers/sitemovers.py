@@ -1,15 +1,20 @@
 """
   This file contains the list of ENABLED site movers
+  (ID name as returned by getID(), module and class; the modules are imported on first use)
 """
 
-from .xrdcp_sitemover import xrdcpSiteMover
-from .dcache_sitemover import dcacheSiteMover
-from .lcgcp_sitemover import lcgcpSiteMover
-from .mv_sitemover import mvSiteMover
+from PluginRegistry import PluginRegistry
 
-from .rucio_sitemover import rucioSiteMover
-from .lsm_sitemover import lsmSiteMover
-from .objectstore_sitemover import objectstoreSiteMover
-from .pandaproxy_sitemover import pandaproxySiteMover
-from .storm_sitemover import stormSiteMover
-from .gfalcopy_sitemover import gfalcopySiteMover
+siteMovers = PluginRegistry("SiteMoverFactory", [
+    ("xrdcp", "movers.xrdcp_sitemover", "xrdcpSiteMover"),
+    ("dccp", "movers.dcache_sitemover", "dcacheSiteMover"),
+    ("lcgcp", "movers.lcgcp_sitemover", "lcgcpSiteMover"),
+    ("mv", "movers.mv_sitemover", "mvSiteMover"),
+
+    ("rucio", "movers.rucio_sitemover", "rucioSiteMover"),
+    ("lsm", "movers.lsm_sitemover", "lsmSiteMover"),
+    ("objectstore", "movers.objectstore_sitemover", "objectstoreSiteMover"),
+    ("pandaproxy", "movers.pandaproxy_sitemover", "pandaproxySiteMover"),
+    ("storm", "movers.storm_sitemover", "stormSiteMover"),
+    ("gfalcopy", "movers.gfalcopy_sitemover", "gfalcopySiteMover"),
+    ])
@@ -0,0 +1,162 @@
+# Test of the replica cache (ReplicaCache) used by JobMover.resolve_replicas(): the Rucio client is replaced by a fake
+# rucio.client module that counts the list_replicas() calls. Checked: a miss queries Rucio and stores the replicas,
+# a hit is served from the cache without a Rucio call, expired entries (replica_cache_ttl) are queried again, the least
+# recently used entry is removed when the cache is full (replica_cache_size), and the replicas of a file are removed
+# from the cache after its stage-in failed.
+# usage: PYTHONPATH=<pilot dir> python test_replica_cache.py
+
+import os
+import sys
+import time
+import types
+import shutil
+import tempfile
+
+# the pilot log and the file state files are written to the pilot home dir
+os.environ.setdefault('PilotHomeDir', tempfile.gettempdir())
+os.environ.pop('PILOT_REPLICA_CACHE', None)
+
+class Client(object):
+    """ Fake Rucio client: returns one replica on TEST_DATADISK per requested file """
+
+    calls = []  # list of the lfns of each list_replicas() call
+
+    def list_replicas(self, dids, schemes=None, sort=None, client_location=None):
+        Client.calls.append(sorted(did['name'] for did in dids))
+        for did in dids:
+            pfn = 'root://se.test.org//rucio/%s/%s' % (did['scope'], did['name'])
+            yield {'scope': did['scope'], 'name': did['name'], 'bytes': 1024, 'adler32': '0a0b0c0d', 'md5': None,
+                   'pfns': {pfn: {'priority': 1, 'rse': 'TEST_DATADISK'}},
+                   'rses': {'TEST_DATADISK': [pfn]}}
+
+rucio = types.ModuleType('rucio')
+rucio.client = types.ModuleType('rucio.client')
+rucio.client.Client = Client
+sys.modules['rucio'] = rucio
+sys.modules['rucio.client'] = rucio.client
+
+import pUtil
+from Job import Job, FileSpec
+from movers import JobMover
+from movers.mv_sitemover import mvSiteMover
+from ReplicaCache import getReplicaCacheCounters
+
+# cache settings read by getReplicaCache() from the catchall field of queuedata
+catchall = ['']
+pUtil.readpar = lambda parameter, **kwargs: catchall[0] if parameter == 'catchall' else ''
+
+class Experiment(object):
+
+    def useTracingService(self):
+        return False
+
+class SiteInformation(object):
+    """ Minimal site information: the mv copytool for the queue and one DDM endpoint """
+
+    def getQueueName(self):
+        return 'TEST_QUEUE'
+
+    def getExperimentObject(self):
+        return Experiment()
+
+    def readpar(self, par):
+        return catchall[0] if par == 'catchall' else ''
+
+    def resolveDDMConf(self, ddmendpoints):
+        return {'TEST_DATADISK': {'state': 'ACTIVE', 'site': 'TEST_SITE', 'type': 'DATADISK', 'aprotocols': {}}}
+
+    def resolvePandaAssociatedStorages(self, pandaqueue):
+        return {pandaqueue: {'pr': ['TEST_DATADISK']}}
+
+    def resolvePandaProtocols(self, pandaqueue, activity):
+        return {pandaqueue: []}
+
+    def resolvePandaCopytools(self, pandaqueue, activity, copytools=None, masterdata=None):
+        return {pandaqueue: [('mv', {'setup': ''})]}
+
+def getMover(workDir, lfns, jobId='1234'):
+    """ Return a JobMover for a job with the input files lfns """
+
+    job = Job()
+    job.jobId = jobId
+    job.workdir = workDir
+    job.jobPars = ''
+    job.inData = [FileSpec(lfn=lfn, scope='mc16_13TeV', guid='%032d' % (i), filesize=1024, checksum='ad:0a0b0c0d', ddmendpoint='TEST_DATADISK', type='input')
+                  for i, lfn in enumerate(lfns)]
+
+    mover = JobMover(job, SiteInformation(), workDir=workDir, stageinretry=1)
+    mover.ddmconf.update(mover.si.resolveDDMConf([]))
+    mover.detect_client_location = lambda: {'ip': '127.0.0.1', 'ip6': '::1', 'fqdn': 'localhost', 'site': 'TEST_SITE'}
+    return mover
+
+def resolve(workDir, lfns):
+    """ Resolve the replicas of lfns, return the lfns queried from Rucio """
+
+    ncalls = len(Client.calls)
+    mover = getMover(workDir, lfns)
+    mover.resolve_replicas(mover.job.inData)
+    for fspec in mover.job.inData:
+        assert fspec.replicas and fspec.replicas[0][0] == 'TEST_DATADISK', "%s: replicas=%s" % (fspec.lfn, fspec.replicas)
+        assert fspec.replicas[0][1] == ['root://se.test.org//rucio/mc16_13TeV/%s' % (fspec.lfn)], "%s: replicas=%s" % (fspec.lfn, fspec.replicas)
+    return sum(Client.calls[ncalls:], [])
+
+if __name__ == "__main__":
+
+    workDir = tempfile.mkdtemp()
+    seDir = tempfile.mkdtemp()
+    home = os.environ.get('HOME')
+    cwd = os.getcwd()
+    try:
+        # miss: the replicas are queried from Rucio and stored
+        catchall[0] = ''
+        assert resolve(workDir, ['A', 'B']) == ['A', 'B'], "miss: queried %s" % (Client.calls)
+        assert os.path.exists(os.path.join(workDir, 'replica_cache.json')), "no cache file"
+
+        # hit: no Rucio call, only the missing file is queried
+        assert resolve(workDir, ['A', 'B']) == [], "hit: queried %s" % (Client.calls)
+        assert resolve(workDir, ['A', 'C']) == ['C'], "partial hit: queried %s" % (Client.calls)
+        assert getReplicaCacheCounters(workDir, '1234') == (3, 3), "counters: %s" % (getReplicaCacheCounters(workDir, '1234'),)
+
+        # TTL expiry: the expired entries are queried again
+        catchall[0] = 'replica_cache_ttl=1'
+        time.sleep(1.5)
+        assert resolve(workDir, ['A', 'B']) == ['A', 'B'], "expiry: queried %s" % (Client.calls)
+
+        # LRU eviction: with 2 entries at most, storing C removes the least recently used entry B
+        catchall[0] = 'replica_cache_size=2'
+        assert resolve(workDir, ['A', 'B']) == [], "queried %s" % (Client.calls)
+        time.sleep(0.1)
+        assert resolve(workDir, ['A']) == [], "queried %s" % (Client.calls)  # A is now used more recently than B
+        time.sleep(0.1)
+        assert resolve(workDir, ['C']) == ['C'], "queried %s" % (Client.calls)  # C expired, stored again
+        assert resolve(workDir, ['A', 'C']) == [], "eviction: queried %s" % (Client.calls)
+        assert resolve(workDir, ['B']) == ['B'], "eviction: queried %s" % (Client.calls)
+
+        # failed stage-in: the replicas of the file are removed from the cache
+        catchall[0] = ''
+        assert resolve(workDir, ['D']) == ['D'], "queried %s" % (Client.calls)
+        os.environ['HOME'] = seDir  # the mv mover stages in from $HOME, D is missing there
+        os.chdir(workDir)
+        mvSiteMover.require_replicas = True
+        try:
+            mover = getMover(workDir, ['D'])
+            ncalls = len(Client.calls)
+            try:
+                mover.stagein()
+            except Exception, e:
+                pass
+            else:
+                assert False, "stage-in of a missing file succeeded"
+        finally:
+            mvSiteMover.require_replicas = False
+        assert len(Client.calls) == ncalls, "stage-in: queried %s" % (Client.calls[ncalls:])
+        assert mover.job.inData[0].status == 'error', "stage-in: status=%s" % (mover.job.inData[0].status)
+        assert resolve(workDir, ['D']) == ['D'], "invalidation: queried %s" % (Client.calls)
+
+        print "OK: %d Rucio calls, cache hits, expiry, eviction and invalidation as expected" % (len(Client.calls))
+    finally:
+        os.chdir(cwd)
+        if home is not None:
+            os.environ['HOME'] = home
+        shutil.rmtree(workDir)
+        shutil.rmtree(seDir)
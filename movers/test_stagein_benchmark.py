@@ -0,0 +1,123 @@
+# Test and benchmark of the concurrent stage-in of JobMover.stagein(): the input files of a job are staged in with the
+# mv site mover from a temporary directory standing in for the SE ($HOME of the mv mover), one after another
+# (stagein_threads=1) and with concurrent transfers (catchall stagein_threads=N). The transferred files and their
+# states are compared between the two runs. The mv mover only creates a symlink, a per file delay can be given to
+# emulate the latency of a real SE transfer.
+# usage: PYTHONPATH=<pilot dir> python test_stagein_benchmark.py [nFiles] [fileSize] [threads] [delay per file (s)]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+nFiles = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+fileSize = int(sys.argv[2]) if len(sys.argv) > 2 else 1024 * 1024
+threads = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+delay = float(sys.argv[4]) if len(sys.argv) > 4 else 0.5
+
+# the pilot log and the file state files are written to the pilot home dir
+os.environ.setdefault('PilotHomeDir', tempfile.gettempdir())
+
+from Job import Job, FileSpec
+from movers import JobMover
+from movers.mv_sitemover import mvSiteMover
+
+class Experiment(object):
+
+    def useTracingService(self):
+        return False
+
+class SiteInformation(object):
+    """ Minimal site information: the mv copytool for the queue, no protocols and no DDM endpoints """
+
+    def __init__(self, catchall):
+        self.catchall = catchall
+
+    def getQueueName(self):
+        return 'TEST_QUEUE'
+
+    def getExperimentObject(self):
+        return Experiment()
+
+    def readpar(self, par):
+        return self.catchall if par == 'catchall' else ''
+
+    def resolveDDMConf(self, ddmendpoints):
+        return {}
+
+    def resolvePandaProtocols(self, pandaqueue, activity):
+        return {pandaqueue: []}
+
+    def resolvePandaCopytools(self, pandaqueue, activity, copytools=None, masterdata=None):
+        return {pandaqueue: [('mv', {'setup': ''})]}
+
+_stageIn = mvSiteMover.stageIn
+
+def stageIn(self, source, destination, fspec):
+    """ mv stage-in with the emulated SE latency """
+
+    time.sleep(delay)
+    return _stageIn(self, source, destination, fspec)
+
+mvSiteMover.stageIn = stageIn
+
+def makeInputs(seDir):
+    files = []
+    for i in range(nFiles):
+        lfn = "EVNT.%06d.pool.root.1" % (i)
+        f = open(os.path.join(seDir, lfn), 'w')
+        f.write("x" * (fileSize + i))  # the files are started in the order of their sizes
+        f.close()
+        files.append(lfn)
+    return files
+
+def stagein(seDir, lfns, nthreads):
+    """ Stage in the files into a new working dir, return (time, transferred files, file states) """
+
+    workDir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workDir)  # the mv mover links the files into the current directory
+    try:
+        job = Job()
+        job.jobId = '1234'
+        job.workdir = workDir
+        job.jobPars = ''
+        job.inData = [FileSpec(lfn=lfn, scope='mc16_13TeV', guid='%032d' % (i), filesize=fileSize + i, ddmendpoint='TEST_DATADISK', type='input')
+                      for i, lfn in enumerate(lfns)]
+
+        mover = JobMover(job, SiteInformation('stagein_threads=%d' % (nthreads)), workDir=workDir, stageinretry=1)
+        t0 = time.time()
+        transferred, failed = mover.stagein()
+        elapsed = time.time() - t0
+
+        assert not failed, "failed transfers: %s" % (failed)
+        for fspec in job.inData:
+            assert fspec.status == 'transferred', "%s: status=%s" % (fspec.lfn, fspec.status)
+            assert os.path.getsize(os.path.join(workDir, fspec.lfn)) == fspec.filesize, "%s: wrong size" % (fspec.lfn)
+        states = [(fspec.lfn, fspec.status, fspec.status_code) for fspec in job.inData]
+
+        return elapsed, sorted(transferred), states
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workDir)
+
+if __name__ == "__main__":
+
+    seDir = tempfile.mkdtemp()
+    home = os.environ.get('HOME')
+    os.environ['HOME'] = seDir  # the mv mover stages in from $HOME
+    try:
+        lfns = makeInputs(seDir)
+        serial, serialFiles, serialStates = stagein(seDir, lfns, 1)
+        concurrent, concurrentFiles, concurrentStates = stagein(seDir, lfns, threads)
+
+        assert serialFiles == concurrentFiles, "transferred files differ: %s != %s" % (serialFiles, concurrentFiles)
+        assert serialStates == concurrentStates, "file states differ: %s != %s" % (serialStates, concurrentStates)
+        print "serial     : %.2f s for %d files of %d kB (%.2f s per file)" % (serial, nFiles, fileSize / 1024, delay)
+        print "concurrent : %.2f s with %d threads" % (concurrent, threads)
+        print "OK: %d files transferred, same files and states" % (len(serialFiles))
+    finally:
+        if home is not None:
+            os.environ['HOME'] = home
+        shutil.rmtree(seDir)
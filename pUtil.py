@@ -14,6 +14,8 @@ import environment
 env = environment.set_environment()
 
 from processes import killProcesses
+from LogWriter import LogWriter
+from HTTPClient import HTTPSessionPool
 
 # exit code
 EC_Failed = 255
@@ -101,15 +103,15 @@ def tolog_file(msg):
 def appendToLog(txt):
     """ append txt to file """
 
+    LogWriter().append(pilotlogFilename, txt)
+
+def flushLog():
+    """ Write all buffered log lines to the pilot log (call before os._exit(), exec and in signal handlers) """
+
     try:
-        f = open(pilotlogFilename, 'a')
-        f.write(txt)
-        f.close()
+        LogWriter().flush()
     except Exception, e:
-        if "No such file" in e:
-            pass
-        else:
-            print "WARNING: Exception caught: %s" % e
+        print "WARNING: Exception caught: %s" % e
 
 def tologNew(msg, tofile=True, label='INFO', essential=False):
     """ Write message to pilot log and to stdout """
@@ -152,21 +154,22 @@ def tolog(msg, tofile=True, label='INFO', essential=False):
     """ Write date+msg to pilot log and to stdout """
 
     try:
-        import inspect
-
         MAXLENGTH = 12
         # getting the name of the module that is invoking tolog() and adjust the length
+        # (sys._getframe() only looks up the calling frame, unlike inspect.stack() which builds the whole stack)
         try:
-            module_name = os.path.basename(inspect.stack()[1][1])
+            module_name = os.path.basename(sys._getframe(1).f_code.co_filename)
         except Exception, e:
             module_name = "unknown"
             #print "Exception caught by tolog(): ", e,
         module_name_cut = module_name[0:MAXLENGTH].ljust(MAXLENGTH)
-        msg = "%i|%s| %s" % (os.getpid(),module_name_cut, msg)
+        pid = os.getpid()
 
         t = timeStampUTC(format='%Y-%m-%d %H:%M:%S')
         if tofile:
-            appendToLog("%s|%s\n" % (t, msg))
+            # the line is written to the pilot log by a background thread
+            LogWriter().write(pilotlogFilename, t, pid, module_name_cut, msg)
+        msg = "%i|%s| %s" % (pid, module_name_cut, msg)
 
         # remove backquotes from the msg since they cause problems with batch submission of pilot
         # (might be present in error messages from the OS)
@@ -968,6 +971,13 @@ def getOutputFileInfo(outputFiles, checksum_cmd, skiplog=False, logFile=""):
     if logFile != "":
         outputFiles.insert(0, logFile)
 
+    # calculate the checksums of all files in parallel; the values are cached and picked up by getLocalFileInfo() below
+    # (as well as by the later stage-out verification)
+    if checksum_cmd in ["adler32", "md5sum"]:
+        from Checksum import calculateChecksumsInParallel
+        filenames = [filename for filename in outputFiles if not (filename == logFile and skiplog) and os.path.isfile(filename)]
+        calculateChecksumsInParallel(filenames)
+
     for filename in outputFiles:
         # add "" for the log metadata since it has not been created yet
         if filename == logFile and skiplog:
@@ -1912,9 +1922,27 @@ class _Curl:
         self.path = 'curl'
         # verification of the host certificate
         self._verifyHost = True
+        catchall = readpar("catchall")
         # modified for Titan test
-        if ('HPC_Titan' in readpar("catchall")) or ('ORNL_Titan_install' in readpar("nickname")):
+        if ('HPC_Titan' in catchall) or ('ORNL_Titan_install' in readpar("nickname")):
             self._verifyHost = False
+        self._tlsv1 = "HPC_HPC" in catchall
+
+        # in-process client with persistent connections (default) or a curl command per call
+        # catchall settings: http_client=session|curl, http_timeout=<max time of a call [s]>, http_retries=<n>
+        settings = {}
+        for entry in catchall.split(','):
+            if '=' in entry:
+                settings[entry.split('=')[0].strip()] = entry.split('=')[1].strip()
+        client = os.environ.get('PILOT_HTTP_CLIENT', settings.get('http_client', 'session'))
+        self.session = client != 'curl' and HTTPSessionPool.isAvailable()
+        try:
+            self.timeout = int(settings.get('http_timeout', 120))
+            self.retries = int(settings.get('http_retries', 0))
+        except ValueError, e:
+            tolog("!!WARNING!!2999!! Invalid http setting in catchall: %s (using default values)" % e)
+            self.timeout = 120
+            self.retries = 0
 
         # request a compressed response
         self.compress = True
@@ -1928,11 +1956,13 @@ class _Curl:
 
     # GET method
     def get(self, url, data, path):
+        if self.session:
+            return self.request('GET', url, data)
         # make command
         com = '%s --silent --get' % self.path
-        if "HPC_HPC" in readpar('catchall'):
+        if self._tlsv1:
             com += ' --tlsv1'
-        com += ' --connect-timeout 100 --max-time 120'
+        com += ' --connect-timeout 100 --max-time %d' % self.timeout
         if not self._verifyHost:
             com += ' --insecure'
         if self.compress:
@@ -1980,11 +2010,13 @@ class _Curl:
 
     # POST method
     def post(self, url, data, path):
+        if self.session:
+            return self.request('POST', url, data)
         # make command
         com = '%s --silent --show-error' % self.path
-        if "HPC_HPC" in readpar('catchall'):
+        if self._tlsv1:
             com += ' --tlsv1'
-        com += ' --connect-timeout 100 --max-time 120'
+        com += ' --connect-timeout 100 --max-time %d' % self.timeout
         if not self._verifyHost:
             com += ' --insecure'
         if self.compress:
@@ -2046,7 +2078,7 @@ class _Curl:
     def put(self, url, data):
         # make command
         com = '%s --silent' % self.path
-        if "HPC_HPC" in readpar('catchall'):
+        if self._tlsv1:
             com += ' --tlsv1'
         if not self._verifyHost:
             com += ' --insecure'
@@ -2076,6 +2108,22 @@ class _Curl:
         # set _verifyHost
         self._verifyHost = verify
 
+    # GET/POST with the in-process client, same return value as the curl command
+    def request(self, method, url, data):
+        headers = {}
+        if 'nJobs' in data:
+            headers['Accept'] = 'application/json'
+        tolog("Sending %s request to %s (session)" % (method, url))
+        try:
+            ret = HTTPSessionPool().request(method, url, data, headers=headers, cert=self.sslCert, key=self.sslKey,
+                                            capath=self.sslCertDir, verify=self._verifyHost, tlsv1=self._tlsv1,
+                                            compress=self.compress, connect_timeout=100, timeout=self.timeout,
+                                            retries=self.retries)
+        except Exception, e:
+            tolog("!!WARNING!!1111!! Caught exception from HTTP session: %s" % (e))
+            ret = [-1, e]
+        return ret
+
 # send message to pandaLogger
 def toPandaLogger(data):
     try:
@@ -2120,8 +2168,9 @@ def toPandaLogger(data):
         else:
             tolog("!!WARNING!!2999!! Dispatcher message curl error: %d " % (curlstat))
             tolog("Response = %s" % (response))
-            tolog("Dumping curl.config file:")
-            dumpFile('%s/curl.config' % (path), topilotlog=True)
+            if not curl.session: # no config file with the in-process client
+                tolog("Dumping curl.config file:")
+                dumpFile('%s/curl.config' % (path), topilotlog=True)
             return curlstat, None, None
 
         return 0, data, response
@@ -2217,15 +2266,16 @@ def toServer(baseURL, cmd, data, path, experiment):
                 tolog("!!WARNING!!2999!! Dispatcher response: %s" % data)
             else:
                 status = int(data['StatusCode'])
-            if status != 0:
+            if status != 0 and not curl.session:
                 # pilotErrorDiag = getDispatcherErrorDiag(status)
                 tolog("Dumping curl config file: %s" % (curl_config))
                 dumpFile(curl_config, topilotlog=True)
         else:
             tolog("!!WARNING!!2999!! Dispatcher message curl error: %d " % (curlstat))
             tolog("Response = %s" % (response))
-            tolog("Dumping curl.config file: %s" % curl_config)
-            dumpFile(curl_config, topilotlog=True)
+            if not curl.session: # no config file with the in-process client
+                tolog("Dumping curl.config file: %s" % curl_config)
+                dumpFile(curl_config, topilotlog=True)
             return curlstat, None, None
         if status == 0:
             return status, data, response
@@ -2559,45 +2609,27 @@ def getJobReport(filename):
 
     report = ""
     if os.path.exists(filename):
-        pattern = re.compile("Job Report produced by")
-        try:
-            f = open(filename, "r")
-        except IOError, e:
-            tolog("!!WARNING!!1299!! %s" % e)
+        # find the start position of the job report (the stdout is scanned once for all patterns, see LogScanner)
+        from LogScanner import scanPayloadStdout
+        matches = scanPayloadStdout(filename, final=True).getMatches('jobreport')
+
+        # grab the last couple of lines in case the trf failed before the job report was printed
+        if len(matches) < 2:
+            N = 10
+            tolog("Job report could not be found in the payload stdout, will add the last %d lines instead for the log extracts" % (N))
+            report = "- Last %d lines from %s -\n" % (N, filename)
+            report = report + tail(filename, N)
         else:
-            matched_lines = []
-            status = True
-            first_report = True
-            while status:
-                # get the next line in the file
-                line = f.readline()
-                if not line:
-                    break
-
-                # find the start position of the job report and grab all remaining lines
-                if re.search(pattern, line) and first_report:
-                    # the job report is repeated, only grab it the second time it appears
-                    first_report = False
-                elif re.search(pattern, line) and not first_report:
-                    # save the job report title line
-                    line = line.replace("=====", "-")
-                    matched_lines.append(line)
-                    while True:
-                        line = f.readline()
-                        if not line:
-                            status = False
-                            break
-                        matched_lines.append(line)
-
-            # grab the last couple of lines in case the trf failed before the job report was printed
-            if len(matched_lines) == 0:
-                N = 10
-                tolog("Job report could not be found in the payload stdout, will add the last %d lines instead for the log extracts" % (N))
-                report = "- Last %d lines from %s -\n" % (N, filename)
-                report = report + tail(filename, N)
+            # the job report is repeated, only grab it the second time it appears (and all remaining lines)
+            try:
+                f = open(filename, "r")
+            except IOError, e:
+                tolog("!!WARNING!!1299!! %s" % e)
             else:
-                report = "".join(matched_lines)
-            f.close()
+                f.seek(matches[1][0])
+                # save the job report title line
+                report = f.readline().replace("=====", "-") + f.read()
+                f.close()
     else:
         tolog("!!WARNING!!1299!! File %s does not exist" % (filename))
 
@@ -3633,11 +3665,9 @@ def getExperiment(experiment):
     _exp = None
 
     try:
-        experimentClass = factory.newExperiment(experiment)
+        _exp = factory.getExperiment(experiment)
     except Exception, e:
         tolog("!!WARNING!!1114!! Experiment factory threw an exception: %s" % (e))
-    else:
-        _exp = experimentClass()
 
     return _exp
 
@@ -3657,11 +3687,10 @@ def getSiteInformation(experiment):
     _exp = None
 
     try:
-        siteInformationClass = factory.newSiteInformation(experiment)
+        _exp = factory.getSiteInformation(experiment)
     except Exception, e:
         tolog("!!WARNING!!1114!! SiteInformation factory threw an exception: %s" % (e))
     else:
-        _exp = siteInformationClass()
         tolog("getSiteInformation: got experiment=%s" % (_exp.getExperiment()))
 
     return _exp
@@ -4382,6 +4411,7 @@ def cleanup(wd, initdir, wrflag, rmwkdir):
         # flush buffers
         sys.stdout.flush()
         sys.stderr.flush()
+        flushLog()
         os._exit(0) # need to call this to clean up the socket, thread etc resources
 
 def shellExitCode(exitCode):
@@ -4503,6 +4533,9 @@ def sig2exc(sig, frm):
     except Exception, e:
         tolog("!!WARNING!!2211!! Caught exception: %s" % (e))
 
+    # make sure that all log lines are written before the pilot is terminated
+    flushLog()
+
     raise SystemError(sig) # this one will trigger the cleanup function to be called
 
 def extractPattern(source, pattern):
@@ -4537,11 +4570,9 @@ def getEventService(experiment):
     _exp = None
 
     try:
-        eventServiceClass = factory.newEventService(experiment)
+        _exp = factory.getEventService(experiment)
     except Exception, e:
         tolog("!!WARNING!!1114!! EventService factory threw an exception: %s" % (e))
-    else:
-        _exp = eventServiceClass()
 
     return _exp
 
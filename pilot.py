@@ -26,8 +26,10 @@ import glexec_utils
 from Configuration import Configuration
 from WatchDog import WatchDog
 from Monitor import Monitor
+from PluginRegistry import reportImportTimes
 import subprocess
 import DeferredStageout
+from EventRangeUpdater import replayJournals
 
 try:
     from rucio.client import Client
@@ -675,6 +677,16 @@ def runJobRecovery(thisSite, _psport, extradir):
             pUtil.tolog("!!WARNING!!1999!! Failed during search for lost jobs: %s" % str(e))
         else:
             pUtil.tolog("Recovered/Updated %d lost job(s)" % (found_lost_jobs))
+
+        # send the event range updates that killed event service jobs left in their journals
+        try:
+            url = '%s:%s/server/panda' % (env['pshttpurl'], str(_psport))
+            sent = replayJournals(_dir or thisSite.wntmpdir or "/tmp", url, 2*env['heartbeatPeriod'])
+        except Exception, e:
+            pUtil.tolog("!!WARNING!!1999!! Failed to replay event range update journals: %s" % str(e))
+        else:
+            if sent:
+                pUtil.tolog("Sent %d event range update(s) of lost jobs" % (sent))
     pUtil.chdir(tmpdir)
 
 def testExternalDir(recoveryDir):
@@ -2830,6 +2842,7 @@ def runMain(runpars):
             # create the first job, usually a production job, but analysis job is ok as well
             # we just use the first job as a MARKER of the "walltime" of the pilot
             env['isJobDownloaded'] = False # (reset in case of multi-jobs)
+            reportImportTimes()
             tp_0 = os.times()
             ec, env['job'], env['number_of_jobs'] = getJob()
             tp_1 = os.times()
@@ -4,37 +4,26 @@ import signal
 import time
 import re
 import pUtil
+from ProcessTable import ProcessTable
 
-def findProcessesInGroup(cpids, pid):
-    """ recursively search for the children processes belonging to pid and return their pids
+def findProcessesInGroup(cpids, pid, table=None):
+    """ search for the children processes belonging to pid and return their pids
     here pid is the parent pid for all the children to be found
     cpids is a list that has to be initialized before calling this function and it contains
-    the pids of the children AND the parent as well """
-
-    cpids.append(pid)
-    psout = commands.getoutput("ps -eo pid,ppid -m | grep %d" % pid)
-    lines = psout.split("\n")
-    if lines != ['']:
-        for i in range(0, len(lines)):
-            try:
-                thispid = int(lines[i].split()[0])
-                thisppid = int(lines[i].split()[1])
-            except Exception as e:
-                pUtil.tolog('exception caught: %s (lines[1]=%s)' % (e, lines[1]))
-            else:
-                if thisppid == pid:
-                    findProcessesInGroup(cpids, thispid)
+    the pids of the children AND the parent as well
+    table is an optional ProcessTable snapshot (a new one is taken if not set) """
 
-def isZombie(pid):
-    """ Return True if pid is a zombie process """
+    if not table:
+        table = ProcessTable()
+    cpids.extend(table.getSubtree(pid))
 
-    zombie = False
+def isZombie(pid, table=None):
+    """ Return True if pid is a zombie process """
 
-    out = commands.getoutput("ps aux | grep %d" % (pid))
-    if "<defunct>" in out:
-        zombie = True
+    if not table:
+        table = ProcessTable()
 
-    return zombie
+    return table.isZombie(pid)
 
 def getProcessCommands(euid, pids):
     """ return a list of process commands corresponding to a pid list for user euid """
@@ -67,11 +56,11 @@ def getProcessCommands(euid, pids):
 
     return processCommands
 
-def dumpStackTrace(pid):
+def dumpStackTrace(pid, table=None):
     """ run the stack trace command """
 
     # make sure that the process is not in a zombie state
-    if not isZombie(pid):
+    if not isZombie(pid, table=table):
         pUtil.tolog("Running stack trace command on pid=%d:" % (pid))
         cmd = "pstack %d" % (pid)
         timeout = 60
@@ -115,8 +104,9 @@ def killProcesses(pid, pgrp):
 
     if not status:
         # firstly find all the children process IDs to be killed
+        table = ProcessTable()
         children = []
-        findProcessesInGroup(children, pid)
+        findProcessesInGroup(children, pid, table=table)
 
         # reverse the process order so that the athena process is killed first (otherwise the stdout will be truncated)
         children.reverse()
@@ -135,10 +125,14 @@ def killProcesses(pid, pgrp):
                 for cmd in cmds:
                     pUtil.tolog(cmd)
 
+                # one snapshot for the kill pass (the children are killed in reverse order, so the process states
+                # of the ones still to be killed are not changed by the previous kills)
+                table.refresh()
+
                 # loop over all child processes
                 for i in children:
                     # dump the stack trace before killing it
-                    dumpStackTrace(i)
+                    dumpStackTrace(i, table=table)
 
                     # kill the process gracefully
                     try:
@@ -355,14 +349,16 @@ def get_instant_cpu_consumption_time(pid):
     return cpu_consumption_time
 
 def get_current_cpu_consumption_time(pid):
-    # get all the child processes                                                                                                                               
-    children = []
-    findProcessesInGroup(children, pid)
+    """
+    Return the CPU consumption time (system+user time) for a given process and all its children.
+    The whole process tree is read from a single process table snapshot.
+
+    :param pid: process id (int).
+    :return: system+user time for the process tree (float).
+    """
 
     cpuconsumptiontime = 0
-    for _pid in children:
-        _cpuconsumptiontime = get_instant_cpu_consumption_time(_pid)
-        if _cpuconsumptiontime:
-            cpuconsumptiontime += _cpuconsumptiontime
+    if pid:
+        cpuconsumptiontime = ProcessTable().getCPUTime(pid)
 
     return cpuconsumptiontime
@@ -0,0 +1,72 @@
+# Test of the log tarball creation (LogTarball.createLogTarball()) for a work directory with several paths to the same
+# file: a hard link and a symlink to a file of fileSize random bytes. The file data must be stored once in the tarball,
+# the other paths as hard link members to the first one, and the tarball must be extracted by GNU tar to the same files.
+# usage: PYTHONPATH=<pilot dir> python test_log_tarball.py [fileSize]
+
+import os
+import sys
+import shutil
+import tarfile
+import tempfile
+import commands
+
+fileSize = int(sys.argv[1]) if len(sys.argv) > 1 else 1024 * 1024
+
+# the pilot log is written to the pilot home dir
+os.environ.setdefault('PilotHomeDir', tempfile.gettempdir())
+
+from LogTarball import createLogTarball
+
+def makeWorkDir(baseDir):
+    """ Create the work dir: data.bin, a hard link and a symlink to it and a small log file, return the file data """
+
+    workDir = os.path.join(baseDir, "PandaJob_1234")
+    os.makedirs(os.path.join(workDir, "sub"))
+    data = os.urandom(fileSize)  # does not compress, the tarball size shows the number of copies
+    f = open(os.path.join(workDir, "data.bin"), 'wb')
+    f.write(data)
+    f.close()
+    os.link(os.path.join(workDir, "data.bin"), os.path.join(workDir, "sub", "hardlink.bin"))
+    os.symlink(os.path.join("..", "data.bin"), os.path.join(workDir, "sub", "symlink.bin"))
+    f = open(os.path.join(workDir, "payload.stdout"), 'w')
+    f.write("log line\n" * 100)
+    f.close()
+    return data
+
+if __name__ == "__main__":
+
+    baseDir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        data = makeWorkDir(baseDir)
+        os.chdir(baseDir)  # member names are relative to the current directory, as for tar
+        tarball = os.path.join(baseDir, "log.tgz")
+        result = createLogTarball(tarball, "PandaJob_1234")
+
+        tf = tarfile.open(tarball, 'r:gz')
+        try:
+            members = dict([(tarinfo.name, tarinfo) for tarinfo in tf.getmembers()])
+        finally:
+            tf.close()
+        regular = [name for name in members if members[name].isreg() and members[name].size == fileSize]
+        links = [name for name in members if members[name].islnk()]
+        assert len(regular) == 1, "file data stored %d times: %s" % (len(regular), regular)
+        assert sorted(links) == ["PandaJob_1234/sub/hardlink.bin", "PandaJob_1234/sub/symlink.bin"], "hard link members: %s" % (links)
+        for name in links:
+            assert members[name].linkname == regular[0], "%s links to %s" % (name, members[name].linkname)
+        assert result['csize'] < 1.5 * fileSize, "tarball size %d B for one copy of %d B" % (result['csize'], fileSize)
+
+        # GNU tar restores every path with the file data
+        extractDir = os.path.join(baseDir, "extract")
+        os.mkdir(extractDir)
+        ec, output = commands.getstatusoutput("tar xzf %s -C %s" % (tarball, extractDir))
+        assert ec == 0, "tar xzf failed: %s" % (output)
+        for name in ["data.bin", "sub/hardlink.bin", "sub/symlink.bin"]:
+            f = open(os.path.join(extractDir, "PandaJob_1234", name), 'rb')
+            assert f.read() == data, "%s: wrong content" % (name)
+            f.close()
+
+        print "OK: %d members, file data stored once, tarball %d B (file %d B)" % (len(members), result['csize'], fileSize)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(baseDir)